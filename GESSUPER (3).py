@@ -20,7 +20,8 @@ import gc  # Garbage Collector para limpeza de memória
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
 import warnings
 import ssl
 import re
@@ -35,16 +36,28 @@ from openpyxl.utils.dataframe import dataframe_to_rows
 from openpyxl.workbook.properties import CalcProperties
 import threading
 import concurrent.futures
+import hashlib
+
+# Infraestrutura fora do script (estado por processo, que sobrevive aos reruns - ver argos/__init__.py)
+from argos.configuracao import aplicar_secrets, estado_processo, problemas_configuracao
+from argos.identificador import (IDENT_LOOKUP_MODE, sanitize_identificador, filtro_identificador,
+                                 modos_busca_identificador)
+from argos.tempos import registrar_tempo_tabela, get_tempos_tabelas
+from argos.cache_disco import (CACHE_DISCO_CONFIG, cache_disco_ativo, ler_cache_disco, gravar_cache_disco,
+                               gravar_cache_disco_em_segundo_plano, get_status_cache_disco)
+from argos.cache_compartilhado import cache_compartilhado, get_status_caches_compartilhados
+from argos.replica import (REPLICA_LOCAL_CONFIG, PYARROW_AVAILABLE, DUCKDB_AVAILABLE, replica_local_ativa,
+                           replica_atualizada, consultar_replica, sincronizar_tabelas, status_replica)
+from argos.lotes import STREAM_CHUNK_SIZE, coluna_numerica, iter_df_chunks
+from argos.excel import (MAX_ROWS_PER_EXCEL, EXCEL_MODO_ESCRITA, EXCEL_BACKEND, EXCEL_XLSXWRITER_MIN_LINHAS,
+                         EXCEL_VALORES_ESTATICOS, EXCEL_LAYOUT_VERSAO, EXCEL_PARALELO_CONFIG, modo_escrita_excel,
+                         calcular_icms_fisco, get_export_filename)
+from argos.paginacao import inicio_apos_cursor
+from argos.rede import REDE_PATH, save_csv_to_network, diagnostico_rede
+from argos.exportacao import (EXPORT_JOBS_CONFIG, EXPORT_CACHE_CONFIG, EXPORT_JOB_ATIVOS, export_to_csv_arquivo,
+                              enviar_job_exportacao, cancelar_job_exportacao, get_jobs_exportacao,
+                              chave_artefato_exportacao, cache_exportacao_ativo, get_status_cache_exportacao)
 
-# Para salvar na rede
-try:
-    import smbclient
-    SMB_AVAILABLE = True
-except ImportError:
-    SMB_AVAILABLE = False
-
-# Limite de linhas por arquivo Excel (Excel suporta 1.048.576, usamos 1.000.000 para segurança)
-MAX_ROWS_PER_EXCEL = 1000000
 
 # Limite para aviso de arquivo grande (acima disso, recomenda CSV)
 LARGE_FILE_WARNING = 200000  # 200k linhas
@@ -58,12 +71,86 @@ SESSION_TIMEOUT_MINUTES = 30
 # Limite de linhas para aplicar filtro de 12 meses (performance)
 LARGE_DATASET_THRESHOLD = 200000
 
-# Caminho da rede para salvar arquivos (evita consumo de memória)
-REDE_PATH = r"\\sef.sc.gov.br\DFS\Fiscalizacao\NIAT\ARGOS\ARGOS_EXPORT"
+# Schema da consulta por empresa, aplicado já na carga (get_base_df e cada lote do streaming):
+#   "numero"    - float64 (valores monetários e alíquotas; float32 perderia centavos acima de ~R$ 100 mil)
+#   "categoria" - category (poucos valores distintos repetidos em milhares de linhas)
+#   "texto"     - string em Arrow quando o pyarrow está disponível (alta cardinalidade)
+# Colunas fora do schema (ex.: data_emissao) ficam como vieram do banco.
+SCHEMA_CONSULTA = {
+    # Valores
+    "icms_emitente": "numero", "icms_destacado": "numero", "bc_fisco": "numero",
+    "aliquota_ia": "numero", "infracao_ia": "numero", "aliq_efetiva": "numero",
+    "icms_devido": "numero", "valor_total": "numero", "valor_do_frete": "numero",
+    "valor_do_seguro": "numero", "valor_outras_despesas": "numero", "valor_do_desconto": "numero",
+    # Dimensões repetidas
+    "tipo_doc": "categoria", "periodo": "categoria", "ncm": "categoria", "cfop": "categoria",
+    "cst": "categoria", "estado_destinatario": "categoria", "uf_entrega": "categoria",
+    "legislacao_ia": "categoria", "entrada_ou_saida": "categoria", "modelo_ecf": "categoria",
+    "origem_prod": "categoria", "ind_final": "categoria", "regime_destinatario": "categoria",
+    "cnae_destinatario": "categoria", "ttd_importacao": "categoria",
+    "cnpj_emitente": "categoria", "ie_emitente": "categoria", "razao_emitente": "categoria",
+    # Texto livre
+    "chave": "texto", "link_acesso": "texto", "descricao": "texto", "gtin": "texto",
+    "cod_prod": "texto", "cod_tot_par": "texto", "numero_nota": "texto", "numero_item": "texto",
+    "ie_destinatario": "texto", "cnpj_destinatario": "texto", "cpf_destinatario": "texto",
+    "razao_destinatario": "texto",
+}
 
-# Cache do ranking (24 horas = 86400 segundos)
+# Os caches de ranking e estatísticas são chaveados pela versão das tabelas (ver
+# sonda_versao em GRUPOS_CONFIG) e duram até a próxima recarga dos dados.
+# Se a sonda falhar, a chave passa a mudar a cada RANKING_CACHE_TTL (24 horas).
 RANKING_CACHE_TTL = 86400
 
+# Máximo de resultados guardados por loader de ranking (versões antigas saem primeiro)
+RANKING_CACHE_MAX_ENTRIES = 40
+
+# Stale-while-revalidate (ver cache_compartilhado): depois de expirar (TTL ou nova versão das
+# tabelas), o último resultado bom continua sendo servido por até estes segundos enquanto
+# é recalculado em segundo plano. 0 = sempre espera o recálculo.
+RANKING_MAX_OBSOLETO_SECONDS = 6 * 3600
+CONSULTA_MAX_OBSOLETO_SECONDS = 1800
+
+# Máximo de consultas por empresa guardadas em memória (as menos usadas saem primeiro)
+CONSULTA_CACHE_MAX_ENTRIES = 32
+
+# Rankings e estatísticas globais saem de um resumo do grupo (empresa × ano × tipo_doc ×
+# níveis válidos), montado com uma varredura por tabela a cada versão das tabelas.
+# True = o resumo também é guardado em Parquet no cache em disco (compartilhado entre processos).
+RESUMO_RANKING_MATERIALIZADO = True
+
+# Empresas por página do ranking ("Carregar mais" busca a próxima página a partir do cursor)
+RANKING_PAGINA_TAMANHO = 100
+
+# Busca paralela por tabela (NFC-e / Cupons / NF-e):
+#   True  - um SELECT por tabela em paralelo, resultados concatenados/somados no pandas
+#   False - modo antigo: um único UNION ALL sobre todas as tabelas
+PARALLEL_TABLE_FETCH = True
+
+# Threads do pool compartilhado de busca por tabela (todas as sessões)
+PARALLEL_FETCH_WORKERS = 6
+
+# Tempo máximo de execução por tabela (segundos), contado a partir do início da query (não
+# da espera na fila do pool). Vai para o Impala como EXEC_TIME_LIMIT_S, que cancela a query
+# no servidor e libera a thread do pool. Tabela que estourar o tempo é registrada como
+# "timeout" e as demais seguem normalmente.
+PARALLEL_TABLE_TIMEOUT_SECONDS = 900
+
+# Folga além do limite para o Impala cancelar a query e devolver o erro; passada a folga,
+# a tabela é dada como "timeout" sem esperar mais
+PARALLEL_TABLE_TIMEOUT_FOLGA_SECONDS = 30
+
+# Agregações da aba Análise (período, NCM, CFOP, produto, estatísticas):
+#   True  - calculadas no Impala em uma única query sobre todo o histórico (get_agregados_consulta)
+#   False - calculadas no pandas sobre a consulta carregada (limitada a 12 meses em bases grandes)
+AGREGADOS_NO_SERVIDOR = True
+
+# Base do histograma logarítmico de valores usado para mediana e percentis no servidor:
+# cada faixa tem 1% de largura relativa, então o percentil tem erro de no máximo ~0,5%.
+HISTOGRAMA_BASE = 1.01
+
+# Quantis da distribuição do grupo (por item e por empresa) exibidos em Resumo e Análise
+QUANTIS_DISTRIBUICAO = [0.5, 0.9, 0.99]
+
 
 # =============================================================================
 # CONFIGURAÇÃO DE GRUPOS (EXTENSÍVEL)
@@ -86,6 +173,11 @@ GRUPOS_CONFIG = {
             "cupons": "niat.infracoes_gessuper_cupons_3M"
             # Não inclui NFe
         },
+        # Sonda de versão de cada tabela (invalida os caches quando a tabela é recriada):
+        #   "metadados" - SHOW TABLE STATS (arquivos, tamanho, linhas), sem ler dados
+        #   "contagem"  - SELECT COUNT(*), MAX(periodo) (resolvido pelas estatísticas do Parquet)
+        #   ou uma query própria com {tabela}, ex.: "SELECT MAX(dt_carga) FROM {tabela}"
+        "sonda_versao": "metadados",
         # Modelo de exportação para Notas de Consumo
         "modelos_exportacao": ["Notas de Consumo"],
         # Colunas específicas para export
@@ -138,6 +230,7 @@ GRUPOS_CONFIG = {
             "nfe": "niat.infracoes_gessuper_nfe_3M"
             # Não inclui NFCe nem Cupons
         },
+        "sonda_versao": "metadados",
         # Modelo de exportação para NFe
         "modelos_exportacao": ["NFe"],
         # Colunas específicas para export
@@ -199,6 +292,7 @@ GRUPOS_CONFIG = {
             "cupons": "niat.infracoes_gesmac_cupons_3m",
             "nfe": "niat.infracoes_gesmac_nfe_3m"
         },
+        "sonda_versao": "metadados",
         # Modelo de exportação único com todas as modalidades (NFe + NFCe + Cupons)
         "modelos_exportacao": ["Anexo J"],
         # Colunas específicas para export
@@ -262,6 +356,7 @@ GRUPOS_CONFIG = {
             "cupons": "niat.infracoes_gesauto_cupons_3m",
             "nfe": "niat.infracoes_gesauto_nfe_3m"
         },
+        "sonda_versao": "metadados",
         # Modelo de exportação único com todas as modalidades
         "modelos_exportacao": ["Anexo J"],
         # Colunas específicas para export
@@ -325,6 +420,7 @@ GRUPOS_CONFIG = {
             "cupons": "niat.infracoes_op_4_cupons_3m",
             "nfe": "niat.infracoes_op_4_nfe_3m"
         },
+        "sonda_versao": "metadados",
         # Modelo de exportação único com todas as modalidades
         "modelos_exportacao": ["Anexo J"],
         # Colunas específicas para export
@@ -510,6 +606,48 @@ except:
     """)
     st.stop()
 
+# Pool de conexões do Impala (um só engine, compartilhado entre todas as sessões).
+# Padrões abaixo; podem ser sobrescritos em secrets.toml, seção [impala_pool]:
+#   [impala_pool]
+#   pool_size = 8
+#   pool_recycle = 1800
+IMPALA_POOL_CONFIG = {
+    'pool_size': 5,          # conexões mantidas abertas
+    'max_overflow': 10,      # conexões extras permitidas em picos (fechadas ao devolver)
+    'pool_timeout': 60,      # segundos esperando uma conexão livre antes de erro
+    'pool_recycle': 3300,    # segundos - recicla antes de a sessão LDAP/SSL expirar no servidor
+    'pool_pre_ping': True,   # testa a conexão antes de entregar (descarta conexões mortas)
+    'warmup': 2,             # conexões abertas em segundo plano ao criar o engine
+}
+
+# Intervalo (segundos) entre consultas da versão das tabelas (SHOW TABLE STATS)
+VERSAO_TABELAS_TTL_SECONDS = 300
+
+# Aquecimento em segundo plano dos caches de ranking e estatísticas de todos os grupos,
+# iniciado junto com o servidor. Pode ser sobrescrito em secrets.toml, seção [aquecimento_cache].
+AQUECIMENTO_CACHE_CONFIG = {
+    'ativo': True,
+    'max_paralelo': 2,            # grupos aquecidos ao mesmo tempo
+    'escalonamento_segundos': 5,  # intervalo entre o início de um grupo e o do próximo
+    'ciclo_segundos': 600,        # nova rodada: refaz o que expirou ou mudou de versão
+}
+
+# Seções do secrets.toml que sobrescrevem as configurações (os padrões ficam junto de cada
+# dicionário, aqui e nos módulos argos.*). Chave desconhecida ou valor de tipo diferente do
+# padrão é ignorado, com aviso no log e no Diagnóstico (ver aplicar_secrets).
+SECOES_SECRETS = {
+    'impala_pool': IMPALA_POOL_CONFIG,
+    'cache_disco': CACHE_DISCO_CONFIG,
+    'replica_local': REPLICA_LOCAL_CONFIG,
+    'aquecimento_cache': AQUECIMENTO_CACHE_CONFIG,
+    'excel_paralelo': EXCEL_PARALELO_CONFIG,
+    'exportacao_jobs': EXPORT_JOBS_CONFIG,
+    'cache_exportacao': EXPORT_CACHE_CONFIG,
+}
+
+for _secao, _config in SECOES_SECRETS.items():
+    aplicar_secrets(_config, _secao, st.secrets)
+
 # =============================================================================
 # 3. FUNÇÕES AUXILIARES
 # =============================================================================
@@ -626,10 +764,6 @@ def check_tables_available(engine, grupo: str = None) -> bool:
         return True
 
 
-def sanitize_identificador(raw: str) -> str:
-    """Remove qualquer coisa que não seja dígito (CNPJ/IE)."""
-    return re.sub(r"\D+", "", raw or "")
-
 def format_currency_br(value) -> str:
     """Formata número como moeda brasileira: R$ 1.234.567,89"""
     if value is None:
@@ -697,9 +831,137 @@ def nivel_config(nivel_str: str):
 # 4. CONEXÃO COM BANCO DE DADOS
 # =============================================================================
 
+# Métricas do pool de conexões (compartilhadas entre sessões e reruns - ver estado_processo)
+_METRICAS_POOL = estado_processo('metricas_pool', lambda: {
+    'checkouts': 0,            # conexões entregues pelo pool
+    'checkins': 0,             # conexões devolvidas
+    'espera_total': 0.0,       # soma do tempo esperando/obtendo conexão (s)
+    'espera_max': 0.0,         # maior espera (s)
+    'esperas_lentas': 0,       # esperas acima de POOL_ESPERA_LENTA_SEGUNDOS
+    'conexoes_criadas': 0,     # handshakes TLS + LDAP realizados
+    'handshake_total': 0.0,    # soma do tempo dos handshakes (s)
+    'handshake_max': 0.0,
+    'invalidacoes': 0,         # conexões descartadas (pre-ping falhou, erro, recycle)
+    'warmup': None,            # resultado do aquecimento inicial
+})
+_METRICAS_POOL_LOCK = estado_processo('metricas_pool_lock', threading.Lock)
+_HANDSHAKE_INICIO = estado_processo('handshake_inicio', threading.local)
+
+# Espera por conexão acima deste valor é contada como lenta (segundos)
+POOL_ESPERA_LENTA_SEGUNDOS = 1.0
+
+
+def _somar_metrica_pool(**valores):
+    """Atualiza as métricas do pool (contadores somam; chaves *_max guardam o maior valor)."""
+    with _METRICAS_POOL_LOCK:
+        for chave, valor in valores.items():
+            if chave.endswith('_max'):
+                _METRICAS_POOL[chave] = max(_METRICAS_POOL[chave], valor)
+            else:
+                _METRICAS_POOL[chave] += valor
+
+
+class PoolMonitorado(QueuePool):
+    """QueuePool que mede o tempo de cada checkout (espera na fila + eventual handshake)."""
+
+    def _do_get(self):
+        inicio = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            espera = time.perf_counter() - inicio
+            _somar_metrica_pool(
+                espera_total=espera,
+                espera_max=espera,
+                esperas_lentas=int(espera >= POOL_ESPERA_LENTA_SEGUNDOS)
+            )
+
+
+def _registrar_eventos_pool(engine):
+    """Liga os eventos do SQLAlchemy que alimentam as métricas do pool."""
+
+    @event.listens_for(engine, "do_connect")
+    def _inicio_handshake(dialect, conn_rec, cargs, cparams):
+        _HANDSHAKE_INICIO.valor = time.perf_counter()
+
+    @event.listens_for(engine, "connect")
+    def _fim_handshake(dbapi_connection, connection_record):
+        inicio = getattr(_HANDSHAKE_INICIO, 'valor', None)
+        duracao = time.perf_counter() - inicio if inicio else 0.0
+        _somar_metrica_pool(conexoes_criadas=1, handshake_total=duracao, handshake_max=duracao)
+
+    @event.listens_for(engine, "checkout")
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        _somar_metrica_pool(checkouts=1)
+
+    @event.listens_for(engine, "checkin")
+    def _checkin(dbapi_connection, connection_record):
+        _somar_metrica_pool(checkins=1)
+
+    @event.listens_for(engine, "invalidate")
+    def _invalidate(dbapi_connection, connection_record, exception):
+        _somar_metrica_pool(invalidacoes=1)
+
+
+def aquecer_pool(engine, n_conexoes: int) -> dict:
+    """
+    Abre `n_conexoes` conexões em paralelo e as devolve ao pool, para que as primeiras
+    consultas não paguem o handshake TLS + LDAP. Retorna o resultado para as métricas.
+    """
+    inicio = time.perf_counter()
+    conexoes = []
+    erro = None
+
+    def abrir():
+        return engine.connect()
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, n_conexoes)) as executor:
+            for future in [executor.submit(abrir) for _ in range(n_conexoes)]:
+                try:
+                    conexoes.append(future.result())
+                except Exception as e:
+                    erro = str(e)[:150]
+    finally:
+        for conn in conexoes:
+            conn.close()
+
+    return {
+        'conexoes': len(conexoes),
+        'segundos': round(time.perf_counter() - inicio, 2),
+        'erro': erro,
+        'quando': datetime.now().strftime('%d/%m/%Y %H:%M:%S'),
+    }
+
+
+def get_metricas_pool(engine) -> dict:
+    """Retorna as métricas acumuladas e o estado atual do pool de conexões."""
+    with _METRICAS_POOL_LOCK:
+        metricas = dict(_METRICAS_POOL)
+
+    metricas['espera_media'] = metricas['espera_total'] / metricas['checkouts'] if metricas['checkouts'] else 0.0
+    metricas['handshake_medio'] = (
+        metricas['handshake_total'] / metricas['conexoes_criadas'] if metricas['conexoes_criadas'] else 0.0
+    )
+
+    pool = getattr(engine, 'pool', None)
+    if isinstance(pool, QueuePool):
+        metricas['em_uso'] = pool.checkedout()
+        metricas['ociosas'] = pool.checkedin()
+        metricas['overflow'] = max(0, pool.overflow())
+        metricas['status'] = pool.status()
+    return metricas
+
+
 @st.cache_resource
 def get_engine():
-    """Cria engine de conexão (compartilhada entre sessões)."""
+    """
+    Cria engine de conexão (compartilhada entre sessões).
+
+    Pool configurado por IMPALA_POOL_CONFIG (ou secrets [impala_pool]): tamanho, overflow,
+    pre-ping e reciclagem das conexões antes da expiração da sessão LDAP/SSL.
+    As conexões de aquecimento são abertas em segundo plano.
+    """
     try:
         engine = create_engine(
             f'impala://{IMPALA_HOST}:{IMPALA_PORT}/{DATABASE}',
@@ -708,13 +970,319 @@ def get_engine():
                 'password': IMPALA_PASSWORD,
                 'auth_mechanism': 'LDAP',
                 'use_ssl': True
-            }
+            },
+            poolclass=PoolMonitorado,
+            pool_size=int(IMPALA_POOL_CONFIG['pool_size']),
+            max_overflow=int(IMPALA_POOL_CONFIG['max_overflow']),
+            pool_timeout=float(IMPALA_POOL_CONFIG['pool_timeout']),
+            pool_recycle=int(IMPALA_POOL_CONFIG['pool_recycle']),
+            pool_pre_ping=bool(IMPALA_POOL_CONFIG['pool_pre_ping']),
         )
+        _registrar_eventos_pool(engine)
+
+        n_warmup = min(int(IMPALA_POOL_CONFIG['warmup']), int(IMPALA_POOL_CONFIG['pool_size']))
+        if n_warmup > 0:
+            def _warmup():
+                resultado = aquecer_pool(engine, n_warmup)
+                with _METRICAS_POOL_LOCK:
+                    _METRICAS_POOL['warmup'] = resultado
+
+            threading.Thread(target=_warmup, name="impala_pool_warmup", daemon=True).start()
+
         return engine
     except Exception as e:
         st.error(f"❌ Erro de conexão: {str(e)[:100]}")
         return None
 
+# =============================================================================
+# 4.1. EXECUÇÃO POR TABELA (PARALELA)
+# =============================================================================
+# Tempos de cada consulta por tabela: argos.tempos (registrar_tempo_tabela)
+
+def get_executor_tabelas():
+    """
+    Pool de threads compartilhado para as consultas por tabela (um por processo). Sem
+    st.cache_resource: também é usado pelos loaders com cache_compartilhado, que recalculam
+    em threads sem contexto do Streamlit.
+    """
+    return estado_processo('executor_tabelas', lambda: concurrent.futures.ThreadPoolExecutor(
+        max_workers=PARALLEL_FETCH_WORKERS,
+        thread_name_prefix="impala_tabela"
+    ))
+
+
+def _ler_tabela(_engine, query: str, timeout: float = None, inicios: dict = None, nome: str = None):
+    """
+    Executa a query de uma tabela e retorna (DataFrame, segundos).
+
+    Com `timeout`, a query roda com EXEC_TIME_LIMIT_S na sessão (o Impala a cancela ao
+    estourar o tempo), e o limite volta a 0 antes de a conexão voltar ao pool. O momento
+    em que a query começou fica em inicios[nome] (ver executar_por_tabela).
+    """
+    inicio = time.perf_counter()
+    if inicios is not None:
+        inicios[nome] = time.monotonic()
+    if not timeout:
+        df = pd.read_sql(query, _engine)
+        return df, time.perf_counter() - inicio
+
+    with _engine.connect() as conn:
+        conn.exec_driver_sql(f"SET EXEC_TIME_LIMIT_S={int(math.ceil(timeout))}")
+        try:
+            df = pd.read_sql(query, conn)
+        finally:
+            try:
+                conn.exec_driver_sql("SET EXEC_TIME_LIMIT_S=0")
+            except Exception:
+                # Sem conseguir limpar o limite, a conexão não volta para o pool
+                conn.invalidate()
+    return df, time.perf_counter() - inicio
+
+
+def executar_por_tabela(_engine, queries: dict, origem: str, parcial_ok: bool = True, timeout: float = None) -> tuple:
+    """
+    Executa uma query por tabela em paralelo (pool compartilhado) e registra tempo e linhas de cada uma.
+
+    Uma tabela com erro ou lenta não bloqueia as demais: cada uma tem seu resultado
+    (ou erro) próprio. Tabelas que não terminam em `timeout` segundos, contados do início
+    da sua query, ficam de fora; o próprio Impala cancela a query (EXEC_TIME_LIMIT_S), então
+    a thread do pool compartilhado não fica presa a ela.
+
+    Args:
+        _engine: Engine de conexão
+        queries: dict {nome_tabela: query}
+        origem: Identificação da chamada (ex.: 'consulta', 'ranking') para os tempos
+        parcial_ok: Se False, lança o primeiro erro quando alguma tabela falhar
+                    (para agregados em que resultado parcial seria enganoso)
+        timeout: Tempo máximo por tabela (padrão: PARALLEL_TABLE_TIMEOUT_SECONDS)
+
+    Returns:
+        tuple: (resultados, falhas)
+            - resultados: dict {nome_tabela: DataFrame} apenas das tabelas que responderam
+            - falhas: dict {nome_tabela: mensagem de erro}
+
+    Raises:
+        Exception: se todas as tabelas falharem, ou se parcial_ok=False e alguma falhar
+    """
+    timeout = timeout or PARALLEL_TABLE_TIMEOUT_SECONDS
+    executor = get_executor_tabelas()
+    inicios = {}   # nome -> time.monotonic() do início da query (preenchido pela thread)
+
+    futures = {executor.submit(_ler_tabela, _engine, query, timeout, inicios, nome): nome
+               for nome, query in queries.items()}
+
+    # O prazo de cada tabela conta do início da sua query, não da espera na fila do pool
+    pendentes = set(futures)
+    estouradas = {}
+    while pendentes:
+        _, pendentes = concurrent.futures.wait(pendentes, timeout=1.0,
+                                               return_when=concurrent.futures.FIRST_COMPLETED)
+        agora = time.monotonic()
+        for future in list(pendentes):
+            comeco = inicios.get(futures[future])
+            if comeco is not None and agora - comeco > timeout + PARALLEL_TABLE_TIMEOUT_FOLGA_SECONDS:
+                pendentes.discard(future)
+                estouradas[future] = agora - comeco
+
+    resultados = {}
+    falhas = {}
+    primeiro_erro = None
+
+    for future, nome in futures.items():
+        if future in estouradas:
+            # O Impala cancela a query pelo EXEC_TIME_LIMIT_S; apenas não esperamos mais por ela
+            falhas[nome] = f"timeout após {timeout:g}s"
+            registrar_tempo_tabela(origem, nome, estouradas[future], 0, "timeout")
+            if primeiro_erro is None:
+                primeiro_erro = TimeoutError(f"Tabela {nome}: {falhas[nome]}")
+            continue
+        try:
+            df, segundos = future.result()
+            resultados[nome] = df
+            registrar_tempo_tabela(origem, nome, segundos, len(df))
+        except Exception as e:
+            falhas[nome] = str(e)
+            segundos = time.monotonic() - inicios.get(nome, time.monotonic())
+            registrar_tempo_tabela(origem, nome, segundos, 0, f"erro: {str(e)[:80]}")
+            if primeiro_erro is None:
+                primeiro_erro = e
+
+    if primeiro_erro is not None and (not resultados or not parcial_ok):
+        raise primeiro_erro
+
+    return resultados, falhas
+
+
+def ler_agregado_por_tabela(_engine, partes: dict, montar_query, chaves: list, origem: str,
+                            partes_replica: dict = None) -> pd.DataFrame:
+    """
+    Executa uma query agregada sobre as tabelas do grupo.
+
+    Com PARALLEL_TABLE_FETCH, a mesma agregação roda em cada tabela em paralelo e os
+    resultados são somados por `chaves` no pandas (válido para SUM e COUNT). Sem ela,
+    usa o modo antigo: uma única query sobre o UNION ALL das tabelas.
+
+    Se `partes_replica` for informado e a réplica local de todas as tabelas estiver
+    atualizada, a agregação roda uma única vez no DuckDB sobre o UNION ALL (sem Impala).
+
+    Args:
+        partes: dict {nome_tabela: SELECT da tabela}
+        montar_query: função(sub_query) -> query agregada sobre "FROM (sub_query) t"
+        chaves: colunas do GROUP BY ([] para totais sem agrupamento)
+        origem: Identificação da chamada para os tempos por tabela
+        partes_replica: como `partes`, mas com os filtros da réplica (modo_ident="replica")
+    """
+    if partes_replica and replica_disponivel(_engine, partes_replica.keys()):
+        try:
+            df = consultar_replica(list(partes_replica.keys()),
+                                   montar_query(" UNION ALL ".join(partes_replica.values())), origem)
+            for col in df.columns:
+                if col not in chaves:
+                    df[col] = pd.to_numeric(df[col], errors='coerce')
+            return df
+        except Exception as e:
+            registrar_tempo_tabela(origem, 'réplica', 0.0, 0, f"erro, usando Impala: {str(e)[:80]}")
+
+    if not PARALLEL_TABLE_FETCH or len(partes) <= 1:
+        inicio = time.perf_counter()
+        df = pd.read_sql(montar_query(" UNION ALL ".join(partes.values())), _engine)
+        registrar_tempo_tabela(origem, " + ".join(partes.keys()) or "-", time.perf_counter() - inicio, len(df))
+        return df
+
+    resultados, _ = executar_por_tabela(
+        _engine,
+        {nome: montar_query(sub) for nome, sub in partes.items()},
+        origem,
+        parcial_ok=False
+    )
+    frames = [df for df in resultados.values() if not df.empty]
+    if not frames:
+        return pd.DataFrame()
+
+    df = pd.concat(frames, ignore_index=True)
+
+    # SUM sem linhas volta NULL (coluna object): converte as medidas antes de somar
+    medidas = [col for col in df.columns if col not in chaves]
+    for col in medidas:
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+
+    if chaves:
+        return df.groupby(chaves, as_index=False, dropna=False, sort=False)[medidas].sum()
+    return df[medidas].sum().to_frame().T
+
+
+# =============================================================================
+# 4.2. VERSÃO DAS TABELAS
+# =============================================================================
+# Cache persistente em disco (Parquet) das consultas: argos.cache_disco; cache em memória
+# com single-flight e stale-while-revalidate dos loaders: argos.cache_compartilhado
+
+@cache_compartilhado(ttl=VERSAO_TABELAS_TTL_SECONDS, copiar=False)
+def get_versao_tabela(_engine, tabela: str, sonda: str = "metadados"):
+    """
+    Impressão digital de uma tabela, conforme a sonda configurada no grupo (sonda_versao):
+        - "metadados": SHOW TABLE STATS (arquivos, tamanho, linhas) - não lê dados
+        - "contagem": SELECT COUNT(*), MAX(periodo) - resolvido pelas estatísticas do Parquet
+        - outra string: query própria, com {tabela} no lugar do nome da tabela
+
+    Muda quando a tabela _3M é recriada. Consultada no máximo a cada VERSAO_TABELAS_TTL_SECONDS.
+    Com cache_compartilhado, e não st.cache_data, porque os loaders a consultam também nos
+    recálculos em segundo plano.
+
+    Returns:
+        str (hash curto) ou None se a sonda falhou
+    """
+    if sonda == "metadados":
+        query = f"SHOW TABLE STATS {tabela}"
+    elif sonda == "contagem":
+        query = f"SELECT COUNT(*) AS linhas, MAX(periodo) AS ultimo_periodo FROM {tabela}"
+    else:
+        query = sonda.format(tabela=tabela)
+    try:
+        df = pd.read_sql(query, _engine)
+    except Exception:
+        return None
+    return hashlib.sha1(f"{tabela}|{df.to_csv(index=False)}".encode('utf-8')).hexdigest()[:16]
+
+
+def get_versao_tabelas(_engine, grupo: str = None):
+    """
+    Versão combinada das tabelas do grupo (ver get_versao_tabela).
+
+    Returns:
+        str ou None se a versão de alguma tabela não pôde ser obtida
+    """
+    config = get_grupo_config(grupo)
+    sonda = config.get('sonda_versao', 'metadados')
+    versoes = []
+    for tipo in sorted(config.get('tabelas', {})):
+        versao = get_versao_tabela(_engine, config['tabelas'][tipo], sonda)
+        if versao is None:
+            return None
+        versoes.append(versao)
+    if not versoes:
+        return None
+    return hashlib.sha1("|".join(versoes).encode('utf-8')).hexdigest()[:16]
+
+
+def versao_cache_grupo(_engine, grupo: str = None) -> str:
+    """
+    Chave de versão dos loaders cacheados (rankings, estatísticas, consulta).
+
+    O cache dura enquanto as tabelas não mudam e é refeito logo após uma recarga.
+    Se a sonda falhar, volta ao comportamento antigo: uma chave nova a cada RANKING_CACHE_TTL.
+    """
+    if grupo is None:
+        grupo = st.session_state.get('grupo_selecionado', GRUPO_PADRAO)
+    versao = get_versao_tabelas(_engine, grupo)
+    if versao:
+        return versao
+    return f"janela-{int(time.time() // RANKING_CACHE_TTL)}"
+
+
+
+# =============================================================================
+# 4.3. RÉPLICA LOCAL DAS TABELAS (PARQUET + DUCKDB)
+# =============================================================================
+
+# Mecanismo em argos.replica; aqui, a versão das tabelas (get_versao_tabela com a sonda do
+# grupo) e as tabelas de cada grupo.
+
+def _sonda_da_tabela(tabela: str) -> str:
+    """Sonda de versão (sonda_versao) do grupo que usa a tabela."""
+    for config in GRUPOS_CONFIG.values():
+        if tabela in config.get('tabelas', {}).values():
+            return config.get('sonda_versao', 'metadados')
+    return 'metadados'
+
+
+def _versao_tabela_replica(_engine):
+    """Função tabela -> versão atual no Impala (ou None), usada pela réplica para validar o manifesto."""
+    return lambda tabela: get_versao_tabela(_engine, tabela, _sonda_da_tabela(tabela))
+
+
+def replica_disponivel(_engine, tabelas) -> bool:
+    """True se todas as tabelas têm réplica atualizada (senão a consulta inteira vai ao Impala)."""
+    tabelas = list(tabelas)
+    versao_tabela = _versao_tabela_replica(_engine)
+    return bool(tabelas) and all(replica_atualizada(tabela, versao_tabela) for tabela in tabelas)
+
+
+def sincronizar_replicas(_engine, grupos: list = None, forcar: bool = False) -> list:
+    """Sincroniza, uma por vez, as tabelas dos grupos cuja réplica está ausente ou desatualizada."""
+    tabelas = []
+    for grupo in grupos or GRUPOS_ORDENADOS:
+        for tabela in get_grupo_tabelas(grupo).values():
+            if tabela not in tabelas:
+                tabelas.append(tabela)
+    return sincronizar_tabelas(_engine, tabelas, _versao_tabela_replica(_engine), forcar)
+
+
+def get_status_replica(_engine, grupo: str) -> pd.DataFrame:
+    """Estado da réplica de cada tabela do grupo (para o diagnóstico)."""
+    return status_replica(get_grupo_tabelas(grupo), _versao_tabela_replica(_engine))
+
+
 # =============================================================================
 # 5. FUNÇÕES DE CARREGAMENTO DE DADOS
 # =============================================================================
@@ -724,43 +1292,38 @@ def get_contribuinte_info(_engine, identificador_digits: str):
     """
     Busca informações do contribuinte na tabela usr_sat_ods.vw_ods_contrib.
     Retorna CNPJ formatado e Razão Social.
+
+    Busca pelas variantes conhecidas do identificador (sem regexp por linha), no CNPJ e
+    depois na IE. Com IDENT_REPETIR_COM_REGEXP, repete com regexp_replace se não encontrar.
     """
-    # Tenta buscar por CNPJ primeiro
-    query_cnpj = f"""
-        SELECT 
-            nu_cnpj,
-            nm_razao_social,
-            nu_ie,
-            nm_fantasia,
-            nm_munic,
-            cd_gerfe,
-            nm_gerfe
-        FROM usr_sat_ods.vw_ods_contrib
-        WHERE regexp_replace(nu_cnpj, '[^0-9]', '') = '{identificador_digits}'
-        LIMIT 1
-    """
-    
-    # Tenta buscar por IE
-    query_ie = f"""
-        SELECT 
-            nu_cnpj,
-            nm_razao_social,
-            nu_ie,
-            nm_fantasia,
-            nm_munic,
-            cd_gerfe,
-            nm_gerfe
-        FROM usr_sat_ods.vw_ods_contrib
-        WHERE regexp_replace(nu_ie, '[^0-9]', '') = '{identificador_digits}'
-        LIMIT 1
-    """
+    def montar_query(filtro):
+        return f"""
+            SELECT 
+                nu_cnpj,
+                nm_razao_social,
+                nu_ie,
+                nm_fantasia,
+                nm_munic,
+                cd_gerfe,
+                nm_gerfe
+            FROM usr_sat_ods.vw_ods_contrib
+            WHERE {filtro}
+            LIMIT 1
+        """
+
+    # Ordem de tentativa: CNPJ e IE em cada modo de modos_busca_identificador
+    queries = [
+        montar_query(filtro_identificador(coluna, identificador_digits, modo))
+        for modo in modos_busca_identificador('nu_cnpj')
+        for coluna in ('nu_cnpj', 'nu_ie')
+    ]
     
     try:
-        # Tenta por CNPJ
-        df = pd.read_sql(query_cnpj, _engine)
-        if df.empty:
-            # Tenta por IE
-            df = pd.read_sql(query_ie, _engine)
+        df = pd.DataFrame()
+        for query in queries:
+            df = pd.read_sql(query, _engine)
+            if not df.empty:
+                break
         
         if not df.empty:
             return {
@@ -830,33 +1393,22 @@ def get_cfop_descricoes(_engine, cfop_list: list) -> dict:
     except Exception as e:
         return {}
 
-@st.cache_data(ttl=CACHE_TTL_SECONDS, show_spinner="Carregando dados base...")
-def get_base_df(_engine, identificador_digits: str, nivel: str = "BAIXA", grupo: str = None, tipo_doc_filter: str = None):
+def _montar_queries_base(identificador_digits: str, nivel: str = "BAIXA", grupo: str = None, tipo_doc_filter: str = None,
+                         projecao: str = "completa", modo_ident: str = None) -> dict:
     """
-    Carrega o DataFrame base para o CNPJ/IE informado.
-    Suporta múltiplos grupos (GESSUPER, GESMAC, etc.)
-
-    Args:
-        _engine: Engine de conexão
-        identificador_digits: CNPJ ou IE (apenas dígitos)
-        nivel: Nível de acurácia (BAIXA, MEDIA, ALTA)
-        grupo: Grupo (GESSUPER, GESMAC). Se None, usa session_state
-        tipo_doc_filter: Filtro opcional por tipo de documento ('NFe', 'NFCe', 'Cupom', None=todos)
+    Monta as queries da consulta por empresa, uma por tabela do grupo.
+    Usada por get_base_df (UNION ALL) e pelo carregamento em lotes (iter_base_df_chunks).
 
-    As colunas são renomeadas para nomes genéricos:
-        - legislacao_X -> legislacao_ia
-        - aliquota_X -> aliquota_ia
-        - infracao_X -> infracao_ia
+    Projeções:
+        - "completa": layout do Anexo J (~43 colunas), necessário para exportar
+        - "resumo": só as colunas usadas em Resumo, Comparativo e Análise
+          (período, data, tipo_doc, emitente, NCM, CFOP, descrição, legislação, alíquota, infração)
 
-    Filtra apenas registros onde infracao_X IS NOT NULL e != 'EXCLUIR'
+    modo_ident: modo de filtro_identificador ("replica" para consultar a réplica local)
 
-    OTIMIZAÇÃO: GESSUPER usa queries simplificadas (~23 colunas) para melhor performance.
-    GESMAC usa queries completas (~43 colunas) com todas as informações necessárias.
+    Returns:
+        dict {tipo_tabela: query} - ex.: {'nfce': ..., 'cupons': ..., 'nfe': ...}
     """
-    # Obtém configuração do grupo
-    if grupo is None:
-        grupo = st.session_state.get('grupo_selecionado', GRUPO_PADRAO)
-
     tabelas = get_grupo_tabelas(grupo)
 
     # Define as colunas baseado no nível
@@ -882,7 +1434,26 @@ def get_base_df(_engine, identificador_digits: str, nivel: str = "BAIXA", grupo:
         AND CAST({col_infracao} AS STRING) != 'EXCLUIR'
     """
 
-    queries = []
+    # Busca do CNPJ sem regexp por linha (ver IDENT_LOOKUP_MODE)
+    filtro_ident = filtro_identificador('cnpj_emitente', identificador_digits, modo_ident)
+
+    queries = {}
+
+    # Projeção reduzida: mesma consulta em todas as tabelas, sem as colunas do Anexo J
+    if projecao == "resumo":
+        tipo_doc_tabela = {'nfce': 'NFCe', 'cupons': 'Cupom', 'nfe': 'NFe'}
+        for tipo, tipo_doc in tipo_doc_tabela.items():
+            if tabelas.get(tipo) and (tipo_doc_filter is None or tipo_doc_filter == tipo_doc):
+                queries[tipo] = f"""
+                    SELECT
+                        data_emissao, periodo, tipo_doc, cnpj_emitente, razao_emitente, ncm,
+                        descricao, CAST(cfop AS STRING) AS cfop, {col_legislacao} AS legislacao_ia,
+                        {col_aliquota} AS aliquota_ia, {col_infracao} AS infracao_ia
+                    FROM {tabelas[tipo]}
+                    WHERE {filtro_ident}
+                    AND {filtro_nivel}
+                """
+        return queries
 
     # Verifica se o grupo usa queries completas (GESMAC, GESAUTO, OP_TTD, GESSUPER_NFE)
     usar_queries_completas = uses_full_queries(grupo)
@@ -905,7 +1476,7 @@ def get_base_df(_engine, identificador_digits: str, nivel: str = "BAIXA", grupo:
                     {col_aliquota} AS aliquota_ia, NULL AS aliq_efetiva, NULL AS icms_devido,
                     {col_infracao} AS infracao_ia
                 FROM {tabelas['nfce']}
-                WHERE regexp_replace(cnpj_emitente, '[^0-9]', '') = '{identificador_digits}'
+                WHERE {filtro_ident}
                 AND {filtro_nivel}
             """
         else:
@@ -920,10 +1491,10 @@ def get_base_df(_engine, identificador_digits: str, nivel: str = "BAIXA", grupo:
                     {col_aliquota} AS aliquota_ia, NULL AS aliq_efetiva,
                     {col_infracao} AS infracao_ia
                 FROM {tabelas['nfce']}
-                WHERE regexp_replace(cnpj_emitente, '[^0-9]', '') = '{identificador_digits}'
+                WHERE {filtro_ident}
                 AND {filtro_nivel}
             """
-        queries.append(query_nfce)
+        queries['nfce'] = query_nfce
 
     # Query Cupons
     if tabelas.get('cupons') and (tipo_doc_filter is None or tipo_doc_filter == 'Cupom'):
@@ -944,7 +1515,7 @@ def get_base_df(_engine, identificador_digits: str, nivel: str = "BAIXA", grupo:
                     {col_aliquota} AS aliquota_ia, NULL AS aliq_efetiva, NULL AS icms_devido,
                     {col_infracao} AS infracao_ia
                 FROM {tabelas['cupons']}
-                WHERE regexp_replace(cnpj_emitente, '[^0-9]', '') = '{identificador_digits}'
+                WHERE {filtro_ident}
                 AND {filtro_nivel}
             """
         else:
@@ -959,10 +1530,10 @@ def get_base_df(_engine, identificador_digits: str, nivel: str = "BAIXA", grupo:
                     {col_aliquota} AS aliquota_ia, NULL AS aliq_efetiva,
                     {col_infracao} AS infracao_ia
                 FROM {tabelas['cupons']}
-                WHERE regexp_replace(cnpj_emitente, '[^0-9]', '') = '{identificador_digits}'
+                WHERE {filtro_ident}
                 AND {filtro_nivel}
             """
-        queries.append(query_cupons)
+        queries['cupons'] = query_cupons
 
     # Query NFe (GESMAC e GESSUPER NFe quando configurado)
     if tabelas.get('nfe') and (tipo_doc_filter is None or tipo_doc_filter == 'NFe'):
@@ -982,7 +1553,7 @@ def get_base_df(_engine, identificador_digits: str, nivel: str = "BAIXA", grupo:
                     {col_aliquota} AS aliquota_ia, NULL AS aliq_efetiva, NULL AS icms_devido,
                     {col_infracao} AS infracao_ia
                 FROM {tabelas['nfe']}
-                WHERE regexp_replace(cnpj_emitente, '[^0-9]', '') = '{identificador_digits}'
+                WHERE {filtro_ident}
                 AND {filtro_nivel}
             """
         else:
@@ -1001,84 +1572,297 @@ def get_base_df(_engine, identificador_digits: str, nivel: str = "BAIXA", grupo:
                     {col_legislacao} AS legislacao_ia, {col_aliquota} AS aliquota_ia,
                     NULL AS aliq_efetiva, NULL AS icms_devido, {col_infracao} AS infracao_ia
                 FROM {tabelas['nfe']}
-                WHERE regexp_replace(cnpj_emitente, '[^0-9]', '') = '{identificador_digits}'
+                WHERE {filtro_ident}
                 AND {filtro_nivel}
             """
-        queries.append(query_nfe)
+        queries['nfe'] = query_nfe
 
-    if not queries:
-        return pd.DataFrame()
+    return queries
 
-    # Combina as queries com UNION ALL
-    full_query = " UNION ALL ".join(queries)
+def get_base_df(_engine, identificador_digits: str, nivel: str = "BAIXA", grupo: str = None, tipo_doc_filter: str = None,
+                projecao: str = "completa"):
+    """
+    Carrega o DataFrame base para o CNPJ/IE informado.
+    Suporta múltiplos grupos (GESSUPER, GESMAC, etc.)
 
-    try:
-        df = pd.read_sql(full_query, _engine)
-        return df
-    except Exception as e:
-        error_msg = str(e)
-        if is_table_unavailable_error(error_msg):
-            st.session_state.tabela_indisponivel = True
-        return pd.DataFrame()
+    Args:
+        _engine: Engine de conexão
+        identificador_digits: CNPJ ou IE (apenas dígitos)
+        nivel: Nível de acurácia (BAIXA, MEDIA, ALTA)
+        grupo: Grupo (GESSUPER, GESMAC). Se None, usa session_state
+        tipo_doc_filter: Filtro opcional por tipo de documento ('NFe', 'NFCe', 'Cupom', None=todos)
+        projecao: "completa" (layout do Anexo J, para exportar) ou "resumo" (colunas de análise).
+            A consulta por empresa carrega "resumo"; "completa" só é buscada ao preparar a exportação.
 
-def calcular_totais(df: pd.DataFrame, nivel_str: str):
-    """
-    Retorna:
-        total_nivel, cfg (dict do nível), has_rows (bool)
-    
-    A query SQL já traz os dados do nível selecionado com colunas genéricas:
-        - legislacao_ia, aliquota_ia, infracao_ia
-    
-    Infração = valor da coluna infracao_ia (ICMS devido pela IA)
-    """
-    cfg = nivel_config(nivel_str)
-    
-    if df.empty:
-        return 0.0, cfg, False
-    
-    # Verifica qual coluna de infração usar
-    # Nova estrutura: infracao_ia (coluna genérica)
-    # Estrutura antiga: infracao_baixa, infracao_media, infracao_alta
-    if 'infracao_ia' in df.columns:
-        col_infracao = 'infracao_ia'
-    else:
-        # Fallback para estrutura antiga
-        col_infracao = cfg['col_infracao']
-    
-    # Converte valores para numérico e soma
-    # Usa COALESCE equivalente: converte para float, trata NaN como 0
-    df_calc = df.copy()
-    df_calc['infracao_valor'] = pd.to_numeric(df_calc[col_infracao], errors='coerce').fillna(0)
-    
-    # Soma os valores das infrações
-    total_nivel = df_calc['infracao_valor'].sum()
-    
-    return float(total_nivel), cfg, True
+    As colunas são renomeadas para nomes genéricos:
+        - legislacao_X -> legislacao_ia
+        - aliquota_X -> aliquota_ia
+        - infracao_X -> infracao_ia
 
-def build_export_df(df: pd.DataFrame, nivel_str: str, grupo: str = None, modelo_export: str = None):
-    """
-    Monta o DataFrame pronto para exportar.
-    A query SQL já traz as colunas renomeadas para nomes genéricos:
-        - legislacao_ia, aliquota_ia, infracao_ia
+    Filtra apenas registros onde infracao_X IS NOT NULL e != 'EXCLUIR'
 
-    Este método apenas renomeia para o formato final do Excel.
+    OTIMIZAÇÃO: GESSUPER usa queries simplificadas (~23 colunas) para melhor performance.
+    GESMAC usa queries completas (~43 colunas) com todas as informações necessárias.
 
-    Args:
-        df: DataFrame com os dados
-        nivel_str: Nível de acurácia
-        grupo: Grupo (GESSUPER, GESMAC). Se None, usa session_state
-        modelo_export: Modelo de exportação para GESMAC ('NFe' ou 'NFCe + Cupom Fiscal')
+    Cache em memória compartilhado entre as sessões (ver cache_compartilhado): duas sessões
+    abrindo o mesmo CNPJ disparam uma só consulta. Resultados parciais não ficam no cache.
+    Resultados completos também ficam no cache em disco (ver CACHE_DISCO_CONFIG), que
+    sobrevive ao TTL e ao reinício do servidor.
     """
-    cfg = nivel_config(nivel_str)
-
+    # Obtém configuração do grupo
     if grupo is None:
         grupo = st.session_state.get('grupo_selecionado', GRUPO_PADRAO)
 
-    if df.empty:
-        return None
-
-    # Copia o DataFrame
-    df_export = df.copy()
+    try:
+        return _carregar_base_df(_engine, identificador_digits, nivel, grupo, tipo_doc_filter, projecao)
+    except Exception as e:
+        if is_table_unavailable_error(str(e)):
+            st.session_state.tabela_indisponivel = True
+        return pd.DataFrame()
+
+
+@cache_compartilhado(
+    ttl=CACHE_TTL_SECONDS,
+    max_obsoleto=CONSULTA_MAX_OBSOLETO_SECONDS,
+    max_entries=CONSULTA_CACHE_MAX_ENTRIES,
+    cachear_se=lambda df: not df.attrs.get('tabelas_falhas'),
+)
+def _carregar_base_df(_engine, identificador_digits: str, nivel: str, grupo: str, tipo_doc_filter: str,
+                      projecao: str):
+    """Parte cacheada de get_base_df (erros são lançados; resultados parciais não são guardados)."""
+    queries = _montar_queries_base(identificador_digits, nivel, grupo, tipo_doc_filter, projecao)
+
+    if not queries:
+        return pd.DataFrame()
+
+    # Cache persistente em disco, compartilhado entre sessões e processos. A chave leva
+    # a versão das tabelas (muda quando são recriadas) e o texto das queries.
+    chave_disco = None
+    if cache_disco_ativo():
+        versao = get_versao_tabelas(_engine, grupo)
+        if versao:
+            chave_disco = ('consulta', grupo, versao, tuple(queries.values()))
+            df_disco = ler_cache_disco(chave_disco)
+            if df_disco is not None:
+                registrar_tempo_tabela('consulta', 'cache em disco', 0.0, len(df_disco))
+                df_disco = aplicar_schema_consulta(df_disco)
+                df_disco.attrs['tabelas_falhas'] = {}
+                return df_disco
+
+    # Réplica local atualizada: a consulta roda no DuckDB, sem ir ao Impala.
+    # Qualquer erro na réplica cai para o Impala abaixo.
+    tabelas = get_grupo_tabelas(grupo)
+    if replica_disponivel(_engine, [tabelas[tipo] for tipo in queries]):
+        try:
+            queries_replica = _montar_queries_base(identificador_digits, nivel, grupo, tipo_doc_filter, projecao,
+                                                   modo_ident="replica")
+            df = pd.concat(
+                [consultar_replica([tabelas[tipo]], query, 'consulta') for tipo, query in queries_replica.items()],
+                ignore_index=True
+            )
+            df.attrs['tabelas_falhas'] = {}
+            return aplicar_schema_consulta(df, medir_memoria=True)
+        except Exception as e:
+            registrar_tempo_tabela('consulta', 'réplica', 0.0, 0, f"erro, usando Impala: {str(e)[:80]}")
+
+    def buscar(queries_modo):
+        if PARALLEL_TABLE_FETCH and len(queries_modo) > 1:
+            # Um SELECT por tabela em paralelo; latência = tabela mais lenta.
+            # Tabelas com erro/timeout ficam em df.attrs['tabelas_falhas'] (resultado parcial).
+            queries_tabela = {tabelas[tipo]: query for tipo, query in queries_modo.items()}
+            resultados, falhas = executar_por_tabela(_engine, queries_tabela, 'consulta')
+            df = pd.concat(
+                [resultados[nome] for nome in queries_tabela if nome in resultados],
+                ignore_index=True
+            )
+            df.attrs['tabelas_falhas'] = falhas
+            return df
+        # Combina as queries com UNION ALL
+        full_query = " UNION ALL ".join(queries_modo.values())
+        inicio = time.perf_counter()
+        df = pd.read_sql(full_query, _engine)
+        registrar_tempo_tabela('consulta', 'UNION ALL', time.perf_counter() - inicio, len(df))
+        return df
+
+    # Com IDENT_REPETIR_COM_REGEXP, repete com regexp se as variantes não acharem nada (ver modos_busca_identificador)
+    for modo in modos_busca_identificador():
+        queries_modo = queries if modo == IDENT_LOOKUP_MODE else _montar_queries_base(
+            identificador_digits, nivel, grupo, tipo_doc_filter, projecao, modo_ident=modo
+        )
+        df = buscar(queries_modo)
+        if not df.empty or df.attrs.get('tabelas_falhas'):
+            break
+    df = aplicar_schema_consulta(df, medir_memoria=True)
+    # Resultado parcial (tabela com erro/timeout) não vai para o disco
+    if chave_disco and not df.attrs.get('tabelas_falhas'):
+        gravar_cache_disco_em_segundo_plano(chave_disco, df)
+    return df
+
+def _dtype_texto_consulta():
+    """
+    Dtype das colunas "texto" do SCHEMA_CONSULTA: string em Arrow com nulos como NaN
+    (mesmo comportamento do object em filtros e comparações). None se indisponível.
+    """
+    if not PYARROW_AVAILABLE:
+        return None
+    try:
+        return pd.StringDtype("pyarrow", na_value=np.nan)  # pandas >= 2.3
+    except TypeError:
+        try:
+            return pd.StringDtype("pyarrow_numpy")  # pandas 2.1 / 2.2
+        except (TypeError, ValueError):
+            return None
+
+DTYPE_TEXTO_CONSULTA = _dtype_texto_consulta()
+
+def aplicar_schema_consulta(df: pd.DataFrame, medir_memoria: bool = False) -> pd.DataFrame:
+    """
+    Aplica o SCHEMA_CONSULTA ao DataFrame da consulta (resultado completo ou lote).
+
+    Valores viram float64 uma única vez, dimensões repetidas viram category e texto livre
+    vira string em Arrow. Colunas "texto" só são convertidas se já forem texto ou vazias
+    (ex.: gtin numérico continua numérico, preservando o tipo da célula no Excel).
+
+    Com medir_memoria=True, guarda em df.attrs['memoria'] os bytes antes/depois do schema.
+    """
+    if df is None or df.empty:
+        return df
+
+    memoria_antes = int(df.memory_usage(deep=True).sum()) if medir_memoria else None
+
+    for col, tipo in SCHEMA_CONSULTA.items():
+        if col not in df.columns:
+            continue
+        serie = df[col]
+        if tipo == "numero":
+            if not pd.api.types.is_numeric_dtype(serie):
+                df[col] = pd.to_numeric(serie, errors='coerce')
+        elif tipo == "categoria":
+            if not isinstance(serie.dtype, pd.CategoricalDtype):
+                df[col] = serie.astype('category')
+        elif tipo == "texto" and DTYPE_TEXTO_CONSULTA is not None:
+            if serie.dtype == object and pd.api.types.infer_dtype(serie, skipna=True) in ('string', 'empty'):
+                df[col] = serie.astype(DTYPE_TEXTO_CONSULTA)
+
+    if medir_memoria:
+        df.attrs['memoria'] = {
+            'antes': memoria_antes,
+            'depois': int(df.memory_usage(deep=True).sum()),
+        }
+    return df
+
+def relatorio_memoria_consulta(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Memória ocupada por coluna (memory_usage deep), da maior para a menor.
+
+    Returns:
+        DataFrame [Coluna, Tipo, MB]
+    """
+    if df is None or df.empty:
+        return pd.DataFrame(columns=['Coluna', 'Tipo', 'MB'])
+    uso = df.memory_usage(deep=True, index=False)
+    return pd.DataFrame({
+        'Coluna': uso.index,
+        'Tipo': [str(df[col].dtype) for col in uso.index],
+        'MB': (uso.to_numpy() / (1024 * 1024)).round(2),
+    }).sort_values('MB', ascending=False).reset_index(drop=True)
+
+def iter_base_df_chunks(_engine, identificador_digits: str, nivel: str = "BAIXA", grupo: str = None,
+                        tipo_doc_filter: str = None, chunksize: int = None, projecao: str = "completa",
+                        ordenar_por: str = None):
+    """
+    Versão em streaming de get_base_df: gera DataFrames tipados de até `chunksize` linhas.
+
+    Cada tabela do grupo é lida separadamente com cursor de streaming (stream_results),
+    sem montar o resultado completo em memória. É a fonte das exportações da aba Exportar.
+    Com `ordenar_por` (ex.: 'data_emissao'), as tabelas são lidas numa única query
+    UNION ALL com ORDER BY - a ordenação fica no Impala, nulos no final como no pandas.
+
+    Diferente de get_base_df, erros não são silenciados: um lote faltando no meio de uma
+    exportação geraria arquivo incompleto. A flag tabela_indisponivel continua sendo marcada.
+    Com IDENT_REPETIR_COM_REGEXP, uma leitura sem nenhuma linha pelas variantes do CNPJ é
+    repetida com regexp (ver modos_busca_identificador).
+    """
+    if grupo is None:
+        grupo = st.session_state.get('grupo_selecionado', GRUPO_PADRAO)
+
+    chunksize = chunksize or STREAM_CHUNK_SIZE
+
+    for modo in modos_busca_identificador():
+        queries = _montar_queries_base(identificador_digits, nivel, grupo, tipo_doc_filter, projecao, modo_ident=modo)
+        if ordenar_por and queries:
+            queries = {'ordenada': f"""
+                SELECT * FROM ({" UNION ALL ".join(queries.values())}) b
+                ORDER BY {ordenar_por} ASC NULLS LAST
+            """}
+        encontrou = False
+        for query in queries.values():
+            try:
+                with _engine.connect().execution_options(stream_results=True) as conn:
+                    for chunk in pd.read_sql(query, conn, chunksize=chunksize):
+                        if not chunk.empty:
+                            encontrou = True
+                            yield aplicar_schema_consulta(chunk)
+            except Exception as e:
+                if is_table_unavailable_error(str(e)):
+                    st.session_state.tabela_indisponivel = True
+                raise
+        if encontrou:
+            return
+
+def calcular_totais(df: pd.DataFrame, nivel_str: str):
+    """
+    Retorna:
+        total_nivel, cfg (dict do nível), has_rows (bool)
+    
+    A query SQL já traz os dados do nível selecionado com colunas genéricas:
+        - legislacao_ia, aliquota_ia, infracao_ia
+    
+    Infração = valor da coluna infracao_ia (ICMS devido pela IA)
+    """
+    cfg = nivel_config(nivel_str)
+    
+    if df.empty:
+        return 0.0, cfg, False
+    
+    # Verifica qual coluna de infração usar
+    # Nova estrutura: infracao_ia (coluna genérica)
+    # Estrutura antiga: infracao_baixa, infracao_media, infracao_alta
+    if 'infracao_ia' in df.columns:
+        col_infracao = 'infracao_ia'
+    else:
+        # Fallback para estrutura antiga
+        col_infracao = cfg['col_infracao']
+    
+    # Soma os valores das infrações (COALESCE equivalente: NaN como 0)
+    total_nivel = coluna_numerica(df[col_infracao]).sum()
+    
+    return float(total_nivel), cfg, True
+
+def build_export_df(df: pd.DataFrame, nivel_str: str, grupo: str = None, modelo_export: str = None):
+    """
+    Monta o DataFrame pronto para exportar.
+    A query SQL já traz as colunas renomeadas para nomes genéricos:
+        - legislacao_ia, aliquota_ia, infracao_ia
+
+    Este método apenas renomeia para o formato final do Excel.
+
+    Args:
+        df: DataFrame com os dados
+        nivel_str: Nível de acurácia
+        grupo: Grupo (GESSUPER, GESMAC). Se None, usa session_state
+        modelo_export: Modelo de exportação para GESMAC ('NFe' ou 'NFCe + Cupom Fiscal')
+    """
+    cfg = nivel_config(nivel_str)
+
+    if grupo is None:
+        grupo = st.session_state.get('grupo_selecionado', GRUPO_PADRAO)
+
+    if df.empty:
+        return None
+
+    # Copia o DataFrame
+    df_export = df.copy()
 
     # Filtra por tipo de documento conforme modelo selecionado
     if modelo_export:
@@ -1100,7 +1884,7 @@ def build_export_df(df: pd.DataFrame, nivel_str: str, grupo: str = None, modelo_
         # Nova estrutura com colunas genéricas
         df_export['legislacao_ia_icms'] = df_export['legislacao_ia']
         df_export['aliquota_ia_icms'] = df_export['aliquota_ia']
-        df_export['icms_devido'] = pd.to_numeric(df_export['infracao_ia'], errors='coerce').fillna(0)
+        df_export['icms_devido'] = coluna_numerica(df_export['infracao_ia'])
     else:
         # Estrutura antiga com colunas por nível
         col_legislacao = cfg['col_legislacao']
@@ -1108,23 +1892,19 @@ def build_export_df(df: pd.DataFrame, nivel_str: str, grupo: str = None, modelo_
         col_infracao = cfg['col_infracao']
         df_export['legislacao_ia_icms'] = df_export[col_legislacao]
         df_export['aliquota_ia_icms'] = df_export[col_aliquota]
-        df_export['icms_devido'] = pd.to_numeric(df_export[col_infracao], errors='coerce').fillna(0)
+        df_export['icms_devido'] = coluna_numerica(df_export[col_infracao])
 
     # Calcula ICMS destacado
     if 'icms_destacado' in df_export.columns:
-        icms_destacado = pd.to_numeric(df_export['icms_destacado'], errors='coerce').fillna(0)
+        icms_destacado = coluna_numerica(df_export['icms_destacado'])
     else:
-        icms_destacado = pd.to_numeric(df_export['icms_emitente'], errors='coerce').fillna(0)
+        icms_destacado = coluna_numerica(df_export['icms_emitente'])
 
-    # Calcula ICMS devido usando a mesma fórmula do Excel: BC Fisco * Alíquota
+    # Calcula ICMS devido e não recolhido com as mesmas fórmulas do Excel
     # (para garantir que o filtro seja consistente com o que aparece no Excel)
-    bc_fisco = pd.to_numeric(df_export['bc_fisco'], errors='coerce').fillna(0)
-    aliquota = pd.to_numeric(df_export['aliquota_ia_icms'], errors='coerce').fillna(0) / 100  # Converte % para decimal
-    icms_devido_calc = (bc_fisco * aliquota).round(2)
-
-    # Calcula ICMS não recolhido (ICMS devido - ICMS destacado)
-    df_export['icms_nao_recolhido'] = (icms_devido_calc - icms_destacado).round(2)
-    df_export['icms_nao_recolhido'] = df_export['icms_nao_recolhido'].clip(lower=0)  # Não pode ser negativo
+    _, df_export['icms_nao_recolhido'] = calcular_icms_fisco(
+        coluna_numerica(df_export['bc_fisco']), coluna_numerica(df_export['aliquota_ia_icms']), icms_destacado
+    )
 
     # Filtra apenas registros com ICMS não-recolhido > 0 (remove zeros e negativos)
     df_export = df_export[df_export['icms_nao_recolhido'] > 0]
@@ -1166,1081 +1946,415 @@ def build_export_df(df: pd.DataFrame, nivel_str: str, grupo: str = None, modelo_
 
     return df_export[colunas_existentes]
 
-# =============================================================================
-# 6. FUNÇÕES DE EXPORTAÇÃO
-# =============================================================================
-
-def export_to_csv(df: pd.DataFrame, identificador: str, nivel: str) -> bytes:
-    """
-    Exporta DataFrame para CSV no formato brasileiro.
-    - Separador: ponto e vírgula (;)
-    - Encoding: latin-1 (ANSI)
-    - Decimal: vírgula (,)
+def iter_export_df(dados, nivel_str: str, grupo: str = None, modelo_export: str = None, ordenar_por: str = None):
     """
-    csv_str = df.to_csv(index=False, sep=";", decimal=",")
-    return csv_str.encode("latin-1", errors="replace")
+    Versão em lotes de build_export_df: aplica a mesma montagem a cada lote de `dados`
+    (DataFrame, função ou iterável de lotes - ver iter_df_chunks).
+    `ordenar_por` (ex.: 'data_emissao') define a ordem dos lotes quando `dados` é DataFrame.
 
-def export_to_excel_template(df: pd.DataFrame, contrib_info: dict, nivel: str, parte_atual: int = None, total_partes: int = None, progress_callback=None, grupo: str = None) -> bytes:
-    """
-    Exporta DataFrame para Excel usando a estrutura do template Anexo J.
-    Inclui fórmulas para recálculos automáticos na aba J2.
-    Ordem das abas: J2 (ICMS DEVIDO), Índice, J1 (NOTAS DE SAÍDAS)
-
-    Args:
-        df: DataFrame com os dados
-        contrib_info: Informações do contribuinte
-        nivel: Nível de acurácia (BAIXA, MEDIA, ALTA)
-        parte_atual: Número da parte atual (se dividido)
-        total_partes: Total de partes (se dividido)
-        progress_callback: Função callback(percentual, mensagem) para reportar progresso
-        grupo: Grupo de operação para determinar estrutura de colunas
+    As regras de build_export_df são linha a linha (filtros e colunas calculadas),
+    então o resultado concatenado é idêntico ao de build_export_df no DataFrame inteiro.
     """
-    def report_progress(pct, msg):
-        if progress_callback:
-            progress_callback(pct, msg)
-
-    report_progress(5, "Criando estrutura do arquivo")
-
-    # Determina se usa estrutura estendida
-    usar_estrutura_estendida = uses_full_queries(grupo) if grupo else False
-
-    buffer = BytesIO()
-
-    # Cria workbook
-    wb = Workbook()
-
-    # Estilos comuns
-    header_font = Font(bold=True, color="FFFFFF", size=10)
-    header_fill = PatternFill(start_color="1565C0", end_color="1565C0", fill_type="solid")
-    header_fill_fisco = PatternFill(start_color="C62828", end_color="C62828", fill_type="solid")
-    header_fill_yellow = PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
-    title_font = Font(bold=True, size=14, color="1565C0")
-    subtitle_font = Font(bold=True, size=11, color="666666")
-
-    thin_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-
-    # =========================================================================
-    # ABA 1: ANEXO J2 - ICMS DEVIDO (resumo por período) - PRIMEIRA ABA
-    # =========================================================================
-    ws_j2 = wb.active
-    ws_j2.title = "ANEXO J2 - ICMS DEVIDO"
-
-    # Cabeçalho institucional
-    ws_j2.merge_cells('A1:D1')
-    ws_j2['A1'] = "ESTADO DE SANTA CATARINA"
-    ws_j2['A1'].font = Font(bold=True, size=14)
-    ws_j2['A1'].alignment = Alignment(horizontal="center")
-
-    ws_j2.merge_cells('A2:D2')
-    ws_j2['A2'] = "Secretaria de Estado da Fazenda"
-    ws_j2['A2'].alignment = Alignment(horizontal="center")
-
-    ws_j2.merge_cells('A3:D3')
-    ws_j2['A3'] = "Diretoria de Administração Tributária"
-    ws_j2['A3'].alignment = Alignment(horizontal="center")
-
-    ws_j2.merge_cells('A4:D4')
-    ws_j2['A4'] = "Gerência de Fiscalização"
-    ws_j2['A4'].alignment = Alignment(horizontal="center")
-
-    # Informações do contribuinte
-    ws_j2['A6'] = "CNPJ:"
-    ws_j2['A6'].font = Font(bold=True)
-    ws_j2['B6'] = contrib_info.get('cnpj', '') if contrib_info else ''
-
-    ws_j2['A7'] = "Razão Social:"
-    ws_j2['A7'].font = Font(bold=True)
-    ws_j2['B7'] = contrib_info.get('razao_social', '') if contrib_info else ''
-
-    # Título da tabela com fundo amarelo
-    ws_j2.merge_cells('A10:D10')
-    ws_j2['A10'] = "APURAÇÃO MENSAL DO VALOR DO ICMS DEVIDO NAS VENDAS DE MERCADORIAS"
-    ws_j2['A10'].font = Font(bold=True, size=12)
-    ws_j2['A10'].fill = header_fill_yellow
-    ws_j2['A10'].alignment = Alignment(horizontal="center")
-
-    # Cabeçalhos da tabela J2
-    headers_j2 = ["Período", "ICMS destacado", "ICMS apurado", "ICMS não recolhido"]
-    for col_idx, header in enumerate(headers_j2, 1):
-        cell = ws_j2.cell(row=11, column=col_idx)
-        cell.value = header
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = Alignment(horizontal="center", vertical="center")
-        cell.border = thin_border
-
-    # Ordena dados por data_emissao para processamento
-    if 'data_emissao' in df.columns:
-        df = df.sort_values('data_emissao', ascending=True, na_position='last').reset_index(drop=True)
-
-    # Obtém períodos únicos e ordena cronologicamente
-    if 'periodo' in df.columns:
-        periodos_unicos = df['periodo'].dropna().unique()
-        periodos = sorted(periodos_unicos, key=lambda x: pd.to_datetime(x, dayfirst=True) if isinstance(x, str) else x)
-    else:
-        periodos = []
+    if grupo is None:
+        grupo = st.session_state.get('grupo_selecionado', GRUPO_PADRAO)
 
-    # Define colunas de referência baseado na estrutura
-    if usar_estrutura_estendida:
-        col_icms_destacado = 'AL'  # Coluna 38: ICMS Destacado na estrutura estendida
-        col_periodo = 'B'
-        col_icms_devido = 'AQ'  # Coluna 43: ICMS devido na estrutura estendida
-    else:
-        col_icms_destacado = 'P'  # Coluna padrão
-        col_periodo = 'B'
-        col_icms_devido = 'W'
+    for chunk in iter_df_chunks(dados, ordenar_por=ordenar_por):
+        chunk_export = build_export_df(chunk, nivel_str, grupo=grupo, modelo_export=modelo_export)
+        if chunk_export is not None and not chunk_export.empty:
+            yield chunk_export
 
-    ultima_linha_dados = len(df) + 3
+def contar_linhas_export(dados, nivel_str: str, grupo: str = None, modelo_export: str = None) -> int:
+    """Conta as linhas que serão exportadas sem manter o DataFrame de exportação em memória."""
+    return sum(len(chunk) for chunk in iter_export_df(dados, nivel_str, grupo, modelo_export))
 
-    for row_idx, periodo in enumerate(periodos, 12):
-        cell_a = ws_j2.cell(row=row_idx, column=1)
-        try:
-            if isinstance(periodo, str):
-                cell_a.value = pd.to_datetime(periodo, dayfirst=True).date()
-            else:
-                cell_a.value = periodo
-            cell_a.number_format = 'DD/MM/YYYY'
-        except:
-            cell_a.value = periodo
-        cell_a.border = thin_border
-        cell_a.alignment = Alignment(horizontal="center")
-
-        # ICMS destacado
-        cell_b = ws_j2.cell(row=row_idx, column=2)
-        cell_b.value = f"=SUMIF('ANEXO J1 - NOTAS DE SAÍDAS'!${col_periodo}$4:${col_periodo}${ultima_linha_dados},$A{row_idx},'ANEXO J1 - NOTAS DE SAÍDAS'!${col_icms_destacado}$4:${col_icms_destacado}${ultima_linha_dados})"
-        cell_b.number_format = '#,##0.00'
-        cell_b.border = thin_border
-
-        # ICMS apurado/devido
-        cell_c = ws_j2.cell(row=row_idx, column=3)
-        cell_c.value = f"=SUMIF('ANEXO J1 - NOTAS DE SAÍDAS'!${col_periodo}$4:${col_periodo}${ultima_linha_dados},$A{row_idx},'ANEXO J1 - NOTAS DE SAÍDAS'!${col_icms_devido}$4:${col_icms_devido}${ultima_linha_dados})"
-        cell_c.number_format = '#,##0.00'
-        cell_c.border = thin_border
-
-        # ICMS não recolhido
-        cell_d = ws_j2.cell(row=row_idx, column=4)
-        cell_d.value = f"=C{row_idx}-B{row_idx}"
-        cell_d.number_format = '#,##0.00'
-        cell_d.border = thin_border
-
-    # Linha de TOTAL
-    total_row = 12 + len(periodos)
-    ws_j2.cell(row=total_row, column=1).value = "TOTAL"
-    ws_j2.cell(row=total_row, column=1).font = Font(bold=True)
-    ws_j2.cell(row=total_row, column=1).border = thin_border
-
-    for col in range(2, 5):
-        cell = ws_j2.cell(row=total_row, column=col)
-        cell.value = f"=SUM({chr(64+col)}12:{chr(64+col)}{total_row-1})"
-        cell.number_format = '#,##0.00'
-        cell.font = Font(bold=True)
-        cell.border = thin_border
-        cell.fill = PatternFill(start_color="E3F2FD", end_color="E3F2FD", fill_type="solid")
-
-    # Autoajuste de largura J2
-    for col_idx in range(1, 5):
-        col_letter = get_column_letter(col_idx)
-        ws_j2.column_dimensions[col_letter].width = 20
-
-    report_progress(20, "Criando aba Índice")
+def contar_linhas_export_servidor(_engine, identificador_digits: str, nivel: str, grupo: str,
+                                  modelo_export: str = None) -> int:
+    """
+    Conta no Impala as linhas que build_export_df manteria, sem trazer os dados: um COUNT
+    por tabela sobre as queries da projeção "completa", com os mesmos filtros de modelo e
+    de ICMS não recolhido > 0 (fórmulas de calcular_icms_fisco, arredondadas a 2 casas).
+    O ROUND do Impala afasta a metade do zero, como argos.excel.arredondar: a contagem e o
+    filtro de build_export_df ficam iguais mesmo em valores como 0,005.
 
-    # =========================================================================
-    # ABA 2: Índice (descrição dos campos) - SEGUNDA ABA
-    # =========================================================================
-    ws_indice = wb.create_sheet("Índice")
-
-    ws_indice['A1'] = "Campo"
-    ws_indice['B1'] = "Descrição"
-    ws_indice['A1'].font = header_font
-    ws_indice['B1'].font = header_font
-    ws_indice['A1'].fill = header_fill
-    ws_indice['B1'].fill = header_fill
-
-    # Índice padronizado conforme especificação
-    indice_dados = [
-        ("Chave de acesso", "Indica do número da chave de acesso das Notas Fiscais. Não é aplicável para as informações da ECF."),
-        ("URL", "Link para acessar o documento fiscal (apenas Notas Fiscais)."),
-        ("Tipo Documento", "Indica a fonte da informação. Podia variar entre Nfe (Nota Fiscal Eletrônica), NFCe (Nota Fiscal do Consumidor Eletrônica) ou ECF (Emissor de Cupom Fiscal)"),
-        ("Data de emissão", "Data de emissão do documento. (No caso de Cupom Fiscal, é a data da Redução Z)"),
-        ("Entrada ou saida", "Indica se a operação é de entrada ou saída de mercadorias."),
-        ("ECF-FAB", "Indica o número de série do Emissor de Cupom Fiscal (ECF). Não aplicável para operações com Notas Fiscais"),
-        ("GTIN", "Código GTIN da mercadoria."),
-        ("NCM", "Código NCM da mercadoria."),
-        ("No. Nota", "Número da Nota Fiscal. Não é aplicável para informações da ECF."),
-        ("No. Item", "Número do item dentro da Nota Fiscal. Não aplicável a Cupons."),
-        ("Origem do Produto", "Informação de Origem do Produto retirado da Nota Fiscal. Não aplicável a ECF (Cupons) - Indica se o produto é nacional ou estrangeiro."),
-        ("Ind Final e Tipo de Operação Final", "Informação de Ind Final retirado da Nota Fiscal. Não aplicável a ECF (Cupons). Indica se o destinatário receberá o produto para revenda/industrialização ou consumo final."),
-        ("TTD 409/410/411", "Indica se o TTD 409, 410 ou 411 estava ativo para o contribuinte no respectivo período da Nota Fiscal. (Aplicável somente para Nfe)"),
-        ("Código do produto", "Código do produto declarado pelo contribuinte para a operação. Válido apenas para Cupons Fiscais"),
-        ("Cód. Tot. Par", "Código totalizador. Informação presenta apenas nas operações ECF."),
-        ("Alíquota Destacada", "Alíquota de ICMS destacada no documento fiscal pelo contribuinte"),
-        ("ICMS Destacado", "ICMS destacado no documento fiscal pelo contribuinte"),
-        ("Valor da operação", "Valor da Base de Cálculo calculada pelo fisco, sem considerar reduções da base de cálculo. As reduções da BC serão aplicadas na alíquota efetiva correta. Para as notas fiscais (NF-e e NFC-e inclui frete, seguro, despesas adicionais , descontado os descontos concedidos). Para os Cupons leva-se em conta apenas o valor declarado na EFD que é o valor efetivo da operação."),
-        ("Alíquota Efetiva Correta (FISCO)", "Alíquota de ICMS considerada pelo fisco para a operação. Aqui considerando eventuais reduções da Base de Cálculo. Para os Cupons fiscais é a alíquota retirada do COD TOT PAR."),
-        ("Alíquota Efetiva destacada pelo Contribuinte", "Alíquota efetiva destacada pelo Contribuinte, que é calculada dividindo o ICMS destacado pelo Valor da Operação sem considerar redução da base de cálculo"),
-        ("ICMS devido", "Valor do ICMS considerado como correto pelo fisco."),
-        ("ICMS não-recolhido", "Valor do ICMS a ser recolhido como diferença pelo contribuinte. Trata-se da dedução do valor de 'ICMS devido' pelo valor do campo 'ICMS destacado'")
+    Erros não são silenciados (quem chama mostra o aviso).
+    """
+    # Mesmas colunas de build_export_df: as queries completas trazem icms_destacado (nulo = 0)
+    destacado = 'icms_destacado' if uses_full_queries(grupo) else 'icms_emitente'
+    tipo_doc = "COALESCE(UPPER(CAST(tipo_doc AS STRING)), '')"
+    filtros = [
+        f"""ROUND(ROUND(COALESCE(CAST(bc_fisco AS DOUBLE), 0) * (COALESCE(CAST(aliquota_ia AS DOUBLE), 0) / 100), 2)
+                 - COALESCE(CAST({destacado} AS DOUBLE), 0), 2) > 0"""
     ]
+    if modelo_export == "NFe":
+        filtros.append(f"{tipo_doc} LIKE '%NFE%' AND {tipo_doc} NOT LIKE '%NFCE%'")
+    elif modelo_export == "Notas de Consumo":
+        filtros.append(f"({tipo_doc} LIKE '%NFCE%' OR {tipo_doc} LIKE '%ECF%' OR {tipo_doc} LIKE '%CUPOM%'"
+                       f" OR {tipo_doc} NOT LIKE '%NFE%')")
 
-    for row_idx, (campo, desc) in enumerate(indice_dados, 2):
-        ws_indice.cell(row=row_idx, column=1).value = campo
-        ws_indice.cell(row=row_idx, column=2).value = desc
-
-    ws_indice.column_dimensions['A'].width = 35
-    ws_indice.column_dimensions['B'].width = 100
+    def montar_query(sub_query):
+        return f"SELECT COUNT(*) AS linhas FROM ({sub_query}) t WHERE {' AND '.join(filtros)}"
 
-    report_progress(30, "Criando aba J1 - Notas de Saídas")
-
-    # =========================================================================
-    # ABA 3: ANEXO J1 - NOTAS DE SAÍDAS (dados detalhados) - TERCEIRA ABA
-    # =========================================================================
-    ws_j1 = wb.create_sheet("ANEXO J1 - NOTAS DE SAÍDAS")
-
-    # Título J1
-    titulo_j1 = "ANEXO J1"
-    if parte_atual is not None and total_partes is not None:
-        titulo_j1 = f"ANEXO J1 - Parte {parte_atual} de {total_partes}"
-    ws_j1['A1'] = titulo_j1
-    ws_j1['A1'].font = title_font
-
-    # Define headers e mapeamento baseado na estrutura
-    if usar_estrutura_estendida:
-        # Headers estendidos para estrutura padronizada
-        ws_j1['D2'] = "INFORMAÇÕES RETIRADAS DOS DOCUMENTOS FISCAIS (Cupons Fiscais ou NFC-e)"
-        ws_j1['D2'].font = subtitle_font
-        ws_j1['AL2'] = "INFORMAÇÕES DECLARADAS PELO FISCO"
-        ws_j1['AL2'].font = Font(bold=True, size=11, color="C62828")
-
-        headers_j1 = [
-            "Data de emissão",       # A (1)
-            "Período",               # B (2)
-            "Tipo Documento",        # C (3)
-            "Chave de acesso",       # D (4)
-            "Link de Acesso",        # E (5)
-            "ECF-FAB",               # F (6)
-            "Entrada ou saída",      # G (7)
-            "IE Emitente",           # H (8)
-            "CNPJ Emitente",         # I (9)
-            "Razão do Emitente",     # J (10)
-            "IE Destinatário",       # K (11)
-            "CNPJ Destinatário",     # L (12)
-            "CPF Destinatário",      # M (13)
-            "Razão do Destinatário", # N (14)
-            "Estado do Destinatário",# O (15)
-            "UF Entrega",            # P (16)
-            "Regime do Destinatário",# Q (17)
-            "CNAE do Destinatário",  # R (18)
-            "Número da Nota",        # S (19)
-            "Número do Item",        # T (20)
-            "Origem do Produto",     # U (21)
-            "Ind Final",             # V (22)
-            "Tipo de Operação Final",# W (23)
-            "TTD 409/410/411",       # X (24)
-            "GTIN",                  # Y (25)
-            "NCM",                   # Z (26)
-            "CST",                   # AA (27)
-            "Descrição do produto",  # AB (28)
-            "CFOP",                  # AC (29)
-            "Código do Produto",     # AD (30)
-            "Valor Total",           # AE (31)
-            "Valor do Frete",        # AF (32)
-            "Valor do Seguro",       # AG (33)
-            "Valor de Outras Despesas",# AH (34)
-            "Valor do Desconto",     # AI (35)
-            "Cod. Tot. Par",         # AJ (36)
-            "Alíquota Destacada",    # AK (37)
-            "ICMS Destacado",        # AL (38)
-            # FISCO
-            "Valor da Operação",     # AM (39)
-            "Alíquota Efetiva Correta (FISCO)",  # AN (40)
-            "Legislação Aplicável",  # AO (41)
-            "Alíquota Efetiva destacada pelo Contribuinte",  # AP (42)
-            "ICMS devido",           # AQ (43)
-            "ICMS não-recolhido"     # AR (44)
-        ]
-
-        col_fisco_inicio = 39  # Coluna AM
-        total_colunas = 44
-
-        column_mapping = {
-            'data_emissao': 1,
-            'periodo': 2,
-            'tipo_doc': 3,
-            'chave': 4,
-            'modelo_ecf': 6,
-            'entrada_ou_saida': 7,
-            'ie_emitente': 8,
-            'cnpj_emitente': 9,
-            'razao_emitente': 10,
-            'ie_destinatario': 11,
-            'cnpj_destinatario': 12,
-            'cpf_destinatario': 13,
-            'razao_destinatario': 14,
-            'estado_destinatario': 15,
-            'uf_entrega': 16,
-            'regime_destinatario': 17,
-            'cnae_destinatario': 18,
-            'numero_nota': 19,
-            'numero_item': 20,
-            'origem_prod': 21,
-            'ind_final': 22,
-            'ttd_importacao': 24,
-            'gtin': 25,
-            'ncm': 26,
-            'cst': 27,
-            'descricao': 28,
-            'cfop': 29,
-            'cod_prod': 30,
-            'valor_total': 31,
-            'valor_do_frete': 32,
-            'valor_do_seguro': 33,
-            'valor_outras_despesas': 34,
-            'valor_do_desconto': 35,
-            'cod_tot_par': 36,
-            'aliquota_emitente': 37,
-            'icms_emitente': 38,
-            'bc_fisco': 39,
-            'aliquota_ia_icms': 40,
-            'legislacao_ia_icms': 41,
-        }
-
-        # Colunas de fórmulas
-        col_link = 5
-        col_aliq_efetiva = 42
-        col_icms_devido = 43
-        col_icms_nao_recolhido = 44
-        col_bc_fisco = 39
-        col_aliq_correta = 40
-        col_icms_destacado = 38
-
-    else:
-        # Headers padrão (estrutura simples)
-        ws_j1['D2'] = "INFORMAÇÕES RETIRADAS DOS DOCUMENTOS FISCAIS (Cupons Fiscais ou NFC-e)"
-        ws_j1['D2'].font = subtitle_font
-        ws_j1['S2'] = "INFORMAÇÕES DECLARADAS PELO FISCO"
-        ws_j1['S2'].font = Font(bold=True, size=11, color="C62828")
-
-        headers_j1 = [
-            "Data de emissão",      # A
-            "Período",              # B
-            "Tipo Documento",       # C
-            "Chave de acesso",      # D
-            "Link de Acesso",       # E
-            "ECF-FAB",              # F
-            "Entrada ou saída",     # G
-            "CNPJ Emitente",        # H
-            "Razão do Emitente",    # I
-            "Número",               # J
-            "GTIN",                 # K
-            "NCM",                  # L
-            "Item",                 # M
-            "Descrição do produto", # N
-            "CFOP",                 # O
-            "ICMS destacado",       # P
-            "Código do Produto",    # Q
-            "Cód. Tot. Par",        # R
-            "Legislação",           # S (FISCO)
-            "Valor da Operação",    # T (FISCO)
-            "Alíquota ICMS correta",# U (FISCO)
-            "Alíquota ICMS efetiva",# V (FISCO)
-            "ICMS devido",          # W (FISCO)
-            "ICMS não-recolhido"    # X (FISCO)
-        ]
+    tabelas = get_grupo_tabelas(grupo)
+    linhas = 0
+    # Com IDENT_REPETIR_COM_REGEXP, repete com regexp se as variantes não acharem nada (ver modos_busca_identificador)
+    for modo in modos_busca_identificador():
+        queries = _montar_queries_base(identificador_digits, nivel, grupo, projecao="completa", modo_ident=modo)
+        partes = {tabelas[tipo]: query for tipo, query in queries.items()}
+        if not partes:
+            return 0
+        df = ler_agregado_por_tabela(_engine, partes, montar_query, [], 'contagem exportação')
+        linhas = int(pd.to_numeric(df['linhas'], errors='coerce').fillna(0).sum()) if not df.empty else 0
+        if linhas:
+            break
+    return linhas
 
-        col_fisco_inicio = 19
-        total_colunas = 24
-
-        column_mapping = {
-            'data_emissao': 1,
-            'periodo': 2,
-            'tipo_doc': 3,
-            'chave': 4,
-            'modelo_ecf': 6,
-            'entrada_ou_saida': 7,
-            'cnpj_emitente': 8,
-            'razao_emitente': 9,
-            'numero_nota': 10,
-            'gtin': 11,
-            'ncm': 12,
-            'numero_item': 13,
-            'descricao': 14,
-            'cfop': 15,
-            'icms_emitente': 16,
-            'cod_prod': 17,
-            'cod_tot_par': 18,
-            'legislacao_ia_icms': 19,
-            'bc_fisco': 20,
-            'aliquota_ia_icms': 21,
-        }
+# =============================================================================
+# 6. FUNÇÕES DE EXPORTAÇÃO
+# =============================================================================
+# Anexo J em Excel: argos.excel; CSV em lotes: argos.lotes; pasta de rede: argos.rede
 
-        col_link = 5
-        col_aliq_efetiva = 22
-        col_icms_devido = 23
-        col_icms_nao_recolhido = 24
-        col_bc_fisco = 20
-        col_aliq_correta = 21
-        col_icms_destacado = 16
-
-    # Cabeçalhos da aba J1
-    for col_idx, header in enumerate(headers_j1, 1):
-        cell = ws_j1.cell(row=3, column=col_idx)
-        cell.value = header
-        cell.font = header_font
-        cell.fill = header_fill_fisco if col_idx >= col_fisco_inicio else header_fill
-        cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-        cell.border = thin_border
-
-    ws_j1.row_dimensions[3].height = 30
-
-    report_progress(40, "Preenchendo dados da aba J1")
-
-    # Preenche os dados
-    total_rows = len(df)
-    progress_interval = max(1, total_rows // 20)
-
-    for row_idx, row_data in enumerate(df.itertuples(index=False), 4):
-        atual_row = row_idx - 4
-        if atual_row % progress_interval == 0:
-            pct = 40 + int((atual_row / total_rows) * 40)
-            report_progress(pct, f"Processando linha {atual_row:,} de {total_rows:,}")
-
-        row_dict = row_data._asdict()
-
-        for col_name, col_idx in column_mapping.items():
-            if col_name in row_dict:
-                cell = ws_j1.cell(row=row_idx, column=col_idx)
-                value = row_dict[col_name]
-
-                if col_name in ['data_emissao', 'periodo'] and pd.notna(value):
-                    try:
-                        if isinstance(value, str):
-                            cell.value = pd.to_datetime(value, dayfirst=True).date()
-                        else:
-                            cell.value = value
-                        cell.number_format = 'DD/MM/YYYY'
-                    except:
-                        cell.value = value
-                elif col_name in ['icms_emitente', 'bc_fisco', 'valor_total', 'valor_do_frete',
-                                  'valor_do_seguro', 'valor_outras_despesas', 'valor_do_desconto'] and pd.notna(value):
-                    try:
-                        cell.value = float(value)
-                        cell.number_format = '#,##0.00'
-                    except:
-                        cell.value = value
-                elif col_name in ['aliquota_ia_icms', 'aliquota_emitente'] and pd.notna(value):
-                    try:
-                        cell.value = float(value) / 100
-                        cell.number_format = '0.00%'
-                    except:
-                        cell.value = value
-                else:
-                    cell.value = value if pd.notna(value) else ''
-
-                cell.border = thin_border
-
-        # Fórmula Link de Acesso
-        cell_link = ws_j1.cell(row=row_idx, column=col_link)
-        cell_link.value = f'=IF({get_column_letter(4)}{row_idx}<>"",HYPERLINK("https://sat.sef.sc.gov.br/tax.NET/Sat.NFe.Web/Consultas/Nfe_ResumoPDF.ashx?id="&{get_column_letter(4)}{row_idx},"Abrir DANFE"),"")'
-        cell_link.border = thin_border
-
-        # Fórmula Alíquota ICMS efetiva
-        cell_aliq = ws_j1.cell(row=row_idx, column=col_aliq_efetiva)
-        cell_aliq.value = f"=IF({get_column_letter(col_bc_fisco)}{row_idx}=0,0,{get_column_letter(col_icms_destacado)}{row_idx}/{get_column_letter(col_bc_fisco)}{row_idx})"
-        cell_aliq.number_format = '0.00%'
-        cell_aliq.border = thin_border
-
-        # Fórmula ICMS devido
-        cell_devido = ws_j1.cell(row=row_idx, column=col_icms_devido)
-        cell_devido.value = f"=ROUND({get_column_letter(col_bc_fisco)}{row_idx}*{get_column_letter(col_aliq_correta)}{row_idx},2)"
-        cell_devido.number_format = '#,##0.00'
-        cell_devido.border = thin_border
-
-        # Fórmula ICMS não-recolhido
-        cell_nao_rec = ws_j1.cell(row=row_idx, column=col_icms_nao_recolhido)
-        cell_nao_rec.value = f"=MAX(0,ROUND({get_column_letter(col_icms_devido)}{row_idx}-{get_column_letter(col_icms_destacado)}{row_idx},2))"
-        cell_nao_rec.number_format = '#,##0.00'
-        cell_nao_rec.border = thin_border
-
-    # Autoajuste de largura J1
-    for col_idx in range(1, total_colunas + 1):
-        col_letter = get_column_letter(col_idx)
-        ws_j1.column_dimensions[col_letter].width = 15
-
-    ws_j1.freeze_panes = 'A4'
-    ultima_linha = 3 + len(df)
-    ws_j1.auto_filter.ref = f"A3:{get_column_letter(total_colunas)}{ultima_linha}"
-
-    report_progress(90, "Configurando recálculo automático")
-    
-    # =========================================================================
-    # FORÇA RECÁLCULO DE FÓRMULAS AO ABRIR O ARQUIVO
-    # =========================================================================
-    # Isso resolve o problema de fórmulas que aparecem em branco até o usuário
-    # clicar na célula e pressionar Enter
-    wb.calculation = CalcProperties(
-        fullCalcOnLoad=True,  # Recálculo completo ao carregar
-        calcMode='auto'       # Modo de cálculo automático
-    )
-    
-    report_progress(95, "Salvando arquivo Excel")
-    
-    # Salva
-    wb.save(buffer)
-    buffer.seek(0)
-    
-    report_progress(100, "Concluído!")
-    
-    return buffer.getvalue()
+# =============================================================================
+# 6.1. EXPORTAÇÕES EM SEGUNDO PLANO (PAINEL DOS JOBS)
+# =============================================================================
+# Fila de jobs e cache de exportações (Excel em disco): argos.exportacao
+
+def _notificar_jobs_sessao(jobs: list):
+    """Toast (uma vez por sessão) para os jobs desta sessão que terminaram."""
+    da_sessao = set(st.session_state.get('export_jobs_sessao', []))
+    notificados = st.session_state.setdefault('export_jobs_notificados', set())
+    for job in jobs:
+        if job['id'] not in da_sessao or job['id'] in notificados or job['status'] in EXPORT_JOB_ATIVOS:
+            continue
+        notificados.add(job['id'])
+        if job['status'] == "concluido":
+            st.toast(f"✅ Exportação concluída: {job['descricao']}", icon="📊")
+        elif job['status'] == "erro":
+            st.toast(f"❌ Exportação com erro: {job['descricao']}")
+
+
+def _exibir_jobs_exportacao(chave: str):
+    jobs = get_jobs_exportacao(chave)
+    _notificar_jobs_sessao(jobs)
+    if not jobs:
+        return
 
-def export_to_excel_or_zip(df: pd.DataFrame, contrib_info: dict, nivel: str, progress_callback=None, grupo: str = None) -> tuple:
-    """
-    Exporta DataFrame para Excel ou ZIP (se mais de 1 milhão de linhas).
+    st.markdown("**📋 Exportações em segundo plano**")
+    for job in jobs:
+        destino = "💾 Rede" if job['destino'] == "rede" else "📥 Download"
+        if job['status'] in EXPORT_JOB_ATIVOS:
+            decorrido = int(time.time() - (job['inicio'] or job['criado']))
+            col1, col2 = st.columns([5, 1])
+            with col1:
+                st.progress(job['progresso'],
+                            text=f"{destino} · {job['mensagem']} ({int(job['progresso'] * 100)}% · {decorrido}s)")
+            with col2:
+                if st.button("✖ Cancelar", key=f"cancelar_job_{job['id']}", use_container_width=True):
+                    cancelar_job_exportacao(job['id'])
+                    st.rerun()
+        elif job['status'] == "concluido":
+            duracao = int((job['fim'] or 0) - (job['inicio'] or job['criado']))
+            if job['destino'] == "rede":
+                st.success(f"✅ {destino} · Salvo na rede em {duracao}s: {job['descricao']}")
+                for fp in job['arquivos_rede']:
+                    st.code(fp)
+            elif job['arquivo'] and os.path.exists(job['arquivo']):
+                tamanho_mb = os.path.getsize(job['arquivo']) / (1024 * 1024)
+                st.success(f"✅ {destino} · Pronto em {duracao}s: **{tamanho_mb:.1f} MB**")
+                with open(job['arquivo'], 'rb') as arquivo:
+                    st.download_button(
+                        "📥 Baixar ZIP" if job['is_zip'] else "📥 Baixar Excel",
+                        arquivo,
+                        file_name=job['nome_arquivo'],
+                        mime="application/zip" if job['is_zip'] else "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        use_container_width=True,
+                        type="primary",
+                        key=f"baixar_job_{job['id']}",
+                        help="Clique e aguarde o navegador iniciar o download"
+                    )
+        elif job['status'] == "cancelado":
+            st.caption(f"⏹️ {destino} · {job['descricao']}: {job['mensagem']}")
+        else:
+            st.error(job['erro'] or "Erro na exportação")
 
-    Args:
-        df: DataFrame com os dados
-        contrib_info: Informações do contribuinte
-        nivel: Nível de acurácia
-        progress_callback: Função callback(current, total, message) para atualizar progresso
-        grupo: Grupo de operação para determinar estrutura de colunas
 
-    Returns:
-        tuple: (bytes_data, filename, is_zip)
-            - bytes_data: conteúdo do arquivo
-            - filename: nome do arquivo sugerido
-            - is_zip: True se for ZIP, False se for Excel único
+def render_jobs_exportacao(chave: str):
     """
-    total_rows = len(df)
-
-    # Se cabe em um único arquivo Excel
-    if total_rows <= MAX_ROWS_PER_EXCEL:
-        if progress_callback:
-            progress_callback(0, 1, "Gerando arquivo Excel...")
-        excel_data = export_to_excel_template(df, contrib_info, nivel, grupo=grupo)
-        if progress_callback:
-            progress_callback(1, 1, "Arquivo Excel gerado!")
-        filename = get_export_filename(contrib_info, nivel, "xlsx")
-        return excel_data, filename, False
-
-    # Precisa dividir em múltiplas partes
-    total_partes = math.ceil(total_rows / MAX_ROWS_PER_EXCEL)
-
-    # Cria buffer para o ZIP
-    zip_buffer = BytesIO()
-
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for parte in range(1, total_partes + 1):
-            if progress_callback:
-                progress_callback(parte - 1, total_partes, f"Gerando parte {parte} de {total_partes}...")
-
-            # Calcula índices de início e fim
-            start_idx = (parte - 1) * MAX_ROWS_PER_EXCEL
-            end_idx = min(parte * MAX_ROWS_PER_EXCEL, total_rows)
-
-            # Extrai a parte do DataFrame
-            df_parte = df.iloc[start_idx:end_idx].copy()
-
-            # Gera o Excel para esta parte
-            excel_data = export_to_excel_template(
-                df_parte,
-                contrib_info,
-                nivel,
-                parte_atual=parte,
-                total_partes=total_partes,
-                grupo=grupo
-            )
-            
-            # Nome do arquivo da parte
-            base_filename = get_export_filename(contrib_info, nivel, "xlsx")
-            parte_filename = base_filename.replace(".xlsx", f" - Parte {parte} de {total_partes}.xlsx")
-            
-            # Adiciona ao ZIP
-            zip_file.writestr(parte_filename, excel_data)
-            
-            if progress_callback:
-                progress_callback(parte, total_partes, f"Parte {parte} de {total_partes} concluída!")
-    
-    zip_buffer.seek(0)
-    
-    # Nome do arquivo ZIP
-    zip_filename = get_export_filename(contrib_info, nivel, "zip")
-    
-    return zip_buffer.getvalue(), zip_filename, True
+    Painel dos jobs de exportação de uma empresa/nível: progresso, cancelamento e download.
 
-def get_export_filename(contrib_info: dict, nivel: str, extension: str) -> str:
-    """
-    Gera o nome do arquivo no formato: CNPJ_14_DIGITOS - RAZAO_SOCIAL.extensao
-    Sanitiza caracteres que podem causar erros em caminhos de rede Windows/DFS.
-    """
-    if contrib_info:
-        cnpj = sanitize_identificador(contrib_info.get('cnpj', ''))
-        razao = contrib_info.get('razao_social', 'EMPRESA')
-        # Limpa caracteres proibidos no Windows: < > : " / \ | ? *
-        razao_clean = re.sub(r'[<>:"/\\|?*]', '', razao)
-        # Remove pontos no final (causam erro em DFS)
-        razao_clean = razao_clean.rstrip('.')
-        # Remove espaços extras
-        razao_clean = re.sub(r'\s+', ' ', razao_clean).strip()
-        # Limita a 50 chars
-        razao_clean = razao_clean[:50].rstrip('.')
-        # Se ficou vazio, usa fallback
-        if not razao_clean:
-            razao_clean = 'EMPRESA'
-        return f"{cnpj} - {razao_clean}.{extension}"
-    return f"infracoes_gessuper_{nivel.lower()}.{extension}"
-
-def get_folder_link(path: str) -> str:
+    Com jobs em andamento, o painel se atualiza sozinho a cada `atualizacao_segundos`
+    (st.fragment, sem rerun da página inteira); em versões do Streamlit sem fragment,
+    há um botão para atualizar.
     """
-    Gera um link para copiar o caminho da pasta.
-    """
-    return path
+    fragment = getattr(st, "fragment", None)
+    em_andamento = any(job['status'] in EXPORT_JOB_ATIVOS for job in get_jobs_exportacao(chave))
+
+    if fragment is not None:
+        @fragment(run_every=EXPORT_JOBS_CONFIG['atualizacao_segundos'] if em_andamento else None)
+        def painel():
+            _exibir_jobs_exportacao(chave)
+            # Ao terminar o último job, um rerun da página para de agendar atualizações
+            if em_andamento and not any(job['status'] in EXPORT_JOB_ATIVOS for job in get_jobs_exportacao(chave)):
+                st.rerun()
+        painel()
+    else:
+        _exibir_jobs_exportacao(chave)
+        if em_andamento and st.button("🔄 Atualizar", key=f"atualizar_jobs_{chave}"):
+            st.rerun()
 
 
-def _smb_write_with_retry(filepath: str, data: bytes, max_retries: int = 2) -> None:
-    """
-    Salva arquivo via SMB com retry automático.
-    Se detectar erro de DFS/conexão, reseta o cache e tenta novamente.
+# =============================================================================
+# 7. ANÁLISES EXPLORATÓRIAS
+# =============================================================================
 
-    Args:
-        filepath: Caminho completo do arquivo na rede
-        data: Dados binários para salvar
-        max_retries: Número máximo de tentativas (padrão: 2)
+def _completar_periodo_analise(df_periodo: pd.DataFrame) -> pd.DataFrame:
+    """Período no formato dos gráficos: [Período, Valor, Qtd, ordem (AAAA-MM), Mes]."""
+    df_periodo = df_periodo.rename(columns={'Itens': 'Qtd'})
+    df_periodo['ordem'] = df_periodo['Período'].apply(
+        lambda x: f"{x[3:7]}-{x[0:2]}" if len(str(x)) >= 7 else x
+    )
+    df_periodo['Mes'] = df_periodo['Período'].apply(
+        lambda x: x[0:2] if len(str(x)) >= 2 else '00'
+    )
+    return df_periodo
 
-    Raises:
-        Exception: Se todas as tentativas falharem
+def agregar_analise(dados, col_infracao: str = 'infracao_ia', top_n: int = 10) -> dict:
     """
-    last_error = None
-
-    for attempt in range(max_retries):
-        try:
-            with smbclient.open_file(filepath, mode="wb") as f:
-                f.write(data)
-            return  # Sucesso!
-        except Exception as e:
-            last_error = e
-            error_msg = str(e)
-
-            # Se for erro de DFS/conexão e ainda temos tentativas, reseta e tenta novamente
-            is_dfs_error = "0xc000035c" in error_msg or "STATUS_UNKNOWN" in error_msg
-            is_connection_error = "connection" in error_msg.lower() or "reset" in error_msg.lower()
-
-            if (is_dfs_error or is_connection_error) and attempt < max_retries - 1:
-                try:
-                    # Reseta cache de conexões SMB
-                    smbclient.reset_connection_cache()
-                    import time
-                    time.sleep(1)  # Pequena pausa antes de tentar novamente
-                except:
-                    pass
-                continue
-            else:
-                # Erro não recuperável ou última tentativa
-                raise
-
-    # Se chegou aqui, todas as tentativas falharam
-    if last_error:
-        raise last_error
+    Calcula as agregações da aba Análise em uma única passada, lote a lote.
 
-def save_to_network_fast(df: pd.DataFrame, contrib_info: dict, nivel: str, progress_callback=None, grupo: str = None) -> tuple:
-    """
-    Salva os arquivos Excel diretamente na rede usando smbclient.
-    Usa a função export_to_excel_template para manter a estrutura do Anexo J.
+    Cada lote gera parciais (soma e contagem por chave) que são somadas no final,
+    então o resultado é o mesmo do groupby no DataFrame inteiro. Da base completa,
+    só a coluna de valores é mantida (para mediana e percentis).
 
     Args:
-        df: DataFrame com os dados
-        contrib_info: Informações do contribuinte
-        nivel: Nível de acurácia
-        progress_callback: Função callback para progresso
-        grupo: Grupo de operação para determinar estrutura de colunas
+        dados: DataFrame, função ou iterável de lotes (ver iter_df_chunks)
+        col_infracao: Coluna com o valor da infração
+        top_n: Quantidade de NCMs, CFOPs e produtos retornados
 
     Returns:
-        tuple: (success, message, file_paths, folder_path)
+        dict com:
+            - periodo: DataFrame [Período, Valor, Qtd, ordem, Mes]
+            - ncm: DataFrame [NCM, Valor, Itens] (top_n por valor)
+            - cfop: DataFrame [CFOP, Valor, Itens] (top_n por valor)
+            - produto: DataFrame [Descrição, Valor, Itens] (top_n por valor)
+            - stats: Series do describe() dos valores, ou None se não há valor > 0
+            - linhas: total de linhas processadas
     """
-    if not SMB_AVAILABLE:
-        return False, "Biblioteca smbclient não disponível. Instale com: pip install smbprotocol", [], REDE_PATH
-
-    total_rows = len(df)
-    file_paths = []
-
-    try:
-        # Se cabe em um único arquivo
-        if total_rows <= MAX_ROWS_PER_EXCEL:
-            if progress_callback:
-                progress_callback(0, 1, "Gerando arquivo Excel com template Anexo J...")
-
-            # Callback interno para repassar progresso
-            def internal_progress(pct, msg):
-                if progress_callback:
-                    # Converte pct (0-100) para (current, total, msg)
-                    progress_callback(pct / 100 * 0.8, 1, msg)  # 0-80% para geração
-
-            # Usa export_to_excel_template para manter a estrutura correta
-            excel_data = export_to_excel_template(df, contrib_info, nivel, progress_callback=internal_progress, grupo=grupo)
-            
-            filename = get_export_filename(contrib_info, nivel, "xlsx")
-            filepath = f"{REDE_PATH}\\{filename}"
-            
-            if progress_callback:
-                progress_callback(0.85, 1, "Salvando na rede...")
-
-            # Salva na rede com retry automático (reseta cache SMB se erro DFS)
-            _smb_write_with_retry(filepath, excel_data)
-
-            file_paths.append(filepath)
-            
-            if progress_callback:
-                progress_callback(1, 1, "Arquivo salvo!")
-            
-            return True, f"Arquivo salvo com sucesso!", file_paths, REDE_PATH
-        
-        # Precisa dividir em múltiplas partes
-        total_partes = math.ceil(total_rows / MAX_ROWS_PER_EXCEL)
-        
-        for parte in range(1, total_partes + 1):
-            if progress_callback:
-                progress_callback(parte - 1, total_partes, f"Gerando parte {parte} de {total_partes}...")
-            
-            # Calcula índices
-            start_idx = (parte - 1) * MAX_ROWS_PER_EXCEL
-            end_idx = min(parte * MAX_ROWS_PER_EXCEL, total_rows)
-            
-            # Extrai a parte
-            df_parte = df.iloc[start_idx:end_idx].copy()
-            
-            # Callback interno para cada parte
-            def internal_progress_parte(pct, msg):
-                if progress_callback:
-                    base_progress = (parte - 1) / total_partes
-                    part_progress = pct / 100 / total_partes * 0.9  # 90% para geração
-                    progress_callback(base_progress + part_progress, 1, f"Parte {parte}: {msg}")
-            
-            # Usa export_to_excel_template para manter a estrutura correta
-            excel_data = export_to_excel_template(
-                df_parte, contrib_info, nivel,
-                parte_atual=parte, total_partes=total_partes,
-                progress_callback=internal_progress_parte, grupo=grupo
-            )
-            
-            # Nome e caminho do arquivo
-            base_filename = get_export_filename(contrib_info, nivel, "xlsx")
-            parte_filename = base_filename.replace(".xlsx", f" - Parte {parte} de {total_partes}.xlsx")
-            filepath = f"{REDE_PATH}\\{parte_filename}"
-
-            # Salva na rede com retry automático (reseta cache SMB se erro DFS)
-            _smb_write_with_retry(filepath, excel_data)
-
-            file_paths.append(filepath)
-            
-            # Libera memória
-            del excel_data
-            del df_parte
-            
-            if progress_callback:
-                progress_callback(parte, total_partes, f"Parte {parte} de {total_partes} salva!")
-        
-        return True, f"{total_partes} arquivos salvos com sucesso!", file_paths, REDE_PATH
-
-    except Exception as e:
-        error_msg = str(e)
-        # Captura o caminho que falhou para diagnóstico
-        filepath_info = file_paths[-1] if file_paths else "N/A"
+    chaves = {'periodo': 'Período', 'ncm': 'NCM', 'cfop': 'CFOP', 'descricao': 'Descrição'}
+    parciais = {col: [] for col in chaves}
+    valores_lotes = []
+    linhas = 0
+
+    for chunk in iter_df_chunks(dados):
+        if col_infracao not in chunk.columns:
+            continue
+        linhas += len(chunk)
+        valor = coluna_numerica(chunk[col_infracao])
+        valores_lotes.append(valor.to_numpy(dtype='float64'))
+
+        for col in chaves:
+            if col in chunk.columns:
+                parciais[col].append(valor.groupby(chunk[col], observed=True).agg(['sum', 'count']))
+
+    resultado = {'linhas': linhas}
+
+    # Soma as parciais de cada lote
+    agregados = {}
+    for col, nome in chaves.items():
+        if parciais[col]:
+            # Lotes podem ter categorias diferentes; a chave volta a ser texto/valor simples
+            df_agg = pd.concat(parciais[col]).groupby(level=0, observed=True).sum().reset_index()
+            df_agg.columns = [nome, 'Valor', 'Itens']
+            df_agg[nome] = df_agg[nome].astype(object)
+        else:
+            df_agg = pd.DataFrame(columns=[nome, 'Valor', 'Itens'])
+        agregados[col] = df_agg
+
+    resultado['periodo'] = _completar_periodo_analise(agregados['periodo'])
+    resultado['ncm'] = agregados['ncm'].nlargest(top_n, 'Valor')
+    resultado['cfop'] = agregados['cfop'].nlargest(top_n, 'Valor')
+    resultado['produto'] = agregados['descricao'].nlargest(top_n, 'Valor').reset_index(drop=True)
+
+    # Estatísticas descritivas (mesmo describe() de antes, sobre os valores concatenados)
+    if valores_lotes:
+        valores = pd.Series(np.concatenate(valores_lotes))
+        resultado['stats'] = valores.describe() if valores.sum() > 0 else None
+    else:
+        resultado['stats'] = None
 
-        # Detecta erro de autenticação Kerberos expirada
-        if "Ticket expired" in error_msg or "SpnegoError" in error_msg or "authenticate" in error_msg.lower():
-            return False, "🔐 **Sessão de rede expirada!** Faça logout/login no Windows ou acesse qualquer pasta de rede no Explorer para renovar.", file_paths, REDE_PATH
+    return resultado
 
-        # Detecta erros de DFS/rede específicos
-        if "0xc000035c" in error_msg or "STATUS_UNKNOWN" in error_msg:
-            return False, f"❌ **Erro de rede DFS!** Possíveis causas:\n\n1. 🔐 Sessão expirada - tente acessar `{REDE_PATH}` no Explorer primeiro\n2. 📁 Pasta de destino indisponível\n3. 🔄 Reinicie o Streamlit\n\n**Detalhes:** {error_msg[:200]}", file_paths, REDE_PATH
+def quantis_histograma(faixas: pd.DataFrame, quantis: list, minimo: float = None, maximo: float = None) -> dict:
+    """
+    Estima quantis a partir do histograma logarítmico de valores (faixas de HISTOGRAMA_BASE).
 
-        # Erro genérico com mais informações
-        return False, f"Erro ao salvar: {error_msg}\n\n**Caminho:** {filepath_info}", file_paths, REDE_PATH
+    Args:
+        faixas: DataFrame [faixa, itens]; faixa k cobre valores em [base^k, base^(k+1)),
+                faixa None reúne os valores <= 0
+        quantis: lista de quantis entre 0 e 1 (ex.: [0.25, 0.5, 0.75])
+        minimo, maximo: limites exatos dos valores, usados para não extrapolar
 
-def save_csv_to_network(df: pd.DataFrame, contrib_info: dict, nivel: str) -> tuple:
-    """
-    Salva CSV diretamente na rede usando smbclient.
-    Formato brasileiro: separador (;), decimal (,), encoding latin-1
-    
     Returns:
-        tuple: (success, message, filepath, folder_path)
+        dict {quantil: valor estimado}
     """
-    if not SMB_AVAILABLE:
-        return False, "Biblioteca smbclient não disponível. Instale com: pip install smbprotocol", None, REDE_PATH
-    
-    try:
-        filename = get_export_filename(contrib_info, nivel, "csv")
-        filepath = f"{REDE_PATH}\\{filename}"
-        
-        # Gera CSV em memória no formato brasileiro
-        csv_str = df.to_csv(index=False, sep=";", decimal=",")
-        csv_bytes = csv_str.encode("latin-1", errors="replace")
-
-        # Salva na rede com retry automático (reseta cache SMB se erro DFS)
-        _smb_write_with_retry(filepath, csv_bytes)
-
-        return True, "CSV salvo com sucesso!", filepath, REDE_PATH
-
-    except Exception as e:
-        error_msg = str(e)
-        # Detecta erro de autenticação Kerberos expirada
-        if "Ticket expired" in error_msg or "SpnegoError" in error_msg or "authenticate" in error_msg.lower():
-            return False, "🔐 **Sessão de rede expirada!** Faça logout/login no Windows ou acesse qualquer pasta de rede no Explorer para renovar.", None, REDE_PATH
-
-        # Detecta erros de DFS/rede específicos
-        if "0xc000035c" in error_msg or "STATUS_UNKNOWN" in error_msg:
-            return False, f"❌ **Erro de rede DFS!** Possíveis causas:\n\n1. 🔐 Sessão expirada - tente acessar `{REDE_PATH}` no Explorer primeiro\n2. 📁 Pasta de destino indisponível\n3. 🔄 Reinicie o Streamlit\n\n**Caminho:** {filepath}\n**Detalhes:** {error_msg[:200]}", None, REDE_PATH
-
-        return False, f"Erro ao salvar CSV: {error_msg}\n\n**Caminho:** {filepath}", None, REDE_PATH
-
+    if faixas is None or faixas.empty:
+        return {q: float('nan') for q in quantis}
+
+    faixas = faixas.assign(
+        ordem=pd.to_numeric(faixas['faixa'], errors='coerce').fillna(-np.inf)
+    ).sort_values('ordem')
+    itens = faixas['itens'].to_numpy(dtype='float64')
+    acumulado = np.cumsum(itens)
+    total = acumulado[-1]
+    # Valor representativo: centro geométrico da faixa (0 para a faixa dos valores <= 0)
+    representantes = np.where(
+        np.isfinite(faixas['ordem']), HISTOGRAMA_BASE ** (faixas['ordem'] + 0.5), 0.0
+    )
 
-def diagnostico_rede() -> dict:
-    """
-    Executa diagnóstico completo de conexão com a rede.
-    Retorna dict com resultados de cada teste.
+    resultado = {}
+    for q in quantis:
+        # Mesma posição usada pelo pandas (interpolação linear sobre n-1)
+        posicao = q * (total - 1)
+        idx = min(int(np.searchsorted(acumulado, posicao, side='right')), len(acumulado) - 1)
+        valor = float(representantes[idx])
+        if minimo is not None:
+            valor = max(valor, float(minimo))
+        if maximo is not None:
+            valor = min(valor, float(maximo))
+        resultado[q] = valor
+    return resultado
+
+def get_agregados_consulta(_engine, identificador_digits: str, nivel: str, grupo: str, top_n: int = 10) -> dict:
     """
-    from datetime import datetime
-    import traceback
-
-    resultados = {
-        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        'smb_disponivel': SMB_AVAILABLE,
-        'rede_path': REDE_PATH,
-        'testes': []
-    }
-
-    if not SMB_AVAILABLE:
-        resultados['testes'].append({
-            'nome': 'Biblioteca SMB',
-            'status': 'ERRO',
-            'mensagem': 'smbclient não instalado. Execute: pip install smbprotocol',
-            'detalhes': None
-        })
-        return resultados
-
-    resultados['testes'].append({
-        'nome': 'Biblioteca SMB',
-        'status': 'OK',
-        'mensagem': 'smbprotocol disponível',
-        'detalhes': None
-    })
-
-    # Teste 1: Listar diretório
-    try:
-        arquivos = smbclient.listdir(REDE_PATH)
-        resultados['testes'].append({
-            'nome': 'Listar diretório',
-            'status': 'OK',
-            'mensagem': f'Diretório acessível ({len(arquivos)} itens)',
-            'detalhes': arquivos[:10] if len(arquivos) > 10 else arquivos
-        })
-    except Exception as e:
-        resultados['testes'].append({
-            'nome': 'Listar diretório',
-            'status': 'ERRO',
-            'mensagem': str(e)[:300],
-            'detalhes': traceback.format_exc()
-        })
-        # Se não conseguiu listar, não adianta continuar
-        return resultados
-
-    # Teste 2: Criar arquivo de teste
-    test_filename = f"_TESTE_CONEXAO_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-    test_filepath = f"{REDE_PATH}\\{test_filename}"
-    test_content = f"Teste de conexão realizado em {datetime.now()}\nUsuário: ARGOS\nSistema: GESSUPER"
-
-    try:
-        with smbclient.open_file(test_filepath, mode="w") as f:
-            f.write(test_content)
-        resultados['testes'].append({
-            'nome': 'Criar arquivo',
-            'status': 'OK',
-            'mensagem': f'Arquivo criado: {test_filename}',
-            'detalhes': test_filepath
-        })
-    except Exception as e:
-        resultados['testes'].append({
-            'nome': 'Criar arquivo',
-            'status': 'ERRO',
-            'mensagem': str(e)[:300],
-            'detalhes': traceback.format_exc()
-        })
-        return resultados
-
-    # Teste 3: Ler arquivo de teste
-    try:
-        with smbclient.open_file(test_filepath, mode="r") as f:
-            conteudo_lido = f.read()
-        if conteudo_lido == test_content:
-            resultados['testes'].append({
-                'nome': 'Ler arquivo',
-                'status': 'OK',
-                'mensagem': 'Conteúdo verificado corretamente',
-                'detalhes': None
-            })
-        else:
-            resultados['testes'].append({
-                'nome': 'Ler arquivo',
-                'status': 'AVISO',
-                'mensagem': 'Arquivo lido mas conteúdo difere',
-                'detalhes': conteudo_lido[:100]
-            })
-    except Exception as e:
-        resultados['testes'].append({
-            'nome': 'Ler arquivo',
-            'status': 'ERRO',
-            'mensagem': str(e)[:300],
-            'detalhes': traceback.format_exc()
-        })
-
-    # Teste 4: Deletar arquivo de teste
-    try:
-        smbclient.remove(test_filepath)
-        resultados['testes'].append({
-            'nome': 'Deletar arquivo',
-            'status': 'OK',
-            'mensagem': 'Arquivo de teste removido',
-            'detalhes': None
-        })
-    except Exception as e:
-        resultados['testes'].append({
-            'nome': 'Deletar arquivo',
-            'status': 'AVISO',
-            'mensagem': f'Não foi possível remover: {str(e)[:200]}',
-            'detalhes': f'Remova manualmente: {test_filepath}'
-        })
-
-    # Teste 5: Criar arquivo binário (simula Excel)
-    test_bin_filename = f"_TESTE_BINARIO_{datetime.now().strftime('%Y%m%d_%H%M%S')}.bin"
-    test_bin_filepath = f"{REDE_PATH}\\{test_bin_filename}"
-    test_bin_content = b"TESTE" * 1000  # 5KB de dados binários
+    Agregações das abas Resumo e Análise calculadas no Impala (ver _carregar_agregados_consulta).
 
+    Erros são lançados para quem chama voltar ao cálculo no pandas; tabela indisponível
+    também marca session_state.tabela_indisponivel, como em get_base_df.
+    """
     try:
-        with smbclient.open_file(test_bin_filepath, mode="wb") as f:
-            f.write(test_bin_content)
-        resultados['testes'].append({
-            'nome': 'Criar arquivo binário',
-            'status': 'OK',
-            'mensagem': f'Arquivo binário criado: {test_bin_filename} (5KB)',
-            'detalhes': test_bin_filepath
-        })
-
-        # Tenta deletar
-        try:
-            smbclient.remove(test_bin_filepath)
-        except:
-            pass
-
+        return _carregar_agregados_consulta(_engine, identificador_digits, nivel, grupo, top_n)
     except Exception as e:
-        resultados['testes'].append({
-            'nome': 'Criar arquivo binário',
-            'status': 'ERRO',
-            'mensagem': str(e)[:300],
-            'detalhes': traceback.format_exc()
-        })
-
-    return resultados
+        if is_table_unavailable_error(str(e)):
+            st.session_state.tabela_indisponivel = True
+        raise
 
 
-def save_to_network(df: pd.DataFrame, contrib_info: dict, nivel: str, progress_callback=None, grupo: str = None) -> tuple:
+@cache_compartilhado(ttl=CACHE_TTL_SECONDS, max_obsoleto=CONSULTA_MAX_OBSOLETO_SECONDS,
+                     max_entries=CONSULTA_CACHE_MAX_ENTRIES)
+def _carregar_agregados_consulta(_engine, identificador_digits: str, nivel: str, grupo: str,
+                                 top_n: int = 10) -> dict:
     """
-    Salva os arquivos Excel diretamente na rede, evitando consumo de memória.
+    Parte cacheada de get_agregados_consulta: agregações das abas Resumo e Análise
+    calculadas no Impala, sobre todo o histórico.
 
-    Args:
-        df: DataFrame com os dados
-        contrib_info: Informações do contribuinte
-        nivel: Nível de acurácia
-        progress_callback: Função callback para progresso
-        grupo: Grupo de operação para determinar estrutura de colunas
+    Uma única query (uma ida ao banco) que lê as tabelas uma vez só: cada linha da base é
+    repetida para as dimensões (CROSS JOIN com uma lista de 6 constantes, em memória) e um
+    único GROUP BY (dimensao, chave) calcula todas - equivalente a GROUPING SETS, que
+    exige Impala 4.1+. Os top N de NCM, CFOP e produto já vêm limitados do servidor
+    (ROW_NUMBER por dimensão). Mediana e percentis saem de um histograma logarítmico dos
+    valores (ver quantis_histograma).
+
+    Erros não são silenciados (o cache não guarda falhas): quem chama volta para o
+    cálculo no pandas com agregar_analise.
 
     Returns:
-        tuple: (success, message, file_paths)
+        dict no formato de agregar_analise (periodo, ncm, cfop, produto, stats, linhas)
     """
-    if not SMB_AVAILABLE:
-        return False, "Biblioteca smbclient não disponível", []
-
-    total_rows = len(df)
-    file_paths = []
-
-    try:
-        # Cria diretório se não existir
-        try:
-            smbclient.makedirs(REDE_PATH, exist_ok=True)
-        except:
-            pass  # Diretório pode já existir
-
-        # Se cabe em um único arquivo
-        if total_rows <= MAX_ROWS_PER_EXCEL:
-            if progress_callback:
-                progress_callback(0, 1, "Gerando arquivo Excel...")
-
-            excel_data = export_to_excel_template(df, contrib_info, nivel, grupo=grupo)
-            filename = get_export_filename(contrib_info, nivel, "xlsx")
-            filepath = f"{REDE_PATH}\\{filename}"
-            
-            with smbclient.open_file(filepath, mode="wb") as f:
-                f.write(excel_data)
-            
-            file_paths.append(filepath)
-            
-            if progress_callback:
-                progress_callback(1, 1, "Arquivo salvo na rede!")
-            
-            return True, f"Arquivo salvo com sucesso!", file_paths
-        
-        # Precisa dividir em múltiplas partes
-        total_partes = math.ceil(total_rows / MAX_ROWS_PER_EXCEL)
-        
-        for parte in range(1, total_partes + 1):
-            if progress_callback:
-                progress_callback(parte - 1, total_partes, f"Gerando e salvando parte {parte} de {total_partes}...")
-            
-            # Calcula índices
-            start_idx = (parte - 1) * MAX_ROWS_PER_EXCEL
-            end_idx = min(parte * MAX_ROWS_PER_EXCEL, total_rows)
-            
-            # Extrai a parte
-            df_parte = df.iloc[start_idx:end_idx].copy()
-            
-            # Gera o Excel
-            excel_data = export_to_excel_template(
-                df_parte, contrib_info, nivel,
-                parte_atual=parte, total_partes=total_partes, grupo=grupo
+    def consultar(queries):
+        faixa_expr = f"CASE WHEN valor > 0 THEN CAST(FLOOR(LN(valor) / LN({HISTOGRAMA_BASE})) AS STRING) END"
+        dimensoes = ('total', 'periodo', 'ncm', 'cfop', 'produto', 'faixa')
+        query = f"""
+            WITH base AS (
+                SELECT periodo, CAST(ncm AS STRING) AS ncm, cfop, descricao,
+                       COALESCE(CAST(infracao_ia AS DOUBLE), 0) AS valor
+                FROM ({" UNION ALL ".join(queries.values())}) b
+            ),
+            dimensoes AS (
+                {" UNION ALL ".join(f"SELECT '{nome}' AS dimensao" for nome in dimensoes)}
+            ),
+            agregado AS (
+                SELECT d.dimensao,
+                       CASE d.dimensao
+                           WHEN 'periodo' THEN CAST(periodo AS STRING)
+                           WHEN 'ncm' THEN ncm
+                           WHEN 'cfop' THEN CAST(cfop AS STRING)
+                           WHEN 'produto' THEN CAST(descricao AS STRING)
+                           WHEN 'faixa' THEN {faixa_expr}
+                       END AS chave,
+                       SUM(valor) AS valor, COUNT(*) AS itens,
+                       MIN(valor) AS minimo, MAX(valor) AS maximo, STDDEV_SAMP(valor) AS desvio
+                FROM base CROSS JOIN dimensoes d
+                GROUP BY 1, 2
             )
+            SELECT dimensao, chave, valor, itens, minimo, maximo, desvio
+            FROM (
+                SELECT a.*,
+                       ROW_NUMBER() OVER (PARTITION BY dimensao
+                                          ORDER BY CASE WHEN chave IS NULL THEN 1 ELSE 0 END, valor DESC) AS posicao
+                FROM agregado a
+            ) r
+            WHERE (dimensao IN ('total', 'faixa') OR chave IS NOT NULL)
+              AND (dimensao IN ('total', 'periodo', 'faixa') OR posicao <= {int(top_n)})
+        """
 
-            # Nome e caminho do arquivo
-            base_filename = get_export_filename(contrib_info, nivel, "xlsx")
-            parte_filename = base_filename.replace(".xlsx", f" - Parte {parte} de {total_partes}.xlsx")
-            filepath = f"{REDE_PATH}\\{parte_filename}"
+        inicio = time.perf_counter()
+        df = pd.read_sql(query, _engine)
+        registrar_tempo_tabela(
+            'agregados', " + ".join(tabelas[tipo] for tipo in queries), time.perf_counter() - inicio, len(df)
+        )
+        return df
 
-            # Salva na rede
-            with smbclient.open_file(filepath, mode="wb") as f:
-                f.write(excel_data)
-            
-            file_paths.append(filepath)
-            
-            # Libera memória
-            del excel_data
-            del df_parte
-            
-            if progress_callback:
-                progress_callback(parte, total_partes, f"Parte {parte} de {total_partes} salva!")
-        
-        return True, f"{total_partes} arquivos salvos com sucesso!", file_paths
-    
-    except Exception as e:
-        error_msg = str(e)
-        # Detecta erro de autenticação Kerberos expirada
-        if "Ticket expired" in error_msg or "SpnegoError" in error_msg or "authenticate" in error_msg.lower():
-            return False, "🔐 **Sessão de rede expirada!** Faça logout/login no Windows ou acesse qualquer pasta de rede no Explorer para renovar.", file_paths
-        return False, f"Erro ao salvar: {error_msg}", file_paths
+    # Com IDENT_REPETIR_COM_REGEXP, repete com regexp se as variantes não acharem nada (ver modos_busca_identificador)
+    tabelas = get_grupo_tabelas(grupo)
+    for modo in modos_busca_identificador():
+        queries = _montar_queries_base(identificador_digits, nivel, grupo, projecao="resumo", modo_ident=modo)
+        if not queries:
+            raise ValueError(f"Grupo {grupo} sem tabelas configuradas")
+        df = consultar(queries)
+        total = df[df['dimensao'] == 'total']
+        if not total.empty and pd.to_numeric(total['itens'], errors='coerce').fillna(0).iloc[0] > 0:
+            break
+
+    for col in ('valor', 'itens', 'minimo', 'maximo', 'desvio'):
+        df[col] = pd.to_numeric(df[col], errors='coerce')
+
+    def dimensao(nome, coluna):
+        df_dim = df[df['dimensao'] == nome][['chave', 'valor', 'itens']]
+        df_dim.columns = [coluna, 'Valor', 'Itens']
+        df_dim['Valor'] = df_dim['Valor'].fillna(0)
+        df_dim['Itens'] = df_dim['Itens'].fillna(0).astype('int64')
+        return df_dim.sort_values('Valor', ascending=False).reset_index(drop=True)
+
+    total = df[df['dimensao'] == 'total']
+    linhas = int(total['itens'].iloc[0]) if not total.empty and pd.notna(total['itens'].iloc[0]) else 0
+    soma = float(total['valor'].iloc[0]) if linhas and pd.notna(total['valor'].iloc[0]) else 0.0
+
+    resultado = {
+        'linhas': linhas,
+        'periodo': _completar_periodo_analise(dimensao('periodo', 'Período')),
+        'ncm': dimensao('ncm', 'NCM'),
+        'cfop': dimensao('cfop', 'CFOP'),
+        'produto': dimensao('produto', 'Descrição'),
+        'stats': None,
+    }
 
-# =============================================================================
-# 7. ANÁLISES EXPLORATÓRIAS
-# =============================================================================
+    if linhas and soma > 0:
+        minimo = float(total['minimo'].iloc[0])
+        maximo = float(total['maximo'].iloc[0])
+        faixas = df[df['dimensao'] == 'faixa'].rename(columns={'chave': 'faixa'})[['faixa', 'itens']]
+        quantis = quantis_histograma(faixas, [0.25, 0.5, 0.75], minimo, maximo)
+        # Mesmo índice do describe() usado no cálculo pelo pandas
+        resultado['stats'] = pd.Series({
+            'count': float(linhas),
+            'mean': soma / linhas,
+            'std': float(total['desvio'].iloc[0]) if pd.notna(total['desvio'].iloc[0]) else 0.0,
+            'min': minimo,
+            '25%': quantis[0.25],
+            '50%': quantis[0.5],
+            '75%': quantis[0.75],
+            'max': maximo,
+        })
+
+    return resultado
 
 def render_analise_exploratoria(df: pd.DataFrame, nivel_str: str, _engine=None):
     """Renderiza análises exploratórias dos dados."""
@@ -2274,10 +2388,10 @@ def render_analise_exploratoria(df: pd.DataFrame, nivel_str: str, _engine=None):
         with col1:
             # Infrações por período
             df_temp = df.copy()
-            df_temp['infracao_valor'] = pd.to_numeric(df_temp[col_infracao], errors='coerce').fillna(0)
+            df_temp['infracao_valor'] = coluna_numerica(df_temp[col_infracao])
             
             if 'periodo' in df_temp.columns:
-                df_periodo = df_temp.groupby('periodo').agg({
+                df_periodo = df_temp.groupby('periodo', observed=True).agg({
                     'infracao_valor': 'sum',
                     'chave': 'count'
                 }).reset_index()
@@ -2322,10 +2436,10 @@ def render_analise_exploratoria(df: pd.DataFrame, nivel_str: str, _engine=None):
         with col1:
             # Top 10 NCMs
             df_temp = df.copy()
-            df_temp['infracao_valor'] = pd.to_numeric(df_temp[col_infracao], errors='coerce').fillna(0)
+            df_temp['infracao_valor'] = coluna_numerica(df_temp[col_infracao])
             
             if 'ncm' in df_temp.columns:
-                df_ncm = df_temp.groupby('ncm').agg({
+                df_ncm = df_temp.groupby('ncm', observed=True).agg({
                     'infracao_valor': ['sum', 'count']
                 }).reset_index()
                 df_ncm.columns = ['NCM', 'Valor Total', 'Itens']
@@ -2363,7 +2477,7 @@ def render_analise_exploratoria(df: pd.DataFrame, nivel_str: str, _engine=None):
         with col2:
             # Top 10 CFOPs
             if 'cfop' in df_temp.columns:
-                df_cfop = df_temp.groupby('cfop').agg({
+                df_cfop = df_temp.groupby('cfop', observed=True).agg({
                     'infracao_valor': ['sum', 'count']
                 }).reset_index()
                 df_cfop.columns = ['CFOP', 'Valor Total', 'Itens']
@@ -2401,7 +2515,7 @@ def render_analise_exploratoria(df: pd.DataFrame, nivel_str: str, _engine=None):
     # TAB 3: Por Produto
     with tabs[2]:
         df_temp = df.copy()
-        df_temp['infracao_valor'] = pd.to_numeric(df_temp[col_infracao], errors='coerce').fillna(0)
+        df_temp['infracao_valor'] = coluna_numerica(df_temp[col_infracao])
         
         if 'descricao' in df_temp.columns:
             # Agrupa por descrição incluindo NCM
@@ -2414,7 +2528,7 @@ def render_analise_exploratoria(df: pd.DataFrame, nivel_str: str, _engine=None):
             if 'ncm' in df_temp.columns:
                 group_cols.append('ncm')
             
-            df_prod = df_temp.groupby(group_cols).agg(agg_dict).reset_index()
+            df_prod = df_temp.groupby(group_cols, observed=True).agg(agg_dict).reset_index()
             
             if 'ncm' in group_cols:
                 df_prod.columns = ['Descrição', 'NCM', 'Valor Total', 'Itens']
@@ -2448,7 +2562,7 @@ def render_analise_exploratoria(df: pd.DataFrame, nivel_str: str, _engine=None):
     # TAB 4: Distribuição de Valores
     with tabs[3]:
         df_temp = df.copy()
-        df_temp['infracao_valor'] = pd.to_numeric(df_temp[col_infracao], errors='coerce').fillna(0)
+        df_temp['infracao_valor'] = coluna_numerica(df_temp[col_infracao])
         df_temp = df_temp[df_temp['infracao_valor'] > 0]
         
         col1, col2 = st.columns(2)
@@ -2537,17 +2651,6 @@ def render_comparativo_niveis(engine, identificador_digits: str, total_rows: int
         filtro_periodo = f"AND periodo IN ({periodos_str})"
         st.caption(f"📅 Períodos: {periodos_ordenados[0]} a {periodos_ordenados[-1]}")
 
-    # Filtro base
-    filtro_baixa = f"""
-        regexp_replace(cnpj_emitente, '[^0-9]', '') = '{identificador_digits}'
-        AND CAST(infracao_baixa AS STRING) != 'EXCLUIR'
-        AND CAST(aliquota_baixa AS STRING) != 'EXCLUIR'
-        AND CAST(legislacao_baixa AS STRING) != 'EXCLUIR'
-        {filtro_periodo}
-    """
-
-    # Monta queries para cada tabela disponível
-    union_parts = []
     select_cols = """
         infracao_alta, infracao_media, infracao_baixa,
         aliquota_alta, aliquota_media, aliquota_baixa,
@@ -2555,87 +2658,96 @@ def render_comparativo_niveis(engine, identificador_digits: str, total_rows: int
         periodo
     """
 
-    if tabelas.get('nfce'):
-        union_parts.append(f"""
-            SELECT {select_cols}
-            FROM {tabelas['nfce']}
-            WHERE {filtro_baixa}
-        """)
-    if tabelas.get('cupons'):
-        union_parts.append(f"""
-            SELECT {select_cols}
-            FROM {tabelas['cupons']}
-            WHERE {filtro_baixa}
-        """)
-    if tabelas.get('nfe'):
-        union_parts.append(f"""
-            SELECT {select_cols}
-            FROM {tabelas['nfe']}
-            WHERE {filtro_baixa}
-        """)
+    def montar_partes(modo_ident=None):
+        """Uma query por tabela disponível (modo_ident="replica" para a réplica local)."""
+        # Filtro base
+        filtro_baixa = f"""
+            {filtro_identificador('cnpj_emitente', identificador_digits, modo_ident)}
+            AND CAST(infracao_baixa AS STRING) != 'EXCLUIR'
+            AND CAST(aliquota_baixa AS STRING) != 'EXCLUIR'
+            AND CAST(legislacao_baixa AS STRING) != 'EXCLUIR'
+            {filtro_periodo}
+        """
+        partes = {}
+        for tipo in ('nfce', 'cupons', 'nfe'):
+            if tabelas.get(tipo):
+                partes[tabelas[tipo]] = f"""
+                    SELECT {select_cols}
+                    FROM {tabelas[tipo]}
+                    WHERE {filtro_baixa}
+                """
+        return partes
+
+    # Monta queries para cada tabela disponível
+    union_parts = montar_partes()
 
     if not union_parts:
         st.warning("Nenhuma tabela disponível para este grupo.")
         return
 
-    union_query = " UNION ALL ".join(union_parts)
-
     # Query com valores EXCLUSIVOS (sem sobreposição entre níveis)
-    query_totais = f"""
-    SELECT
-        -- ALTA pura: válido em ALTA
-        SUM(CASE WHEN CAST(infracao_alta AS STRING) != 'EXCLUIR'
-                 AND CAST(aliquota_alta AS STRING) != 'EXCLUIR'
-                 AND CAST(legislacao_alta AS STRING) != 'EXCLUIR'
-                 THEN CAST(infracao_baixa AS FLOAT) ELSE 0 END) as total_alta,
-
-        -- MÉDIA pura: válido em MÉDIA mas NÃO em ALTA
-        SUM(CASE WHEN (CAST(infracao_media AS STRING) != 'EXCLUIR'
-                       AND CAST(aliquota_media AS STRING) != 'EXCLUIR'
-                       AND CAST(legislacao_media AS STRING) != 'EXCLUIR')
-                  AND (CAST(infracao_alta AS STRING) = 'EXCLUIR'
-                       OR CAST(aliquota_alta AS STRING) = 'EXCLUIR'
-                       OR CAST(legislacao_alta AS STRING) = 'EXCLUIR')
-                 THEN CAST(infracao_baixa AS FLOAT) ELSE 0 END) as total_media,
-
-        -- BAIXA pura: válido em BAIXA mas NÃO em MÉDIA
-        SUM(CASE WHEN (CAST(infracao_baixa AS STRING) != 'EXCLUIR'
-                       AND CAST(aliquota_baixa AS STRING) != 'EXCLUIR'
-                       AND CAST(legislacao_baixa AS STRING) != 'EXCLUIR')
-                  AND (CAST(infracao_media AS STRING) = 'EXCLUIR'
-                       OR CAST(aliquota_media AS STRING) = 'EXCLUIR'
-                       OR CAST(legislacao_media AS STRING) = 'EXCLUIR')
-                 THEN CAST(infracao_baixa AS FLOAT) ELSE 0 END) as total_baixa,
-
-        -- Contagens exclusivas
-        SUM(CASE WHEN CAST(infracao_alta AS STRING) != 'EXCLUIR'
-                 AND CAST(aliquota_alta AS STRING) != 'EXCLUIR'
-                 AND CAST(legislacao_alta AS STRING) != 'EXCLUIR'
-                 THEN 1 ELSE 0 END) as qtd_alta,
-
-        SUM(CASE WHEN (CAST(infracao_media AS STRING) != 'EXCLUIR'
-                       AND CAST(aliquota_media AS STRING) != 'EXCLUIR'
-                       AND CAST(legislacao_media AS STRING) != 'EXCLUIR')
-                  AND (CAST(infracao_alta AS STRING) = 'EXCLUIR'
-                       OR CAST(aliquota_alta AS STRING) = 'EXCLUIR'
-                       OR CAST(legislacao_alta AS STRING) = 'EXCLUIR')
-                 THEN 1 ELSE 0 END) as qtd_media,
-
-        SUM(CASE WHEN (CAST(infracao_baixa AS STRING) != 'EXCLUIR'
-                       AND CAST(aliquota_baixa AS STRING) != 'EXCLUIR'
-                       AND CAST(legislacao_baixa AS STRING) != 'EXCLUIR')
-                  AND (CAST(infracao_media AS STRING) = 'EXCLUIR'
-                       OR CAST(aliquota_media AS STRING) = 'EXCLUIR'
-                       OR CAST(legislacao_media AS STRING) = 'EXCLUIR')
-                 THEN 1 ELSE 0 END) as qtd_baixa
-
-    FROM (
-        {union_query}
-    ) t
-    """
+    def montar_query(union_query):
+        return f"""
+        SELECT
+            -- ALTA pura: válido em ALTA
+            SUM(CASE WHEN CAST(infracao_alta AS STRING) != 'EXCLUIR'
+                     AND CAST(aliquota_alta AS STRING) != 'EXCLUIR'
+                     AND CAST(legislacao_alta AS STRING) != 'EXCLUIR'
+                     THEN CAST(infracao_baixa AS FLOAT) ELSE 0 END) as total_alta,
+
+            -- MÉDIA pura: válido em MÉDIA mas NÃO em ALTA
+            SUM(CASE WHEN (CAST(infracao_media AS STRING) != 'EXCLUIR'
+                           AND CAST(aliquota_media AS STRING) != 'EXCLUIR'
+                           AND CAST(legislacao_media AS STRING) != 'EXCLUIR')
+                      AND (CAST(infracao_alta AS STRING) = 'EXCLUIR'
+                           OR CAST(aliquota_alta AS STRING) = 'EXCLUIR'
+                           OR CAST(legislacao_alta AS STRING) = 'EXCLUIR')
+                     THEN CAST(infracao_baixa AS FLOAT) ELSE 0 END) as total_media,
+
+            -- BAIXA pura: válido em BAIXA mas NÃO em MÉDIA
+            SUM(CASE WHEN (CAST(infracao_baixa AS STRING) != 'EXCLUIR'
+                           AND CAST(aliquota_baixa AS STRING) != 'EXCLUIR'
+                           AND CAST(legislacao_baixa AS STRING) != 'EXCLUIR')
+                      AND (CAST(infracao_media AS STRING) = 'EXCLUIR'
+                           OR CAST(aliquota_media AS STRING) = 'EXCLUIR'
+                           OR CAST(legislacao_media AS STRING) = 'EXCLUIR')
+                     THEN CAST(infracao_baixa AS FLOAT) ELSE 0 END) as total_baixa,
+
+            -- Contagens exclusivas
+            SUM(CASE WHEN CAST(infracao_alta AS STRING) != 'EXCLUIR'
+                     AND CAST(aliquota_alta AS STRING) != 'EXCLUIR'
+                     AND CAST(legislacao_alta AS STRING) != 'EXCLUIR'
+                     THEN 1 ELSE 0 END) as qtd_alta,
+
+            SUM(CASE WHEN (CAST(infracao_media AS STRING) != 'EXCLUIR'
+                           AND CAST(aliquota_media AS STRING) != 'EXCLUIR'
+                           AND CAST(legislacao_media AS STRING) != 'EXCLUIR')
+                      AND (CAST(infracao_alta AS STRING) = 'EXCLUIR'
+                           OR CAST(aliquota_alta AS STRING) = 'EXCLUIR'
+                           OR CAST(legislacao_alta AS STRING) = 'EXCLUIR')
+                     THEN 1 ELSE 0 END) as qtd_media,
+
+            SUM(CASE WHEN (CAST(infracao_baixa AS STRING) != 'EXCLUIR'
+                           AND CAST(aliquota_baixa AS STRING) != 'EXCLUIR'
+                           AND CAST(legislacao_baixa AS STRING) != 'EXCLUIR')
+                      AND (CAST(infracao_media AS STRING) = 'EXCLUIR'
+                           OR CAST(aliquota_media AS STRING) = 'EXCLUIR'
+                           OR CAST(legislacao_media AS STRING) = 'EXCLUIR')
+                     THEN 1 ELSE 0 END) as qtd_baixa
+
+        FROM (
+            {union_query}
+        ) t
+        """
     
     try:
-        df_totais = pd.read_sql(query_totais, engine)
+        # Com IDENT_REPETIR_COM_REGEXP, repete com regexp se as variantes não acharem nada (ver modos_busca_identificador)
+        for modo in modos_busca_identificador():
+            df_totais = ler_agregado_por_tabela(engine, montar_partes(modo), montar_query, [], 'comparativo',
+                                                partes_replica=montar_partes("replica"))
+            qtd = df_totais.reindex(columns=['qtd_alta', 'qtd_media', 'qtd_baixa']).apply(pd.to_numeric, errors='coerce')
+            if qtd.fillna(0).to_numpy().sum() > 0:
+                break
         
         if df_totais.empty:
             st.warning("Não foi possível calcular os totais por nível.")
@@ -2762,170 +2874,247 @@ def render_comparativo_niveis(engine, identificador_digits: str, total_rows: int
             st.warning(f"Não foi possível carregar o comparativo entre níveis: {error_msg[:100]}")
 
 # =============================================================================
-# 9. RANKING DE EMPRESAS (CACHE DIÁRIO)
+# 9. RANKING DE EMPRESAS (CACHE POR VERSÃO DAS TABELAS)
 # =============================================================================
 
-@st.cache_data(ttl=RANKING_CACHE_TTL, show_spinner=False)
-def get_ranking_data(_engine, nivel: str = "ALTA", top_n: int = 100, _cache_version: int = 8, grupo: str = None):
+# Bits da coluna `niveis` do resumo materializado: níveis em que a linha é válida
+# (infração, alíquota e legislação do nível diferentes de 'EXCLUIR')
+NIVEIS_BITS = {'ALTA': 4, 'MEDIA': 2, 'BAIXA': 1}
+
+
+def _partes_resumo(tabelas: dict) -> dict:
     """
-    Busca ranking agregado de empresas por valor de infração.
-    Cache de 24 horas pois dados não mudam frequentemente.
-    Retorna dados agregados por empresa e por ano.
-    _cache_version: incrementar para invalidar cache
-    grupo: grupo (GESSUPER, GESMAC). Se None, usa session_state
+    SELECT de cada tabela com as linhas válidas em algum nível: emitente, ano, tipo_doc,
+    `niveis` (ver NIVEIS_BITS) e o valor de cada nível. Base do resumo dos rankings e da
+    distribuição dos itens; sem filtro por CNPJ, serve também para a réplica local.
+    """
+    def valido(nivel):
+        n = nivel.lower()
+        return (f"(CAST(infracao_{n} AS STRING) != 'EXCLUIR' "
+                f"AND CAST(aliquota_{n} AS STRING) != 'EXCLUIR' "
+                f"AND CAST(legislacao_{n} AS STRING) != 'EXCLUIR')")
+
+    niveis = " + ".join(
+        f"CASE WHEN {valido(nivel)} THEN {bit} ELSE 0 END" for nivel, bit in NIVEIS_BITS.items()
+    )
+    filtro = " OR ".join(valido(nivel) for nivel in NIVEIS_BITS)
 
+    return {
+        tabela: f"""
+            SELECT
+                cnpj_emitente, razao_emitente, SUBSTR(periodo, 4, 4) AS ano, tipo_doc,
+                {niveis} AS niveis,
+                CAST(infracao_alta AS FLOAT) AS valor_alta,
+                CAST(infracao_media AS FLOAT) AS valor_media,
+                CAST(infracao_baixa AS FLOAT) AS valor_baixa
+            FROM {tabela}
+            WHERE {filtro}
+        """
+        for tabela in tabelas.values()
+    }
+
+
+@cache_compartilhado(max_entries=RANKING_CACHE_MAX_ENTRIES, copiar=False)
+def _carregar_resumo_grupo(_engine, grupo: str, versao_tabelas: str):
     """
-    if grupo is None:
-        grupo = st.session_state.get('grupo_selecionado', GRUPO_PADRAO)
+    Resumo materializado do grupo e histograma dos itens, montados na mesma varredura.
 
+    Cada linha das partes (_partes_resumo) entra uma vez como linha do resumo ('resumo') e
+    uma vez por nível em que é válida e tem valor numérico ('faixa'), e um único GROUP BY
+    por tabela soma as duas coisas. As linhas de cada tipo são separadas depois, no pandas.
+
+    Returns:
+        dict {'resumo', 'distribuicao'} (DataFrames, vazios se nenhuma linha válida) ou
+        None se o grupo não tem tabelas. Erros do Impala são lançados.
+    """
     tabelas = get_grupo_tabelas(grupo)
+    if not tabelas:
+        return None
 
-    nivel_upper = (nivel or "ALTA").upper()
-    col_infracao = f"infracao_{nivel_upper.lower()}"
-    col_aliquota = f"aliquota_{nivel_upper.lower()}"
-    col_legislacao = f"legislacao_{nivel_upper.lower()}"
+    chave_resumo = ('resumo_ranking', grupo, versao_tabelas)
+    chave_distribuicao = ('histograma_itens', grupo, versao_tabelas)
+    if RESUMO_RANKING_MATERIALIZADO:
+        resumo = ler_cache_disco(chave_resumo)
+        distribuicao = ler_cache_disco(chave_distribuicao)
+        if resumo is not None and distribuicao is not None:
+            return {'resumo': resumo, 'distribuicao': distribuicao}
+
+    # Linha 'resumo' (nível nulo) + uma linha 'faixa' por nível; o bit diz se a linha é
+    # válida no nível, e valores nulos ou não numéricos ficam fora do histograma
+    linhas = " UNION ALL ".join(
+        ["SELECT 'resumo' AS linha, CAST(NULL AS STRING) AS nivel, 0 AS bit"]
+        + [f"SELECT 'faixa' AS linha, '{nivel}' AS nivel, {bit} AS bit" for nivel, bit in NIVEIS_BITS.items()]
+    )
+    valor_do_nivel = "CASE x.nivel " + " ".join(
+        f"WHEN '{nivel}' THEN t.valor_{nivel.lower()}" for nivel in NIVEIS_BITS
+    ) + " END"
+
+    def do_resumo(expr):
+        return f"CASE WHEN x.linha = 'resumo' THEN {expr} END"
+
+    def montar_query(union_query):
+        return f"""
+        SELECT
+            linha, cnpj_emitente, razao_emitente, ano, tipo_doc, niveis, nivel, faixa,
+            SUM(valor_alta) AS valor_alta,
+            SUM(valor_media) AS valor_media,
+            SUM(valor_baixa) AS valor_baixa,
+            COUNT(*) AS qtd
+        FROM (
+            SELECT
+                x.linha,
+                {do_resumo('t.cnpj_emitente')} AS cnpj_emitente,
+                {do_resumo('t.razao_emitente')} AS razao_emitente,
+                {do_resumo('t.ano')} AS ano,
+                {do_resumo('t.tipo_doc')} AS tipo_doc,
+                {do_resumo('t.niveis')} AS niveis,
+                x.nivel,
+                CASE WHEN {valor_do_nivel} > 0
+                     THEN CAST(FLOOR(LN({valor_do_nivel}) / LN({HISTOGRAMA_BASE})) AS STRING) END AS faixa,
+                {do_resumo('t.valor_alta')} AS valor_alta,
+                {do_resumo('t.valor_media')} AS valor_media,
+                {do_resumo('t.valor_baixa')} AS valor_baixa
+            FROM (
+                {union_query}
+            ) t
+            CROSS JOIN ({linhas}) x
+            WHERE x.linha = 'resumo'
+               OR (CAST(FLOOR(t.niveis / x.bit) AS BIGINT) % 2 = 1 AND {valor_do_nivel} IS NOT NULL)
+        ) r
+        GROUP BY linha, cnpj_emitente, razao_emitente, ano, tipo_doc, niveis, nivel, faixa
+        """
 
-    filtro = f"""
-        {col_infracao} IS NOT NULL
-        AND CAST({col_infracao} AS STRING) != 'EXCLUIR'
-        AND CAST({col_aliquota} AS STRING) != 'EXCLUIR'
-        AND CAST({col_legislacao} AS STRING) != 'EXCLUIR'
+    partes = _partes_resumo(tabelas)
+    chaves = ['linha', 'cnpj_emitente', 'razao_emitente', 'ano', 'tipo_doc', 'niveis', 'nivel', 'faixa']
+    # Sem filtro por CNPJ: as mesmas queries servem para a réplica local
+    df = ler_agregado_por_tabela(_engine, partes, montar_query, chaves, 'resumo_ranking', partes_replica=partes)
+    if df.empty:
+        return {'resumo': pd.DataFrame(), 'distribuicao': pd.DataFrame()}
+
+    resumo = df[df['linha'] == 'resumo'].drop(columns=['linha', 'nivel', 'faixa']).reset_index(drop=True)
+    resumo['niveis'] = pd.to_numeric(resumo['niveis'], errors='coerce').fillna(0).astype('int8')
+    resumo['qtd'] = pd.to_numeric(resumo['qtd'], errors='coerce').fillna(0).astype('int64')
+    for col in ['valor_alta', 'valor_media', 'valor_baixa']:
+        resumo[col] = pd.to_numeric(resumo[col], errors='coerce').astype('float64')
+    for col in ['cnpj_emitente', 'razao_emitente', 'ano', 'tipo_doc']:
+        resumo[col] = resumo[col].astype(object).where(resumo[col].notna(), None)
+
+    distribuicao = df.loc[df['linha'] == 'faixa', ['nivel', 'faixa', 'qtd']].rename(
+        columns={'qtd': 'itens'}).reset_index(drop=True)
+    distribuicao['itens'] = pd.to_numeric(distribuicao['itens'], errors='coerce').fillna(0).astype('int64')
+    distribuicao['faixa'] = distribuicao['faixa'].astype(object).where(distribuicao['faixa'].notna(), None)
+
+    if RESUMO_RANKING_MATERIALIZADO:
+        gravar_cache_disco(chave_resumo, resumo)
+        gravar_cache_disco(chave_distribuicao, distribuicao)
+    return {'resumo': resumo, 'distribuicao': distribuicao}
+
+
+def get_resumo_ranking(_engine, grupo: str, versao_tabelas: str):
     """
+    Resumo materializado do grupo, base de todos os rankings e estatísticas globais.
 
-    # Monta queries para cada tabela disponível
-    union_parts = []
-    if tabelas.get('nfce'):
-        union_parts.append(f"""
-            SELECT cnpj_emitente, razao_emitente, periodo, {col_infracao}
-            FROM {tabelas['nfce']}
-            WHERE {filtro}
-        """)
-    if tabelas.get('cupons'):
-        union_parts.append(f"""
-            SELECT cnpj_emitente, razao_emitente, periodo, {col_infracao}
-            FROM {tabelas['cupons']}
-            WHERE {filtro}
-        """)
-    if tabelas.get('nfe'):
-        union_parts.append(f"""
-            SELECT cnpj_emitente, razao_emitente, periodo, {col_infracao}
-            FROM {tabelas['nfe']}
-            WHERE {filtro}
-        """)
+    Uma linha por empresa × ano × tipo_doc × combinação de níveis válidos (`niveis`, ver
+    NIVEIS_BITS), com as somas de infracao_alta/media/baixa e a quantidade de itens.
+    Todos os níveis saem da mesma varredura de cada tabela, junto com o histograma de
+    get_distribuicao_itens (ver _carregar_resumo_grupo). Com RESUMO_RANKING_MATERIALIZADO
+    é lido do cache em disco (Parquet, compartilhado entre processos) quando existe e gravado
+    após a montagem. A chave é a versão das tabelas, então o resumo é refeito uma vez por
+    recarga dos dados.
 
-    if not union_parts:
-        return None, None, None
+    Returns:
+        DataFrame (vazio se nenhuma linha válida) ou None se o grupo não tem tabelas.
+        Erros do Impala são lançados.
+    """
+    carregado = _carregar_resumo_grupo(_engine, grupo, versao_tabelas)
+    return None if carregado is None else carregado['resumo']
 
-    union_query = " UNION ALL ".join(union_parts)
 
-    # Query otimizada - agregação no banco de dados
-    query = f"""
-    SELECT
-        cnpj_emitente,
-        razao_emitente,
-        SUBSTR(periodo, 4, 4) as ano,
-        SUM(CAST({col_infracao} AS FLOAT)) as total_valor,
-        COUNT(*) as qtd_itens
-    FROM (
-        {union_query}
-    ) t
-    GROUP BY cnpj_emitente, razao_emitente, SUBSTR(periodo, 4, 4)
+def get_distribuicao_itens(_engine, grupo: str, versao_tabelas: str):
     """
-    
+    Distribuição dos valores por item do grupo, em cada nível: histograma logarítmico
+    (faixas de HISTOGRAMA_BASE, o mesmo de get_agregados_consulta), sem query própria:
+    sai do mesmo GROUP BY do resumo (_carregar_resumo_grupo). Valores nulos ou não
+    numéricos ficam fora; a faixa None reúne só os valores <= 0. O histograma de cada
+    tabela é somado por faixa (é combinável), e os quantis saem de quantis_histograma
+    com erro de ~0,5%. Persistido no cache em disco como o resumo.
+
+    Returns:
+        DataFrame [nivel, faixa, itens] ou None se o grupo não tem tabelas.
+        Erros do Impala são lançados.
+    """
+    carregado = _carregar_resumo_grupo(_engine, grupo, versao_tabelas)
+    return None if carregado is None else carregado['distribuicao']
+
+
+def _resumo_no_nivel(resumo: pd.DataFrame, nivel: str) -> pd.DataFrame:
+    """Linhas do resumo válidas no nível (inclusivo), como no filtro das consultas por nível."""
+    bit = NIVEIS_BITS.get((nivel or "ALTA").upper(), NIVEIS_BITS['ALTA'])
+    return resumo[(resumo['niveis'] & bit) > 0]
+
+
+def _colunas_por_nivel(resumo: pd.DataFrame, chaves: list) -> pd.DataFrame:
+    """
+    Abre o resumo em colunas por nível, para somar todos os níveis num único groupby:
+        - valor_<nivel>, itens_<nivel>: nível inclusivo (linha válida no nível)
+        - total_<nivel>, qtd_<nivel>: nível exclusivo, valorado por infracao_baixa
+          (ALTA pura = válido em ALTA; MÉDIA pura = válido em MÉDIA e não em ALTA;
+          BAIXA pura = válido em BAIXA e não em MÉDIA; todos exigem validade em BAIXA)
+    """
+    niveis = resumo['niveis']
+    valido = {nivel: (niveis & bit) > 0 for nivel, bit in NIVEIS_BITS.items()}
+    exclusivo = {
+        'ALTA': valido['BAIXA'] & valido['ALTA'],
+        'MEDIA': valido['BAIXA'] & valido['MEDIA'] & ~valido['ALTA'],
+        'BAIXA': valido['BAIXA'] & ~valido['MEDIA'],
+    }
+
+    df = pd.DataFrame({col: resumo[col] for col in chaves})
+    for nivel in NIVEIS_BITS:
+        n = nivel.lower()
+        df[f'valor_{n}'] = resumo[f'valor_{n}'].where(valido[nivel], 0.0).fillna(0.0)
+        df[f'itens_{n}'] = resumo['qtd'].where(valido[nivel], 0)
+    for nivel in NIVEIS_BITS:
+        n = nivel.lower()
+        df[f'total_{n}'] = resumo['valor_baixa'].where(exclusivo[nivel], 0.0).fillna(0.0)
+        df[f'qtd_{n}'] = resumo['qtd'].where(exclusivo[nivel], 0)
+    return df
+
+
+@cache_compartilhado(max_entries=RANKING_CACHE_MAX_ENTRIES, copiar=False)
+def get_totais_empresas(_engine, grupo: str, versao_tabelas: str):
+    """
+    Totais por empresa de todos os níveis de uma vez (ver _colunas_por_nivel), a partir
+    do resumo do grupo. Base comum do ranking de acurácia e das estatísticas globais.
+
+    Returns:
+        DataFrame por cnpj_emitente/razao_emitente ou None se o grupo não tem tabelas
+    """
+    resumo = get_resumo_ranking(_engine, grupo, versao_tabelas)
+    if resumo is None:
+        return None
+    chaves = ['cnpj_emitente', 'razao_emitente']
+    return _colunas_por_nivel(resumo, chaves).groupby(chaves, as_index=False, dropna=False, sort=False).sum()
+
+
+def get_ranking_data(_engine, nivel: str = "ALTA", top_n: int = RANKING_PAGINA_TAMANHO, grupo: str = None,
+                     versao_tabelas: str = None, cursor: tuple = None):
+    """
+    Busca uma página do ranking de empresas por valor de infração.
+    Retorna dados agregados por empresa e por ano.
+
+    grupo: grupo (GESSUPER, GESMAC). Se None, usa session_state
+    versao_tabelas: versão das tabelas do grupo (chave do cache). Se None, usa versao_cache_grupo.
+    cursor: stats['proximo_cursor'] da página anterior (None = primeira página)
+    O cache dura até as tabelas mudarem; erros não ficam no cache. Quando a versão muda, o
+    ranking anterior é servido (até RANKING_MAX_OBSOLETO_SECONDS) enquanto o novo é calculado.
+    """
+    if grupo is None:
+        grupo = st.session_state.get('grupo_selecionado', GRUPO_PADRAO)
+    if versao_tabelas is None:
+        versao_tabelas = versao_cache_grupo(_engine, grupo)
     try:
-        df = pd.read_sql(query, _engine)
-        
-        if df.empty:
-            return None, None, None
-        
-        # Pivoteia para ter anos como colunas
-        df_pivot_valor = df.pivot_table(
-            index=['cnpj_emitente', 'razao_emitente'],
-            columns='ano',
-            values='total_valor',
-            aggfunc='sum',
-            fill_value=0
-        ).reset_index()
-        
-        df_pivot_qtd = df.pivot_table(
-            index=['cnpj_emitente', 'razao_emitente'],
-            columns='ano',
-            values='qtd_itens',
-            aggfunc='sum',
-            fill_value=0
-        ).reset_index()
-        
-        # Calcula totais
-        anos_cols = [c for c in df_pivot_valor.columns if c not in ['cnpj_emitente', 'razao_emitente']]
-        
-        # Garante que as colunas de anos sejam numéricas (float64)
-        for col in anos_cols:
-            df_pivot_valor[col] = pd.to_numeric(df_pivot_valor[col], errors='coerce').fillna(0).astype('float64')
-            df_pivot_qtd[col] = pd.to_numeric(df_pivot_qtd[col], errors='coerce').fillna(0).astype('float64')
-        
-        # Calcula TOTAL como soma das colunas de anos (float64)
-        df_pivot_valor['TOTAL'] = df_pivot_valor[anos_cols].sum(axis=1).astype('float64')
-        df_pivot_qtd['TOTAL'] = df_pivot_qtd[anos_cols].sum(axis=1).astype('float64')
-        
-        # =====================================================================
-        # ESTATÍSTICAS GERAIS (ANTES DE LIMITAR ÀS TOP N)
-        # =====================================================================
-        total_geral_todas = float(df_pivot_valor['TOTAL'].sum())
-        qtd_empresas_total = len(df_pivot_valor)
-        total_itens_todas = int(df_pivot_qtd['TOTAL'].sum())
-        
-        # Estatísticas por ano (todas empresas)
-        stats_por_ano = {}
-        for ano in anos_cols:
-            if ano in df_pivot_valor.columns:
-                valor_ano = float(df_pivot_valor[ano].sum())
-                qtd_ano = int(df_pivot_qtd[ano].sum()) if ano in df_pivot_qtd.columns else 0
-                stats_por_ano[ano] = {
-                    'valor': valor_ano,
-                    'qtd': qtd_ano,
-                    'pct': (valor_ano / total_geral_todas * 100) if total_geral_todas > 0 else 0,
-                    'empresas_ativas': int((df_pivot_valor[ano] > 0).sum())
-                }
-        
-        # =====================================================================
-        # ORDENA E LIMITA ÀS TOP N
-        # =====================================================================
-        indices_ordenados = df_pivot_valor['TOTAL'].values.argsort()[::-1]  # Decrescente
-        df_pivot_valor = df_pivot_valor.iloc[indices_ordenados].head(top_n).reset_index(drop=True)
-        
-        # Alinha df_qtd com df_valor
-        df_pivot_qtd = df_pivot_qtd.set_index(['cnpj_emitente', 'razao_emitente'])
-        df_pivot_qtd = df_pivot_qtd.reindex(
-            df_pivot_valor.set_index(['cnpj_emitente', 'razao_emitente']).index
-        ).reset_index()
-        
-        # Estatísticas descritivas (das top N)
-        stats_descritivas = {
-            'media': float(df_pivot_valor['TOTAL'].mean()),
-            'mediana': float(df_pivot_valor['TOTAL'].median()),
-            'std': float(df_pivot_valor['TOTAL'].std()),
-            'min': float(df_pivot_valor['TOTAL'].min()),
-            'max': float(df_pivot_valor['TOTAL'].max()),
-            'q1': float(df_pivot_valor['TOTAL'].quantile(0.25)),
-            'q3': float(df_pivot_valor['TOTAL'].quantile(0.75)),
-        }
-        
-        # Total das top N
-        total_top_n = float(df_pivot_valor['TOTAL'].sum())
-        total_itens_top_n = int(df_pivot_qtd['TOTAL'].sum())
-        
-        return df_pivot_valor, df_pivot_qtd, {
-            'total_geral': total_geral_todas,  # Total de TODAS as empresas
-            'total_top_n': total_top_n,        # Total das top N
-            'qtd_empresas': len(df_pivot_valor),  # Qtd no ranking (top N)
-            'qtd_empresas_total': qtd_empresas_total,  # Qtd total de empresas
-            'anos': sorted(anos_cols),
-            'por_ano': stats_por_ano,
-            'descritivas': stats_descritivas,
-            'total_itens': total_itens_todas,  # Total de itens
-            'total_itens_top_n': total_itens_top_n
-        }
-        
+        return _carregar_ranking_data(_engine, nivel, top_n, grupo, versao_tabelas, cursor)
     except Exception as e:
         error_msg = str(e)
         if is_table_unavailable_error(error_msg):
@@ -2935,230 +3124,349 @@ def get_ranking_data(_engine, nivel: str = "ALTA", top_n: int = 100, _cache_vers
         return None, None, None
 
 
-@st.cache_data(ttl=RANKING_CACHE_TTL, show_spinner=False)
-def get_global_stats(_engine, nivel: str = "ALTA", grupo: str = None):
+@cache_compartilhado(max_obsoleto=RANKING_MAX_OBSOLETO_SECONDS, max_entries=RANKING_CACHE_MAX_ENTRIES,
+                     arg_versao='versao_tabelas', copiar=False)
+def _carregar_ordem_ranking(_engine, nivel: str, grupo: str, versao_tabelas: str):
     """
-    Busca estatísticas globais para comparação.
-    Cache de 24 horas.
+    Ordem completa do ranking de um nível, calculada uma vez por versão das tabelas.
+
+    Returns:
+        dict (somente leitura) ou None se o grupo não tem tabelas:
+            - 'ordem': empresas (cnpj_emitente, razao_emitente, TOTAL, itens) em ordem
+              decrescente de TOTAL, desempate por CNPJ e razão social
+            - 'por_ano': empresa × ano (valor, qtd) com a posição ('pos') da empresa na
+              ordem, ordenado por 'pos': uma página é uma fatia contínua
+            - 'stats': estatísticas de todas as empresas (totais, anos, por ano)
     """
-    if grupo is None:
-        grupo = st.session_state.get('grupo_selecionado', GRUPO_PADRAO)
+    resumo = get_resumo_ranking(_engine, grupo, versao_tabelas)
+    if resumo is None:
+        return None
 
-    tabelas = get_grupo_tabelas(grupo)
+    # Todos os níveis estão no mesmo resumo: o ranking de um nível é só uma projeção dele
+    col_valor = f"valor_{(nivel or 'ALTA').lower()}"
+    chaves = ['cnpj_emitente', 'razao_emitente']
+    por_ano = _resumo_no_nivel(resumo, nivel).groupby(
+        chaves + ['ano'], as_index=False, dropna=False, sort=False
+    ).agg(valor=(col_valor, 'sum'), qtd=('qtd', 'sum'))
+    por_ano = por_ano[por_ano['ano'].notna()].reset_index(drop=True)  # período sem ano fica fora, como no pivot
+    if por_ano.empty:
+        return {'ordem': pd.DataFrame(), 'por_ano': por_ano, 'stats': None}
+    por_ano['valor'] = coluna_numerica(por_ano['valor']).fillna(0.0).astype('float64')
+    por_ano['qtd'] = coluna_numerica(por_ano['qtd']).fillna(0).astype('float64')
+
+    agrupado = por_ano.groupby(chaves, dropna=False, sort=False)
+    ordem = agrupado.agg(TOTAL=('valor', 'sum'), itens=('qtd', 'sum')).reset_index()
+    ordem['_empresa'] = np.arange(len(ordem), dtype='int64')  # mesmo número de ngroup()
+    ordem['_cnpj'] = ordem['cnpj_emitente'].fillna('').astype(str)
+    ordem['_razao'] = ordem['razao_emitente'].fillna('').astype(str)
+    ordem = ordem.sort_values(['TOTAL', '_cnpj', '_razao'], ascending=[False, True, True], ignore_index=True)
+
+    # Posição de cada empresa no ranking, levada às linhas empresa × ano
+    posicao_empresa = np.empty(len(ordem), dtype='int64')
+    posicao_empresa[ordem['_empresa'].to_numpy()] = np.arange(len(ordem), dtype='int64')
+    por_ano['pos'] = posicao_empresa[agrupado.ngroup().to_numpy()]
+    por_ano = por_ano.sort_values('pos', kind='stable', ignore_index=True)
+
+    # Estatísticas de todas as empresas (antes da paginação)
+    total_geral = float(ordem['TOTAL'].sum())
+    anos = sorted(a for a in por_ano['ano'].dropna().unique())
+    agregado_ano = por_ano.groupby('ano', dropna=True).agg(
+        valor=('valor', 'sum'), qtd=('qtd', 'sum'), empresas_ativas=('valor', lambda v: int((v > 0).sum()))
+    )
+    stats_por_ano = {
+        ano: {
+            'valor': float(linha['valor']),
+            'qtd': int(linha['qtd']),
+            'pct': (float(linha['valor']) / total_geral * 100) if total_geral > 0 else 0,
+            'empresas_ativas': int(linha['empresas_ativas']),
+        }
+        for ano, linha in agregado_ano.iterrows()
+    }
+    return {
+        'ordem': ordem,
+        'por_ano': por_ano,
+        'stats': {
+            'total_geral': total_geral,
+            'qtd_empresas_total': len(ordem),
+            'total_itens': int(ordem['itens'].sum()),
+            'anos': anos,
+            'por_ano': stats_por_ano,
+        },
+    }
 
-    nivel_upper = (nivel or "ALTA").upper()
-    col_infracao = f"infracao_{nivel_upper.lower()}"
-    col_aliquota = f"aliquota_{nivel_upper.lower()}"
-    col_legislacao = f"legislacao_{nivel_upper.lower()}"
 
-    filtro = f"""
-        {col_infracao} IS NOT NULL
-        AND CAST({col_infracao} AS STRING) != 'EXCLUIR'
-        AND CAST({col_aliquota} AS STRING) != 'EXCLUIR'
-        AND CAST({col_legislacao} AS STRING) != 'EXCLUIR'
+@cache_compartilhado(max_obsoleto=RANKING_MAX_OBSOLETO_SECONDS, max_entries=RANKING_CACHE_MAX_ENTRIES,
+                     arg_versao='versao_tabelas')
+def _carregar_ranking_data(_engine, nivel: str, top_n: int, grupo: str, versao_tabelas: str,
+                           cursor: tuple = None):
     """
+    Parte cacheada de get_ranking_data (chaveada pela versão das tabelas; erros são lançados).
 
-    # Monta queries para cada tabela disponível
-    union_parts = []
-    if tabelas.get('nfce'):
-        union_parts.append(f"""
-            SELECT cnpj_emitente, {col_infracao}
-            FROM {tabelas['nfce']}
-            WHERE {filtro}
-        """)
-    if tabelas.get('cupons'):
-        union_parts.append(f"""
-            SELECT cnpj_emitente, {col_infracao}
-            FROM {tabelas['cupons']}
-            WHERE {filtro}
-        """)
-    if tabelas.get('nfe'):
-        union_parts.append(f"""
-            SELECT cnpj_emitente, {col_infracao}
-            FROM {tabelas['nfe']}
-            WHERE {filtro}
-        """)
+    A ordem de todas as empresas vem pronta de _carregar_ordem_ranking; aqui só a página
+    (top_n empresas depois do cursor) é recortada e pivotada, então o custo depende do
+    tamanho da página e não da quantidade de empresas do grupo.
+    """
+    dados = _carregar_ordem_ranking(_engine, nivel, grupo, versao_tabelas)
+    if dados is None or dados['ordem'].empty:
+        return None, None, None
 
-    if not union_parts:
-        return None
+    ordem, por_ano, stats_gerais = dados['ordem'], dados['por_ano'], dados['stats']
+    inicio = inicio_apos_cursor(ordem, cursor)
+    fim = min(inicio + int(top_n), len(ordem))
+    if inicio >= fim:
+        return None, None, None
+
+    # Linhas empresa × ano da página: fatia contínua de por_ano (ordenado por 'pos')
+    posicoes = por_ano['pos'].to_numpy()
+    df = por_ano.iloc[np.searchsorted(posicoes, inicio, side='left'):np.searchsorted(posicoes, fim, side='left')]
+
+    # Pivoteia para ter anos como colunas (todos os anos do grupo, na mesma ordem em todas as
+    # páginas). O índice é a posição no ranking, então as empresas já saem na ordem da página.
+    anos_cols = stats_gerais['anos']
+    empresas = ordem.iloc[inicio:fim][['cnpj_emitente', 'razao_emitente']].reset_index(drop=True)
+
+    def _pivotar(coluna):
+        pivot = df.pivot_table(index='pos', columns='ano', values=coluna, aggfunc='sum', fill_value=0)
+        pivot = pivot.reindex(index=range(inicio, fim), columns=anos_cols, fill_value=0).astype('float64')
+        pivot = pivot.reset_index(drop=True)
+        pivot.columns.name = None
+        # TOTAL como soma das colunas de anos (float64)
+        pivot['TOTAL'] = pivot[anos_cols].sum(axis=1).astype('float64')
+        return pd.concat([empresas, pivot], axis=1)
+
+    df_pivot_valor = _pivotar('valor')
+    df_pivot_qtd = _pivotar('qtd')
+
+    ultima = ordem.iloc[fim - 1]
+    return df_pivot_valor, df_pivot_qtd, {
+        **stats_gerais,
+        'total_top_n': float(df_pivot_valor['TOTAL'].sum()),  # Total da página
+        'qtd_empresas': len(df_pivot_valor),                  # Qtd na página
+        'total_itens_top_n': int(df_pivot_qtd['TOTAL'].sum()),
+        'descritivas': _estatisticas_descritivas_ranking(df_pivot_valor['TOTAL']),
+        'posicao_inicial': inicio + 1,
+        'proximo_cursor': (float(ultima['TOTAL']), ultima['_cnpj'], ultima['_razao']) if fim < len(ordem) else None,
+    }
+
+
+def _estatisticas_descritivas_ranking(totais: pd.Series) -> dict:
+    """Estatísticas descritivas do TOTAL das empresas exibidas no ranking."""
+    return {
+        'media': float(totais.mean()),
+        'mediana': float(totais.median()),
+        'std': float(totais.std()),
+        'min': float(totais.min()),
+        'max': float(totais.max()),
+        'q1': float(totais.quantile(0.25)),
+        'q3': float(totais.quantile(0.75)),
+    }
 
-    union_query = " UNION ALL ".join(union_parts)
 
-    query = f"""
-    SELECT
-        COUNT(DISTINCT cnpj_emitente) as total_empresas,
-        SUM(CAST({col_infracao} AS FLOAT)) as total_valor,
-        COUNT(*) as total_itens,
-        AVG(CAST({col_infracao} AS FLOAT)) as media_item
-    FROM (
-        {union_query}
-    ) t
+def get_ranking_paginas(_engine, nivel: str, grupo: str, paginas: int):
     """
-    
+    Junta as `paginas` primeiras páginas do ranking (botão "Carregar mais"), seguindo o
+    cursor de cada página. Cada página vem do cache; os totais e as estatísticas
+    descritivas passam a se referir a todas as empresas carregadas.
+
+    Returns:
+        (df_valor, df_qtd, stats) como get_ranking_data, ou (None, None, None)
+    """
+    versao_tabelas = versao_cache_grupo(_engine, grupo)
+    valores, qtds, stats, cursor = [], [], None, None
+    for _ in range(max(1, int(paginas))):
+        df_valor, df_qtd, stats_pagina = get_ranking_data(
+            _engine, nivel, RANKING_PAGINA_TAMANHO, grupo=grupo, versao_tabelas=versao_tabelas, cursor=cursor
+        )
+        if df_valor is None:
+            break
+        valores.append(df_valor)
+        qtds.append(df_qtd)
+        stats = stats_pagina if stats is None else {**stats, 'proximo_cursor': stats_pagina['proximo_cursor']}
+        cursor = stats_pagina['proximo_cursor']
+        if cursor is None:
+            break
+
+    if not valores:
+        return None, None, None
+    df_valor = pd.concat(valores, ignore_index=True)
+    df_qtd = pd.concat(qtds, ignore_index=True)
+    stats = {
+        **stats,
+        'total_top_n': float(df_valor['TOTAL'].sum()),
+        'qtd_empresas': len(df_valor),
+        'total_itens_top_n': int(df_qtd['TOTAL'].sum()),
+        'descritivas': _estatisticas_descritivas_ranking(df_valor['TOTAL']),
+    }
+    return df_valor, df_qtd, stats
+
+
+def get_global_stats(_engine, nivel: str = "ALTA", grupo: str = None, versao_tabelas: str = None):
+    """
+    Busca estatísticas globais para comparação.
+    Cache chaveado pela versão das tabelas (ver get_ranking_data).
+    """
+    if grupo is None:
+        grupo = st.session_state.get('grupo_selecionado', GRUPO_PADRAO)
+    if versao_tabelas is None:
+        versao_tabelas = versao_cache_grupo(_engine, grupo)
     try:
-        df = pd.read_sql(query, _engine)
-        if df.empty:
-            return None
-        return {
-            'total_empresas': int(df['total_empresas'].iloc[0]) if pd.notna(df['total_empresas'].iloc[0]) else 0,
-            'total_valor': float(df['total_valor'].iloc[0]) if pd.notna(df['total_valor'].iloc[0]) else 0,
-            'total_itens': int(df['total_itens'].iloc[0]) if pd.notna(df['total_itens'].iloc[0]) else 0,
-            'media_item': float(df['media_item'].iloc[0]) if pd.notna(df['media_item'].iloc[0]) else 0
-        }
+        return _carregar_global_stats(_engine, nivel, grupo, versao_tabelas)
     except Exception as e:
-        error_msg = str(e)
-        if is_table_unavailable_error(error_msg):
+        if is_table_unavailable_error(str(e)):
             st.warning(TABLE_UNAVAILABLE_MSG)
         return None
 
 
-@st.cache_data(ttl=RANKING_CACHE_TTL, show_spinner=False)
-def get_ranking_acuracia(_engine, top_n: int = 100, _cache_version: int = 6, grupo: str = None):
-    """
-    Busca ranking de empresas por qualidade de acurácia.
-    Ordena por: maior % ALTA, depois % MÉDIA, depois % BAIXA, depois valor total.
-    Cache de 24 horas.
+@cache_compartilhado(max_obsoleto=RANKING_MAX_OBSOLETO_SECONDS, max_entries=RANKING_CACHE_MAX_ENTRIES,
+                     arg_versao='versao_tabelas')
+def _carregar_global_stats(_engine, nivel: str, grupo: str, versao_tabelas: str):
+    """Parte cacheada de get_global_stats (chaveada pela versão das tabelas; erros são lançados)."""
+    totais = get_totais_empresas(_engine, grupo, versao_tabelas)
+    if totais is None:
+        return None
 
-    Lógica dos níveis (hierarquia inclusiva):
-    - BAIXA = todos os registros válidos
-    - MÉDIA = subconjunto de BAIXA (registros mais confiáveis)
-    - ALTA = subconjunto de MÉDIA (registros mais confiáveis ainda)
+    n = (nivel or "ALTA").lower()
+    totais = totais[totais[f'itens_{n}'] > 0]
+    if totais.empty:
+        return None
+    total_valor = float(totais[f'valor_{n}'].sum())
+    total_itens = int(totais[f'itens_{n}'].sum())
+    return {
+        'total_empresas': int(totais['cnpj_emitente'].nunique()),
+        'total_valor': total_valor,
+        'total_itens': total_itens,
+        'media_item': total_valor / total_itens if total_itens > 0 else 0
+    }
 
-    Para calcular valores EXCLUSIVOS:
-    - ALTA pura = válido em ALTA
-    - MÉDIA pura = válido em MÉDIA mas NÃO em ALTA
-    - BAIXA pura = válido em BAIXA mas NÃO em MÉDIA
+
+def get_posicao_ranking(_engine, identificador_digits: str, nivel: str = "ALTA", grupo: str = None,
+                        versao_tabelas: str = None):
+    """
+    Posição exata da empresa (CNPJ) no ranking do nível, sem query adicional: o valor da
+    empresa vem do índice do ranking (_carregar_indice_ranking) e a posição, de uma busca
+    binária nos totais ordenados de todas as empresas.
+
+    Returns:
+        dict com 'posicao' (1 = maior valor; empates dividem a posição), 'total_empresas',
+        'percentil' (% das empresas com valor menor) e 'valor', ou None se a empresa não
+        está no ranking ou o índice não pôde ser montado
     """
     if grupo is None:
         grupo = st.session_state.get('grupo_selecionado', GRUPO_PADRAO)
+    if versao_tabelas is None:
+        versao_tabelas = versao_cache_grupo(_engine, grupo)
+    try:
+        indice = _carregar_indice_ranking(_engine, nivel, grupo, versao_tabelas)
+    except Exception:
+        return None  # a tela mostra "N/A"; o erro aparece no ranking e nas estatísticas
+    if indice is None:
+        return None
 
-    tabelas = get_grupo_tabelas(grupo)
+    valor = indice['por_cnpj'].get(sanitize_identificador(identificador_digits))
+    if valor is None:
+        return None
+    totais = indice['totais']
+    total_empresas = len(totais)
+    maiores = total_empresas - int(np.searchsorted(totais, valor, side='right'))
+    menores = int(np.searchsorted(totais, valor, side='left'))
+    return {
+        'posicao': maiores + 1,
+        'total_empresas': total_empresas,
+        'percentil': menores / total_empresas * 100,
+        'valor': float(valor),
+    }
 
-    filtro_baixa = """
-        CAST(infracao_baixa AS STRING) != 'EXCLUIR'
-        AND CAST(aliquota_baixa AS STRING) != 'EXCLUIR'
-        AND CAST(legislacao_baixa AS STRING) != 'EXCLUIR'
+
+def get_distribuicao_grupo(_engine, nivel: str = "ALTA", grupo: str = None, versao_tabelas: str = None):
     """
+    Quantis (QUANTIS_DISTRIBUICAO) da distribuição do grupo no nível, sem query adicional:
+        - 'itens': valor por item, do histograma de get_distribuicao_itens (~0,5% de erro)
+        - 'empresas': total por empresa, exatos, dos totais ordenados do índice do ranking
 
-    # Monta queries para cada tabela disponível
-    union_parts = []
-    select_cols = """
-        cnpj_emitente, razao_emitente,
-        infracao_alta, infracao_media, infracao_baixa,
-        aliquota_alta, aliquota_media, aliquota_baixa,
-        legislacao_alta, legislacao_media, legislacao_baixa
+    Returns:
+        dict {'itens': {q: valor}, 'empresas': {q: valor}} ou None se indisponível
     """
+    if grupo is None:
+        grupo = st.session_state.get('grupo_selecionado', GRUPO_PADRAO)
+    if versao_tabelas is None:
+        versao_tabelas = versao_cache_grupo(_engine, grupo)
+    try:
+        faixas = get_distribuicao_itens(_engine, grupo, versao_tabelas)
+        indice = _carregar_indice_ranking(_engine, nivel, grupo, versao_tabelas)
+    except Exception:
+        return None  # a tela segue sem a distribuição; o erro aparece no ranking e nas estatísticas
+    if faixas is None or faixas.empty or indice is None:
+        return None
 
-    if tabelas.get('nfce'):
-        union_parts.append(f"""
-            SELECT {select_cols}
-            FROM {tabelas['nfce']}
-            WHERE {filtro_baixa}
-        """)
-    if tabelas.get('cupons'):
-        union_parts.append(f"""
-            SELECT {select_cols}
-            FROM {tabelas['cupons']}
-            WHERE {filtro_baixa}
-        """)
-    if tabelas.get('nfe'):
-        union_parts.append(f"""
-            SELECT {select_cols}
-            FROM {tabelas['nfe']}
-            WHERE {filtro_baixa}
-        """)
+    nivel_upper = (nivel or "ALTA").upper()
+    faixas_nivel = faixas[faixas['nivel'] == nivel_upper][['faixa', 'itens']]
+    if faixas_nivel.empty:
+        return None
+    return {
+        'itens': quantis_histograma(faixas_nivel, QUANTIS_DISTRIBUICAO),
+        'empresas': {q: float(np.quantile(indice['totais'], q)) for q in QUANTIS_DISTRIBUICAO},
+    }
 
-    if not union_parts:
+
+def faixa_na_distribuicao(valor: float, quantis: dict) -> str:
+    """Descreve onde o valor fica entre os quantis (ex.: "entre p90 e p99")."""
+    def rotulo(q):
+        return f"p{q * 100:g}"
+
+    ordenados = sorted(quantis.items())
+    if valor > ordenados[-1][1]:
+        return f"acima do {rotulo(ordenados[-1][0])}"
+    if valor <= ordenados[0][1]:
+        return f"até o {rotulo(ordenados[0][0])}"
+    for (q_inf, v_inf), (q_sup, v_sup) in zip(ordenados, ordenados[1:]):
+        if v_inf < valor <= v_sup:
+            return f"entre {rotulo(q_inf)} e {rotulo(q_sup)}"
+    return "-"
+
+
+@cache_compartilhado(max_obsoleto=RANKING_MAX_OBSOLETO_SECONDS, max_entries=RANKING_CACHE_MAX_ENTRIES,
+                     arg_versao='versao_tabelas', copiar=False)
+def _carregar_indice_ranking(_engine, nivel: str, grupo: str, versao_tabelas: str):
+    """
+    Índice do ranking do nível para consulta de posição (somente leitura):
+        - 'totais': array crescente com o total de cada CNPJ (busca binária)
+        - 'por_cnpj': Series CNPJ (só dígitos) -> total
+    Montado a partir da ordem do ranking (_carregar_ordem_ranking), uma vez por versão das tabelas.
+    """
+    dados = _carregar_ordem_ranking(_engine, nivel, grupo, versao_tabelas)
+    if dados is None or dados['ordem'].empty:
         return None
+    ordem = dados['ordem']
+    cnpj = ordem['_cnpj'].str.replace(r'\D+', '', regex=True)
+    por_cnpj = ordem['TOTAL'].groupby(cnpj.to_numpy(), sort=False).sum()
+    return {
+        'totais': np.sort(por_cnpj.to_numpy(dtype='float64')),
+        'por_cnpj': por_cnpj,
+    }
 
-    union_query = " UNION ALL ".join(union_parts)
 
-    query = f"""
-    SELECT
-        cnpj_emitente,
-        razao_emitente,
-
-        -- ALTA pura: válido em ALTA (usa infracao_baixa como valor base)
-        SUM(CASE WHEN CAST(infracao_alta AS STRING) != 'EXCLUIR'
-                 AND CAST(aliquota_alta AS STRING) != 'EXCLUIR'
-                 AND CAST(legislacao_alta AS STRING) != 'EXCLUIR'
-                 THEN CAST(infracao_baixa AS FLOAT) ELSE 0 END) as total_alta,
-
-        -- MÉDIA pura: válido em MÉDIA mas NÃO em ALTA
-        SUM(CASE WHEN (CAST(infracao_media AS STRING) != 'EXCLUIR'
-                       AND CAST(aliquota_media AS STRING) != 'EXCLUIR'
-                       AND CAST(legislacao_media AS STRING) != 'EXCLUIR')
-                  AND (CAST(infracao_alta AS STRING) = 'EXCLUIR'
-                       OR CAST(aliquota_alta AS STRING) = 'EXCLUIR'
-                       OR CAST(legislacao_alta AS STRING) = 'EXCLUIR')
-                 THEN CAST(infracao_baixa AS FLOAT) ELSE 0 END) as total_media,
-
-        -- BAIXA pura: válido em BAIXA mas NÃO em MÉDIA
-        SUM(CASE WHEN (CAST(infracao_baixa AS STRING) != 'EXCLUIR'
-                       AND CAST(aliquota_baixa AS STRING) != 'EXCLUIR'
-                       AND CAST(legislacao_baixa AS STRING) != 'EXCLUIR')
-                  AND (CAST(infracao_media AS STRING) = 'EXCLUIR'
-                       OR CAST(aliquota_media AS STRING) = 'EXCLUIR'
-                       OR CAST(legislacao_media AS STRING) = 'EXCLUIR')
-                 THEN CAST(infracao_baixa AS FLOAT) ELSE 0 END) as total_baixa,
-
-        -- Contagens para referência
-        SUM(CASE WHEN CAST(infracao_alta AS STRING) != 'EXCLUIR'
-                 AND CAST(aliquota_alta AS STRING) != 'EXCLUIR'
-                 AND CAST(legislacao_alta AS STRING) != 'EXCLUIR'
-                 THEN 1 ELSE 0 END) as qtd_alta,
-
-        SUM(CASE WHEN (CAST(infracao_media AS STRING) != 'EXCLUIR'
-                       AND CAST(aliquota_media AS STRING) != 'EXCLUIR'
-                       AND CAST(legislacao_media AS STRING) != 'EXCLUIR')
-                  AND (CAST(infracao_alta AS STRING) = 'EXCLUIR'
-                       OR CAST(aliquota_alta AS STRING) = 'EXCLUIR'
-                       OR CAST(legislacao_alta AS STRING) = 'EXCLUIR')
-                 THEN 1 ELSE 0 END) as qtd_media,
-
-        SUM(CASE WHEN (CAST(infracao_baixa AS STRING) != 'EXCLUIR'
-                       AND CAST(aliquota_baixa AS STRING) != 'EXCLUIR'
-                       AND CAST(legislacao_baixa AS STRING) != 'EXCLUIR')
-                  AND (CAST(infracao_media AS STRING) = 'EXCLUIR'
-                       OR CAST(aliquota_media AS STRING) = 'EXCLUIR'
-                       OR CAST(legislacao_media AS STRING) = 'EXCLUIR')
-                 THEN 1 ELSE 0 END) as qtd_baixa
-
-    FROM (
-        {union_query}
-    ) t
-    GROUP BY cnpj_emitente, razao_emitente
+def get_ranking_acuracia(_engine, top_n: int = 100, grupo: str = None, versao_tabelas: str = None):
+    """
+    Busca ranking de empresas por qualidade de acurácia.
+    Ordena por: maior % ALTA, depois % MÉDIA, depois % BAIXA, depois valor total.
+    Cache chaveado pela versão das tabelas (ver get_ranking_data).
+
+    Lógica dos níveis (hierarquia inclusiva):
+    - BAIXA = todos os registros válidos
+    - MÉDIA = subconjunto de BAIXA (registros mais confiáveis)
+    - ALTA = subconjunto de MÉDIA (registros mais confiáveis ainda)
+
+    Para calcular valores EXCLUSIVOS:
+    - ALTA pura = válido em ALTA
+    - MÉDIA pura = válido em MÉDIA mas NÃO em ALTA
+    - BAIXA pura = válido em BAIXA mas NÃO em MÉDIA
     """
-    
+    if grupo is None:
+        grupo = st.session_state.get('grupo_selecionado', GRUPO_PADRAO)
+    if versao_tabelas is None:
+        versao_tabelas = versao_cache_grupo(_engine, grupo)
     try:
-        df = pd.read_sql(query, _engine)
-        
-        if df.empty:
-            return None
-        
-        # Calcula totais e percentuais
-        df['total_valor'] = df['total_alta'] + df['total_media'] + df['total_baixa']
-        df['total_qtd'] = df['qtd_alta'] + df['qtd_media'] + df['qtd_baixa']
-        
-        # Filtra empresas com algum valor
-        df = df[df['total_valor'] > 0].copy()
-        
-        # Calcula percentuais
-        df['pct_alta'] = (df['total_alta'] / df['total_valor'] * 100).round(2)
-        df['pct_media'] = (df['total_media'] / df['total_valor'] * 100).round(2)
-        df['pct_baixa'] = (df['total_baixa'] / df['total_valor'] * 100).round(2)
-        
-        # Ordena: maior % ALTA, depois % MÉDIA, depois % BAIXA, depois valor total
-        df = df.sort_values(
-            by=['pct_alta', 'pct_media', 'pct_baixa', 'total_valor'],
-            ascending=[False, False, False, False]
-        ).head(top_n).reset_index(drop=True)
-        
-        # Adiciona posição no ranking
-        df['#'] = range(1, len(df) + 1)
-        
-        return df
-        
+        return _carregar_ranking_acuracia(_engine, top_n, grupo, versao_tabelas)
     except Exception as e:
         error_msg = str(e)
         if is_table_unavailable_error(error_msg):
@@ -3168,164 +3476,228 @@ def get_ranking_acuracia(_engine, top_n: int = 100, _cache_version: int = 6, gru
         return None
 
 
-@st.cache_data(ttl=RANKING_CACHE_TTL, show_spinner=False)
-def get_stats_acuracia_geral(_engine, _cache_version: int = 1, grupo: str = None):
+@cache_compartilhado(max_obsoleto=RANKING_MAX_OBSOLETO_SECONDS, max_entries=RANKING_CACHE_MAX_ENTRIES,
+                     arg_versao='versao_tabelas')
+def _carregar_ranking_acuracia(_engine, top_n: int, grupo: str, versao_tabelas: str):
+    """Parte cacheada de get_ranking_acuracia (chaveada pela versão das tabelas; erros são lançados)."""
+    totais = get_totais_empresas(_engine, grupo, versao_tabelas)
+    if totais is None:
+        return None
+    df = totais[['cnpj_emitente', 'razao_emitente',
+                 'total_alta', 'total_media', 'total_baixa', 'qtd_alta', 'qtd_media', 'qtd_baixa']].copy()
+    
+    if df.empty:
+        return None
+    
+    # Calcula totais e percentuais
+    df['total_valor'] = df['total_alta'] + df['total_media'] + df['total_baixa']
+    df['total_qtd'] = df['qtd_alta'] + df['qtd_media'] + df['qtd_baixa']
+    
+    # Filtra empresas com algum valor
+    df = df[df['total_valor'] > 0].copy()
+    
+    # Calcula percentuais
+    df['pct_alta'] = (df['total_alta'] / df['total_valor'] * 100).round(2)
+    df['pct_media'] = (df['total_media'] / df['total_valor'] * 100).round(2)
+    df['pct_baixa'] = (df['total_baixa'] / df['total_valor'] * 100).round(2)
+    
+    # Ordena: maior % ALTA, depois % MÉDIA, depois % BAIXA, depois valor total
+    df = df.sort_values(
+        by=['pct_alta', 'pct_media', 'pct_baixa', 'total_valor'],
+        ascending=[False, False, False, False]
+    ).head(top_n).reset_index(drop=True)
+    
+    # Adiciona posição no ranking
+    df['#'] = range(1, len(df) + 1)
+    
+    return df
+    
+
+
+def get_stats_acuracia_geral(_engine, grupo: str = None, versao_tabelas: str = None):
     """
     Busca estatísticas gerais de acurácia (totais por nível).
     Retorna valor e quantidade para cada nível (ALTA, MÉDIA, BAIXA) com valores exclusivos.
-    Cache de 24 horas.
+    Cache chaveado pela versão das tabelas (ver get_ranking_data).
     """
     if grupo is None:
         grupo = st.session_state.get('grupo_selecionado', GRUPO_PADRAO)
+    if versao_tabelas is None:
+        versao_tabelas = versao_cache_grupo(_engine, grupo)
+    try:
+        return _carregar_stats_acuracia_geral(_engine, grupo, versao_tabelas)
+    except Exception as e:
+        error_msg = str(e)
+        if is_table_unavailable_error(error_msg):
+            st.warning(TABLE_UNAVAILABLE_MSG)
+        elif "TTransport" in error_msg or "timeout" in error_msg.lower() or "read 0 bytes" in error_msg:
+            st.warning("⏳ **Consulta muito pesada.** A query de estatísticas gerais pode demorar. Tente novamente em alguns minutos.")
+        else:
+            st.error(f"Erro ao buscar estatísticas: {error_msg[:150]}")
+        return None
 
-    tabelas = get_grupo_tabelas(grupo)
 
-    filtro_baixa = """
-        CAST(infracao_baixa AS STRING) != 'EXCLUIR'
-        AND CAST(aliquota_baixa AS STRING) != 'EXCLUIR'
-        AND CAST(legislacao_baixa AS STRING) != 'EXCLUIR'
-    """
+@cache_compartilhado(max_obsoleto=RANKING_MAX_OBSOLETO_SECONDS, max_entries=RANKING_CACHE_MAX_ENTRIES,
+                     arg_versao='versao_tabelas')
+def _carregar_stats_acuracia_geral(_engine, grupo: str, versao_tabelas: str):
+    """Parte cacheada de get_stats_acuracia_geral (chaveada pela versão das tabelas; erros são lançados)."""
+    totais = get_totais_empresas(_engine, grupo, versao_tabelas)
+    if totais is None:
+        return None
+    df = totais[['total_alta', 'total_media', 'total_baixa', 'qtd_alta', 'qtd_media', 'qtd_baixa']].sum().to_frame().T
+    df = df.rename(columns={'total_alta': 'valor_alta', 'total_media': 'valor_media', 'total_baixa': 'valor_baixa'})
+    
+    if df.empty:
+        return None
+    
+    # Extrai valores
+    valor_alta = float(df['valor_alta'].iloc[0]) if pd.notna(df['valor_alta'].iloc[0]) else 0
+    valor_media = float(df['valor_media'].iloc[0]) if pd.notna(df['valor_media'].iloc[0]) else 0
+    valor_baixa = float(df['valor_baixa'].iloc[0]) if pd.notna(df['valor_baixa'].iloc[0]) else 0
+    
+    qtd_alta = int(df['qtd_alta'].iloc[0]) if pd.notna(df['qtd_alta'].iloc[0]) else 0
+    qtd_media = int(df['qtd_media'].iloc[0]) if pd.notna(df['qtd_media'].iloc[0]) else 0
+    qtd_baixa = int(df['qtd_baixa'].iloc[0]) if pd.notna(df['qtd_baixa'].iloc[0]) else 0
+    
+    # Totais
+    valor_total = valor_alta + valor_media + valor_baixa
+    qtd_total = qtd_alta + qtd_media + qtd_baixa
+    
+    # Percentuais
+    pct_valor_alta = (valor_alta / valor_total * 100) if valor_total > 0 else 0
+    pct_valor_media = (valor_media / valor_total * 100) if valor_total > 0 else 0
+    pct_valor_baixa = (valor_baixa / valor_total * 100) if valor_total > 0 else 0
+    
+    pct_qtd_alta = (qtd_alta / qtd_total * 100) if qtd_total > 0 else 0
+    pct_qtd_media = (qtd_media / qtd_total * 100) if qtd_total > 0 else 0
+    pct_qtd_baixa = (qtd_baixa / qtd_total * 100) if qtd_total > 0 else 0
+    
+    return {
+        'valor_alta': valor_alta,
+        'valor_media': valor_media,
+        'valor_baixa': valor_baixa,
+        'valor_total': valor_total,
+        'qtd_alta': qtd_alta,
+        'qtd_media': qtd_media,
+        'qtd_baixa': qtd_baixa,
+        'qtd_total': qtd_total,
+        'pct_valor_alta': pct_valor_alta,
+        'pct_valor_media': pct_valor_media,
+        'pct_valor_baixa': pct_valor_baixa,
+        'pct_qtd_alta': pct_qtd_alta,
+        'pct_qtd_media': pct_qtd_media,
+        'pct_qtd_baixa': pct_qtd_baixa
+    }
 
-    # Monta queries para cada tabela disponível
-    union_parts = []
-    select_cols = """
-        infracao_alta, infracao_media, infracao_baixa,
-        aliquota_alta, aliquota_media, aliquota_baixa,
-        legislacao_alta, legislacao_media, legislacao_baixa
-    """
 
-    if tabelas.get('nfce'):
-        union_parts.append(f"""
-            SELECT {select_cols}
-            FROM {tabelas['nfce']}
-            WHERE {filtro_baixa}
-        """)
-    if tabelas.get('cupons'):
-        union_parts.append(f"""
-            SELECT {select_cols}
-            FROM {tabelas['cupons']}
-            WHERE {filtro_baixa}
-        """)
-    if tabelas.get('nfe'):
-        union_parts.append(f"""
-            SELECT {select_cols}
-            FROM {tabelas['nfe']}
-            WHERE {filtro_baixa}
-        """)
+# =============================================================================
+# 9.0. AQUECIMENTO DOS CACHES DE RANKING EM SEGUNDO PLANO
+# =============================================================================
 
-    if not union_parts:
-        return None
+# Último aquecimento de cada grupo (deste processo)
+_AQUECIMENTO_CACHE = estado_processo('aquecimento_cache', dict)
+_AQUECIMENTO_CACHE_LOCK = estado_processo('aquecimento_cache_lock', threading.Lock)
 
-    union_query = " UNION ALL ".join(union_parts)
 
-    query = f"""
-    SELECT
-        -- ALTA pura: válido em ALTA
-        SUM(CASE WHEN CAST(infracao_alta AS STRING) != 'EXCLUIR'
-                 AND CAST(aliquota_alta AS STRING) != 'EXCLUIR'
-                 AND CAST(legislacao_alta AS STRING) != 'EXCLUIR'
-                 THEN CAST(infracao_baixa AS FLOAT) ELSE 0 END) as valor_alta,
-
-        -- MÉDIA pura: válido em MÉDIA mas NÃO em ALTA
-        SUM(CASE WHEN (CAST(infracao_media AS STRING) != 'EXCLUIR'
-                       AND CAST(aliquota_media AS STRING) != 'EXCLUIR'
-                       AND CAST(legislacao_media AS STRING) != 'EXCLUIR')
-                  AND (CAST(infracao_alta AS STRING) = 'EXCLUIR'
-                       OR CAST(aliquota_alta AS STRING) = 'EXCLUIR'
-                       OR CAST(legislacao_alta AS STRING) = 'EXCLUIR')
-                 THEN CAST(infracao_baixa AS FLOAT) ELSE 0 END) as valor_media,
-
-        -- BAIXA pura: válido em BAIXA mas NÃO em MÉDIA
-        SUM(CASE WHEN (CAST(infracao_baixa AS STRING) != 'EXCLUIR'
-                       AND CAST(aliquota_baixa AS STRING) != 'EXCLUIR'
-                       AND CAST(legislacao_baixa AS STRING) != 'EXCLUIR')
-                  AND (CAST(infracao_media AS STRING) = 'EXCLUIR'
-                       OR CAST(aliquota_media AS STRING) = 'EXCLUIR'
-                       OR CAST(legislacao_media AS STRING) = 'EXCLUIR')
-                 THEN CAST(infracao_baixa AS FLOAT) ELSE 0 END) as valor_baixa,
-
-        -- Contagens exclusivas
-        SUM(CASE WHEN CAST(infracao_alta AS STRING) != 'EXCLUIR'
-                 AND CAST(aliquota_alta AS STRING) != 'EXCLUIR'
-                 AND CAST(legislacao_alta AS STRING) != 'EXCLUIR'
-                 THEN 1 ELSE 0 END) as qtd_alta,
-
-        SUM(CASE WHEN (CAST(infracao_media AS STRING) != 'EXCLUIR'
-                       AND CAST(aliquota_media AS STRING) != 'EXCLUIR'
-                       AND CAST(legislacao_media AS STRING) != 'EXCLUIR')
-                  AND (CAST(infracao_alta AS STRING) = 'EXCLUIR'
-                       OR CAST(aliquota_alta AS STRING) = 'EXCLUIR'
-                       OR CAST(legislacao_alta AS STRING) = 'EXCLUIR')
-                 THEN 1 ELSE 0 END) as qtd_media,
-
-        SUM(CASE WHEN (CAST(infracao_baixa AS STRING) != 'EXCLUIR'
-                       AND CAST(aliquota_baixa AS STRING) != 'EXCLUIR'
-                       AND CAST(legislacao_baixa AS STRING) != 'EXCLUIR')
-                  AND (CAST(infracao_media AS STRING) = 'EXCLUIR'
-                       OR CAST(aliquota_media AS STRING) = 'EXCLUIR'
-                       OR CAST(legislacao_media AS STRING) = 'EXCLUIR')
-                 THEN 1 ELSE 0 END) as qtd_baixa
-
-    FROM (
-        {union_query}
-    ) t
+def aquecer_caches_grupo(engine, grupo: str) -> dict:
     """
-    
+    Calcula os caches de ranking e estatísticas do grupo com os mesmos argumentos usados
+    pelas telas (ranking top 100, acurácia top 100 e 10000, estatísticas e índice de posição
+    por nível), para
+    que o primeiro auditor do dia já encontre tudo pronto. Com o cache quente, leva milissegundos.
+    """
+    inicio = time.perf_counter()
+    versao = None
+    erro = None
     try:
-        df = pd.read_sql(query, _engine)
-        
-        if df.empty:
-            return None
-        
-        # Extrai valores
-        valor_alta = float(df['valor_alta'].iloc[0]) if pd.notna(df['valor_alta'].iloc[0]) else 0
-        valor_media = float(df['valor_media'].iloc[0]) if pd.notna(df['valor_media'].iloc[0]) else 0
-        valor_baixa = float(df['valor_baixa'].iloc[0]) if pd.notna(df['valor_baixa'].iloc[0]) else 0
-        
-        qtd_alta = int(df['qtd_alta'].iloc[0]) if pd.notna(df['qtd_alta'].iloc[0]) else 0
-        qtd_media = int(df['qtd_media'].iloc[0]) if pd.notna(df['qtd_media'].iloc[0]) else 0
-        qtd_baixa = int(df['qtd_baixa'].iloc[0]) if pd.notna(df['qtd_baixa'].iloc[0]) else 0
-        
-        # Totais
-        valor_total = valor_alta + valor_media + valor_baixa
-        qtd_total = qtd_alta + qtd_media + qtd_baixa
-        
-        # Percentuais
-        pct_valor_alta = (valor_alta / valor_total * 100) if valor_total > 0 else 0
-        pct_valor_media = (valor_media / valor_total * 100) if valor_total > 0 else 0
-        pct_valor_baixa = (valor_baixa / valor_total * 100) if valor_total > 0 else 0
-        
-        pct_qtd_alta = (qtd_alta / qtd_total * 100) if qtd_total > 0 else 0
-        pct_qtd_media = (qtd_media / qtd_total * 100) if qtd_total > 0 else 0
-        pct_qtd_baixa = (qtd_baixa / qtd_total * 100) if qtd_total > 0 else 0
-        
-        return {
-            'valor_alta': valor_alta,
-            'valor_media': valor_media,
-            'valor_baixa': valor_baixa,
-            'valor_total': valor_total,
-            'qtd_alta': qtd_alta,
-            'qtd_media': qtd_media,
-            'qtd_baixa': qtd_baixa,
-            'qtd_total': qtd_total,
-            'pct_valor_alta': pct_valor_alta,
-            'pct_valor_media': pct_valor_media,
-            'pct_valor_baixa': pct_valor_baixa,
-            'pct_qtd_alta': pct_qtd_alta,
-            'pct_qtd_media': pct_qtd_media,
-            'pct_qtd_baixa': pct_qtd_baixa
-        }
-        
+        versao = versao_cache_grupo(engine, grupo)
+        # O resumo não serve versão antiga: espera a montagem, e os loaders abaixo (que
+        # poderiam devolver o valor anterior e recalcular em segundo plano) só projetam
+        get_resumo_ranking(engine, grupo, versao)  # já traz o histograma de get_distribuicao_itens
+        _carregar_ranking_data(engine, "ALTA", RANKING_PAGINA_TAMANHO, grupo, versao)
+        for top_n in (10000, 100):
+            _carregar_ranking_acuracia(engine, top_n, grupo, versao)
+        _carregar_stats_acuracia_geral(engine, grupo, versao)
+        for nivel in NIVEIS_BITS:
+            _carregar_global_stats(engine, nivel, grupo, versao)
+            _carregar_indice_ranking(engine, nivel, grupo, versao)
     except Exception as e:
-        error_msg = str(e)
-        if is_table_unavailable_error(error_msg):
-            st.warning(TABLE_UNAVAILABLE_MSG)
-        elif "TTransport" in error_msg or "timeout" in error_msg.lower() or "read 0 bytes" in error_msg:
-            st.warning("⏳ **Consulta muito pesada.** A query de estatísticas gerais pode demorar. Tente novamente em alguns minutos.")
-        else:
-            st.error(f"Erro ao buscar estatísticas: {error_msg[:150]}")
+        erro = str(e)[:150]
+
+    resultado = {
+        'grupo': grupo,
+        'versao': versao,
+        'segundos': round(time.perf_counter() - inicio, 2),
+        'status': f"erro: {erro}" if erro else "ok",
+        'quando': datetime.now().strftime('%d/%m/%Y %H:%M:%S'),
+    }
+    with _AQUECIMENTO_CACHE_LOCK:
+        _AQUECIMENTO_CACHE[grupo] = resultado
+    return resultado
+
+
+def _rodada_aquecimento(engine):
+    """Aquece todos os grupos de GRUPOS_ORDENADOS, escalonados e com concorrência limitada."""
+    max_paralelo = max(1, int(AQUECIMENTO_CACHE_CONFIG['max_paralelo']))
+    escalonamento = float(AQUECIMENTO_CACHE_CONFIG['escalonamento_segundos'])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_paralelo, thread_name_prefix="argos_aquecimento") as executor:
+        futures = []
+        for i, grupo in enumerate(GRUPOS_ORDENADOS):
+            if i and escalonamento > 0:
+                time.sleep(escalonamento)
+            futures.append(executor.submit(aquecer_caches_grupo, engine, grupo))
+        concurrent.futures.wait(futures)
+
+
+@st.cache_resource
+def iniciar_aquecimento_cache(_engine):
+    """
+    Inicia (uma vez por processo) a thread que aquece os caches de todos os grupos e
+    repete a rodada a cada `ciclo_segundos`: após uma recarga das tabelas ou uma limpeza
+    de cache, o próximo ciclo refaz o resumo antes que um usuário precise dele. Com a
+    réplica local ativa, cada ciclo começa sincronizando as tabelas desatualizadas.
+    """
+    if not AQUECIMENTO_CACHE_CONFIG['ativo']:
         return None
 
+    def _loop():
+        while True:
+            if REPLICA_LOCAL_CONFIG['sincronizar_automaticamente']:
+                try:
+                    # Réplica antes do aquecimento: o resumo do ranking já é montado sobre ela
+                    sincronizar_replicas(_engine)
+                except Exception:
+                    pass
+            try:
+                _rodada_aquecimento(_engine)
+            except Exception:
+                pass  # um ciclo com erro não derruba o aquecimento; o status fica por grupo
+            time.sleep(max(60, float(AQUECIMENTO_CACHE_CONFIG['ciclo_segundos'])))
+
+    thread = threading.Thread(target=_loop, name="argos_aquecimento_cache", daemon=True)
+    thread.start()
+    return thread
+
+
+def get_status_aquecimento() -> pd.DataFrame:
+    """Último aquecimento de cada grupo, na ordem das abas."""
+    with _AQUECIMENTO_CACHE_LOCK:
+        registros = [_AQUECIMENTO_CACHE[g] for g in GRUPOS_ORDENADOS if g in _AQUECIMENTO_CACHE]
+    return pd.DataFrame(registros)
+
+
+def render_carregar_mais_ranking(stats: dict, chave_paginas: str):
+    """Botão que carrega a próxima página do ranking (RANKING_PAGINA_TAMANHO empresas)."""
+    if stats.get('proximo_cursor') is None:
+        if stats['qtd_empresas'] > RANKING_PAGINA_TAMANHO:
+            st.caption(f"Todas as {stats['qtd_empresas_total']:,} empresas carregadas.")
+        return
+    restantes = stats['qtd_empresas_total'] - stats['qtd_empresas']
+    if st.button(f"⬇️ Carregar mais {min(RANKING_PAGINA_TAMANHO, restantes):,} empresas "
+                 f"({restantes:,} restantes)", key=f"btn_{chave_paginas}"):
+        st.session_state[chave_paginas] = st.session_state.get(chave_paginas, 1) + 1
+        st.rerun()
+
 
 def render_ranking(engine, nivel: str = "ALTA"):
     """Renderiza a página de Ranking de Empresas."""
@@ -3370,10 +3742,12 @@ def render_ranking(engine, nivel: str = "ALTA"):
     nivel = "ALTA"
     
     # Mostra período limite no caption
-    st.caption("📊 Nível: **🟢 ALTA** (maior confiabilidade) | Dados agregados por empresa e ano | Cache: 24h")
+    st.caption("📊 Nível: **🟢 ALTA** (maior confiabilidade) | Dados agregados por empresa e ano | Cache: até a próxima carga das tabelas")
     
     with st.spinner("Carregando ranking..."):
-        df_valor, df_qtd, stats = get_ranking_data(engine, nivel, top_n=100, _cache_version=8)
+        grupo = st.session_state.get('grupo_selecionado', GRUPO_PADRAO)
+        chave_paginas = f"ranking_paginas_{grupo}"
+        df_valor, df_qtd, stats = get_ranking_paginas(engine, nivel, grupo, st.session_state.get(chave_paginas, 1))
     
     if df_valor is None:
         st.warning("Não foi possível carregar o ranking.")
@@ -3394,16 +3768,16 @@ def render_ranking(engine, nivel: str = "ALTA"):
     with col2:
         pct_top100 = (stats['total_top_n'] / stats['total_geral'] * 100) if stats['total_geral'] > 0 else 0
         st.metric(
-            "🏆 Top 100", 
+            f"🏆 Top {stats['qtd_empresas']}", 
             format_currency_br(stats['total_top_n']),
             delta=f"{pct_top100:.1f}% do total",
-            help="Soma das 100 maiores empresas"
+            help=f"Soma das {stats['qtd_empresas']} maiores empresas (páginas carregadas)"
         )
     with col3:
         st.metric(
             "🏢 Empresas", 
             f"{stats['qtd_empresas_total']:,}",
-            delta=f"Top 100 de {stats['qtd_empresas_total']:,}",
+            delta=f"Top {stats['qtd_empresas']:,} de {stats['qtd_empresas_total']:,}",
             delta_color="off",
             help="Total de empresas com infrações"
         )
@@ -3464,7 +3838,7 @@ def render_ranking(engine, nivel: str = "ALTA"):
     # =========================================================================
     # SELETOR DE ANO PARA ORDENAÇÃO
     # =========================================================================
-    st.markdown("### 🏅 Top 100 Empresas")
+    st.markdown(f"### 🏅 Top {stats['qtd_empresas']:,} Empresas")
     
     col_ordem, col_info = st.columns([1, 5])
     
@@ -3538,6 +3912,8 @@ def render_ranking(engine, nivel: str = "ALTA"):
         st.caption("💡 Clique no cabeçalho da coluna para ordenar. Colunas % mostram participação de cada ano no total da empresa.")
     else:
         st.caption(f"💡 Ranking ordenado por **% em {ano_selecionado}**. Empresas com maior concentração de infrações neste ano aparecem primeiro. ⭐ = ano selecionado.")
+
+    render_carregar_mais_ranking(stats, chave_paginas)
     
     # =========================================================================
     # EXPANDER: ESTATÍSTICAS GERAIS DE ACURÁCIA
@@ -3557,7 +3933,7 @@ def render_ranking(engine, nivel: str = "ALTA"):
         
         with st.spinner("Carregando estatísticas de acurácia..."):
             # Primeiro tenta usar os dados do ranking de acurácia (mais leve)
-            df_acuracia = get_ranking_acuracia(engine, top_n=10000, _cache_version=6)
+            df_acuracia = get_ranking_acuracia(engine, top_n=10000)
             
             if df_acuracia is not None and not df_acuracia.empty:
                 # Calcula totais a partir do ranking (soma de todas as empresas)
@@ -3760,7 +4136,7 @@ def render_ranking(engine, nivel: str = "ALTA"):
         """)
         
         with st.spinner("Carregando ranking de acurácia..."):
-            df_acuracia = get_ranking_acuracia(engine, top_n=100, _cache_version=6)
+            df_acuracia = get_ranking_acuracia(engine, top_n=100)
         
         if df_acuracia is not None and not df_acuracia.empty:
             # Prepara dados para exibição
@@ -4107,6 +4483,13 @@ def search_products_by_description(_engine, search_term: str, limit: int = 1000,
     union_query = " UNION ALL ".join(union_parts)
     query = f"{union_query} LIMIT {limit}"
 
+    # Réplica local atualizada: o LIKE roda no DuckDB sobre os arquivos locais
+    if replica_disponivel(_engine, tabelas.values()):
+        try:
+            return consultar_replica(list(tabelas.values()), query, 'pesquisa_produtos')
+        except Exception as e:
+            registrar_tempo_tabela('pesquisa_produtos', 'réplica', 0.0, 0, f"erro, usando Impala: {str(e)[:80]}")
+
     try:
         df = pd.read_sql(query, _engine)
         return df
@@ -4189,7 +4572,7 @@ def render_pesquisa_produtos(engine):
         # PRÉ-PROCESSAMENTO DOS DADOS
         # =====================================================================
         # Converte infracao_baixa para numérico
-        df['valor_infracao'] = pd.to_numeric(df['infracao_baixa'], errors='coerce').fillna(0)
+        df['valor_infracao'] = coluna_numerica(df['infracao_baixa'])
         
         # =====================================================================
         # RESULTADOS
@@ -4507,10 +4890,11 @@ def render_ranking_tab(engine, grupo: str):
     # Usa nível ALTA fixo (maior confiabilidade)
     nivel = "ALTA"
 
-    st.caption("📊 Nível: **🟢 ALTA** (maior confiabilidade) | Dados agregados por empresa e ano | Cache: 24h")
+    st.caption("📊 Nível: **🟢 ALTA** (maior confiabilidade) | Dados agregados por empresa e ano | Cache: até a próxima carga das tabelas")
 
     with st.spinner("Carregando ranking..."):
-        df_valor, df_qtd, stats = get_ranking_data(engine, nivel, top_n=100, _cache_version=8, grupo=grupo)
+        chave_paginas = f"ranking_paginas_{grupo}"
+        df_valor, df_qtd, stats = get_ranking_paginas(engine, nivel, grupo, st.session_state.get(chave_paginas, 1))
 
     if df_valor is None:
         st.warning("Não foi possível carregar o ranking.")
@@ -4529,16 +4913,16 @@ def render_ranking_tab(engine, grupo: str):
     with col2:
         pct_top100 = (stats['total_top_n'] / stats['total_geral'] * 100) if stats['total_geral'] > 0 else 0
         st.metric(
-            "🏆 Top 100",
+            f"🏆 Top {stats['qtd_empresas']}",
             format_currency_br(stats['total_top_n']),
             delta=f"{pct_top100:.1f}% do total",
-            help="Soma das 100 maiores empresas"
+            help=f"Soma das {stats['qtd_empresas']} maiores empresas (páginas carregadas)"
         )
     with col3:
         st.metric(
             "🏢 Empresas",
             f"{stats['qtd_empresas_total']:,}",
-            delta=f"Top 100 de {stats['qtd_empresas_total']:,}",
+            delta=f"Top {stats['qtd_empresas']:,} de {stats['qtd_empresas_total']:,}",
             delta_color="off",
             help="Total de empresas com infrações"
         )
@@ -4590,7 +4974,7 @@ def render_ranking_tab(engine, grupo: str):
             df_display[col_pct] = df_display[col_pct].fillna(0)
 
     # TABELA DO RANKING
-    st.markdown("### 🏅 Top 100 Empresas")
+    st.markdown(f"### 🏅 Top {stats['qtd_empresas']:,} Empresas")
 
     # Reordena colunas
     cols_ordenadas = ['#', 'CNPJ', 'Razão Social']
@@ -4625,6 +5009,8 @@ def render_ranking_tab(engine, grupo: str):
 
     st.caption("💡 Clique no cabeçalho da coluna para ordenar. Ordenado por valor TOTAL.")
 
+    render_carregar_mais_ranking(stats, chave_paginas)
+
     # =========================================================================
     # EXPANDER: ESTATÍSTICAS GERAIS DE ACURÁCIA
     # =========================================================================
@@ -4643,7 +5029,7 @@ def render_ranking_tab(engine, grupo: str):
 
         with st.spinner("Carregando estatísticas de acurácia..."):
             # Primeiro tenta usar os dados do ranking de acurácia (mais leve)
-            df_acuracia = get_ranking_acuracia(engine, top_n=10000, _cache_version=6, grupo=grupo)
+            df_acuracia = get_ranking_acuracia(engine, top_n=10000, grupo=grupo)
 
             if df_acuracia is not None and not df_acuracia.empty:
                 # Calcula totais a partir do ranking (soma de todas as empresas)
@@ -4846,7 +5232,7 @@ def render_ranking_tab(engine, grupo: str):
         """)
 
         with st.spinner("Carregando ranking de acurácia..."):
-            df_acuracia_rank = get_ranking_acuracia(engine, top_n=100, _cache_version=6, grupo=grupo)
+            df_acuracia_rank = get_ranking_acuracia(engine, top_n=100, grupo=grupo)
 
         if df_acuracia_rank is not None and not df_acuracia_rank.empty:
             # Prepara dados para exibição
@@ -5083,6 +5469,159 @@ def render_ranking_tab(engine, grupo: str):
             fig.update_layout(xaxis_tickangle=-45, showlegend=False)
             st.plotly_chart(fig, use_container_width=True)
 
+    # =========================================================================
+    # EXPANDER: DIAGNÓSTICO DE DESEMPENHO
+    # =========================================================================
+    with st.expander("⚡ Diagnóstico de Desempenho", expanded=False):
+        problemas = problemas_configuracao()
+        if problemas:
+            st.warning("⚠️ Configurações do secrets.toml ignoradas (valendo o padrão):\n\n" +
+                       "\n".join(f"- {problema}" for problema in problemas))
+
+        modo_auto = modo_escrita_excel(EXCEL_XLSXWRITER_MIN_LINHAS)
+        st.caption(
+            f"Backend: {EXCEL_BACKEND} — exportações a partir de {EXCEL_XLSXWRITER_MIN_LINHAS:,} linhas usam "
+            f"'{modo_auto}'; abaixo disso, '{EXCEL_MODO_ESCRITA}'."
+        )
+
+        st.markdown("---")
+        st.markdown("**🔌 Pool de conexões Impala** (desde o início do servidor)")
+
+        metricas_pool = get_metricas_pool(engine)
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.metric("Em uso", metricas_pool.get('em_uso', 0),
+                      delta=f"overflow {metricas_pool.get('overflow', 0)}", delta_color="off")
+        with col2:
+            st.metric("Ociosas", metricas_pool.get('ociosas', 0))
+        with col3:
+            st.metric("Checkouts", f"{metricas_pool['checkouts']:,}")
+        with col4:
+            st.metric("Invalidações", metricas_pool['invalidacoes'])
+
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.metric("Espera média", f"{metricas_pool['espera_media'] * 1000:.0f} ms")
+        with col2:
+            st.metric("Espera máxima", f"{metricas_pool['espera_max']:.2f} s",
+                      delta=f"{metricas_pool['esperas_lentas']} lentas", delta_color="off")
+        with col3:
+            st.metric("Handshakes", metricas_pool['conexoes_criadas'])
+        with col4:
+            st.metric("Handshake médio", f"{metricas_pool['handshake_medio']:.2f} s")
+
+        warmup = metricas_pool.get('warmup')
+        if warmup:
+            if warmup['erro']:
+                st.caption(f"🔥 Aquecimento ({warmup['quando']}): {warmup['conexoes']} conexões - erro: {warmup['erro']}")
+            else:
+                st.caption(f"🔥 Aquecimento ({warmup['quando']}): {warmup['conexoes']} conexões em {warmup['segundos']} s")
+        st.caption(
+            f"Config: pool_size={IMPALA_POOL_CONFIG['pool_size']}, max_overflow={IMPALA_POOL_CONFIG['max_overflow']}, "
+            f"pool_timeout={IMPALA_POOL_CONFIG['pool_timeout']}s, pool_recycle={IMPALA_POOL_CONFIG['pool_recycle']}s, "
+            f"pre_ping={IMPALA_POOL_CONFIG['pool_pre_ping']}"
+        )
+
+        st.markdown("---")
+        st.markdown("**💽 Cache em disco das consultas** (Parquet, compartilhado entre sessões)")
+        if cache_disco_ativo():
+            status_disco = get_status_cache_disco()
+            col1, col2, col3, col4 = st.columns(4)
+            with col1:
+                st.metric("Arquivos", status_disco['arquivos'],
+                          delta=f"{status_disco['mb']:,.0f} / {CACHE_DISCO_CONFIG['max_mb']:,} MB", delta_color="off")
+            with col2:
+                st.metric("Acertos", status_disco['acertos'])
+            with col3:
+                st.metric("Faltas", status_disco['faltas'])
+            with col4:
+                st.metric("Removidos (LRU)", status_disco['removidos'],
+                          delta=f"{status_disco['erros']} erros", delta_color="off")
+            st.caption(f"Diretório: `{CACHE_DISCO_CONFIG['diretorio']}` · métricas deste processo")
+        else:
+            st.caption("Desativado" + ("" if PYARROW_AVAILABLE else " (pyarrow indisponível)") + ".")
+
+        st.markdown("**📦 Cache de exportações** (Excel/ZIP gerados, compartilhado entre sessões)")
+        if cache_exportacao_ativo():
+            status_export = get_status_cache_exportacao()
+            st.caption(
+                f"{status_export['arquivos']} arquivos · {status_export['mb']:,.0f} / {EXPORT_CACHE_CONFIG['max_mb']:,} MB · "
+                f"layout v{EXCEL_LAYOUT_VERSAO} · diretório: `{EXPORT_CACHE_CONFIG['diretorio']}`"
+            )
+        else:
+            st.caption("Desativado.")
+
+        st.markdown("---")
+        config_versao = get_grupo_config(grupo)
+        sonda = config_versao.get('sonda_versao', 'metadados')
+        st.markdown(f"**🏷️ Versão das tabelas** (chave dos caches de ranking e estatísticas - sonda: {sonda})")
+        versoes = [
+            {'tipo': tipo, 'tabela': tabela, 'versao': get_versao_tabela(engine, tabela, sonda) or "sonda falhou"}
+            for tipo, tabela in config_versao.get('tabelas', {}).items()
+        ]
+        st.dataframe(pd.DataFrame(versoes), use_container_width=True, hide_index=True)
+        st.caption(f"Chave atual do grupo: `{versao_cache_grupo(engine, grupo)}` · "
+                   f"sondas refeitas a cada {VERSAO_TABELAS_TTL_SECONDS // 60} min · "
+                   f"resumo materializado dos rankings: {'ativo' if RESUMO_RANKING_MATERIALIZADO else 'desativado'}")
+
+        st.markdown("---")
+        st.markdown("**🧩 Cache compartilhado dos loaders** (single-flight e stale-while-revalidate)")
+        st.dataframe(get_status_caches_compartilhados(), use_container_width=True, hide_index=True)
+        st.caption(
+            "acertos: valor válido · obsoletos: valor anterior servido enquanto recalcula · "
+            "esperas: sessões que aguardaram um cálculo já em andamento"
+        )
+
+        st.markdown("---")
+        st.markdown("**🗄️ Réplica local** (Parquet + DuckDB; consulta, comparativo e pesquisa de produtos)")
+        if not replica_local_ativa():
+            motivo = ("" if DUCKDB_AVAILABLE else " (duckdb indisponível)") + ("" if PYARROW_AVAILABLE else " (pyarrow indisponível)")
+            st.caption("Desativada" + motivo + ".")
+        else:
+            st.dataframe(get_status_replica(engine, grupo), use_container_width=True, hide_index=True)
+            st.caption(f"Diretório: `{REPLICA_LOCAL_CONFIG['diretorio']}` · tabelas desatualizadas são consultadas no Impala")
+            if st.button("🔄 Sincronizar réplica do grupo", key="btn_sincronizar_replica"):
+                threading.Thread(
+                    target=sincronizar_replicas, args=(engine, [grupo], True),
+                    name="argos_replica_manual", daemon=True
+                ).start()
+                st.info("Sincronização iniciada em segundo plano.")
+
+        st.markdown("---")
+        st.markdown("**🔥 Aquecimento dos caches de ranking** (segundo plano, todos os grupos)")
+        if not AQUECIMENTO_CACHE_CONFIG['ativo']:
+            st.caption("Desativado.")
+        else:
+            df_aquecimento = get_status_aquecimento()
+            if df_aquecimento.empty:
+                st.caption("Primeira rodada em andamento.")
+            else:
+                st.dataframe(df_aquecimento, use_container_width=True, hide_index=True)
+            st.caption(
+                f"Config: max_paralelo={AQUECIMENTO_CACHE_CONFIG['max_paralelo']}, "
+                f"escalonamento={AQUECIMENTO_CACHE_CONFIG['escalonamento_segundos']}s, "
+                f"ciclo={AQUECIMENTO_CACHE_CONFIG['ciclo_segundos']}s"
+            )
+
+        st.markdown("---")
+        modo_busca = "paralela por tabela" if PARALLEL_TABLE_FETCH else "UNION ALL"
+        st.markdown(f"**⏱️ Tempos por tabela** (últimas consultas de todas as sessões - modo: {modo_busca})")
+
+        df_tempos = get_tempos_tabelas()
+        if df_tempos.empty:
+            st.caption("Nenhuma consulta registrada desde o início do servidor.")
+        else:
+            st.dataframe(df_tempos, use_container_width=True, hide_index=True)
+            df_tempos_ok = df_tempos[df_tempos['status'] == 'ok']
+            if not df_tempos_ok.empty:
+                st.dataframe(
+                    df_tempos_ok.groupby(['origem', 'tabela'])['segundos']
+                    .agg(['count', 'mean', 'max']).round(2).reset_index()
+                    .rename(columns={'count': 'consultas', 'mean': 'média (s)', 'max': 'máximo (s)'}),
+                    use_container_width=True,
+                    hide_index=True
+                )
+
     # =========================================================================
     # EXPANDER: DIAGNÓSTICO DE REDE
     # =========================================================================
@@ -5278,6 +5817,13 @@ def main():
     if engine is None:
         st.stop()
 
+    # Caches de ranking de todos os grupos aquecidos em segundo plano (uma thread por processo)
+    iniciar_aquecimento_cache(engine)
+
+    # Avisa sobre exportações em segundo plano desta sessão que terminaram (em qualquer página)
+    if st.session_state.get('export_jobs_sessao'):
+        _notificar_jobs_sessao(get_jobs_exportacao())
+
     # =========================================================================
     # CSS CUSTOMIZADO PARA ABAS PRINCIPAIS
     # =========================================================================
@@ -5459,7 +6005,8 @@ def render_operacao_fiscal(engine, grupo: str):
                                 
                                 st.write(f"📊 Carregando infrações ({nivel_consulta_principal})...")
                                 progress_bar.progress(50)
-                                df = get_base_df(engine, ident_digits, nivel_consulta_principal)
+                                # Só as colunas de análise; as do Anexo J vêm ao preparar a exportação
+                                df = get_base_df(engine, ident_digits, nivel_consulta_principal, projecao="resumo")
                                 progress_bar.progress(100)
                                 
                                 # Verifica novamente se houve erro de tabela indisponível
@@ -5471,12 +6018,17 @@ def render_operacao_fiscal(engine, grupo: str):
                                     st.warning(f"⚠️ Nenhum registro para: {cnpj_ie_input}")
                                 else:
                                     status.update(label=f"✅ {len(df):,} registros", state="complete", expanded=False)
+                                    # Resultado parcial (df.attrs['tabelas_falhas']) não fica no cache:
+                                    # a próxima consulta busca de novo
+                                    tabelas_falhas = df.attrs.get('tabelas_falhas') or {}
                                     st.session_state[consulta_dados_key] = {
                                         'df': df,
                                         'contrib_info': contrib_info,
                                         'ident_digits': ident_digits,
                                         'identificador': cnpj_ie_input,
-                                        'nivel': nivel_consulta_principal
+                                        'nivel': nivel_consulta_principal,
+                                        'tabelas_falhas': tabelas_falhas,
+                                        'projecao': 'resumo'
                                     }
                                     st.rerun()
                     else:
@@ -5553,7 +6105,26 @@ def render_operacao_fiscal(engine, grupo: str):
             </div>
         </div>
         """, unsafe_allow_html=True)
+
+        # Busca paralela por tabela: avisa se alguma tabela não respondeu
+        tabelas_falhas = dados.get('tabelas_falhas') or {}
+        if tabelas_falhas:
+            st.warning(
+                "⚠️ **Resultado parcial:** as tabelas abaixo não responderam e estão fora desta consulta. "
+                "Use **🔍 Nova Consulta** para tentar novamente.\n\n"
+                + "\n".join(f"- `{tabela}`: {erro[:150]}" for tabela, erro in tabelas_falhas.items())
+            )
         
+        # Agregações no Impala (Resumo e Análise): histórico completo, uma ida ao banco,
+        # cacheada junto com a consulta. Se falhar, a Análise calcula no pandas.
+        agregados_servidor = None
+        erro_agregados = None
+        if AGREGADOS_NO_SERVIDOR:
+            try:
+                agregados_servidor = get_agregados_consulta(engine, ident_digits, nivel_atual, grupo)
+            except Exception as e:
+                erro_agregados = str(e)
+
         # =====================================================================
         # TABS DE NAVEGAÇÃO
         # =====================================================================
@@ -5565,8 +6136,8 @@ def render_operacao_fiscal(engine, grupo: str):
         # TAB 1: RESUMO (com comparativos)
         # -----------------------------------------------------------------
         with tab_resumo:
-            # Busca estatísticas globais para comparação (cache 24h)
-            global_stats = get_global_stats(engine, nivel_atual)
+            # Busca estatísticas globais do grupo para comparação (cache pela versão das tabelas)
+            global_stats = get_global_stats(engine, nivel_atual, grupo=grupo)
             
             # Calcula métricas comparativas
             if global_stats and global_stats['total_valor'] > 0:
@@ -5599,10 +6170,20 @@ def render_operacao_fiscal(engine, grupo: str):
                     delta_color="off"
                 )
             with col3:
-                periodos = df['periodo'].nunique() if 'periodo' in df.columns else 0
+                if agregados_servidor is not None:
+                    periodos = len(agregados_servidor['periodo'])
+                else:
+                    periodos = df['periodo'].nunique() if 'periodo' in df.columns else 0
                 st.metric("📅 Períodos", periodos)
             with col4:
-                if 'data_emissao' in df.columns:
+                ordem_periodos = (
+                    agregados_servidor['periodo'].sort_values('ordem')['Período'].tolist()
+                    if agregados_servidor is not None else []
+                )
+                if ordem_periodos:
+                    # Períodos MM/AAAA já agregados no servidor: evita converter todas as datas
+                    periodo_range = f"{ordem_periodos[0]} - {ordem_periodos[-1]}"
+                elif 'data_emissao' in df.columns:
                     df_datas = pd.to_datetime(df['data_emissao'], errors='coerce')
                     if not df_datas.isna().all():
                         periodo_range = f"{df_datas.min().strftime('%m/%Y')} - {df_datas.max().strftime('%m/%Y')}"
@@ -5630,10 +6211,16 @@ def render_operacao_fiscal(engine, grupo: str):
                     delta_color="inverse" if diff_media > 0 else "normal"
                 )
             with col3:
-                if global_stats and global_stats['total_empresas'] > 0:
-                    # Estima posição no ranking (simplificado)
-                    posicao_estimada = max(1, int(global_stats['total_empresas'] * (1 - pct_valor_global/100)))
-                    st.metric("🏆 Ranking Estimado", f"Top {min(posicao_estimada, 100)}")
+                # Posição exata no ranking do nível (busca binária no índice em cache)
+                posicao = get_posicao_ranking(engine, ident_digits, nivel_atual, grupo=grupo)
+                if posicao:
+                    st.metric(
+                        "🏆 Posição no Ranking",
+                        f"{posicao['posicao']:,}º de {posicao['total_empresas']:,}",
+                        delta=f"acima de {posicao['percentil']:.1f}% das empresas",
+                        delta_color="off",
+                        help="Posição pelo valor total de infração no nível, entre todas as empresas do grupo"
+                    )
                 else:
                     st.metric("🏆 Ranking", "N/A")
             with col4:
@@ -5642,6 +6229,29 @@ def render_operacao_fiscal(engine, grupo: str):
                 else:
                     st.metric("🏢 Total Empresas", "N/A")
             
+            # Onde a empresa fica na distribuição do grupo (quantis em cache, sem nova varredura)
+            distribuicao = get_distribuicao_grupo(engine, nivel_atual, grupo=grupo)
+            if distribuicao:
+                with st.expander("📐 Distribuição no grupo", expanded=False):
+                    media_item_empresa = total_nivel / len(df) if len(df) > 0 else 0
+                    linhas_dist = []
+                    for titulo, chave, valor_empresa in (
+                        ("Total por empresa", 'empresas', total_nivel),
+                        ("Valor por item", 'itens', media_item_empresa),
+                    ):
+                        quantis = distribuicao[chave]
+                        linha = {'Distribuição': titulo}
+                        linha.update({f"p{q * 100:g}": format_currency_br(v) for q, v in quantis.items()})
+                        linha['Empresa'] = format_currency_br(valor_empresa)
+                        linha['Posição'] = faixa_na_distribuicao(valor_empresa, quantis)
+                        linhas_dist.append(linha)
+                    st.dataframe(pd.DataFrame(linhas_dist), use_container_width=True, hide_index=True)
+                    st.caption(
+                        "Total por empresa: quantis exatos entre todas as empresas do grupo. "
+                        "Valor por item: quantis do histograma de todos os itens do grupo (erro ~0,5%), "
+                        "comparados com a média por item da empresa."
+                    )
+
             # Informações comparativas em texto
             if global_stats and pct_valor_global > 0:
                 st.markdown("---")
@@ -5654,6 +6264,39 @@ def render_operacao_fiscal(engine, grupo: str):
                     </p>
                 </div>
                 """, unsafe_allow_html=True)
+
+            # Memória da consulta (schema compacto aplicado na carga, ver SCHEMA_CONSULTA)
+            with st.expander("🧠 Memória da consulta", expanded=False):
+                memoria = df.attrs.get('memoria') or {}
+                memoria_atual = int(df.memory_usage(deep=True).sum())
+                col1, col2, col3 = st.columns(3)
+                with col1:
+                    st.metric("Memória atual", f"{memoria_atual / (1024 * 1024):,.1f} MB")
+                with col2:
+                    if memoria.get('antes'):
+                        st.metric("Sem schema (object)", f"{memoria['antes'] / (1024 * 1024):,.1f} MB")
+                    else:
+                        st.metric("Sem schema (object)", "N/A")
+                with col3:
+                    if memoria.get('antes'):
+                        economia = (1 - memoria_atual / memoria['antes']) * 100
+                        st.metric("Economia", f"{economia:.0f}%")
+                    else:
+                        st.metric("Economia", "N/A")
+
+                # Cada aba de grupo mantém sua própria consulta no session_state
+                total_abas = 0
+                for grupo_mem in GRUPOS_CONFIG:
+                    dados_mem = st.session_state.get(f'consulta_dados_{grupo_mem}')
+                    if not dados_mem:
+                        continue
+                    if dados_mem.get('df') is not None:
+                        total_abas += int(dados_mem['df'].memory_usage(deep=True).sum())
+                st.caption(
+                    f"Consultas abertas em todas as abas de grupo: {total_abas / (1024 * 1024):,.1f} MB"
+                    + ("" if PYARROW_AVAILABLE else " · pyarrow indisponível: textos ficam como object")
+                )
+                st.dataframe(relatorio_memoria_consulta(df), use_container_width=True, hide_index=True)
         
         # -----------------------------------------------------------------
         # TAB 2: EXPORTAR
@@ -5676,18 +6319,75 @@ def render_operacao_fiscal(engine, grupo: str):
                 )
                 st.markdown("---")
 
-            df_export = build_export_df(df, nivel_atual, grupo=grupo_export, modelo_export=modelo_selecionado)
+            # A consulta traz só as colunas de análise; as colunas completas do Anexo J
+            # (destinatário, frete, seguro, CST, chave...) são lidas do Impala em lotes só
+            # durante a exportação (iter_base_df_chunks), sem montar a base inteira em memória.
+            consulta_resumo = dados.get('projecao') == 'resumo'
+
+            def lotes_export(ordenar_por=None):
+                if not consulta_resumo:
+                    return df
+                return lambda: iter_base_df_chunks(engine, ident_digits, nivel_atual, grupo_export,
+                                                   projecao="completa", ordenar_por=ordenar_por)
+
+            # Exportação em lotes: o DataFrame de exportação nunca é montado inteiro.
+            # CSV mantém a ordem da consulta; Excel sai ordenado por data de emissão.
+            def fonte_export_csv():
+                return iter_export_df(lotes_export(), nivel_atual, grupo=grupo_export, modelo_export=modelo_selecionado)
+
+            def fonte_export_excel():
+                return iter_export_df(lotes_export('data_emissao'), nivel_atual, grupo=grupo_export,
+                                      modelo_export=modelo_selecionado, ordenar_por='data_emissao')
+
+            # Total de linhas exportáveis por modelo, guardado na própria consulta: uma nova
+            # consulta (ou a aba de outro grupo) tem a sua própria contagem
+            contagens = dados.setdefault('contagem_export', {})
+            if modelo_selecionado not in contagens and not consulta_resumo:
+                contagens[modelo_selecionado] = contar_linhas_export(
+                    df, nivel_atual, grupo=grupo_export, modelo_export=modelo_selecionado
+                )
+            total_rows = contagens.get(modelo_selecionado, 0)
+
+            if modelo_selecionado not in contagens:
+                st.info(
+                    f"📦 A consulta carregou apenas as colunas de análise ({len(df.columns)} colunas). "
+                    "Para exportar o Anexo J, prepare a exportação: as linhas são contadas no servidor "
+                    "e as colunas completas são lidas em lotes ao gerar o arquivo."
+                )
+                if st.button("📦 Preparar exportação", type="primary", use_container_width=True,
+                             key=f"btn_preparar_export_{grupo}"):
+                    st.session_state.tabela_indisponivel = False
+                    try:
+                        with st.spinner("Contando as linhas para exportação..."):
+                            contagens[modelo_selecionado] = contar_linhas_export_servidor(
+                                engine, ident_digits, nivel_atual, grupo_export, modelo_selecionado
+                            )
+                    except Exception as e:
+                        if is_table_unavailable_error(str(e)):
+                            st.warning(TABLE_UNAVAILABLE_MSG)
+                        else:
+                            st.warning(f"⚠️ Não foi possível contar as linhas para exportação: {str(e)[:200]}")
+                    else:
+                        st.rerun()
+            elif total_rows == 0:
+                st.warning("⚠️ Nenhum registro retornado para exportação.")
 
-            if df_export is not None and not df_export.empty:
-                total_rows = len(df_export)
+            if total_rows > 0:
                 needs_split = total_rows > MAX_ROWS_PER_EXCEL
                 is_large_file = total_rows > LARGE_FILE_WARNING
                 
                 filename_csv = get_export_filename(contrib_info, nivel_atual, "csv")
-                cache_key = f"excel_data_{ident_digits}_{nivel_atual}"
-                
-                if cache_key not in st.session_state:
-                    st.session_state[cache_key] = None
+                chave_jobs = f"{ident_digits}_{nivel_atual}_{modelo_selecionado}"
+
+                def enviar_excel(destino):
+                    # Mesma empresa, modelo e versão dos dados: o Excel sai do cache de exportações
+                    chave_artefato = chave_artefato_exportacao(grupo, modelo_selecionado, nivel_atual, ident_digits,
+                                                               versao_cache_grupo(engine, grupo), valores_estaticos)
+                    job_id = enviar_job_exportacao(fonte_export_excel, contrib_info, nivel_atual, grupo,
+                                                   total_rows, destino, chave_jobs, chave_artefato, valores_estaticos)
+                    jobs_sessao = st.session_state.setdefault('export_jobs_sessao', [])
+                    if job_id not in jobs_sessao:
+                        jobs_sessao.append(job_id)
                 
                 if needs_split:
                     num_partes = math.ceil(total_rows / MAX_ROWS_PER_EXCEL)
@@ -5698,12 +6398,22 @@ def render_operacao_fiscal(engine, grupo: str):
                 # Aviso sobre bloqueio para arquivos grandes
                 if total_rows > 100000:
                     st.warning("""
-                    ⚠️ **Atenção:** Arquivos Excel com muitas linhas podem levar **2-4 minutos** para gerar.
-                    Durante esse tempo, a aplicação pode ficar lenta para outros usuários.
+                    ⚠️ **Atenção:** Arquivos Excel com muitas linhas podem levar **alguns minutos** para gerar.
+                    O Excel é gerado em segundo plano: você pode continuar usando a aplicação e
+                    acompanhar o progresso abaixo, mesmo recarregando a página.
                     
                     **Recomendação:** Use **CSV** (gera em segundos) ou **Salvar na Rede** (mais rápido).
                     """)
                 
+                valores_estaticos = st.checkbox(
+                    "⚡ Excel com valores calculados (abre sem recalcular)",
+                    value=EXCEL_VALORES_ESTATICOS,
+                    key=f"excel_valores_estaticos_{grupo}",
+                    help="Grava alíquota efetiva, ICMS devido, ICMS não-recolhido e os totais da J2 como valores, "
+                         "em vez de fórmulas. Os valores são os mesmos; o arquivo fica menor e abre na hora. "
+                         "O link do DANFE continua funcionando."
+                )
+
                 sub_tab_rede, sub_tab_download = st.tabs(["💾 Rede (Recomendado)", "📥 Download"])
                 
                 with sub_tab_rede:
@@ -5724,7 +6434,7 @@ def render_operacao_fiscal(engine, grupo: str):
                         if st.button("🚀 Salvar CSV", use_container_width=True, type="primary"):
                             progress_bar = st.progress(0, text="Iniciando...")
                             progress_bar.progress(10, text="📊 Preparando dados (10%)...")
-                            success, message, filepath, _ = save_csv_to_network(df_export, contrib_info, nivel_atual)
+                            success, message, filepath, _ = save_csv_to_network(fonte_export_csv, contrib_info, nivel_atual)
                             progress_bar.progress(100, text="✅ Concluído (100%)")
                             if success:
                                 st.success(f"✅ {message}")
@@ -5733,93 +6443,30 @@ def render_operacao_fiscal(engine, grupo: str):
                                 st.error(message)
                     with col2:
                         if st.button("💾 Salvar Excel", use_container_width=True):
-                            progress_bar = st.progress(0, text="Iniciando exportação Excel...")
-                            status_text = st.empty()
-                            
-                            status_text.info("⏳ Gerando arquivo Excel... Isso pode levar alguns minutos.")
-                            
-                            # Etapa 1: Preparação (0-5%)
-                            progress_bar.progress(5, text="📋 Preparando estrutura (5%)...")
-                            
-                            # Etapa 2: Gera Excel com progresso simulado
-                            progress_bar.progress(10, text="📊 Processando dados (10%)...")
-                            
-                            # Callback de progresso
-                            def progress_callback(current, total, msg):
-                                pct = int(10 + (current / max(total, 1)) * 80)  # 10% a 90%
-                                progress_bar.progress(pct, text=f"{msg} ({pct}%)")
-                            
-                            success, message, file_paths, _ = save_to_network_fast(
-                                df_export, contrib_info, nivel_atual, progress_callback, grupo=grupo
-                            )
-                            
-                            progress_bar.progress(100, text="✅ Concluído (100%)")
-                            status_text.empty()
-                            
-                            if success:
-                                st.success(f"✅ {message}")
-                                for fp in file_paths:
-                                    st.code(fp)
-                            else:
-                                st.error(message)
+                            # Gerado em segundo plano (ver argos.exportacao); o progresso aparece no painel abaixo
+                            enviar_excel("rede")
                 
                 with sub_tab_download:
                     col1, col2 = st.columns(2)
                     with col1:
-                        csv_data = export_to_csv(df_export, ident_digits, nivel_atual)
-                        st.download_button("📥 CSV", csv_data, file_name=filename_csv, mime="text/csv", use_container_width=True)
+                        # CSV gerado sob demanda num arquivo (a fonte lê o Impala em lotes)
+                        arquivos_csv = dados.setdefault('arquivos_csv', {})
+                        caminho_csv = arquivos_csv.get(modelo_selecionado)
+                        if caminho_csv and os.path.exists(caminho_csv):
+                            with open(caminho_csv, 'rb') as arquivo_csv:
+                                st.download_button("📥 CSV", arquivo_csv, file_name=filename_csv, mime="text/csv",
+                                                   use_container_width=True)
+                        elif st.button("📄 Gerar CSV", use_container_width=True, key=f"btn_gerar_csv_{grupo}"):
+                            with st.spinner("Gerando CSV..."):
+                                arquivos_csv[modelo_selecionado] = export_to_csv_arquivo(fonte_export_csv)
+                            st.rerun()
                     with col2:
                         if st.button("📊 Gerar Excel", use_container_width=True):
-                            progress_bar = st.progress(0, text="Iniciando geração do Excel...")
-                            status_text = st.empty()
-                            
-                            total_rows_export = len(df_export)
-                            tempo_estimado = max(60, total_rows_export // 5000)  # ~5000 linhas/seg
-                            status_text.info(f"⏳ Gerando Excel ({total_rows_export:,} linhas)... Tempo estimado: ~{tempo_estimado//60} min {tempo_estimado%60} seg")
-                            
-                            # Callback de progresso real
-                            def progress_callback_download(pct, msg):
-                                progress_bar.progress(pct, text=f"{msg} ({pct}%)")
-                            
-                            # Chama a função de exportação com callback
-                            excel_bytes = export_to_excel_template(
-                                df_export, contrib_info, nivel_atual,
-                                progress_callback=progress_callback_download,
-                                grupo=grupo
-                            )
-                            
-                            st.session_state[cache_key] = excel_bytes
-                            
-                            progress_bar.progress(100, text="✅ Excel gerado com sucesso! (100%)")
-                            
-                            # Calcula tamanho do arquivo
-                            tamanho_mb = len(excel_bytes) / (1024 * 1024)
-                            status_text.success(f"✅ Arquivo pronto! **{tamanho_mb:.1f} MB** - Clique em '📥 Baixar Excel' abaixo.")
-                            
-                            # Força rerun para mostrar o botão de download
-                            st.rerun()
-                        
-                        if st.session_state.get(cache_key):
-                            excel_data = st.session_state[cache_key]
-                            tamanho_mb = len(excel_data) / (1024 * 1024)
-                            
-                            st.info(f"📦 Arquivo pronto: **{tamanho_mb:.1f} MB** ({len(df_export):,} linhas)")
-                            
-                            # Aviso para arquivos grandes
-                            if tamanho_mb > 50:
-                                st.warning("⚠️ Arquivo grande! O download pode levar alguns segundos. Aguarde o navegador processar.")
-                            
-                            st.download_button(
-                                "📥 Baixar Excel", 
-                                excel_data,
-                                file_name=get_export_filename(contrib_info, nivel_atual, "xlsx"),
-                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                use_container_width=True,
-                                type="primary",
-                                help="Clique e aguarde o navegador iniciar o download"
-                            )
-                            
-                            st.caption("💡 Se o download não iniciar, verifique se seu navegador bloqueou popups.")
+                            # Gerado em segundo plano (ver argos.exportacao); o download aparece no painel abaixo
+                            enviar_excel("download")
+
+                st.markdown("---")
+                render_jobs_exportacao(chave_jobs)
         
         # -----------------------------------------------------------------
         # TAB 3: COMPARATIVO
@@ -5834,10 +6481,19 @@ def render_operacao_fiscal(engine, grupo: str):
         # -----------------------------------------------------------------
         with tab_analise:
             col_infracao = 'infracao_ia' if 'infracao_ia' in df.columns else cfg['col_infracao']
-            
+            analise_bundle = agregados_servidor
+            if erro_agregados:
+                st.caption(f"⚠️ Agregações no servidor indisponíveis ({erro_agregados[:80]}); calculando localmente.")
+
             # Verifica se precisa filtrar por período (datasets grandes)
             total_rows = len(df)
-            if total_rows > LARGE_DATASET_THRESHOLD:
+            if analise_bundle is not None:
+                df_analise = df
+                st.caption(
+                    f"💡 Agregações calculadas no servidor sobre todo o histórico "
+                    f"({analise_bundle['linhas']:,} registros). Clique nas seções para expandir"
+                )
+            elif total_rows > LARGE_DATASET_THRESHOLD:
                 st.warning(f"⚠️ Dataset grande ({total_rows:,} linhas). Análise limitada aos **últimos 12 meses** para melhor performance.")
                 
                 # Filtra últimos 12 meses
@@ -5880,24 +6536,24 @@ def render_operacao_fiscal(engine, grupo: str):
             
             # Agregações são cacheadas no session_state
             agg_key = f"analise_agg_{ident_digits}_{nivel_atual}"
-            
+            if analise_bundle is not None:
+                agg_key += "_servidor"
+
+            # Sem o servidor, todas as agregações saem de uma única passada em lotes (ver agregar_analise)
+            if analise_bundle is None:
+                cache_key_bundle = f"{agg_key}_bundle_{len(df_analise)}"
+                if len(df_analise) > 0 and cache_key_bundle not in st.session_state:
+                    st.session_state[cache_key_bundle] = agregar_analise(df_analise, col_infracao)
+                analise_bundle = st.session_state.get(cache_key_bundle)
+
             # Verifica se df_analise tem dados
-            if len(df_analise) == 0:
+            if len(df_analise) == 0 or not analise_bundle or analise_bundle['linhas'] == 0:
                 st.error("❌ Nenhum dado encontrado para análise nos períodos selecionados.")
                 st.info("💡 Verifique se há dados nos últimos 12 meses ou use a aba Resumo para ver todos os dados.")
             else:
                 # ----- ESTATÍSTICAS (PRIMEIRO E EXPANDIDO) -----
                 with st.expander("📊 Estatísticas", expanded=True):
-                    # Força recálculo se não estiver no cache
-                    cache_key_stats = f"{agg_key}_stats_{len(df_analise)}"
-                    if cache_key_stats not in st.session_state:
-                        valores = pd.to_numeric(df_analise[col_infracao], errors='coerce').fillna(0)
-                        if len(valores) > 0 and valores.sum() > 0:
-                            st.session_state[cache_key_stats] = valores.describe()
-                        else:
-                            st.session_state[cache_key_stats] = None
-
-                    stats = st.session_state.get(cache_key_stats)
+                    stats = analise_bundle['stats']
 
                     if stats is not None and not pd.isna(stats.get('mean', float('nan'))):
                         col1, col2, col3, col4 = st.columns(4)
@@ -5911,6 +6567,19 @@ def render_operacao_fiscal(engine, grupo: str):
                         col2.metric("Qtd. Itens", format_number_br(int(stats['count'])))
                         col3.metric("Desvio Padrão", format_currency_br(stats['std']))
                         col4.metric("75º Percentil", format_currency_br(stats['75%']))
+
+                        # Itens do grupo inteiro no mesmo nível (histograma em cache)
+                        distribuicao = get_distribuicao_grupo(engine, nivel_atual, grupo=grupo)
+                        if distribuicao:
+                            quantis_itens = distribuicao['itens']
+                            colunas = st.columns(len(quantis_itens) + 1)
+                            for coluna, (q, valor) in zip(colunas, quantis_itens.items()):
+                                coluna.metric(f"Grupo p{q * 100:g} (item)", format_currency_br(valor))
+                            colunas[-1].metric(
+                                "Mediana da empresa no grupo",
+                                faixa_na_distribuicao(stats['50%'], quantis_itens),
+                                help="Posição da mediana dos itens da empresa na distribuição dos itens do grupo"
+                            )
                     else:
                         st.warning("⚠️ Não há dados numéricos válidos para calcular estatísticas.")
                 
@@ -5925,30 +6594,7 @@ def render_operacao_fiscal(engine, grupo: str):
                             key="tipo_viz_analise"
                         )
                         
-                        # Cache para agregações
-                        cache_key_periodo = f"agg_periodo_{ident_digits}_{nivel_atual}"
-                        
-                        if cache_key_periodo not in st.session_state:
-                            df_temp = df_analise[['periodo', col_infracao]].copy()
-                            df_temp['valor'] = pd.to_numeric(df_temp[col_infracao], errors='coerce').fillna(0)
-                            
-                            # Agrupa por período
-                            df_agg = df_temp.groupby('periodo')['valor'].agg(['sum', 'count']).reset_index()
-                            df_agg.columns = ['Período', 'Valor', 'Qtd']
-                            
-                            # Cria coluna para ordenação cronológica (AAAA-MM)
-                            df_agg['ordem'] = df_agg['Período'].apply(
-                                lambda x: f"{x[3:7]}-{x[0:2]}" if len(str(x)) >= 7 else x
-                            )
-                            
-                            # Extrai mês para agregação mensal
-                            df_agg['Mes'] = df_agg['Período'].apply(
-                                lambda x: x[0:2] if len(str(x)) >= 2 else '00'
-                            )
-                            
-                            st.session_state[cache_key_periodo] = df_agg
-                        
-                        df_periodo = st.session_state[cache_key_periodo].copy()
+                        df_periodo = analise_bundle['periodo'].copy()
                         
                         # Mapeamento de mês para nome
                         meses_nome = {
@@ -6007,11 +6653,7 @@ def render_operacao_fiscal(engine, grupo: str):
                         # Força recriação do cache se estrutura mudou
                         cache_key_ncm = f"{agg_key}_ncm_v2"
                         if cache_key_ncm not in st.session_state:
-                            df_temp = df_analise[['ncm', col_infracao]].copy()
-                            df_temp['valor'] = pd.to_numeric(df_temp[col_infracao], errors='coerce').fillna(0)
-                            df_ncm = df_temp.groupby('ncm')['valor'].agg(['sum', 'count']).reset_index()
-                            df_ncm.columns = ['NCM', 'Valor', 'Itens']
-                            df_ncm = df_ncm.nlargest(10, 'Valor')
+                            df_ncm = analise_bundle['ncm'].copy()
 
                             # Busca descrições dos NCMs
                             ncm_desc = get_ncm_descricoes(engine, df_ncm['NCM'].tolist())
@@ -6052,11 +6694,7 @@ def render_operacao_fiscal(engine, grupo: str):
                         # Força recriação do cache se estrutura mudou
                         cache_key_cfop = f"{agg_key}_cfop_v2"
                         if cache_key_cfop not in st.session_state:
-                            df_temp = df_analise[['cfop', col_infracao]].copy()
-                            df_temp['valor'] = pd.to_numeric(df_temp[col_infracao], errors='coerce').fillna(0)
-                            df_cfop = df_temp.groupby('cfop')['valor'].agg(['sum', 'count']).reset_index()
-                            df_cfop.columns = ['CFOP', 'Valor', 'Itens']
-                            df_cfop = df_cfop.nlargest(10, 'Valor')
+                            df_cfop = analise_bundle['cfop'].copy()
 
                             # Busca descrições dos CFOPs
                             cfop_desc = get_cfop_descricoes(engine, df_cfop['CFOP'].tolist())
@@ -6094,17 +6732,7 @@ def render_operacao_fiscal(engine, grupo: str):
                 # ----- PRODUTOS (TOP 10 - TABELA COM PROGRESS) -----
                 with st.expander("📦 Top 10 Produtos", expanded=False):
                     if 'descricao' in df_analise.columns:
-                        # Força recriação do cache se estrutura mudou
-                        cache_key_prod = f"{agg_key}_prod_v2"
-                        if cache_key_prod not in st.session_state:
-                            df_temp = df_analise[['descricao', col_infracao]].copy()
-                            df_temp['valor'] = pd.to_numeric(df_temp[col_infracao], errors='coerce').fillna(0)
-                            df_prod = df_temp.groupby('descricao')['valor'].agg(['sum', 'count']).reset_index()
-                            df_prod.columns = ['Descrição', 'Valor', 'Itens']
-                            df_prod = df_prod.nlargest(10, 'Valor').reset_index(drop=True)
-                            st.session_state[cache_key_prod] = df_prod
-
-                        df_prod = st.session_state[cache_key_prod].copy()
+                        df_prod = analise_bundle['produto'].copy()
                         max_valor = float(df_prod['Valor'].max()) if len(df_prod) > 0 else 1.0
                         max_itens = int(df_prod['Itens'].max()) if len(df_prod) > 0 else 1
 
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""
+Infraestrutura do ARGOS separada do script do Streamlit ("GESSUPER (3).py").
+
+O Streamlit executa o script de novo a cada interação, num módulo novo: variáveis
+globais do script (caches em memória, métricas, fila de jobs) voltam ao valor inicial
+a cada rerun. O estado que precisa valer para o processo inteiro fica nestes módulos,
+importados uma vez só, e nenhum deles importa o streamlit.
+
+    configuracao        - overrides do secrets.toml validados e estado do processo
+    identificador       - CNPJ/IE: normalização, variantes e filtro SQL
+    tempos              - tempos das consultas por tabela (diagnóstico)
+    arquivos            - diretórios privados e arquivos temporários
+    cache_disco         - cache persistente em Parquet das consultas (LRU)
+    cache_compartilhado - cache em memória com single-flight e stale-while-revalidate
+    replica             - réplica local das tabelas em Parquet, consultada com DuckDB
+    lotes               - processamento em lotes (streaming) e CSV
+    excel               - Anexo J em Excel (modos de escrita, partes e ZIP)
+    paginacao           - página seguinte do ranking a partir do cursor
+    rede                - gravação na pasta de rede (SMB)
+    exportacao          - fila de jobs de exportação e cache dos Excel gerados
+"""
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""Diretórios privados e arquivos temporários das exportações e dos caches em disco."""
+import os
+
+
+def criar_diretorio_privado(diretorio: str):
+    """
+    Cria o diretório (e os intermediários) acessível só pelo usuário do servidor (0700).
+    Usado nos diretórios com arquivos exportados, que têm dados dos contribuintes; um
+    diretório que já existe também tem as permissões restringidas.
+    """
+    os.makedirs(diretorio, mode=0o700, exist_ok=True)
+    try:
+        os.chmod(diretorio, 0o700)
+    except OSError:
+        pass  # sem permissão para alterar (ex.: diretório de outro usuário) ou sem suporte (Windows)
+
+
+def remover_arquivo_temporario(caminho: str):
+    """Remove o arquivo, se ainda existir."""
+    try:
+        os.remove(caminho)
+    except OSError:
+        pass
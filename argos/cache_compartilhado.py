@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Cache em memória do processo para os loaders pesados do Impala: single-flight e
+stale-while-revalidate (ver cache_compartilhado).
+"""
+import concurrent.futures
+import copy
+import functools
+import inspect
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+# Loaders com cache_compartilhado, por nome (para o diagnóstico)
+_CACHES_COMPARTILHADOS = {}
+
+# Entradas, cálculos em andamento e métricas de cada loader, por nome. O script do
+# Streamlit aplica o decorador de novo a cada rerun: o estado fica aqui, e não na
+# closure do decorador, para que os reruns encontrem as entradas já calculadas.
+_ESTADOS = {}
+_ESTADOS_LOCK = threading.Lock()
+
+
+def _estado_loader(nome: str) -> dict:
+    with _ESTADOS_LOCK:
+        if nome not in _ESTADOS:
+            _ESTADOS[nome] = {
+                'entradas': OrderedDict(),
+                'em_andamento': {},
+                'lock': threading.Lock(),
+                'metricas': {'acertos': 0, 'obsoletos': 0, 'esperas': 0, 'calculos': 0, 'erros': 0},
+            }
+        return _ESTADOS[nome]
+
+
+def cache_compartilhado(ttl: float = None, max_obsoleto: float = 0, max_entries: int = None,
+                        arg_versao: str = None, cachear_se=None, copiar: bool = True):
+    """
+    Cache em memória do processo para os loaders pesados do Impala, no lugar do st.cache_data.
+
+    - Single-flight: uma só execução por chave; sessões que pedem a mesma chave enquanto
+      ela está sendo calculada esperam o resultado em vez de disparar a mesma query.
+    - Stale-while-revalidate: expirada a entrada (após `ttl` segundos ou, com `arg_versao`,
+      quando esse argumento muda), o último valor bom é devolvido na hora por até
+      `max_obsoleto` segundos e o recálculo roda em segundo plano (um por chave).
+
+    Como no st.cache_data, argumentos iniciados por "_" não entram na chave e quem chama
+    recebe uma cópia (copiar=False para loaders internos que não alteram o resultado).
+    Exceções não ficam no cache (quem estava esperando recebe a mesma exceção) e valores
+    recusados por `cachear_se(valor)` também não (ex.: resultado parcial).
+
+    O loader não pode chamar o Streamlit (st.*, st.session_state, funções com
+    st.cache_data/st.cache_resource): o recálculo em segundo plano roda numa thread sem o
+    contexto da sessão, e o resultado é compartilhado por todas as sessões. Tudo o que
+    depende da sessão (ex.: o grupo selecionado) entra como argumento, e avisos para a
+    sessão ficam com quem chama o loader.
+
+    Args:
+        ttl: validade em segundos (None = até mudar a versão ou sair pelo max_entries)
+        max_obsoleto: segundos em que um valor expirado ainda pode ser servido
+        max_entries: máximo de chaves guardadas (as menos usadas saem primeiro)
+        arg_versao: argumento com a versão dos dados; fica fora da chave, e um valor
+            diferente do guardado torna a entrada obsoleta
+        cachear_se: função(valor) -> bool; False = não guarda
+        copiar: devolve cópia (copy.deepcopy) do valor guardado
+    """
+    def decorador(func):
+        assinatura = inspect.signature(func)
+        estado = _estado_loader(func.__name__)
+        entradas = estado['entradas']
+        em_andamento = estado['em_andamento']
+        lock = estado['lock']
+        metricas = estado['metricas']
+
+        def _chave(args, kwargs):
+            ligados = assinatura.bind(*args, **kwargs)
+            ligados.apply_defaults()
+            versao = ligados.arguments.get(arg_versao) if arg_versao else None
+            chave = tuple(
+                (nome, valor) for nome, valor in ligados.arguments.items()
+                if not nome.startswith('_') and nome != arg_versao
+            )
+            return chave, versao
+
+        def _estado(entrada, versao, agora):
+            """(fresca, servível) da entrada. Chamada com o lock."""
+            obsoleta_desde = None
+            if ttl is not None and agora - entrada['criado'] >= ttl:
+                obsoleta_desde = entrada['criado'] + ttl
+            if arg_versao and entrada['versao'] != versao:
+                if entrada['versao_mudou'] is None:
+                    entrada['versao_mudou'] = agora
+                obsoleta_desde = min(obsoleta_desde or agora, entrada['versao_mudou'])
+            if obsoleta_desde is None:
+                return True, True
+            return False, agora - obsoleta_desde < max_obsoleto
+
+        def _podar():
+            """Remove entradas vencidas além do max_obsoleto e o excesso do max_entries. Chamada com o lock."""
+            if ttl is not None:
+                limite = time.time() - ttl - max_obsoleto
+                for chave in [c for c, e in entradas.items() if e['criado'] < limite]:
+                    del entradas[chave]
+            while max_entries and len(entradas) > max_entries:
+                entradas.popitem(last=False)
+
+        def _calcular(chave, versao, futuro, args, kwargs):
+            try:
+                valor = func(*args, **kwargs)
+            except BaseException as e:
+                with lock:
+                    metricas['erros'] += 1
+                    em_andamento.pop(chave, None)
+                futuro.set_exception(e)
+                raise
+            with lock:
+                metricas['calculos'] += 1
+                if cachear_se is None or cachear_se(valor):
+                    entradas[chave] = {'valor': valor, 'criado': time.time(), 'versao': versao, 'versao_mudou': None}
+                    entradas.move_to_end(chave)
+                    _podar()
+                em_andamento.pop(chave, None)
+            futuro.set_result(valor)
+            return valor
+
+        def _revalidar(chave, versao, futuro, args, kwargs):
+            try:
+                _calcular(chave, versao, futuro, args, kwargs)
+            except Exception:
+                pass  # o valor obsoleto continua até o max_obsoleto; a próxima chamada tenta de novo
+
+        def _entregar(valor):
+            return copy.deepcopy(valor) if copiar else valor
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            chave, versao = _chave(args, kwargs)
+            servir = False
+            revalidar = None
+            with lock:
+                entrada = entradas.get(chave)
+                if entrada is not None:
+                    fresca, servir = _estado(entrada, versao, time.time())
+                if servir:
+                    entradas.move_to_end(chave)
+                    valor = entrada['valor']
+                    if fresca:
+                        metricas['acertos'] += 1
+                    else:
+                        metricas['obsoletos'] += 1
+                        if chave not in em_andamento:
+                            revalidar = concurrent.futures.Future()
+                            em_andamento[chave] = revalidar
+                else:
+                    _podar()
+                    futuro = em_andamento.get(chave)
+                    dono = futuro is None
+                    if dono:
+                        futuro = concurrent.futures.Future()
+                        em_andamento[chave] = futuro
+                    else:
+                        metricas['esperas'] += 1
+
+            if servir:
+                if revalidar is not None:
+                    threading.Thread(
+                        target=_revalidar, args=(chave, versao, revalidar, args, kwargs),
+                        name=f"argos_revalidar_{func.__name__}", daemon=True
+                    ).start()
+                return _entregar(valor)
+            if not dono:
+                return _entregar(futuro.result())
+            return _entregar(_calcular(chave, versao, futuro, args, kwargs))
+
+        def clear():
+            """Descarta as entradas guardadas (cálculos em andamento não são afetados)."""
+            with lock:
+                entradas.clear()
+
+        def status() -> dict:
+            with lock:
+                return dict(metricas, entradas=len(entradas), em_andamento=len(em_andamento))
+
+        wrapper.clear = clear
+        wrapper.status = status
+        _CACHES_COMPARTILHADOS[func.__name__] = wrapper
+        return wrapper
+
+    return decorador
+
+
+def get_status_caches_compartilhados() -> pd.DataFrame:
+    """Métricas de cada loader com cache_compartilhado (deste processo)."""
+    return pd.DataFrame([
+        dict(loader=nome, **wrapper.status()) for nome, wrapper in _CACHES_COMPARTILHADOS.items()
+    ])
+
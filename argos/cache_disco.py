@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Cache persistente em disco (Parquet) das consultas por empresa, compartilhado entre
+sessões e processos, com LRU por tamanho. Também usado pelo cache de exportações
+(argos.exportacao), que guarda os Excel no mesmo esquema de arquivos.
+"""
+import hashlib
+import importlib.util
+import os
+import tempfile
+import threading
+import time
+
+import pandas as pd
+
+# Parquet (pandas.read_parquet/to_parquet) - opcional
+PYARROW_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
+
+# Cache persistente em disco (Parquet) das consultas por empresa, compartilhado entre
+# sessões e processos. Pode ser sobrescrito em secrets.toml, seção [cache_disco].
+CACHE_DISCO_CONFIG = {
+    'ativo': True,
+    'diretorio': os.path.join(tempfile.gettempdir(), "argos_cache"),
+    'max_mb': 5000,          # acima disso, remove os arquivos menos usados (LRU)
+}
+
+# Métricas do cache em disco (deste processo)
+_METRICAS_CACHE_DISCO = {'acertos': 0, 'faltas': 0, 'gravacoes': 0, 'erros': 0, 'removidos': 0}
+_METRICAS_CACHE_DISCO_LOCK = threading.Lock()
+
+
+def _somar_metrica_cache_disco(**valores):
+    """Soma contadores às métricas do cache em disco."""
+    with _METRICAS_CACHE_DISCO_LOCK:
+        for chave, valor in valores.items():
+            _METRICAS_CACHE_DISCO[chave] += valor
+
+
+def cache_disco_ativo() -> bool:
+    """O cache em disco precisa do pyarrow (Parquet) e pode ser desligado na configuração."""
+    return bool(CACHE_DISCO_CONFIG['ativo']) and PYARROW_AVAILABLE
+
+
+def _caminho_cache_disco(chave: tuple) -> str:
+    nome = hashlib.sha1(repr(chave).encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DISCO_CONFIG['diretorio'], f"{nome}.parquet")
+
+
+def ler_cache_disco(chave: tuple):
+    """
+    Lê um DataFrame do cache em disco. Retorna None se não existir ou estiver ilegível.
+    A leitura atualiza a data de modificação do arquivo (ordem do LRU).
+    """
+    if not cache_disco_ativo():
+        return None
+    caminho = _caminho_cache_disco(chave)
+    try:
+        df = pd.read_parquet(caminho)
+    except FileNotFoundError:
+        _somar_metrica_cache_disco(faltas=1)
+        return None
+    except Exception:
+        # Arquivo corrompido ou de versão incompatível: descarta
+        _somar_metrica_cache_disco(erros=1)
+        try:
+            os.remove(caminho)
+        except OSError:
+            pass
+        return None
+    try:
+        os.utime(caminho)
+    except OSError:
+        pass
+    _somar_metrica_cache_disco(acertos=1)
+    return df
+
+
+def gravar_cache_disco(chave: tuple, df: pd.DataFrame) -> bool:
+    """
+    Grava o DataFrame no cache em disco. Escreve em arquivo temporário e renomeia,
+    para que outro processo nunca leia um Parquet pela metade. Depois aplica o LRU.
+    """
+    if not cache_disco_ativo() or df is None or df.empty:
+        return False
+    caminho = _caminho_cache_disco(chave)
+    temporario = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(CACHE_DISCO_CONFIG['diretorio'], exist_ok=True)
+        df.to_parquet(temporario, index=False)
+        os.replace(temporario, caminho)
+    except Exception:
+        # Ex.: coluna object com tipos misturados, disco cheio
+        _somar_metrica_cache_disco(erros=1)
+        try:
+            os.remove(temporario)
+        except OSError:
+            pass
+        return False
+    _somar_metrica_cache_disco(gravacoes=1)
+    limpar_cache_disco()
+    return True
+
+
+def gravar_cache_disco_em_segundo_plano(chave: tuple, df: pd.DataFrame):
+    """Grava no cache em disco sem atrasar quem fez a consulta."""
+    if cache_disco_ativo():
+        threading.Thread(target=gravar_cache_disco, args=(chave, df), name="argos_cache_disco", daemon=True).start()
+
+
+def arquivos_cache_disco(diretorio: str = None) -> list:
+    """Lista [(caminho, tamanho, mtime)] dos arquivos do cache em disco (ou de `diretorio`)."""
+    if diretorio is None:
+        diretorio = CACHE_DISCO_CONFIG['diretorio']
+    arquivos = []
+    try:
+        nomes = os.listdir(diretorio)
+    except OSError:
+        return arquivos
+    for nome in nomes:
+        caminho = os.path.join(diretorio, nome)
+        try:
+            info = os.stat(caminho)
+        except OSError:
+            continue  # removido por outro processo
+        arquivos.append((caminho, info.st_size, info.st_mtime))
+    return arquivos
+
+
+def limpar_cache_disco(max_mb: float = None) -> int:
+    """
+    Remove os arquivos menos usados até o cache caber em `max_mb` (padrão: CACHE_DISCO_CONFIG).
+    Temporários órfãos (processo interrompido) com mais de 1 hora também são removidos.
+
+    Returns:
+        int: quantidade de arquivos removidos
+    """
+    limite = float(CACHE_DISCO_CONFIG['max_mb'] if max_mb is None else max_mb) * 1024 * 1024
+    removidos = remover_menos_usados(CACHE_DISCO_CONFIG['diretorio'], limite)
+    if removidos:
+        _somar_metrica_cache_disco(removidos=removidos)
+    return removidos
+
+
+def remover_menos_usados(diretorio: str, limite_bytes: float) -> int:
+    """
+    LRU de um diretório de cache: remove os arquivos com data de modificação mais antiga
+    até o total caber em `limite_bytes`, e os temporários (.tmp) com mais de 1 hora.
+    Travas (.lock) ficam para quem as criou (ver argos.exportacao).
+
+    Returns:
+        int: quantidade de arquivos removidos
+    """
+    agora = time.time()
+    removidos = 0
+
+    arquivos = []
+    for caminho, tamanho, mtime in arquivos_cache_disco(diretorio):
+        if caminho.endswith('.lock'):
+            continue
+        if caminho.endswith('.tmp'):
+            if agora - mtime > 3600:
+                try:
+                    os.remove(caminho)
+                    removidos += 1
+                except OSError:
+                    pass
+            continue
+        arquivos.append((caminho, tamanho, mtime))
+
+    total = sum(tamanho for _, tamanho, _ in arquivos)
+    for caminho, tamanho, _ in sorted(arquivos, key=lambda a: a[2]):
+        if total <= limite_bytes:
+            break
+        try:
+            os.remove(caminho)
+            removidos += 1
+        except OSError:
+            pass
+        total -= tamanho
+
+    return removidos
+
+
+def get_status_cache_disco() -> dict:
+    """Tamanho atual do cache em disco e métricas deste processo."""
+    arquivos = [a for a in arquivos_cache_disco() if a[0].endswith('.parquet')]
+    with _METRICAS_CACHE_DISCO_LOCK:
+        status = dict(_METRICAS_CACHE_DISCO)
+    status['arquivos'] = len(arquivos)
+    status['mb'] = sum(tamanho for _, tamanho, _ in arquivos) / (1024 * 1024)
+    return status
+
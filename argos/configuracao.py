@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Overrides das configurações pelo secrets.toml e estado compartilhado do processo."""
+import logging
+import threading
+
+logger = logging.getLogger("argos")
+
+# Problemas encontrados nos overrides (seção.chave -> descrição), para o diagnóstico
+_PROBLEMAS_CONFIGURACAO = {}
+_PROBLEMAS_LOCK = threading.Lock()
+
+# Estado do script principal que precisa valer para o processo inteiro (ver estado_processo)
+_ESTADO_PROCESSO = {}
+_ESTADO_PROCESSO_LOCK = threading.Lock()
+
+
+def _valor_valido(padrao, valor) -> bool:
+    """O override tem o tipo do valor padrão (int e float são intercambiáveis; bool só com bool)."""
+    if isinstance(padrao, bool) or isinstance(valor, bool):
+        return isinstance(padrao, bool) and isinstance(valor, bool)
+    if isinstance(padrao, (int, float)):
+        return isinstance(valor, (int, float))
+    return isinstance(valor, type(padrao))
+
+
+def _registrar_problema(chave: str, descricao: str):
+    with _PROBLEMAS_LOCK:
+        novo = _PROBLEMAS_CONFIGURACAO.get(chave) != descricao
+        _PROBLEMAS_CONFIGURACAO[chave] = descricao
+    if novo:
+        logger.warning("secrets.toml [%s]: %s - usando o valor padrão", chave, descricao)
+
+
+def aplicar_secrets(config: dict, secao: str, secrets) -> list:
+    """
+    Sobrescreve `config` com a seção `secao` do secrets.toml (st.secrets ou dict).
+
+    Só entram chaves que existem em `config` e valores do mesmo tipo do padrão. Chave
+    desconhecida (ex.: erro de digitação) ou valor de outro tipo (ex.: "8" em vez de 8) é
+    ignorado com aviso no log, uma vez por processo, e fica em problemas_configuracao()
+    para o diagnóstico.
+
+    Returns:
+        list: descrições dos problemas desta seção (vazia se tudo foi aplicado)
+    """
+    try:
+        valores = secrets.get(secao, {}) or {}
+    except Exception:
+        return []  # sem secrets.toml: valem os padrões
+    try:
+        valores = dict(valores)
+    except (TypeError, ValueError):
+        descricao = f"a seção deveria ser uma tabela [{secao}], não {valores!r}"
+        _registrar_problema(secao, descricao)
+        return [f"[{secao}] {descricao}"]
+
+    problemas = []
+    for chave, valor in valores.items():
+        if chave not in config:
+            descricao = f"chave desconhecida '{chave}' (válidas: {', '.join(sorted(config))})"
+        elif not _valor_valido(config[chave], valor):
+            descricao = (f"'{chave}' = {valor!r} deveria ser {type(config[chave]).__name__} "
+                         f"(padrão: {config[chave]!r})")
+        else:
+            config[chave] = valor
+            continue
+        _registrar_problema(f"{secao}.{chave}", descricao)
+        problemas.append(f"[{secao}] {descricao}")
+    return problemas
+
+
+def problemas_configuracao() -> list:
+    """Overrides do secrets.toml ignorados neste processo, como 'seção.chave: descrição'."""
+    with _PROBLEMAS_LOCK:
+        return [f"{chave}: {descricao}" for chave, descricao in sorted(_PROBLEMAS_CONFIGURACAO.items())]
+
+
+def estado_processo(nome: str, fabrica):
+    """
+    Objeto compartilhado pelo processo inteiro, criado por `fabrica()` no primeiro uso.
+
+    O Streamlit executa o script principal de novo a cada rerun, num módulo novo: uma
+    variável global como `_METRICAS = {...}` voltaria ao valor inicial a cada interação.
+    Com `_METRICAS = estado_processo('metricas', lambda: {...})`, todos os reruns e
+    sessões recebem o mesmo objeto.
+    """
+    with _ESTADO_PROCESSO_LOCK:
+        if nome not in _ESTADO_PROCESSO:
+            _ESTADO_PROCESSO[nome] = fabrica()
+        return _ESTADO_PROCESSO[nome]
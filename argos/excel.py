@@ -0,0 +1,1652 @@
+# -*- coding: utf-8 -*-
+"""
+Anexo J em Excel: layout, modos de escrita (openpyxl célula a célula, openpyxl write_only
+e xlsxwriter), exportações em partes e ZIP, e nomes dos arquivos.
+"""
+import copy
+import functools
+import importlib.util
+import itertools
+import math
+import multiprocessing
+import os
+import queue
+import re
+import shutil
+import tempfile
+import time
+import zipfile
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
+from openpyxl.utils import column_index_from_string, get_column_letter
+from openpyxl.workbook.properties import CalcProperties
+
+from argos.arquivos import remover_arquivo_temporario
+from argos.identificador import sanitize_identificador
+from argos.lotes import STREAM_CHUNK_SIZE, coluna_numerica, gravar_lotes_parquet, iter_df_chunks, ler_lotes_parquet
+
+# Escritor xlsx de memória constante para exportações grandes - opcional
+try:
+    import xlsxwriter
+    XLSXWRITER_AVAILABLE = True
+except ImportError:
+    XLSXWRITER_AVAILABLE = False
+
+# Limite de linhas por arquivo Excel (Excel suporta 1.048.576, usamos 1.000.000 para segurança)
+MAX_ROWS_PER_EXCEL = 1000000
+
+# Escrita do Excel (Anexo J), mesmo layout e fórmulas nos dois modos:
+#   "streaming" - openpyxl write_only: linhas gravadas em sequência, estilos montados uma vez, memória limitada
+#   "padrao"    - Workbook normal, célula a célula (todo o arquivo em memória até salvar)
+EXCEL_MODO_ESCRITA = "streaming"
+
+# Backend do Excel: "auto" usa o xlsxwriter (constant_memory) a partir de EXCEL_XLSXWRITER_MIN_LINHAS
+# linhas, se instalado, e o openpyxl (EXCEL_MODO_ESCRITA) abaixo disso; "openpyxl"/"xlsxwriter" fixam o backend
+EXCEL_BACKEND = "auto"
+EXCEL_XLSXWRITER_MIN_LINHAS = 50000
+
+# Colunas calculadas do Anexo J: False grava as fórmulas da J1 e os SUMIF da J2, recalculados
+# ao abrir o arquivo; True grava os valores já calculados (ver _colunas_estaticas_j1), e o
+# arquivo abre sem recalcular. Padrão da aba de exportação, que permite escolher.
+EXCEL_VALORES_ESTATICOS = False
+
+# Versão do layout do Anexo J (colunas, fórmulas, formatos). Entra na chave do cache de
+# exportações (argos.exportacao): incrementar ao mudar o arquivo gerado invalida os Excel já guardados.
+EXCEL_LAYOUT_VERSAO = 1
+
+# Partes do Excel (exportações acima de MAX_ROWS_PER_EXCEL linhas) geradas em processos
+# paralelos, cada um gravando sua parte em arquivo temporário. Requer pyarrow (os lotes da
+# parte vão para o filho em Parquet); sem pyarrow ou com 'ativo' = False, as partes são
+# geradas em sequência. Seção [excel_paralelo] no secrets.toml.
+#
+# Os filhos são criados com spawn, não com fork: um fork a partir do servidor (várias
+# threads) copiaria travas seguradas por outras threads (cache_compartilhado, jobs, pools do
+# Impala, DuckDB, BLAS) e sockets abertos. O filho spawn começa num interpretador novo,
+# importa só argos.excel e recebe apenas caminhos: o diretório com os lotes da parte, um
+# Parquet por lote, e o arquivo onde grava o .xlsx. Não abre conexão nem chama st.*; fala
+# com o pai pela fila. Se algo ainda assim travar, o pai encerra o filho após
+# 'timeout_parte_segundos' e a exportação falha com erro.
+PYARROW_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
+
+EXCEL_PARALELO_CONFIG = {
+    'ativo': True,
+    'max_processos': 4,      # partes geradas ao mesmo tempo (cada processo com uma parte em memória)
+    'timeout_parte_segundos': 1800,  # tempo máximo de um processo filho; 0 = sem limite
+}
+
+
+def arredondar(valores: pd.Series, casas: int = 2) -> pd.Series:
+    """
+    ROUND do Impala e do Excel: a metade se afasta do zero (0,125 -> 0,13; -0,125 -> -0,13).
+    O Series.round do pandas arredonda a metade para o par (0,125 -> 0,12).
+    """
+    fator = 10 ** casas
+    escalado = valores * fator
+    inteiro = np.trunc(escalado)
+    inteiro = inteiro + np.sign(escalado) * ((escalado - inteiro).abs() >= 0.5)
+    return inteiro / fator
+
+
+def calcular_icms_fisco(bc_fisco: pd.Series, aliquota_pct: pd.Series, icms_destacado: pd.Series) -> tuple:
+    """
+    ICMS devido e não recolhido pelas regras das fórmulas da J1:
+        devido = ROUND(BC fisco * alíquota, 2)
+        não recolhido = MAX(0, ROUND(devido - destacado, 2))
+
+    Usado no filtro de build_export_df e nos valores estáticos do Anexo J, para que os dois
+    coincidam. Séries numéricas (ver coluna_numerica), alíquota em percentual.
+    O arredondamento é o do ROUND (ver arredondar), o mesmo da contagem no servidor
+    (contar_linhas_export_servidor) e das fórmulas do Excel.
+
+    Returns:
+        (icms_devido, icms_nao_recolhido)
+    """
+    icms_devido = arredondar(bc_fisco * (aliquota_pct / 100))
+    icms_nao_recolhido = arredondar(icms_devido - icms_destacado).clip(lower=0)  # Não pode ser negativo
+    return icms_devido, icms_nao_recolhido
+
+
+# Aba Índice do Anexo J: (campo, descrição), padronizado conforme especificação
+ANEXO_J_INDICE = [
+    ("Chave de acesso", "Indica do número da chave de acesso das Notas Fiscais. Não é aplicável para as informações da ECF."),
+    ("URL", "Link para acessar o documento fiscal (apenas Notas Fiscais)."),
+    ("Tipo Documento", "Indica a fonte da informação. Podia variar entre Nfe (Nota Fiscal Eletrônica), NFCe (Nota Fiscal do Consumidor Eletrônica) ou ECF (Emissor de Cupom Fiscal)"),
+    ("Data de emissão", "Data de emissão do documento. (No caso de Cupom Fiscal, é a data da Redução Z)"),
+    ("Entrada ou saida", "Indica se a operação é de entrada ou saída de mercadorias."),
+    ("ECF-FAB", "Indica o número de série do Emissor de Cupom Fiscal (ECF). Não aplicável para operações com Notas Fiscais"),
+    ("GTIN", "Código GTIN da mercadoria."),
+    ("NCM", "Código NCM da mercadoria."),
+    ("No. Nota", "Número da Nota Fiscal. Não é aplicável para informações da ECF."),
+    ("No. Item", "Número do item dentro da Nota Fiscal. Não aplicável a Cupons."),
+    ("Origem do Produto", "Informação de Origem do Produto retirado da Nota Fiscal. Não aplicável a ECF (Cupons) - Indica se o produto é nacional ou estrangeiro."),
+    ("Ind Final e Tipo de Operação Final", "Informação de Ind Final retirado da Nota Fiscal. Não aplicável a ECF (Cupons). Indica se o destinatário receberá o produto para revenda/industrialização ou consumo final."),
+    ("TTD 409/410/411", "Indica se o TTD 409, 410 ou 411 estava ativo para o contribuinte no respectivo período da Nota Fiscal. (Aplicável somente para Nfe)"),
+    ("Código do produto", "Código do produto declarado pelo contribuinte para a operação. Válido apenas para Cupons Fiscais"),
+    ("Cód. Tot. Par", "Código totalizador. Informação presenta apenas nas operações ECF."),
+    ("Alíquota Destacada", "Alíquota de ICMS destacada no documento fiscal pelo contribuinte"),
+    ("ICMS Destacado", "ICMS destacado no documento fiscal pelo contribuinte"),
+    ("Valor da operação", "Valor da Base de Cálculo calculada pelo fisco, sem considerar reduções da base de cálculo. As reduções da BC serão aplicadas na alíquota efetiva correta. Para as notas fiscais (NF-e e NFC-e inclui frete, seguro, despesas adicionais , descontado os descontos concedidos). Para os Cupons leva-se em conta apenas o valor declarado na EFD que é o valor efetivo da operação."),
+    ("Alíquota Efetiva Correta (FISCO)", "Alíquota de ICMS considerada pelo fisco para a operação. Aqui considerando eventuais reduções da Base de Cálculo. Para os Cupons fiscais é a alíquota retirada do COD TOT PAR."),
+    ("Alíquota Efetiva destacada pelo Contribuinte", "Alíquota efetiva destacada pelo Contribuinte, que é calculada dividindo o ICMS destacado pelo Valor da Operação sem considerar redução da base de cálculo"),
+    ("ICMS devido", "Valor do ICMS considerado como correto pelo fisco."),
+    ("ICMS não-recolhido", "Valor do ICMS a ser recolhido como diferença pelo contribuinte. Trata-se da dedução do valor de 'ICMS devido' pelo valor do campo 'ICMS destacado'")
+]
+
+def _layout_anexo_j1(usar_estrutura_estendida: bool) -> dict:
+    """
+    Layout da aba J1 do Anexo J, comum aos modos de escrita (ver export_to_excel_template):
+    cabeçalhos, coluna de cada campo (1 = A), colunas das fórmulas e as colunas da J1
+    referenciadas pelas fórmulas da J2.
+    """
+    if usar_estrutura_estendida:
+        # Headers estendidos para estrutura padronizada
+        celula_fisco = 'AL2'
+
+        headers_j1 = [
+            "Data de emissão",       # A (1)
+            "Período",               # B (2)
+            "Tipo Documento",        # C (3)
+            "Chave de acesso",       # D (4)
+            "Link de Acesso",        # E (5)
+            "ECF-FAB",               # F (6)
+            "Entrada ou saída",      # G (7)
+            "IE Emitente",           # H (8)
+            "CNPJ Emitente",         # I (9)
+            "Razão do Emitente",     # J (10)
+            "IE Destinatário",       # K (11)
+            "CNPJ Destinatário",     # L (12)
+            "CPF Destinatário",      # M (13)
+            "Razão do Destinatário", # N (14)
+            "Estado do Destinatário",# O (15)
+            "UF Entrega",            # P (16)
+            "Regime do Destinatário",# Q (17)
+            "CNAE do Destinatário",  # R (18)
+            "Número da Nota",        # S (19)
+            "Número do Item",        # T (20)
+            "Origem do Produto",     # U (21)
+            "Ind Final",             # V (22)
+            "Tipo de Operação Final",# W (23)
+            "TTD 409/410/411",       # X (24)
+            "GTIN",                  # Y (25)
+            "NCM",                   # Z (26)
+            "CST",                   # AA (27)
+            "Descrição do produto",  # AB (28)
+            "CFOP",                  # AC (29)
+            "Código do Produto",     # AD (30)
+            "Valor Total",           # AE (31)
+            "Valor do Frete",        # AF (32)
+            "Valor do Seguro",       # AG (33)
+            "Valor de Outras Despesas",# AH (34)
+            "Valor do Desconto",     # AI (35)
+            "Cod. Tot. Par",         # AJ (36)
+            "Alíquota Destacada",    # AK (37)
+            "ICMS Destacado",        # AL (38)
+            # FISCO
+            "Valor da Operação",     # AM (39)
+            "Alíquota Efetiva Correta (FISCO)",  # AN (40)
+            "Legislação Aplicável",  # AO (41)
+            "Alíquota Efetiva destacada pelo Contribuinte",  # AP (42)
+            "ICMS devido",           # AQ (43)
+            "ICMS não-recolhido"     # AR (44)
+        ]
+
+        col_fisco_inicio = 39  # Coluna AM
+        total_colunas = 44
+
+        column_mapping = {
+            'data_emissao': 1,
+            'periodo': 2,
+            'tipo_doc': 3,
+            'chave': 4,
+            'modelo_ecf': 6,
+            'entrada_ou_saida': 7,
+            'ie_emitente': 8,
+            'cnpj_emitente': 9,
+            'razao_emitente': 10,
+            'ie_destinatario': 11,
+            'cnpj_destinatario': 12,
+            'cpf_destinatario': 13,
+            'razao_destinatario': 14,
+            'estado_destinatario': 15,
+            'uf_entrega': 16,
+            'regime_destinatario': 17,
+            'cnae_destinatario': 18,
+            'numero_nota': 19,
+            'numero_item': 20,
+            'origem_prod': 21,
+            'ind_final': 22,
+            'ttd_importacao': 24,
+            'gtin': 25,
+            'ncm': 26,
+            'cst': 27,
+            'descricao': 28,
+            'cfop': 29,
+            'cod_prod': 30,
+            'valor_total': 31,
+            'valor_do_frete': 32,
+            'valor_do_seguro': 33,
+            'valor_outras_despesas': 34,
+            'valor_do_desconto': 35,
+            'cod_tot_par': 36,
+            'aliquota_emitente': 37,
+            'icms_emitente': 38,
+            'bc_fisco': 39,
+            'aliquota_ia_icms': 40,
+            'legislacao_ia_icms': 41,
+        }
+
+        # Colunas de fórmulas
+        col_link = 5
+        col_aliq_efetiva = 42
+        col_icms_devido = 43
+        col_icms_nao_recolhido = 44
+        col_bc_fisco = 39
+        col_aliq_correta = 40
+        col_icms_destacado = 38
+
+    else:
+        # Headers padrão (estrutura simples)
+        celula_fisco = 'S2'
+
+        headers_j1 = [
+            "Data de emissão",      # A
+            "Período",              # B
+            "Tipo Documento",       # C
+            "Chave de acesso",      # D
+            "Link de Acesso",       # E
+            "ECF-FAB",              # F
+            "Entrada ou saída",     # G
+            "CNPJ Emitente",        # H
+            "Razão do Emitente",    # I
+            "Número",               # J
+            "GTIN",                 # K
+            "NCM",                  # L
+            "Item",                 # M
+            "Descrição do produto", # N
+            "CFOP",                 # O
+            "ICMS destacado",       # P
+            "Código do Produto",    # Q
+            "Cód. Tot. Par",        # R
+            "Legislação",           # S (FISCO)
+            "Valor da Operação",    # T (FISCO)
+            "Alíquota ICMS correta",# U (FISCO)
+            "Alíquota ICMS efetiva",# V (FISCO)
+            "ICMS devido",          # W (FISCO)
+            "ICMS não-recolhido"    # X (FISCO)
+        ]
+
+        col_fisco_inicio = 19
+        total_colunas = 24
+
+        column_mapping = {
+            'data_emissao': 1,
+            'periodo': 2,
+            'tipo_doc': 3,
+            'chave': 4,
+            'modelo_ecf': 6,
+            'entrada_ou_saida': 7,
+            'cnpj_emitente': 8,
+            'razao_emitente': 9,
+            'numero_nota': 10,
+            'gtin': 11,
+            'ncm': 12,
+            'numero_item': 13,
+            'descricao': 14,
+            'cfop': 15,
+            'icms_emitente': 16,
+            'cod_prod': 17,
+            'cod_tot_par': 18,
+            'legislacao_ia_icms': 19,
+            'bc_fisco': 20,
+            'aliquota_ia_icms': 21,
+        }
+
+        col_link = 5
+        col_aliq_efetiva = 22
+        col_icms_devido = 23
+        col_icms_nao_recolhido = 24
+        col_bc_fisco = 20
+        col_aliq_correta = 21
+        col_icms_destacado = 16
+
+    return {
+        'celula_fisco': celula_fisco,
+        'headers': headers_j1,
+        'col_fisco_inicio': col_fisco_inicio,
+        'total_colunas': total_colunas,
+        'column_mapping': column_mapping,
+        'col_link': col_link,
+        'col_aliq_efetiva': col_aliq_efetiva,
+        'col_icms_devido': col_icms_devido,
+        'col_icms_nao_recolhido': col_icms_nao_recolhido,
+        'col_bc_fisco': col_bc_fisco,
+        'col_aliq_correta': col_aliq_correta,
+        'col_icms_destacado': col_icms_destacado,
+        # Colunas da J1 usadas no SUMIF da J2
+        'letra_periodo': 'B',
+        'letra_icms_destacado': get_column_letter(col_icms_destacado),
+        'letra_icms_devido': get_column_letter(col_icms_devido),
+    }
+
+
+def export_to_excel_template(df, contrib_info: dict, nivel: str, parte_atual: int = None, total_partes: int = None, progress_callback=None, grupo: str = None, total_linhas: int = None, modo_escrita: str = None, valores_estaticos: bool = None) -> bytes:
+    """
+    Exporta DataFrame para Excel usando a estrutura do template Anexo J.
+    Inclui fórmulas para recálculos automáticos na aba J2.
+    Ordem das abas: J2 (ICMS DEVIDO), Índice, J1 (NOTAS DE SAÍDAS)
+
+    A aba J1 é preenchida lote a lote; os períodos e a última linha usados nas fórmulas
+    da J2 são coletados durante o preenchimento e a J2 é completada no final.
+
+    Modos de escrita com o mesmo layout e as mesmas fórmulas: "streaming" (openpyxl
+    write_only, memória limitada), "padrao" (openpyxl, Workbook célula a célula) e
+    "xlsxwriter" (constant_memory). Sem `modo_escrita`, o modo sai de modo_escrita_excel
+    (EXCEL_BACKEND e número de linhas).
+
+    Com `valores_estaticos`, as colunas calculadas da J1 e os totais da J2 são gravados como
+    valores (ver _colunas_estaticas_j1 e _acumular_totais_j2), iguais aos de build_export_df;
+    só o link do DANFE continua fórmula. O arquivo fica menor e abre sem recalcular a planilha.
+
+    Args:
+        df: DataFrame com os dados, ou lotes (função/iterável - ver iter_df_chunks).
+            DataFrame é ordenado por data_emissao; em lotes, a ordenação é feita dentro de cada lote.
+        contrib_info: Informações do contribuinte
+        nivel: Nível de acurácia (BAIXA, MEDIA, ALTA)
+        parte_atual: Número da parte atual (se dividido)
+        total_partes: Total de partes (se dividido)
+        progress_callback: Função callback(percentual, mensagem) para reportar progresso
+        grupo: Grupo de operação para determinar estrutura de colunas
+        total_linhas: Total de linhas esperado (só para o progresso quando `df` são lotes)
+        modo_escrita: "streaming", "padrao" ou "xlsxwriter" (None = automático)
+        valores_estaticos: valores no lugar das fórmulas (None = EXCEL_VALORES_ESTATICOS)
+    """
+    if modo_escrita is None:
+        modo_escrita = modo_escrita_excel(len(df) if isinstance(df, pd.DataFrame) else total_linhas)
+    if modo_escrita == "xlsxwriter":
+        exportar = _export_excel_xlsxwriter
+    elif modo_escrita == "streaming":
+        exportar = _export_excel_streaming
+    else:
+        exportar = _export_excel_celulas
+    if valores_estaticos is None:
+        valores_estaticos = EXCEL_VALORES_ESTATICOS
+    return exportar(df, contrib_info, nivel, parte_atual, total_partes, progress_callback, grupo, total_linhas,
+                    valores_estaticos)
+
+def modo_escrita_excel(total_linhas: int = None) -> str:
+    """
+    Modo de escrita do Anexo J conforme EXCEL_BACKEND: xlsxwriter (se instalado) para
+    exportações a partir de EXCEL_XLSXWRITER_MIN_LINHAS linhas no modo "auto";
+    EXCEL_MODO_ESCRITA (openpyxl) nos demais casos ou com total de linhas desconhecido.
+    """
+    if EXCEL_BACKEND == "xlsxwriter" and XLSXWRITER_AVAILABLE:
+        return "xlsxwriter"
+    if (EXCEL_BACKEND == "auto" and XLSXWRITER_AVAILABLE and total_linhas
+            and total_linhas >= EXCEL_XLSXWRITER_MIN_LINHAS):
+        return "xlsxwriter"
+    return EXCEL_MODO_ESCRITA
+
+# Conversão das colunas da J1 antes da escrita (mesmas regras nos dois modos):
+# datas em date, moeda em float, alíquota em fração (/100), demais campos com NaN -> ''
+COLUNAS_J1_DATA = ('data_emissao', 'periodo')
+COLUNAS_J1_MOEDA = ('icms_emitente', 'bc_fisco', 'valor_total', 'valor_do_frete',
+                    'valor_do_seguro', 'valor_outras_despesas', 'valor_do_desconto')
+COLUNAS_J1_PERCENTUAL = ('aliquota_ia_icms', 'aliquota_emitente')
+
+# Estilo de cada valor convertido -> formato numérico da célula ('borda' = só a borda)
+FORMATOS_J1 = {'data': 'DD/MM/YYYY', 'moeda': '#,##0.00', 'percentual': '0.00%'}
+
+# Consulta do DANFE pela chave de acesso (coluna "Link de Acesso" da J1)
+URL_CONSULTA_DANFE = "https://sat.sef.sc.gov.br/tax.NET/Sat.NFe.Web/Consultas/Nfe_ResumoPDF.ashx?id="
+
+
+@functools.lru_cache(maxsize=None)
+def _plano_colunas_j1(usar_estrutura_estendida: bool) -> tuple:
+    """
+    Plano de conversão da J1, compilado uma vez por layout (estendido ou padrão):
+    tupla de (campo, índice 0-based da coluna na J1, tipo), com tipo em
+    'data', 'moeda', 'percentual' ou 'texto'.
+    """
+    plano = []
+    for col_name, col_idx in _layout_anexo_j1(usar_estrutura_estendida)['column_mapping'].items():
+        if col_name in COLUNAS_J1_DATA:
+            tipo = 'data'
+        elif col_name in COLUNAS_J1_MOEDA:
+            tipo = 'moeda'
+        elif col_name in COLUNAS_J1_PERCENTUAL:
+            tipo = 'percentual'
+        else:
+            tipo = 'texto'
+        plano.append((col_name, col_idx - 1, tipo))
+    return tuple(plano)
+
+
+def _converter_coluna_j1(serie: pd.Series, tipo: str) -> tuple:
+    """
+    Converte uma coluna inteira do lote para os valores gravados na J1.
+
+    Valores que não convertem ficam como vieram e só com borda, como na conversão
+    célula a célula; nulos viram ''. Para datas em texto, o formato é inferido para o
+    lote; as poucas strings fora dele são convertidas uma a uma.
+
+    Returns:
+        (valores: list, estilo) - estilo é um nome de FORMATOS_J1/'borda' comum a toda a
+        coluna, ou uma lista com o estilo de cada valor quando há falhas de conversão.
+    """
+    nulos = serie.isna().to_numpy()
+
+    if tipo == 'texto':
+        return serie.astype(object).where(~nulos, '').tolist(), 'borda'
+
+    if tipo == 'data':
+        valores = serie.astype(object).to_numpy(copy=True)
+        estilos = np.full(len(valores), 'data', dtype=object)
+        e_texto = np.fromiter((isinstance(v, str) for v in valores), dtype=bool, count=len(valores)) & ~nulos
+        if e_texto.any():
+            textos = valores[e_texto]
+            datas = pd.to_datetime(pd.Series(textos), dayfirst=True, errors='coerce')
+            falhas = datas.isna().to_numpy()
+            convertidas = datas.dt.date.to_numpy(dtype=object)
+            for i in np.flatnonzero(falhas):
+                try:
+                    data = pd.to_datetime(textos[i], dayfirst=True)
+                    if pd.isna(data):
+                        raise ValueError(textos[i])
+                    convertidas[i] = data.date()
+                    falhas[i] = False
+                except Exception:
+                    convertidas[i] = textos[i]
+            valores[e_texto] = convertidas
+            estilos[np.flatnonzero(e_texto)[falhas]] = 'borda'
+    else:
+        numeros = pd.to_numeric(serie, errors='coerce').to_numpy(dtype=float)
+        falhas = np.isnan(numeros) & ~nulos
+        if tipo == 'percentual':
+            numeros = numeros / 100
+        valores = numeros.astype(object)
+        estilos = np.full(len(valores), tipo, dtype=object)
+        if falhas.any():
+            valores[falhas] = serie.to_numpy(dtype=object)[falhas]
+            estilos[falhas] = 'borda'
+
+    valores[nulos] = ''
+    estilos[nulos] = 'borda'
+    estilos = estilos.tolist()
+    if len(set(estilos)) <= 1:
+        return valores.tolist(), (estilos[0] if estilos else 'borda')
+    return valores.tolist(), estilos
+
+
+def _converter_lote_j1(chunk: pd.DataFrame, plano: tuple, calculadas: tuple = ()) -> tuple:
+    """
+    Converte de uma vez as colunas do lote presentes no plano (_plano_colunas_j1).
+    `calculadas` acrescenta colunas já prontas, como (índice, valores, estilo) - ver
+    _colunas_estaticas_j1.
+
+    Returns:
+        (indices, linhas, estilos) - índices 0-based das colunas convertidas na J1 e dois
+        iteráveis paralelos de tuplas simples (valores e estilos de cada linha, na ordem
+        de `indices`), prontos para o escritor.
+    """
+    n = len(chunk)
+    indices, colunas, estilos = [], [], []
+    for col_name, idx, tipo in plano:
+        if col_name in chunk.columns:
+            valores, estilo = _converter_coluna_j1(chunk[col_name], tipo)
+            indices.append(idx)
+            colunas.append(valores)
+            estilos.append(estilo)
+    for idx, valores, estilo in calculadas:
+        indices.append(idx)
+        colunas.append(valores)
+        estilos.append(estilo)
+
+    linhas = zip(*colunas) if colunas else itertools.repeat((), n)
+    if all(isinstance(estilo, str) for estilo in estilos):
+        estilos_linhas = itertools.repeat(tuple(estilos), n)
+    else:
+        estilos_linhas = zip(*[itertools.repeat(estilo, n) if isinstance(estilo, str) else estilo
+                               for estilo in estilos])
+    return indices, linhas, estilos_linhas
+
+
+def _formulas_j1(layout: dict) -> tuple:
+    """
+    Fórmulas de cada linha da J1, comuns aos três modos de escrita:
+    tupla de (índice 0-based da coluna, modelo da fórmula com {r} = linha, estilo).
+    """
+    bc = get_column_letter(layout['col_bc_fisco'])
+    destacado = get_column_letter(layout['col_icms_destacado'])
+    aliq_correta = get_column_letter(layout['col_aliq_correta'])
+    devido = get_column_letter(layout['col_icms_devido'])
+    return (
+        (layout['col_link'] - 1, '=IF(D{r}<>"",HYPERLINK("' + URL_CONSULTA_DANFE + '"&D{r},"Abrir DANFE"),"")', 'borda'),
+        (layout['col_aliq_efetiva'] - 1, f"=IF({bc}{{r}}=0,0,{destacado}{{r}}/{bc}{{r}})", 'percentual'),
+        (layout['col_icms_devido'] - 1, f"=ROUND({bc}{{r}}*{aliq_correta}{{r}},2)", 'moeda'),
+        (layout['col_icms_nao_recolhido'] - 1, f"=MAX(0,ROUND({devido}{{r}}-{destacado}{{r}},2))", 'moeda'),
+    )
+
+
+def _colunas_estaticas_j1(chunk: pd.DataFrame, layout: dict, primeira_linha: int) -> tuple:
+    """
+    Colunas calculadas da J1 com valores, no lugar das fórmulas de _formulas_j1 (modo
+    valores_estaticos): alíquota efetiva, ICMS devido e não recolhido por calcular_icms_fisco,
+    os mesmos valores do filtro de build_export_df. Vazios e inválidos contam como 0, como
+    nas fórmulas. O link continua fórmula (HYPERLINK não tem valor equivalente), mas só nas
+    linhas com chave de acesso e sem o IF.
+
+    Args:
+        primeira_linha: linha do Excel da primeira linha do lote (referência do link)
+
+    Returns:
+        (colunas, icms_destacado, icms_devido) - colunas no formato de `calculadas` de
+        _converter_lote_j1 (o link com estilo 'link'); as duas séries alimentam _acumular_totais_j2
+    """
+    zeros = pd.Series(0.0, index=chunk.index)
+
+    def numerica(campo):
+        return coluna_numerica(chunk[campo]) if campo in chunk.columns else zeros
+
+    bc_fisco = numerica('bc_fisco')
+    icms_destacado = numerica('icms_emitente')
+    icms_devido, icms_nao_recolhido = calcular_icms_fisco(bc_fisco, numerica('aliquota_ia_icms'), icms_destacado)
+    aliq_efetiva = (icms_destacado / bc_fisco.where(bc_fisco != 0)).fillna(0)
+
+    if 'chave' in chunk.columns:
+        tem_chave = (chunk['chave'].notna() & (chunk['chave'].astype(str) != '')).to_numpy()
+    else:
+        tem_chave = np.zeros(len(chunk), dtype=bool)
+    modelo_link = '=HYPERLINK("' + URL_CONSULTA_DANFE + '"&D{r},"Abrir DANFE")'
+    links = [modelo_link.format(r=r) if chave else '' for r, chave in enumerate(tem_chave, primeira_linha)]
+
+    colunas = (
+        (layout['col_link'] - 1, links, 'link'),
+        (layout['col_aliq_efetiva'] - 1, aliq_efetiva.tolist(), 'percentual'),
+        (layout['col_icms_devido'] - 1, icms_devido.tolist(), 'moeda'),
+        (layout['col_icms_nao_recolhido'] - 1, icms_nao_recolhido.tolist(), 'moeda'),
+    )
+    return colunas, icms_destacado, icms_devido
+
+
+def _acumular_totais_j2(totais: dict, chunk: pd.DataFrame, icms_destacado: pd.Series, icms_devido: pd.Series):
+    """
+    Soma o ICMS destacado e o devido do lote por período em `totais` (período -> [destacado, devido]).
+    O período da consulta é category (SCHEMA_CONSULTA): observed=True soma só os períodos do lote.
+    """
+    if 'periodo' not in chunk.columns:
+        return
+    por_periodo = pd.DataFrame({'destacado': icms_destacado, 'devido': icms_devido}).groupby(
+        chunk['periodo'], observed=True
+    ).sum()
+    for periodo, (destacado, devido) in zip(por_periodo.index, por_periodo.to_numpy()):
+        soma = totais.setdefault(periodo, [0.0, 0.0])
+        soma[0] += float(destacado)
+        soma[1] += float(devido)
+
+
+def _linhas_periodo_j2(layout: dict, periodos_unicos: set, ultima_linha: int, totais: dict = None) -> list:
+    """
+    Linhas de período da J2 (a partir da linha 12), comuns aos escritores:
+    lista de (linha, período, é_data, B, C, D) - fórmulas SUMIF sobre a J1 ou, com `totais`
+    (ver _acumular_totais_j2), os valores já somados.
+    """
+    periodos = sorted(periodos_unicos, key=lambda x: pd.to_datetime(x, dayfirst=True) if isinstance(x, str) else x)
+
+    def faixa_j1(letra_coluna):
+        return f"'ANEXO J1 - NOTAS DE SAÍDAS'!${letra_coluna}$4:${letra_coluna}${ultima_linha}"
+
+    def valor_periodo(periodo):
+        try:
+            return (pd.to_datetime(periodo, dayfirst=True).date() if isinstance(periodo, str) else periodo), True
+        except Exception:
+            return periodo, False
+
+    if totais is not None:
+        # O SUMIF compara o valor da célula: períodos escritos de formas diferentes que viram
+        # a mesma data somam juntos
+        por_valor = {}
+        for periodo, (destacado, devido) in totais.items():
+            soma = por_valor.setdefault(valor_periodo(periodo)[0], [0.0, 0.0])
+            soma[0] += destacado
+            soma[1] += devido
+
+    faixa_periodo = faixa_j1(layout['letra_periodo'])
+    linhas = []
+    for row_idx, periodo in enumerate(periodos, 12):
+        valor, e_data = valor_periodo(periodo)
+        if totais is not None:
+            destacado, devido = por_valor.get(valor, (0.0, 0.0))
+            linhas.append((row_idx, valor, e_data, destacado, devido, devido - destacado))
+            continue
+        linhas.append((
+            row_idx, valor, e_data,
+            f"=SUMIF({faixa_periodo},$A{row_idx},{faixa_j1(layout['letra_icms_destacado'])})",
+            f"=SUMIF({faixa_periodo},$A{row_idx},{faixa_j1(layout['letra_icms_devido'])})",
+            f"=C{row_idx}-B{row_idx}",
+        ))
+    return linhas
+
+
+def _linha_total_j2(linhas_periodo: list, valores_estaticos: bool) -> list:
+    """Colunas B a D da linha TOTAL da J2: SUM das linhas de período ou a soma já calculada."""
+    if valores_estaticos:
+        return [sum(linha[coluna] for linha in linhas_periodo) for coluna in (3, 4, 5)]
+    total_row = 12 + len(linhas_periodo)
+    return [f"=SUM({letra}12:{letra}{total_row - 1})" for letra in "BCD"]
+
+
+def _export_excel_celulas(df, contrib_info: dict, nivel: str, parte_atual: int = None, total_partes: int = None, progress_callback=None, grupo: str = None, total_linhas: int = None, valores_estaticos: bool = False) -> bytes:
+    """Modo "padrao" de export_to_excel_template: Workbook normal, preenchido célula a célula."""
+    def report_progress(pct, msg):
+        if progress_callback:
+            progress_callback(pct, msg)
+
+    report_progress(5, "Criando estrutura do arquivo")
+
+    # Determina se usa estrutura estendida (todos os grupos usam - ver uses_full_queries)
+    usar_estrutura_estendida = bool(grupo)
+
+    buffer = BytesIO()
+
+    # Cria workbook
+    wb = Workbook()
+
+    # Estilos comuns
+    header_font = Font(bold=True, color="FFFFFF", size=10)
+    header_fill = PatternFill(start_color="1565C0", end_color="1565C0", fill_type="solid")
+    header_fill_fisco = PatternFill(start_color="C62828", end_color="C62828", fill_type="solid")
+    header_fill_yellow = PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid")
+    title_font = Font(bold=True, size=14, color="1565C0")
+    subtitle_font = Font(bold=True, size=11, color="666666")
+
+    thin_border = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'),
+        bottom=Side(style='thin')
+    )
+
+    # =========================================================================
+    # ABA 1: ANEXO J2 - ICMS DEVIDO (resumo por período) - PRIMEIRA ABA
+    # =========================================================================
+    ws_j2 = wb.active
+    ws_j2.title = "ANEXO J2 - ICMS DEVIDO"
+
+    # Cabeçalho institucional
+    ws_j2.merge_cells('A1:D1')
+    ws_j2['A1'] = "ESTADO DE SANTA CATARINA"
+    ws_j2['A1'].font = Font(bold=True, size=14)
+    ws_j2['A1'].alignment = Alignment(horizontal="center")
+
+    ws_j2.merge_cells('A2:D2')
+    ws_j2['A2'] = "Secretaria de Estado da Fazenda"
+    ws_j2['A2'].alignment = Alignment(horizontal="center")
+
+    ws_j2.merge_cells('A3:D3')
+    ws_j2['A3'] = "Diretoria de Administração Tributária"
+    ws_j2['A3'].alignment = Alignment(horizontal="center")
+
+    ws_j2.merge_cells('A4:D4')
+    ws_j2['A4'] = "Gerência de Fiscalização"
+    ws_j2['A4'].alignment = Alignment(horizontal="center")
+
+    # Informações do contribuinte
+    ws_j2['A6'] = "CNPJ:"
+    ws_j2['A6'].font = Font(bold=True)
+    ws_j2['B6'] = contrib_info.get('cnpj', '') if contrib_info else ''
+
+    ws_j2['A7'] = "Razão Social:"
+    ws_j2['A7'].font = Font(bold=True)
+    ws_j2['B7'] = contrib_info.get('razao_social', '') if contrib_info else ''
+
+    # Título da tabela com fundo amarelo
+    ws_j2.merge_cells('A10:D10')
+    ws_j2['A10'] = "APURAÇÃO MENSAL DO VALOR DO ICMS DEVIDO NAS VENDAS DE MERCADORIAS"
+    ws_j2['A10'].font = Font(bold=True, size=12)
+    ws_j2['A10'].fill = header_fill_yellow
+    ws_j2['A10'].alignment = Alignment(horizontal="center")
+
+    # Cabeçalhos da tabela J2
+    headers_j2 = ["Período", "ICMS destacado", "ICMS apurado", "ICMS não recolhido"]
+    for col_idx, header in enumerate(headers_j2, 1):
+        cell = ws_j2.cell(row=11, column=col_idx)
+        cell.value = header
+        cell.font = header_font
+        cell.fill = header_fill
+        cell.alignment = Alignment(horizontal="center", vertical="center")
+        cell.border = thin_border
+
+    # Autoajuste de largura J2
+    for col_idx in range(1, 5):
+        col_letter = get_column_letter(col_idx)
+        ws_j2.column_dimensions[col_letter].width = 20
+
+    # Períodos e fórmulas da J2 são preenchidos após a J1 (ver final da função)
+
+    report_progress(20, "Criando aba Índice")
+
+    # =========================================================================
+    # ABA 2: Índice (descrição dos campos) - SEGUNDA ABA
+    # =========================================================================
+    ws_indice = wb.create_sheet("Índice")
+
+    ws_indice['A1'] = "Campo"
+    ws_indice['B1'] = "Descrição"
+    ws_indice['A1'].font = header_font
+    ws_indice['B1'].font = header_font
+    ws_indice['A1'].fill = header_fill
+    ws_indice['B1'].fill = header_fill
+
+    for row_idx, (campo, desc) in enumerate(ANEXO_J_INDICE, 2):
+        ws_indice.cell(row=row_idx, column=1).value = campo
+        ws_indice.cell(row=row_idx, column=2).value = desc
+
+    ws_indice.column_dimensions['A'].width = 35
+    ws_indice.column_dimensions['B'].width = 100
+
+    report_progress(30, "Criando aba J1 - Notas de Saídas")
+
+    # =========================================================================
+    # ABA 3: ANEXO J1 - NOTAS DE SAÍDAS (dados detalhados) - TERCEIRA ABA
+    # =========================================================================
+    ws_j1 = wb.create_sheet("ANEXO J1 - NOTAS DE SAÍDAS")
+
+    # Título J1
+    titulo_j1 = "ANEXO J1"
+    if parte_atual is not None and total_partes is not None:
+        titulo_j1 = f"ANEXO J1 - Parte {parte_atual} de {total_partes}"
+    ws_j1['A1'] = titulo_j1
+    ws_j1['A1'].font = title_font
+
+    # Layout da J1 (colunas, cabeçalhos e colunas das fórmulas) conforme a estrutura
+    layout = _layout_anexo_j1(usar_estrutura_estendida)
+    ws_j1['D2'] = "INFORMAÇÕES RETIRADAS DOS DOCUMENTOS FISCAIS (Cupons Fiscais ou NFC-e)"
+    ws_j1['D2'].font = subtitle_font
+    ws_j1[layout['celula_fisco']] = "INFORMAÇÕES DECLARADAS PELO FISCO"
+    ws_j1[layout['celula_fisco']].font = Font(bold=True, size=11, color="C62828")
+
+    headers_j1 = layout['headers']
+    col_fisco_inicio = layout['col_fisco_inicio']
+    total_colunas = layout['total_colunas']
+
+    # Cabeçalhos da aba J1
+    for col_idx, header in enumerate(headers_j1, 1):
+        cell = ws_j1.cell(row=3, column=col_idx)
+        cell.value = header
+        cell.font = header_font
+        cell.fill = header_fill_fisco if col_idx >= col_fisco_inicio else header_fill
+        cell.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+        cell.border = thin_border
+
+    ws_j1.row_dimensions[3].height = 30
+
+    report_progress(40, "Preenchendo dados da aba J1")
+
+    # Ordena dados por data_emissao para processamento (DataFrame completo)
+    if isinstance(df, pd.DataFrame):
+        if 'data_emissao' in df.columns:
+            df = df.sort_values('data_emissao', ascending=True, na_position='last', kind='stable').reset_index(drop=True)
+        total_linhas = len(df)
+
+    # Preenche os dados lote a lote
+    total_rows = total_linhas or 0
+    progress_interval = max(1, total_rows // 20) if total_rows else STREAM_CHUNK_SIZE
+    periodos_unicos = set()
+    totais_j2 = {} if valores_estaticos else None
+    row_idx = 3
+
+    plano = _plano_colunas_j1(usar_estrutura_estendida)
+    # Com valores estáticos, as colunas calculadas vêm prontas em cada lote
+    formulas = () if valores_estaticos else _formulas_j1(layout)
+
+    for chunk in iter_df_chunks(df):
+        if not isinstance(df, pd.DataFrame) and 'data_emissao' in chunk.columns:
+            chunk = chunk.sort_values('data_emissao', ascending=True, na_position='last', kind='stable')
+        if 'periodo' in chunk.columns:
+            periodos_unicos.update(chunk['periodo'].dropna().unique())
+
+        # Valores estáticos: colunas calculadas entram como colunas convertidas, sem fórmulas
+        calculadas = ()
+        if valores_estaticos:
+            calculadas, icms_destacado, icms_devido = _colunas_estaticas_j1(chunk, layout, row_idx + 1)
+            _acumular_totais_j2(totais_j2, chunk, icms_destacado, icms_devido)
+
+        # Conversão por coluna, uma vez por lote; o laço abaixo só percorre tuplas
+        indices, linhas, estilos_linhas = _converter_lote_j1(chunk, plano, calculadas)
+        colunas_excel = [idx + 1 for idx in indices]
+
+        for valores, estilos in zip(linhas, estilos_linhas):
+            row_idx += 1
+            atual_row = row_idx - 4
+            if atual_row % progress_interval == 0:
+                if total_rows:
+                    pct = 40 + int((min(atual_row, total_rows) / total_rows) * 40)
+                    report_progress(pct, f"Processando linha {atual_row:,} de {total_rows:,}")
+                else:
+                    report_progress(40, f"Processando linha {atual_row:,}")
+
+            for col_idx, valor, nome_estilo in zip(colunas_excel, valores, estilos):
+                cell = ws_j1.cell(row=row_idx, column=col_idx, value=valor)
+                formato = FORMATOS_J1.get(nome_estilo)
+                if formato:
+                    cell.number_format = formato
+                cell.border = thin_border
+
+            # Fórmulas (com valores estáticos, as colunas calculadas já foram escritas acima)
+            for idx, modelo, nome_estilo in formulas:
+                cell = ws_j1.cell(row=row_idx, column=idx + 1, value=modelo.format(r=row_idx))
+                formato = FORMATOS_J1.get(nome_estilo)
+                if formato:
+                    cell.number_format = formato
+                cell.border = thin_border
+
+    # Autoajuste de largura J1
+    for col_idx in range(1, total_colunas + 1):
+        col_letter = get_column_letter(col_idx)
+        ws_j1.column_dimensions[col_letter].width = 15
+
+    ws_j1.freeze_panes = 'A4'
+    ultima_linha = row_idx
+    ws_j1.auto_filter.ref = f"A3:{get_column_letter(total_colunas)}{ultima_linha}"
+
+    report_progress(85, "Preenchendo aba J2 - ICMS devido")
+
+    # =========================================================================
+    # ANEXO J2 - períodos e fórmulas (após a J1: períodos e última linha já conhecidos)
+    # =========================================================================
+    # Fórmulas SUMIF sobre a J1 (AL/AQ na estrutura estendida, P/W na padrão) ou valores já somados
+    linhas_periodo = _linhas_periodo_j2(layout, periodos_unicos, ultima_linha, totais_j2)
+
+    for row_idx, periodo, e_data, valor_b, valor_c, valor_d in linhas_periodo:
+        cell_a = ws_j2.cell(row=row_idx, column=1)
+        cell_a.value = periodo
+        if e_data:
+            cell_a.number_format = 'DD/MM/YYYY'
+        cell_a.border = thin_border
+        cell_a.alignment = Alignment(horizontal="center")
+
+        # ICMS destacado, ICMS apurado/devido e ICMS não recolhido
+        for col, valor in ((2, valor_b), (3, valor_c), (4, valor_d)):
+            cell = ws_j2.cell(row=row_idx, column=col)
+            cell.value = valor
+            cell.number_format = '#,##0.00'
+            cell.border = thin_border
+
+    # Linha de TOTAL
+    total_row = 12 + len(linhas_periodo)
+    ws_j2.cell(row=total_row, column=1).value = "TOTAL"
+    ws_j2.cell(row=total_row, column=1).font = Font(bold=True)
+    ws_j2.cell(row=total_row, column=1).border = thin_border
+
+    for col, valor in enumerate(_linha_total_j2(linhas_periodo, valores_estaticos), 2):
+        cell = ws_j2.cell(row=total_row, column=col)
+        cell.value = valor
+        cell.number_format = '#,##0.00'
+        cell.font = Font(bold=True)
+        cell.border = thin_border
+        cell.fill = PatternFill(start_color="E3F2FD", end_color="E3F2FD", fill_type="solid")
+
+    report_progress(90, "Configurando recálculo automático")
+    
+    # =========================================================================
+    # FORÇA RECÁLCULO DE FÓRMULAS AO ABRIR O ARQUIVO
+    # =========================================================================
+    # Isso resolve o problema de fórmulas que aparecem em branco até o usuário
+    # clicar na célula e pressionar Enter. Com valores estáticos só restam os links:
+    # sem recálculo completo (ver _calculo_ao_abrir)
+    wb.calculation = _calculo_ao_abrir(valores_estaticos)
+    
+    report_progress(95, "Salvando arquivo Excel")
+    
+    # Salva
+    wb.save(buffer)
+    buffer.seek(0)
+    
+    report_progress(100, "Concluído!")
+    
+    return buffer.getvalue()
+
+def _calculo_ao_abrir(valores_estaticos: bool) -> CalcProperties:
+    """
+    Propriedades de cálculo dos modos openpyxl. Com fórmulas, recálculo completo ao abrir
+    (fullCalcOnLoad), porque o openpyxl não grava o valor das fórmulas. Com valores
+    estáticos só restam os links do DANFE, e o arquivo não pede o recálculo de tudo.
+    """
+    return CalcProperties(fullCalcOnLoad=not valores_estaticos, calcMode='auto')
+
+
+def _celula_estilizada(ws, valor, modelo=None):
+    """
+    Célula do modo write_only com o estilo de `modelo` (célula montada uma vez com fonte,
+    borda, preenchimento e formato). Copiar o estilo já registrado evita reatribuir e
+    procurar fonte, borda e formato no workbook a cada célula.
+    """
+    cell = WriteOnlyCell(ws, value=valor)
+    if modelo is not None:
+        cell._style = copy.copy(modelo._style)
+    return cell
+
+
+def _modelo_celula(ws, **estilo):
+    """Célula-modelo para _celula_estilizada (font, fill, border, alignment, number_format)."""
+    cell = WriteOnlyCell(ws)
+    for atributo, valor in estilo.items():
+        setattr(cell, atributo, valor)
+    return cell
+
+
+def _export_excel_streaming(df, contrib_info: dict, nivel: str, parte_atual: int = None, total_partes: int = None,
+                            progress_callback=None, grupo: str = None, total_linhas: int = None,
+                            valores_estaticos: bool = False) -> bytes:
+    """
+    Modo "streaming" de export_to_excel_template (openpyxl write_only).
+
+    Mesmo layout, estilos e fórmulas do modo "padrao", mas cada linha é gravada no arquivo
+    temporário da aba assim que montada: a memória fica limitada ao lote atual, não ao
+    arquivo inteiro. Os estilos são montados uma única vez (ver _celula_estilizada).
+    Larguras, altura do cabeçalho e painel congelado são definidos antes da primeira linha
+    de cada aba; autofiltro e células mescladas são gravados no fechamento. A J2 continua
+    sendo a primeira aba, mas suas linhas só são escritas depois da J1 (cada aba tem seu
+    próprio arquivo temporário).
+    """
+    def report_progress(pct, msg):
+        if progress_callback:
+            progress_callback(pct, msg)
+
+    report_progress(5, "Criando estrutura do arquivo")
+
+    usar_estrutura_estendida = bool(grupo)  # todos os grupos usam a estendida (ver uses_full_queries)
+    layout = _layout_anexo_j1(usar_estrutura_estendida)
+    total_colunas = layout['total_colunas']
+
+    wb = Workbook(write_only=True)
+    ws_j2 = wb.create_sheet("ANEXO J2 - ICMS DEVIDO")
+    ws_indice = wb.create_sheet("Índice")
+    ws_j1 = wb.create_sheet("ANEXO J1 - NOTAS DE SAÍDAS")
+
+    # Estilos (os mesmos do modo "padrao"), montados uma vez
+    header_font = Font(bold=True, color="FFFFFF", size=10)
+    header_fill = PatternFill(start_color="1565C0", end_color="1565C0", fill_type="solid")
+    header_fill_fisco = PatternFill(start_color="C62828", end_color="C62828", fill_type="solid")
+    thin_border = Border(
+        left=Side(style='thin'),
+        right=Side(style='thin'),
+        top=Side(style='thin'),
+        bottom=Side(style='thin')
+    )
+    centro = Alignment(horizontal="center")
+    estilo = {
+        'borda': _modelo_celula(ws_j1, border=thin_border),
+        'link': _modelo_celula(ws_j1, border=thin_border),
+        'data': _modelo_celula(ws_j1, border=thin_border, number_format='DD/MM/YYYY'),
+        'moeda': _modelo_celula(ws_j1, border=thin_border, number_format='#,##0.00'),
+        'percentual': _modelo_celula(ws_j1, border=thin_border, number_format='0.00%'),
+        'negrito': _modelo_celula(ws_j1, font=Font(bold=True)),
+        'centro': _modelo_celula(ws_j1, alignment=centro),
+        'cabecalho_indice': _modelo_celula(ws_j1, font=header_font, fill=header_fill),
+        'cabecalho_j2': _modelo_celula(ws_j1, font=header_font, fill=header_fill, border=thin_border,
+                                       alignment=Alignment(horizontal="center", vertical="center")),
+        'cabecalho_j1': _modelo_celula(ws_j1, font=header_font, fill=header_fill, border=thin_border,
+                                       alignment=Alignment(horizontal="center", vertical="center", wrap_text=True)),
+        'cabecalho_j1_fisco': _modelo_celula(ws_j1, font=header_font, fill=header_fill_fisco, border=thin_border,
+                                             alignment=Alignment(horizontal="center", vertical="center", wrap_text=True)),
+        'periodo_j2': _modelo_celula(ws_j1, border=thin_border, number_format='DD/MM/YYYY', alignment=centro),
+        'periodo_j2_texto': _modelo_celula(ws_j1, border=thin_border, alignment=centro),
+        'total_j2': _modelo_celula(ws_j1, number_format='#,##0.00', font=Font(bold=True), border=thin_border,
+                                   fill=PatternFill(start_color="E3F2FD", end_color="E3F2FD", fill_type="solid")),
+        'total_j2_rotulo': _modelo_celula(ws_j1, font=Font(bold=True), border=thin_border),
+    }
+
+    def celula(ws, valor, nome_estilo):
+        return _celula_estilizada(ws, valor, estilo[nome_estilo])
+
+    # Dimensões gravadas antes da primeira linha de cada aba
+    for col_idx in range(1, 5):
+        ws_j2.column_dimensions[get_column_letter(col_idx)].width = 20
+    ws_indice.column_dimensions['A'].width = 35
+    ws_indice.column_dimensions['B'].width = 100
+    for col_idx in range(1, total_colunas + 1):
+        ws_j1.column_dimensions[get_column_letter(col_idx)].width = 15
+    ws_j1.row_dimensions[3].height = 30
+    ws_j1.freeze_panes = 'A4'
+
+    report_progress(20, "Criando aba Índice")
+
+    # =========================================================================
+    # Índice
+    # =========================================================================
+    ws_indice.append([celula(ws_indice, "Campo", 'cabecalho_indice'),
+                      celula(ws_indice, "Descrição", 'cabecalho_indice')])
+    for campo, desc in ANEXO_J_INDICE:
+        ws_indice.append([campo, desc])
+
+    report_progress(30, "Criando aba J1 - Notas de Saídas")
+
+    # =========================================================================
+    # ANEXO J1 - cabeçalho
+    # =========================================================================
+    titulo_j1 = "ANEXO J1"
+    if parte_atual is not None and total_partes is not None:
+        titulo_j1 = f"ANEXO J1 - Parte {parte_atual} de {total_partes}"
+    ws_j1.append([_celula_estilizada(ws_j1, titulo_j1, _modelo_celula(ws_j1, font=Font(bold=True, size=14, color="1565C0")))])
+
+    linha_2 = [None] * total_colunas
+    linha_2[3] = _celula_estilizada(
+        ws_j1, "INFORMAÇÕES RETIRADAS DOS DOCUMENTOS FISCAIS (Cupons Fiscais ou NFC-e)",
+        _modelo_celula(ws_j1, font=Font(bold=True, size=11, color="666666"))
+    )
+    col_fisco_titulo = column_index_from_string(layout['celula_fisco'].rstrip('0123456789'))
+    linha_2[col_fisco_titulo - 1] = _celula_estilizada(
+        ws_j1, "INFORMAÇÕES DECLARADAS PELO FISCO",
+        _modelo_celula(ws_j1, font=Font(bold=True, size=11, color="C62828"))
+    )
+    ws_j1.append(linha_2)
+
+    ws_j1.append([
+        celula(ws_j1, header, 'cabecalho_j1_fisco' if col_idx >= layout['col_fisco_inicio'] else 'cabecalho_j1')
+        for col_idx, header in enumerate(layout['headers'], 1)
+    ])
+
+    report_progress(40, "Preenchendo dados da aba J1")
+
+    # =========================================================================
+    # ANEXO J1 - dados, linha a linha em sequência
+    # =========================================================================
+    # DataFrame: lotes já na ordem de data_emissao via vetor de posições (sem copiar o DataFrame ordenado)
+    if isinstance(df, pd.DataFrame):
+        total_linhas = len(df)
+
+    # Com valores estáticos, as colunas calculadas vêm prontas em cada lote
+    formulas = () if valores_estaticos else _formulas_j1(layout)
+
+    total_rows = total_linhas or 0
+    progress_interval = max(1, total_rows // 20) if total_rows else STREAM_CHUNK_SIZE
+    periodos_unicos = set()
+    totais_j2 = {} if valores_estaticos else None
+    row_idx = 3
+    plano = _plano_colunas_j1(usar_estrutura_estendida)
+
+    for chunk in iter_df_chunks(df, ordenar_por='data_emissao'):
+        if not isinstance(df, pd.DataFrame) and 'data_emissao' in chunk.columns:
+            chunk = chunk.sort_values('data_emissao', ascending=True, na_position='last', kind='stable')
+        if 'periodo' in chunk.columns:
+            periodos_unicos.update(chunk['periodo'].dropna().unique())
+
+        calculadas = ()
+        if valores_estaticos:
+            calculadas, icms_destacado, icms_devido = _colunas_estaticas_j1(chunk, layout, row_idx + 1)
+            _acumular_totais_j2(totais_j2, chunk, icms_destacado, icms_devido)
+
+        # Conversão por coluna, uma vez por lote; o laço abaixo só percorre tuplas
+        indices, linhas, estilos_linhas = _converter_lote_j1(chunk, plano, calculadas)
+
+        for valores, estilos in zip(linhas, estilos_linhas):
+            row_idx += 1
+            atual_row = row_idx - 4
+            if atual_row % progress_interval == 0:
+                if total_rows:
+                    pct = 40 + int((min(atual_row, total_rows) / total_rows) * 40)
+                    report_progress(pct, f"Processando linha {atual_row:,} de {total_rows:,}")
+                else:
+                    report_progress(40, f"Processando linha {atual_row:,}")
+
+            linha = [None] * total_colunas
+            for idx, valor, nome_estilo in zip(indices, valores, estilos):
+                linha[idx] = celula(ws_j1, valor, nome_estilo)
+
+            for idx, modelo, nome_estilo in formulas:
+                linha[idx] = celula(ws_j1, modelo.format(r=row_idx), nome_estilo)
+            ws_j1.append(linha)
+
+    ultima_linha = row_idx
+    ws_j1.auto_filter.ref = f"A3:{get_column_letter(total_colunas)}{ultima_linha}"
+
+    report_progress(85, "Preenchendo aba J2 - ICMS devido")
+
+    # =========================================================================
+    # ANEXO J2 - escrita completa agora que períodos e última linha da J1 são conhecidos
+    # =========================================================================
+    ws_j2.append([_celula_estilizada(ws_j2, "ESTADO DE SANTA CATARINA",
+                                     _modelo_celula(ws_j2, font=Font(bold=True, size=14), alignment=centro))])
+    for texto in ("Secretaria de Estado da Fazenda", "Diretoria de Administração Tributária", "Gerência de Fiscalização"):
+        ws_j2.append([celula(ws_j2, texto, 'centro')])
+    ws_j2.append([])
+    ws_j2.append([celula(ws_j2, "CNPJ:", 'negrito'), contrib_info.get('cnpj', '') if contrib_info else ''])
+    ws_j2.append([celula(ws_j2, "Razão Social:", 'negrito'), contrib_info.get('razao_social', '') if contrib_info else ''])
+    ws_j2.append([])
+    ws_j2.append([])
+    ws_j2.append([_celula_estilizada(
+        ws_j2, "APURAÇÃO MENSAL DO VALOR DO ICMS DEVIDO NAS VENDAS DE MERCADORIAS",
+        _modelo_celula(ws_j2, font=Font(bold=True, size=12), alignment=centro,
+                       fill=PatternFill(start_color="FFFF00", end_color="FFFF00", fill_type="solid"))
+    )])
+    for faixa in ('A1:D1', 'A2:D2', 'A3:D3', 'A4:D4', 'A10:D10'):
+        ws_j2.merged_cells.add(faixa)
+
+    ws_j2.append([celula(ws_j2, header, 'cabecalho_j2')
+                  for header in ["Período", "ICMS destacado", "ICMS apurado", "ICMS não recolhido"]])
+
+    linhas_periodo = _linhas_periodo_j2(layout, periodos_unicos, ultima_linha, totais_j2)
+    for row_idx, periodo, e_data, valor_b, valor_c, valor_d in linhas_periodo:
+        ws_j2.append([
+            celula(ws_j2, periodo, 'periodo_j2' if e_data else 'periodo_j2_texto'),
+            celula(ws_j2, valor_b, 'moeda'),
+            celula(ws_j2, valor_c, 'moeda'),
+            celula(ws_j2, valor_d, 'moeda'),
+        ])
+
+    # Linha de TOTAL
+    ws_j2.append([celula(ws_j2, "TOTAL", 'total_j2_rotulo')] + [
+        celula(ws_j2, valor, 'total_j2') for valor in _linha_total_j2(linhas_periodo, valores_estaticos)
+    ])
+
+    report_progress(90, "Configurando recálculo automático")
+
+    # Recálculo ao abrir o arquivo, como no modo "padrao"
+    wb.calculation = _calculo_ao_abrir(valores_estaticos)
+
+    report_progress(95, "Salvando arquivo Excel")
+
+    buffer = BytesIO()
+    wb.save(buffer)
+
+    report_progress(100, "Concluído!")
+
+    return buffer.getvalue()
+
+def _export_excel_xlsxwriter(df, contrib_info: dict, nivel: str, parte_atual: int = None, total_partes: int = None,
+                             progress_callback=None, grupo: str = None, total_linhas: int = None,
+                             valores_estaticos: bool = False) -> bytes:
+    """
+    Modo "xlsxwriter" de export_to_excel_template (xlsxwriter em constant_memory).
+
+    Mesmas abas, layout, estilos, fórmulas, painel congelado e autofiltro dos modos
+    openpyxl. Em constant_memory cada linha é descarregada ao passar para a seguinte,
+    então tudo é escrito em ordem de linha; como no modo "streaming", cada aba tem seu
+    arquivo temporário e a J2 é escrita por último. Larguras são passadas em pixels
+    (largura * 7) para gravar no arquivo a mesma largura do openpyxl.
+
+    Com valores estáticos, os links são gravados com o valor já calculado ("Abrir DANFE").
+    """
+    if not XLSXWRITER_AVAILABLE:
+        raise RuntimeError("Biblioteca xlsxwriter não disponível")
+
+    def report_progress(pct, msg):
+        if progress_callback:
+            progress_callback(pct, msg)
+
+    report_progress(5, "Criando estrutura do arquivo")
+
+    usar_estrutura_estendida = bool(grupo)  # todos os grupos usam a estendida (ver uses_full_queries)
+    layout = _layout_anexo_j1(usar_estrutura_estendida)
+    total_colunas = layout['total_colunas']
+
+    buffer = BytesIO()
+    wb = xlsxwriter.Workbook(buffer, {
+        'constant_memory': True,
+        'strings_to_urls': False,     # texto com "http://" continua texto, como no openpyxl
+        'tmpdir': tempfile.gettempdir(),
+    })
+    wb.set_calc_mode('auto')         # fullCalcOnLoad é gravado por padrão
+    ws_j2 = wb.add_worksheet("ANEXO J2 - ICMS DEVIDO")
+    ws_indice = wb.add_worksheet("Índice")
+    ws_j1 = wb.add_worksheet("ANEXO J1 - NOTAS DE SAÍDAS")
+
+    # Estilos equivalentes aos do openpyxl (criados uma vez)
+    cabecalho = {'bold': True, 'font_color': '#FFFFFF', 'font_size': 10, 'bg_color': '#1565C0', 'pattern': 1}
+    formato = {
+        'borda': wb.add_format({'border': 1}),
+        'link': wb.add_format({'border': 1}),
+        'data': wb.add_format({'border': 1, 'num_format': FORMATOS_J1['data']}),
+        'moeda': wb.add_format({'border': 1, 'num_format': FORMATOS_J1['moeda']}),
+        'percentual': wb.add_format({'border': 1, 'num_format': FORMATOS_J1['percentual']}),
+        'negrito': wb.add_format({'bold': True}),
+        'centro': wb.add_format({'align': 'center'}),
+        'titulo_j2': wb.add_format({'bold': True, 'font_size': 14, 'align': 'center'}),
+        'faixa_j2': wb.add_format({'bold': True, 'font_size': 12, 'align': 'center', 'bg_color': '#FFFF00', 'pattern': 1}),
+        'cabecalho_indice': wb.add_format(cabecalho),
+        'cabecalho_j2': wb.add_format({**cabecalho, 'border': 1, 'align': 'center', 'valign': 'vcenter'}),
+        'cabecalho_j1': wb.add_format({**cabecalho, 'border': 1, 'align': 'center', 'valign': 'vcenter',
+                                       'text_wrap': True}),
+        'cabecalho_j1_fisco': wb.add_format({**cabecalho, 'bg_color': '#C62828', 'border': 1, 'align': 'center',
+                                             'valign': 'vcenter', 'text_wrap': True}),
+        'titulo_j1': wb.add_format({'bold': True, 'font_size': 14, 'font_color': '#1565C0'}),
+        'subtitulo_j1': wb.add_format({'bold': True, 'font_size': 11, 'font_color': '#666666'}),
+        'subtitulo_fisco': wb.add_format({'bold': True, 'font_size': 11, 'font_color': '#C62828'}),
+        'periodo_j2': wb.add_format({'border': 1, 'num_format': FORMATOS_J1['data'], 'align': 'center'}),
+        'periodo_j2_texto': wb.add_format({'border': 1, 'align': 'center'}),
+        'total_j2': wb.add_format({'bold': True, 'border': 1, 'num_format': FORMATOS_J1['moeda'],
+                                   'bg_color': '#E3F2FD', 'pattern': 1}),
+        'total_j2_rotulo': wb.add_format({'bold': True, 'border': 1}),
+    }
+
+    # Dimensões (definidas antes de escrever as linhas, como exige o constant_memory)
+    ws_j2.set_column_pixels(0, 3, 20 * 7)
+    ws_indice.set_column_pixels(0, 0, 35 * 7)
+    ws_indice.set_column_pixels(1, 1, 100 * 7)
+    ws_j1.set_column_pixels(0, total_colunas - 1, 15 * 7)
+    ws_j1.set_row(2, 30)
+    ws_j1.freeze_panes(3, 0)
+
+    report_progress(20, "Criando aba Índice")
+
+    # =========================================================================
+    # Índice
+    # =========================================================================
+    ws_indice.write(0, 0, "Campo", formato['cabecalho_indice'])
+    ws_indice.write(0, 1, "Descrição", formato['cabecalho_indice'])
+    for row, (campo, desc) in enumerate(ANEXO_J_INDICE, 1):
+        ws_indice.write_string(row, 0, campo)
+        ws_indice.write_string(row, 1, desc)
+
+    report_progress(30, "Criando aba J1 - Notas de Saídas")
+
+    # =========================================================================
+    # ANEXO J1 - cabeçalho
+    # =========================================================================
+    titulo_j1 = "ANEXO J1"
+    if parte_atual is not None and total_partes is not None:
+        titulo_j1 = f"ANEXO J1 - Parte {parte_atual} de {total_partes}"
+    ws_j1.write_string(0, 0, titulo_j1, formato['titulo_j1'])
+    ws_j1.write_string(1, 3, "INFORMAÇÕES RETIRADAS DOS DOCUMENTOS FISCAIS (Cupons Fiscais ou NFC-e)",
+                       formato['subtitulo_j1'])
+    col_fisco_titulo = column_index_from_string(layout['celula_fisco'].rstrip('0123456789'))
+    ws_j1.write_string(1, col_fisco_titulo - 1, "INFORMAÇÕES DECLARADAS PELO FISCO", formato['subtitulo_fisco'])
+    for col_idx, header in enumerate(layout['headers'], 1):
+        estilo_cabecalho = 'cabecalho_j1_fisco' if col_idx >= layout['col_fisco_inicio'] else 'cabecalho_j1'
+        ws_j1.write_string(2, col_idx - 1, header, formato[estilo_cabecalho])
+
+    report_progress(40, "Preenchendo dados da aba J1")
+
+    # =========================================================================
+    # ANEXO J1 - dados, em ordem de linha
+    # =========================================================================
+    if isinstance(df, pd.DataFrame):
+        total_linhas = len(df)
+
+    formulas = () if valores_estaticos else _formulas_j1(layout)
+    total_rows = total_linhas or 0
+    progress_interval = max(1, total_rows // 20) if total_rows else STREAM_CHUNK_SIZE
+    periodos_unicos = set()
+    totais_j2 = {} if valores_estaticos else None
+    row_idx = 3
+    plano = _plano_colunas_j1(usar_estrutura_estendida)
+    escrever = ws_j1.write
+    escrever_formula = ws_j1.write_formula
+
+    for chunk in iter_df_chunks(df, ordenar_por='data_emissao'):
+        if not isinstance(df, pd.DataFrame) and 'data_emissao' in chunk.columns:
+            chunk = chunk.sort_values('data_emissao', ascending=True, na_position='last', kind='stable')
+        if 'periodo' in chunk.columns:
+            periodos_unicos.update(chunk['periodo'].dropna().unique())
+
+        calculadas = ()
+        if valores_estaticos:
+            calculadas, icms_destacado, icms_devido = _colunas_estaticas_j1(chunk, layout, row_idx + 1)
+            _acumular_totais_j2(totais_j2, chunk, icms_destacado, icms_devido)
+
+        indices, linhas, estilos_linhas = _converter_lote_j1(chunk, plano, calculadas)
+
+        for valores, estilos in zip(linhas, estilos_linhas):
+            row_idx += 1
+            atual_row = row_idx - 4
+            if atual_row % progress_interval == 0:
+                if total_rows:
+                    pct = 40 + int((min(atual_row, total_rows) / total_rows) * 40)
+                    report_progress(pct, f"Processando linha {atual_row:,} de {total_rows:,}")
+                else:
+                    report_progress(40, f"Processando linha {atual_row:,}")
+
+            # xlsxwriter usa linhas 0-based (row_idx é a linha do Excel)
+            linha = row_idx - 1
+            for idx, valor, nome_estilo in zip(indices, valores, estilos):
+                if nome_estilo == 'link' and valor:
+                    escrever_formula(linha, idx, valor, formato['link'], "Abrir DANFE")
+                else:
+                    escrever(linha, idx, valor, formato[nome_estilo])
+            for idx, modelo, nome_estilo in formulas:
+                escrever_formula(linha, idx, modelo.format(r=row_idx), formato[nome_estilo])
+
+    ultima_linha = row_idx
+    ws_j1.autofilter(2, 0, ultima_linha - 1, total_colunas - 1)
+
+    report_progress(85, "Preenchendo aba J2 - ICMS devido")
+
+    # =========================================================================
+    # ANEXO J2 - escrita completa agora que períodos e última linha da J1 são conhecidos
+    # =========================================================================
+    ws_j2.merge_range(0, 0, 0, 3, "ESTADO DE SANTA CATARINA", formato['titulo_j2'])
+    for row, texto in enumerate(("Secretaria de Estado da Fazenda", "Diretoria de Administração Tributária",
+                                 "Gerência de Fiscalização"), 1):
+        ws_j2.merge_range(row, 0, row, 3, texto, formato['centro'])
+    ws_j2.write_string(5, 0, "CNPJ:", formato['negrito'])
+    ws_j2.write(5, 1, contrib_info.get('cnpj', '') if contrib_info else '')
+    ws_j2.write_string(6, 0, "Razão Social:", formato['negrito'])
+    ws_j2.write(6, 1, contrib_info.get('razao_social', '') if contrib_info else '')
+    ws_j2.merge_range(9, 0, 9, 3, "APURAÇÃO MENSAL DO VALOR DO ICMS DEVIDO NAS VENDAS DE MERCADORIAS",
+                      formato['faixa_j2'])
+    for col, header in enumerate(["Período", "ICMS destacado", "ICMS apurado", "ICMS não recolhido"]):
+        ws_j2.write_string(10, col, header, formato['cabecalho_j2'])
+
+    linhas_periodo = _linhas_periodo_j2(layout, periodos_unicos, ultima_linha, totais_j2)
+    for row_idx, periodo, e_data, valor_b, valor_c, valor_d in linhas_periodo:
+        ws_j2.write(row_idx - 1, 0, periodo, formato['periodo_j2' if e_data else 'periodo_j2_texto'])
+        # write: fórmula (texto com "=") ou número (valores estáticos)
+        ws_j2.write(row_idx - 1, 1, valor_b, formato['moeda'])
+        ws_j2.write(row_idx - 1, 2, valor_c, formato['moeda'])
+        ws_j2.write(row_idx - 1, 3, valor_d, formato['moeda'])
+
+    # Linha de TOTAL
+    total_row = 12 + len(linhas_periodo)
+    ws_j2.write_string(total_row - 1, 0, "TOTAL", formato['total_j2_rotulo'])
+    for col, valor in enumerate(_linha_total_j2(linhas_periodo, valores_estaticos), 1):
+        ws_j2.write(total_row - 1, col, valor, formato['total_j2'])
+
+    report_progress(90, "Configurando recálculo automático")
+    report_progress(95, "Salvando arquivo Excel")
+
+    wb.close()
+
+    report_progress(100, "Concluído!")
+
+    return buffer.getvalue()
+
+def dividir_em_partes(dados, max_linhas: int = None):
+    """
+    Divide uma fonte de lotes (ver iter_df_chunks) em partes de até `max_linhas` linhas.
+
+    Gera, para cada parte, um iterador de lotes. As partes compartilham a mesma fonte
+    e devem ser consumidas em ordem, cada uma até o fim, antes de pedir a próxima.
+    """
+    max_linhas = max_linhas or MAX_ROWS_PER_EXCEL
+    fonte = iter_df_chunks(dados)
+    sobra = [None]
+
+    def lotes_da_parte():
+        restante = max_linhas
+        while restante > 0:
+            if sobra[0] is not None:
+                chunk, sobra[0] = sobra[0], None
+            else:
+                chunk = next(fonte, None)
+                if chunk is None:
+                    return
+            if len(chunk) > restante:
+                sobra[0] = chunk.iloc[restante:]
+                chunk = chunk.iloc[:restante]
+            restante -= len(chunk)
+            yield chunk
+
+    while True:
+        if sobra[0] is None:
+            primeiro = next(fonte, None)
+            if primeiro is None:
+                return
+            sobra[0] = primeiro
+        yield lotes_da_parte()
+
+def excel_paralelo_disponivel() -> bool:
+    """Partes do Excel em processos paralelos: ativo na configuração e pyarrow instalado (lotes em Parquet)."""
+    return (bool(EXCEL_PARALELO_CONFIG['ativo']) and int(EXCEL_PARALELO_CONFIG['max_processos']) > 1
+            and PYARROW_AVAILABLE)
+
+
+def _arquivo_temporario_parte() -> str:
+    """Caminho de um arquivo temporário (já criado) para uma parte do Excel."""
+    fd, caminho = tempfile.mkstemp(prefix="argos_parte_", suffix=".xlsx")
+    os.close(fd)
+    return caminho
+
+
+def _processo_parte_excel(fila, diretorio_lotes: str, linhas: int, contrib_info: dict, nivel: str, parte: int,
+                          total_partes: int, grupo: str, caminho: str, valores_estaticos: bool = None):
+    """
+    Corpo do processo filho (spawn) de gerar_partes_excel: lê os lotes da parte em
+    `diretorio_lotes`, gera a parte do Anexo J em `caminho` e informa progresso e erros ao
+    processo pai pela fila.
+    """
+    def progresso(pct, msg):
+        fila.put(('progresso', parte, pct, msg))
+
+    try:
+        conteudo = export_to_excel_template(
+            functools.partial(ler_lotes_parquet, diretorio_lotes), contrib_info, nivel,
+            parte_atual=parte if total_partes > 1 else None,
+            total_partes=total_partes if total_partes > 1 else None,
+            progress_callback=progresso, grupo=grupo, total_linhas=linhas,
+            valores_estaticos=valores_estaticos
+        )
+        with open(caminho, 'wb') as f:
+            f.write(conteudo)
+    except Exception as e:
+        fila.put(('erro', parte, 0, str(e)[:500]))
+        raise SystemExit(1)
+
+
+def gerar_partes_excel(df, contrib_info: dict, nivel: str, total_rows: int, progress_callback=None, grupo: str = None,
+                       valores_estaticos: bool = None):
+    """
+    Gera as partes do Anexo J de uma exportação com mais de MAX_ROWS_PER_EXCEL linhas,
+    cada uma em um arquivo temporário.
+
+    Com excel_paralelo_disponivel(), até `max_processos` partes são geradas ao mesmo tempo,
+    cada uma num processo filho criado por spawn (ver EXCEL_PARALELO_CONFIG). O pai grava os
+    lotes de cada parte em Parquet (gravar_lotes_parquet), lote a lote, sem juntar a parte
+    num DataFrame só, e o filho (_processo_parte_excel, função de módulo) lê os lotes do
+    disco. DataFrame é fatiado por posição, sem cópia. Sem pyarrow, ou com uma única parte,
+    as partes são geradas em sequência no próprio processo, como antes.
+
+    O progresso de todas as partes é somado em progress_callback(partes_concluidas,
+    total_partes, mensagem), com partes_concluidas fracionário. Um processo filho que passa
+    de EXCEL_PARALELO_CONFIG['timeout_parte_segundos'] é encerrado e a exportação falha.
+
+    Com uma única parte (exportação em segundo plano - ver argos.exportacao), o arquivo sai sem
+    numeração, igual ao Excel único.
+    `valores_estaticos` é repassado a export_to_excel_template.
+
+    Gera (parte, total_partes, caminho) na ordem das partes. Cada arquivo é removido quando
+    o próximo item é pedido (ou ao final/erro), então deve ser usado antes disso.
+
+    `total_rows` de fontes em lotes vem da contagem feita ao preparar a exportação: se a
+    fonte trouxer mais partes do que ela prevê (tabelas recarregadas no meio do caminho),
+    a exportação falha em vez de gerar partes com numeração errada.
+    """
+    total_partes = math.ceil(total_rows / MAX_ROWS_PER_EXCEL)
+
+    def conferir_parte(parte):
+        if parte > total_partes:
+            raise RuntimeError(
+                f"Os dados têm mais de {total_rows:,} linhas, o total contado ao preparar a exportação "
+                "(tabelas recarregadas?). Prepare a exportação de novo."
+            )
+
+    if isinstance(df, pd.DataFrame):
+        fonte_partes = ((parte, df.iloc[(parte - 1) * MAX_ROWS_PER_EXCEL:parte * MAX_ROWS_PER_EXCEL])
+                        for parte in range(1, math.ceil(len(df) / MAX_ROWS_PER_EXCEL) + 1))
+    else:
+        fonte_partes = enumerate(dividir_em_partes(df, MAX_ROWS_PER_EXCEL), 1)
+
+    # Uma parte só não ganha nada com outro processo: gera no próprio processo
+    if total_partes <= 1 or not excel_paralelo_disponivel():
+        for parte, dados_parte in fonte_partes:
+            conferir_parte(parte)
+            linhas_parte = min(MAX_ROWS_PER_EXCEL, total_rows - (parte - 1) * MAX_ROWS_PER_EXCEL)
+
+            def progresso_parte(pct, msg, parte=parte):
+                if progress_callback:
+                    progress_callback(parte - 1 + pct / 100, total_partes, f"Parte {parte}: {msg}")
+
+            conteudo = export_to_excel_template(
+                dados_parte, contrib_info, nivel,
+                parte_atual=parte if total_partes > 1 else None,
+                total_partes=total_partes if total_partes > 1 else None,
+                progress_callback=progresso_parte, grupo=grupo, total_linhas=linhas_parte,
+                valores_estaticos=valores_estaticos
+            )
+            caminho = _arquivo_temporario_parte()
+            try:
+                with open(caminho, 'wb') as f:
+                    f.write(conteudo)
+                del conteudo
+                yield parte, total_partes, caminho
+            finally:
+                remover_arquivo_temporario(caminho)
+        return
+
+    ctx = multiprocessing.get_context('spawn')
+    fila = ctx.Queue()
+    max_processos = max(1, min(int(EXCEL_PARALELO_CONFIG['max_processos']), total_partes))
+    limite_parte = float(EXCEL_PARALELO_CONFIG['timeout_parte_segundos'] or 0)
+    rodando = {}     # parte -> (processo, caminho, diretório dos lotes, início)
+    prontas = {}     # parte -> caminho (concluídas, aguardando a vez de serem entregues)
+    progresso = {}   # parte -> percentual
+    erros = {}       # parte -> mensagem do processo filho
+    proxima = 1
+    esgotada = False
+    mensagem = f"Gerando {total_partes} partes em paralelo..."
+
+    def ler_fila(timeout):
+        nonlocal mensagem
+        try:
+            item = fila.get(timeout=timeout)
+            while True:
+                tipo, parte_msg, pct, msg = item
+                if tipo == 'erro':
+                    erros[parte_msg] = msg
+                else:
+                    progresso[parte_msg] = pct
+                    mensagem = f"Parte {parte_msg}: {msg}"
+                item = fila.get_nowait()
+        except queue.Empty:
+            pass
+
+    try:
+        while not esgotada or rodando or prontas:
+            # Inicia novas partes até o limite de processos
+            while not esgotada and len(rodando) < max_processos:
+                item = next(fonte_partes, None)
+                if item is None:
+                    esgotada = True
+                    break
+                parte, dados_parte = item
+                conferir_parte(parte)
+                # DataFrame sai ordenado por data_emissao, como os writers fariam com a parte inteira
+                diretorio, linhas = gravar_lotes_parquet(dados_parte, prefixo="argos_parte_", ordenar_por='data_emissao')
+                del dados_parte
+                caminho = _arquivo_temporario_parte()
+                processo = ctx.Process(
+                    target=_processo_parte_excel,
+                    args=(fila, diretorio, linhas, contrib_info, nivel, parte, total_partes, grupo, caminho,
+                          valores_estaticos),
+                    daemon=True
+                )
+                try:
+                    processo.start()
+                except BaseException:
+                    shutil.rmtree(diretorio, ignore_errors=True)
+                    remover_arquivo_temporario(caminho)
+                    raise
+                rodando[parte] = (processo, caminho, diretorio, time.monotonic())
+                progresso[parte] = 0
+
+            ler_fila(timeout=0.5)
+
+            for parte, (processo, caminho, diretorio, inicio) in list(rodando.items()):
+                if processo.exitcode is None:
+                    if limite_parte > 0 and time.monotonic() - inicio > limite_parte:
+                        processo.terminate()
+                        processo.join(5)
+                        del rodando[parte]
+                        shutil.rmtree(diretorio, ignore_errors=True)
+                        remover_arquivo_temporario(caminho)
+                        raise RuntimeError(
+                            f"A parte {parte} de {total_partes} passou de {limite_parte:.0f}s e foi interrompida"
+                        )
+                    continue
+                processo.join()
+                del rodando[parte]
+                shutil.rmtree(diretorio, ignore_errors=True)
+                if processo.exitcode != 0:
+                    remover_arquivo_temporario(caminho)
+                    ler_fila(timeout=0.1)
+                    detalhe = erros.get(parte, f"processo terminou com código {processo.exitcode}")
+                    raise RuntimeError(f"Falha ao gerar a parte {parte} de {total_partes}: {detalhe}")
+                prontas[parte] = caminho
+                progresso[parte] = 100
+
+            if progress_callback:
+                progress_callback(sum(progresso.values()) / 100, total_partes, mensagem)
+
+            # Entrega as partes concluídas na ordem
+            while proxima in prontas:
+                caminho = prontas.pop(proxima)
+                try:
+                    yield proxima, total_partes, caminho
+                finally:
+                    remover_arquivo_temporario(caminho)
+                proxima += 1
+    finally:
+        for processo, caminho, diretorio, _ in rodando.values():
+            if processo.is_alive():
+                processo.terminate()
+            processo.join(5)
+            shutil.rmtree(diretorio, ignore_errors=True)
+            remover_arquivo_temporario(caminho)
+        for caminho in prontas.values():
+            remover_arquivo_temporario(caminho)
+        fila.close()
+
+
+def montar_zip_partes(df, contrib_info: dict, nivel: str, total_rows: int, progress_callback=None, grupo: str = None,
+                      arquivo=None, valores_estaticos: bool = None):
+    """
+    Monta o ZIP de uma exportação em partes (ver gerar_partes_excel) direto num arquivo em
+    disco: cada .xlsx é copiado do arquivo da parte para o ZIP, em blocos e sem
+    recompressão (ZIP_STORED - o xlsx já é um ZIP comprimido), então o pico de memória é
+    o de uma parte, não o do ZIP inteiro.
+
+    Args:
+        arquivo: arquivo binário de destino, aberto para escrita (ex.: open(caminho, 'w+b'))
+        valores_estaticos: ver export_to_excel_template
+    """
+    with zipfile.ZipFile(arquivo, 'w', zipfile.ZIP_STORED, allowZip64=True) as zip_file:
+        for parte, total_partes, caminho in gerar_partes_excel(df, contrib_info, nivel, total_rows, progress_callback,
+                                                               grupo, valores_estaticos):
+            # Adiciona ao ZIP direto do arquivo temporário da parte
+            zip_file.write(caminho, get_export_filename_parte(contrib_info, nivel, parte, total_partes))
+
+
+def get_export_filename(contrib_info: dict, nivel: str, extension: str) -> str:
+    """
+    Gera o nome do arquivo no formato: CNPJ_14_DIGITOS - RAZAO_SOCIAL.extensao
+    Sanitiza caracteres que podem causar erros em caminhos de rede Windows/DFS.
+    """
+    if contrib_info:
+        cnpj = sanitize_identificador(contrib_info.get('cnpj', ''))
+        razao = contrib_info.get('razao_social', 'EMPRESA')
+        # Limpa caracteres proibidos no Windows: < > : " / \ | ? *
+        razao_clean = re.sub(r'[<>:"/\\|?*]', '', razao)
+        # Remove pontos no final (causam erro em DFS)
+        razao_clean = razao_clean.rstrip('.')
+        # Remove espaços extras
+        razao_clean = re.sub(r'\s+', ' ', razao_clean).strip()
+        # Limita a 50 chars
+        razao_clean = razao_clean[:50].rstrip('.')
+        # Se ficou vazio, usa fallback
+        if not razao_clean:
+            razao_clean = 'EMPRESA'
+        return f"{cnpj} - {razao_clean}.{extension}"
+    return f"infracoes_gessuper_{nivel.lower()}.{extension}"
+
+def get_export_filename_parte(contrib_info: dict, nivel: str, parte: int, total_partes: int) -> str:
+    """Nome do .xlsx de uma parte ("... - Parte X de Y.xlsx"); sem numeração quando há uma só."""
+    filename = get_export_filename(contrib_info, nivel, "xlsx")
+    if total_partes <= 1:
+        return filename
+    return filename.replace(".xlsx", f" - Parte {parte} de {total_partes}.xlsx")
+
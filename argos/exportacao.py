@@ -0,0 +1,597 @@
+# -*- coding: utf-8 -*-
+"""
+Exportações em segundo plano: fila de jobs de Excel (status, progresso e cancelamento por
+processo) e cache em disco dos Excel/ZIP gerados, compartilhado entre sessões e processos.
+"""
+import concurrent.futures
+import functools
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:  # Windows: a trava dos artefatos vale só entre os jobs do mesmo processo
+    FCNTL_AVAILABLE = False
+
+from argos.arquivos import criar_diretorio_privado, remover_arquivo_temporario
+from argos.cache_disco import arquivos_cache_disco, remover_menos_usados
+from argos.excel import (EXCEL_LAYOUT_VERSAO, MAX_ROWS_PER_EXCEL, PYARROW_AVAILABLE, gerar_partes_excel,
+                         get_export_filename, montar_zip_partes)
+from argos.lotes import escrever_csv_lotes, gravar_lotes_parquet, iter_df_chunks, ler_lotes_parquet
+from argos.rede import REDE_PATH, SMB_AVAILABLE, mensagem_erro_rede, smb_write_with_retry
+
+# Exportações Excel em segundo plano: jobs com status e progresso por processo, gerados
+# fora da execução do script. Seção [exportacao_jobs] no secrets.toml.
+EXPORT_JOBS_CONFIG = {
+    'max_simultaneos': 2,       # jobs gerados ao mesmo tempo; os demais aguardam na fila
+    'retencao_minutos': 120,    # jobs encerrados (e seus arquivos) ficam disponíveis por este tempo
+    'diretorio': os.path.join(tempfile.gettempdir(), "argos_exportacoes"),
+    'atualizacao_segundos': 2,  # intervalo de atualização do painel de jobs
+}
+
+# Cache em disco dos Excel/ZIP gerados, compartilhado entre sessões e processos.
+# Seção [cache_exportacao] no secrets.toml.
+EXPORT_CACHE_CONFIG = {
+    'ativo': True,
+    'diretorio': os.path.join(tempfile.gettempdir(), "argos_cache_exportacao"),
+    'max_mb': 10000,         # acima disso, remove os arquivos menos usados (LRU)
+}
+
+
+def export_to_csv_arquivo(df) -> str:
+    """
+    Exporta para CSV no formato brasileiro (ver escrever_csv_lotes), lote a lote, num
+    arquivo em EXPORT_JOBS_CONFIG['diretorio'], e retorna o caminho (para st.download_button
+    com open(caminho, 'rb')). O arquivo é removido depois de `retencao_minutos`, junto com
+    os jobs antigos.
+    - Separador: ponto e vírgula (;)
+    - Encoding: latin-1 (ANSI)
+    - Decimal: vírgula (,)
+    """
+    criar_diretorio_privado(EXPORT_JOBS_CONFIG['diretorio'])
+    fd, caminho = tempfile.mkstemp(prefix="argos_csv_", suffix=".csv", dir=EXPORT_JOBS_CONFIG['diretorio'])
+    try:
+        with os.fdopen(fd, 'wb') as destino:
+            escrever_csv_lotes(df, destino)
+    except Exception:
+        remover_arquivo_temporario(caminho)
+        raise
+    return caminho
+
+
+# =============================================================================
+# FILA DE JOBS
+# =============================================================================
+
+class ExportacaoCancelada(Exception):
+    """Job de exportação cancelado pelo usuário."""
+
+
+# Jobs de exportação deste processo (job_id -> dict), do mais antigo para o mais recente.
+# Ficam fora do session_state: sobrevivem a reruns e à troca de sessão, mas não a um
+# reinício do servidor (a fila e os jobs em andamento se perdem).
+_EXPORT_JOBS = OrderedDict()
+_EXPORT_JOBS_LOCK = threading.Lock()
+
+# Fonte dos jobs na fila (job_id -> DataFrame ou função de lotes), fora do job: o job
+# guarda só o diretório dos lotes em disco (ver _fonte_em_disco)
+_FONTES_JOBS = {}
+
+# Diretórios de lotes (argos_fonte_*) sem uso há mais que isto, deixados por um processo que
+# terminou no meio de um job, são removidos com os jobs antigos
+FONTE_JOB_OBSOLETA_SECONDS = 24 * 3600
+
+EXPORT_JOB_ATIVOS = ("na fila", "gerando")
+
+
+_EXECUTOR_EXPORTACAO = None
+_EXECUTOR_EXPORTACAO_LOCK = threading.Lock()
+
+
+def get_executor_exportacao():
+    """Pool de threads das exportações em segundo plano (uma thread por job em andamento), criado no primeiro uso."""
+    global _EXECUTOR_EXPORTACAO
+    with _EXECUTOR_EXPORTACAO_LOCK:
+        if _EXECUTOR_EXPORTACAO is None:
+            _EXECUTOR_EXPORTACAO = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, int(EXPORT_JOBS_CONFIG['max_simultaneos'])),
+                thread_name_prefix="argos_exportacao"
+            )
+        return _EXECUTOR_EXPORTACAO
+
+
+def _atualizar_job(job_id: str, **campos):
+    with _EXPORT_JOBS_LOCK:
+        if job_id in _EXPORT_JOBS:
+            _EXPORT_JOBS[job_id].update(campos)
+
+
+def _limpar_jobs_antigos():
+    """Remove jobs encerrados há mais de `retencao_minutos`, com seus arquivos."""
+    limite = time.time() - float(EXPORT_JOBS_CONFIG['retencao_minutos']) * 60
+    with _EXPORT_JOBS_LOCK:
+        antigos = [job_id for job_id, job in _EXPORT_JOBS.items()
+                   if job['status'] not in EXPORT_JOB_ATIVOS and (job['fim'] or 0) < limite]
+        removidos = [_EXPORT_JOBS.pop(job_id) for job_id in antigos]
+    for job in removidos:
+        # Arquivos do cache de exportações ficam para o LRU (limpar_cache_exportacao)
+        if job.get('arquivo') and not job.get('arquivo_cache'):
+            remover_arquivo_temporario(job['arquivo'])
+
+    # CSVs gerados para download (export_to_csv_arquivo) e lotes de jobs interrompidos
+    limite_fontes = time.time() - FONTE_JOB_OBSOLETA_SECONDS
+    try:
+        with os.scandir(EXPORT_JOBS_CONFIG['diretorio']) as entradas:
+            for entrada in entradas:
+                if entrada.name.startswith("argos_csv_") and entrada.stat().st_mtime < limite:
+                    remover_arquivo_temporario(entrada.path)
+                elif entrada.name.startswith("argos_fonte_") and entrada.stat().st_mtime < limite_fontes:
+                    shutil.rmtree(entrada.path, ignore_errors=True)
+    except OSError:
+        pass
+
+
+def enviar_job_exportacao(fonte, contrib_info: dict, nivel: str, grupo: str, total_linhas: int,
+                          destino: str, chave: str, chave_artefato: tuple = None, valores_estaticos: bool = None) -> str:
+    """
+    Coloca uma exportação Excel na fila e retorna o id do job.
+
+    Args:
+        fonte: dados da exportação (DataFrame ou função de lotes - ver iter_df_chunks)
+        destino: "download" (arquivo guardado para baixar) ou "rede" (salvo em REDE_PATH)
+        chave: identifica a exportação (empresa e nível); um job ativo com a mesma chave e
+               destino é reaproveitado em vez de gerar o arquivo de novo
+        chave_artefato: chave do Excel no cache de exportações (chave_artefato_exportacao);
+               None = não usa o cache
+        valores_estaticos: valores no lugar das fórmulas (ver export_to_excel_template)
+
+    O job roda em get_executor_exportacao(), fora da execução do script; as partes de um ZIP
+    são geradas em processos filhos (gerar_partes_excel). Download de um Excel que já está
+    no cache não entra na fila: o job já nasce concluído.
+
+    A fonte fica em _FONTES_JOBS só enquanto o job aguarda na fila: ao gerar, o job a grava
+    em disco (_fonte_em_disco) e a solta.
+    """
+    _limpar_jobs_antigos()
+    artefato = ler_artefato_exportacao(chave_artefato) if destino == "download" else None
+
+    with _EXPORT_JOBS_LOCK:
+        for job_id, job in _EXPORT_JOBS.items():
+            if job['chave'] != chave or job['destino'] != destino or job['chave_artefato'] != chave_artefato:
+                continue
+            if job['status'] in EXPORT_JOB_ATIVOS:
+                return job_id
+            if (artefato and job['status'] == "concluido" and job['arquivo'] == artefato[0]
+                    and job['chave_artefato'] == chave_artefato):
+                return job_id
+
+        agora = time.time()
+        job_id = hashlib.md5(f"{chave}|{destino}|{agora}".encode()).hexdigest()[:12]
+        _EXPORT_JOBS[job_id] = {
+            'id': job_id,
+            'chave': chave,
+            'chave_artefato': chave_artefato,
+            'destino': destino,
+            'descricao': get_export_filename(contrib_info, nivel, 'xlsx') +
+                         (f" ({total_linhas:,} linhas)" if total_linhas is not None else "") +
+                         (" - valores calculados" if valores_estaticos else ""),
+            'status': "na fila",
+            'progresso': 0.0,
+            'mensagem': "Aguardando na fila...",
+            'criado': time.time(),
+            'inicio': None,
+            'fim': None,
+            'arquivo': None,       # download: arquivo gerado (xlsx ou zip)
+            'arquivo_cache': False,  # True: `arquivo` está no cache de exportações (não é removido com o job)
+            'temporario': None,    # arquivo em geração (removido se o job falhar ou for cancelado)
+            'nome_arquivo': None,
+            'is_zip': False,
+            'arquivos_rede': [],   # rede: caminhos salvos
+            'lotes': None,         # diretório com os lotes da fonte em Parquet, enquanto o job gera
+            'erro': None,
+            'cancelar': threading.Event(),
+        }
+        if artefato:
+            caminho, is_zip = artefato
+            _EXPORT_JOBS[job_id].update(
+                status="concluido", progresso=1.0, mensagem="Do cache de exportações", inicio=agora, fim=agora,
+                arquivo=caminho, arquivo_cache=True, is_zip=is_zip,
+                nome_arquivo=get_export_filename(contrib_info, nivel, "zip" if is_zip else "xlsx")
+            )
+            return job_id
+        _FONTES_JOBS[job_id] = fonte
+
+    get_executor_exportacao().submit(
+        _executar_job_exportacao, job_id, contrib_info, nivel, grupo, total_linhas, destino, chave_artefato,
+        valores_estaticos
+    )
+    return job_id
+
+
+def cancelar_job_exportacao(job_id: str):
+    """Pede o cancelamento do job: na fila, não chega a começar; gerando, para no próximo progresso."""
+    with _EXPORT_JOBS_LOCK:
+        job = _EXPORT_JOBS.get(job_id)
+        if job and job['status'] in EXPORT_JOB_ATIVOS:
+            job['cancelar'].set()
+            job['mensagem'] = "Cancelando..."
+
+
+def get_jobs_exportacao(chave: str = None) -> list:
+    """Cópia do estado dos jobs (todos, ou os de uma chave), do mais recente para o mais antigo."""
+    with _EXPORT_JOBS_LOCK:
+        jobs = [{k: v for k, v in job.items() if k != 'cancelar'}
+                for job in _EXPORT_JOBS.values() if chave is None or job['chave'] == chave]
+    return jobs[::-1]
+
+
+def _gerar_artefato_job(job_id: str, fonte, contrib_info: dict, nivel: str, grupo: str, total_linhas: int,
+                       progresso, chave_artefato: tuple = None, valores_estaticos: bool = None) -> tuple:
+    """
+    Gera o Excel do job - xlsx único ou ZIP com as partes - e retorna (caminho, no_cache, is_zip).
+
+    Com o cache de exportações ativo, o arquivo é gravado direto no cache (chave_artefato);
+    senão, em EXPORT_JOBS_CONFIG['diretorio'], até o job expirar. A geração escreve num
+    temporário e renomeia no final, para que ninguém leia um arquivo pela metade.
+    """
+    is_zip = total_linhas > MAX_ROWS_PER_EXCEL
+    no_cache = chave_artefato is not None and cache_exportacao_ativo()
+    if no_cache:
+        caminho = _caminho_artefato(chave_artefato, is_zip)
+    else:
+        caminho = os.path.join(EXPORT_JOBS_CONFIG['diretorio'], f"{job_id}.{'zip' if is_zip else 'xlsx'}")
+    criar_diretorio_privado(os.path.dirname(caminho))
+    temporario = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+    _atualizar_job(job_id, temporario=temporario)
+
+    if is_zip:
+        with open(temporario, 'w+b') as arquivo:
+            montar_zip_partes(fonte, contrib_info, nivel, total_linhas, progresso, grupo, arquivo=arquivo,
+                              valores_estaticos=valores_estaticos)
+    else:
+        for _, _, caminho_parte in gerar_partes_excel(fonte, contrib_info, nivel, total_linhas, progresso, grupo,
+                                                      valores_estaticos):
+            shutil.move(caminho_parte, temporario)
+        if not os.path.exists(temporario):
+            raise ValueError("Nenhum dado para exportar")
+    os.replace(temporario, caminho)
+    _atualizar_job(job_id, temporario=None)
+
+    if no_cache:
+        limpar_cache_exportacao()
+    return caminho, no_cache, is_zip
+
+
+def _enviar_artefato_rede(job_id: str, caminho: str, is_zip: bool, contrib_info: dict, nivel: str, progresso) -> list:
+    """Salva o Excel do job em REDE_PATH; do ZIP, cada parte vira um arquivo (mesmos nomes dos membros)."""
+    if not SMB_AVAILABLE:
+        raise RuntimeError("Biblioteca smbclient não disponível. Instale com: pip install smbprotocol")
+
+    file_paths = []
+    filepath = "N/A"
+    try:
+        if not is_zip:
+            filepath = f"{REDE_PATH}\\{get_export_filename(contrib_info, nivel, 'xlsx')}"
+            progresso(0, 1, "Salvando na rede...")
+            with open(caminho, 'rb') as origem:
+                smb_write_with_retry(filepath, origem)
+            file_paths.append(filepath)
+        else:
+            with zipfile.ZipFile(caminho) as zip_file:
+                nomes = zip_file.namelist()
+                for i, nome in enumerate(nomes):
+                    filepath = f"{REDE_PATH}\\{nome}"
+                    progresso(i, len(nomes), f"Salvando na rede: parte {i + 1} de {len(nomes)}...")
+                    # Membros gravados sem compressão (ZIP_STORED): cópia direta do ZIP para a rede
+                    with zip_file.open(nome) as origem:
+                        smb_write_with_retry(filepath, origem)
+                    file_paths.append(filepath)
+                    _atualizar_job(job_id, arquivos_rede=list(file_paths))
+    except ExportacaoCancelada:
+        raise
+    except Exception as e:
+        raise RuntimeError(mensagem_erro_rede(str(e), filepath)) from e
+    return file_paths
+
+
+def _fonte_em_disco(job_id: str, fonte, total_linhas: int, progresso) -> tuple:
+    """
+    Grava a fonte do job em Parquet, lote a lote, num diretório em EXPORT_JOBS_CONFIG['diretorio']
+    (gravar_lotes_parquet), e retorna (fonte lida do disco, linhas gravadas). A fonte é lida
+    uma vez só - DataFrame em ordem de data de emissão, como os writers fariam com ele - e o
+    job passa a segurar apenas o caminho. `progresso` é chamado a cada lote (cancelamento).
+
+    Sem pyarrow, a fonte continua em memória até o artefato existir.
+    """
+    if not PYARROW_AVAILABLE:
+        if total_linhas is None:
+            total_linhas = sum(len(c) for c in iter_df_chunks(fonte))
+        return fonte, total_linhas
+
+    def lotes():
+        linhas = 0
+        for chunk in iter_df_chunks(fonte, ordenar_por='data_emissao'):
+            linhas += len(chunk)
+            progresso(0, 1, f"Lendo os dados: {linhas:,} linhas...")
+            yield chunk
+
+    criar_diretorio_privado(EXPORT_JOBS_CONFIG['diretorio'])
+    diretorio, linhas = gravar_lotes_parquet(lotes(), prefixo=f"argos_fonte_{job_id}_",
+                                             diretorio_base=EXPORT_JOBS_CONFIG['diretorio'])
+    _atualizar_job(job_id, lotes=diretorio)
+    return functools.partial(ler_lotes_parquet, diretorio), linhas
+
+
+def _descartar_fonte_job(job_id: str):
+    """Remove os lotes da fonte do job gravados em disco (artefato pronto, erro ou cancelamento)."""
+    with _EXPORT_JOBS_LOCK:
+        _FONTES_JOBS.pop(job_id, None)
+        diretorio = _EXPORT_JOBS[job_id].get('lotes')
+        _EXPORT_JOBS[job_id]['lotes'] = None
+    if diretorio:
+        shutil.rmtree(diretorio, ignore_errors=True)
+
+
+def _executar_job_exportacao(job_id: str, contrib_info: dict, nivel: str, grupo: str, total_linhas: int,
+                             destino: str, chave_artefato: tuple = None, valores_estaticos: bool = None):
+    """
+    Corpo do job (thread de get_executor_exportacao): obtém o Excel - do cache de exportações
+    ou gerando - e o entrega no destino.
+
+    Single-flight: jobs com a mesma chave_artefato (outra sessão, ou download e rede da mesma
+    exportação) geram o arquivo uma vez só; os demais esperam e o leem do cache.
+
+    A fonte sai de _FONTES_JOBS ao começar; ao gerar, é gravada em disco (_fonte_em_disco).
+    Com o artefato pronto, a fonte e os lotes em disco são descartados antes da entrega.
+    """
+    with _EXPORT_JOBS_LOCK:
+        cancelar = _EXPORT_JOBS[job_id]['cancelar']
+        fonte = _FONTES_JOBS.pop(job_id, None)
+    if cancelar.is_set():
+        _atualizar_job(job_id, status="cancelado", mensagem="Cancelado antes de começar", fim=time.time())
+        return
+
+    _atualizar_job(job_id, status="gerando", inicio=time.time(), mensagem="Preparando dados...")
+
+    trava = None  # trava do artefato, enquanto este job o gera
+
+    def progresso(concluidas, total, msg):
+        if cancelar.is_set():
+            raise ExportacaoCancelada()
+        _atualizar_job(job_id, progresso=min(1.0, concluidas / max(total, 1)), mensagem=msg)
+
+    try:
+        if chave_artefato is not None and cache_exportacao_ativo():
+            trava = _esperar_trava_artefato(chave_artefato, progresso)
+        try:
+            artefato = ler_artefato_exportacao(chave_artefato)
+            if artefato:
+                caminho, is_zip = artefato
+                no_cache = True
+            else:
+                # O total gravado é o dos dados lidos agora (a contagem ao preparar pode ter ficado velha)
+                fonte, total_linhas = _fonte_em_disco(job_id, fonte, total_linhas, progresso)
+                if not total_linhas:
+                    raise ValueError("Nenhum dado para exportar")
+                caminho, no_cache, is_zip = _gerar_artefato_job(
+                    job_id, fonte, contrib_info, nivel, grupo, total_linhas, progresso, chave_artefato, valores_estaticos
+                )
+        finally:
+            if trava:
+                _liberar_trava_artefato(trava)
+                trava = None
+        fonte = None
+        _descartar_fonte_job(job_id)
+
+        if destino == "rede":
+            try:
+                arquivos = _enviar_artefato_rede(job_id, caminho, is_zip, contrib_info, nivel, progresso)
+            finally:
+                if not no_cache:
+                    remover_arquivo_temporario(caminho)
+            _atualizar_job(job_id, arquivos_rede=arquivos)
+        else:
+            _atualizar_job(job_id, arquivo=caminho, arquivo_cache=no_cache, is_zip=is_zip,
+                           nome_arquivo=get_export_filename(contrib_info, nivel, "zip" if is_zip else "xlsx"))
+        _atualizar_job(job_id, status="concluido", progresso=1.0,
+                       mensagem="Concluído" if not artefato else "Concluído (do cache de exportações)", fim=time.time())
+    except ExportacaoCancelada:
+        _descartar_temporario_job(job_id)
+        _atualizar_job(job_id, status="cancelado", mensagem="Cancelado pelo usuário", fim=time.time())
+    except Exception as e:
+        _descartar_temporario_job(job_id)
+        _atualizar_job(job_id, status="erro", erro=str(e)[:500], mensagem="Erro", fim=time.time())
+    finally:
+        _descartar_fonte_job(job_id)
+
+
+def _descartar_temporario_job(job_id: str):
+    """Remove o arquivo que o job estava gerando (job cancelado ou com erro)."""
+    with _EXPORT_JOBS_LOCK:
+        temporario = _EXPORT_JOBS[job_id].get('temporario')
+        _EXPORT_JOBS[job_id]['temporario'] = None
+    if temporario:
+        remover_arquivo_temporario(temporario)
+
+
+# =============================================================================
+# CACHE DE EXPORTAÇÕES (EXCEL EM DISCO)
+# =============================================================================
+
+# Trava de geração de um artefato (single-flight entre jobs de todos os processos): flock
+# num arquivo .lock ao lado do artefato. O sistema libera o flock quando o processo dono
+# morre, então não há trava presa; o arquivo é removido ao liberar. Arquivos .lock sem uso
+# há mais que isto (de um processo que morreu) são removidos pela limpeza do cache, se
+# ninguém os estiver segurando.
+TRAVA_ARTEFATO_OBSOLETA_SECONDS = 600
+
+# Espera máxima pela trava de outro job com a mesma chave; depois disso o job gera o seu
+# artefato sem a trava (no pior caso, o arquivo é gerado duas vezes; a gravação é atômica)
+TRAVA_ARTEFATO_ESPERA_MAX_SECONDS = 1800
+
+# Sem fcntl: caminhos das travas seguradas pelos jobs deste processo
+_TRAVAS_SEM_FCNTL = set()
+_TRAVAS_SEM_FCNTL_LOCK = threading.Lock()
+
+
+def cache_exportacao_ativo() -> bool:
+    return bool(EXPORT_CACHE_CONFIG['ativo'])
+
+
+def chave_artefato_exportacao(grupo: str, modelo_export: str, nivel: str, ident_digits: str, versao_dados: str,
+                              valores_estaticos: bool = False) -> tuple:
+    """
+    Chave do Excel de uma exportação no cache: grupo, modelo, nível, empresa, versão dos
+    dados (versao_cache_grupo - muda quando as tabelas _3M são recarregadas) e versão do
+    layout (EXCEL_LAYOUT_VERSAO, com fórmulas ou valores estáticos). Chaves iguais geram
+    arquivos iguais.
+    """
+    layout = (EXCEL_LAYOUT_VERSAO, "valores" if valores_estaticos else "formulas")
+    return (grupo, modelo_export, nivel, ident_digits, versao_dados, layout)
+
+
+def _caminho_artefato(chave: tuple, is_zip: bool) -> str:
+    nome = hashlib.sha1(repr(chave).encode('utf-8')).hexdigest()
+    return os.path.join(EXPORT_CACHE_CONFIG['diretorio'], f"{nome}.{'zip' if is_zip else 'xlsx'}")
+
+
+def _travar_artefato(chave: tuple):
+    """
+    Tenta pegar a trava de geração do artefato, sem esperar (ver TRAVA_ARTEFATO_OBSOLETA_SECONDS).
+
+    Returns:
+        trava (caminho, descritor) para _liberar_trava_artefato, ou None se outro job -
+        deste ou de outro processo - já está gerando o artefato
+    """
+    criar_diretorio_privado(EXPORT_CACHE_CONFIG['diretorio'])
+    caminho = os.path.splitext(_caminho_artefato(chave, False))[0] + ".lock"
+    if not FCNTL_AVAILABLE:
+        with _TRAVAS_SEM_FCNTL_LOCK:
+            if caminho in _TRAVAS_SEM_FCNTL:
+                return None
+            _TRAVAS_SEM_FCNTL.add(caminho)
+        return caminho, None
+
+    for _ in range(3):
+        fd = os.open(caminho, os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        # O dono anterior (ou a limpeza do cache) pode ter removido o arquivo entre o open e
+        # o flock: a trava só vale se o caminho ainda é o arquivo travado
+        try:
+            if os.stat(caminho).st_ino == os.fstat(fd).st_ino:
+                return caminho, fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+    return None
+
+
+def _esperar_trava_artefato(chave: tuple, progresso):
+    """
+    Pega a trava do artefato, esperando o job que o está gerando por até
+    TRAVA_ARTEFATO_ESPERA_MAX_SECONDS. `progresso` é chamado a cada tentativa e lança
+    ExportacaoCancelada se o job for cancelado durante a espera.
+
+    Returns:
+        trava, ou None se o prazo acabou (o job gera o artefato sem a trava)
+    """
+    limite = time.monotonic() + TRAVA_ARTEFATO_ESPERA_MAX_SECONDS
+    while True:
+        trava = _travar_artefato(chave)
+        if trava or time.monotonic() >= limite:
+            return trava
+        progresso(0, 1, "Aguardando a mesma exportação, em geração por outro job...")
+        time.sleep(0.5)
+
+
+def _liberar_trava_artefato(trava: tuple):
+    """Remove o arquivo da trava e solta o flock (nessa ordem: quem esperava confere o arquivo)."""
+    caminho, fd = trava
+    if fd is None:
+        with _TRAVAS_SEM_FCNTL_LOCK:
+            _TRAVAS_SEM_FCNTL.discard(caminho)
+        return
+    remover_arquivo_temporario(caminho)
+    os.close(fd)
+
+
+def _remover_travas_obsoletas(diretorio: str) -> int:
+    """
+    Remove os arquivos .lock sem uso há mais de TRAVA_ARTEFATO_OBSOLETA_SECONDS, deixados por
+    processos que morreram. Uma trava segurada nunca é removida: o arquivo só sai com o
+    flock na mão.
+
+    Returns:
+        int: quantidade de travas removidas
+    """
+    if not FCNTL_AVAILABLE:
+        return 0
+    agora = time.time()
+    removidas = 0
+    for caminho, _, mtime in arquivos_cache_disco(diretorio):
+        if not caminho.endswith('.lock') or agora - mtime <= TRAVA_ARTEFATO_OBSOLETA_SECONDS:
+            continue
+        try:
+            fd = os.open(caminho, os.O_RDWR)
+        except OSError:
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.remove(caminho)
+            removidas += 1
+        except OSError:
+            pass  # segurada por um job, ou já removida
+        finally:
+            os.close(fd)
+    return removidas
+
+
+def ler_artefato_exportacao(chave: tuple):
+    """
+    Procura o Excel (ou o ZIP das partes) da exportação no cache.
+    O acesso atualiza a data de modificação do arquivo (ordem do LRU).
+
+    Returns:
+        (caminho, is_zip) ou None se não estiver no cache
+    """
+    if chave is None or not cache_exportacao_ativo():
+        return None
+    for is_zip in (False, True):
+        caminho = _caminho_artefato(chave, is_zip)
+        try:
+            os.utime(caminho)
+        except OSError:
+            continue
+        return caminho, is_zip
+    return None
+
+
+def limpar_cache_exportacao(max_mb: float = None) -> int:
+    """
+    Remove os Excel menos usados até o cache caber em `max_mb` (padrão: EXPORT_CACHE_CONFIG).
+
+    Returns:
+        int: quantidade de arquivos removidos
+    """
+    limite = float(EXPORT_CACHE_CONFIG['max_mb'] if max_mb is None else max_mb) * 1024 * 1024
+    removidas = _remover_travas_obsoletas(EXPORT_CACHE_CONFIG['diretorio'])
+    return removidas + remover_menos_usados(EXPORT_CACHE_CONFIG['diretorio'], limite)
+
+
+def get_status_cache_exportacao() -> dict:
+    """Quantidade e tamanho dos arquivos no cache de exportações."""
+    arquivos = [a for a in arquivos_cache_disco(EXPORT_CACHE_CONFIG['diretorio'])
+                if not a[0].endswith(('.tmp', '.lock'))]
+    return {'arquivos': len(arquivos), 'mb': sum(tamanho for _, tamanho, _ in arquivos) / (1024 * 1024)}
+
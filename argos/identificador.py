@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Identificador do contribuinte (CNPJ/IE): normalização, formas gravadas nas tabelas e filtro SQL."""
+import re
+
+# Modo de busca do CNPJ/IE nas tabelas de infrações:
+#   "variantes" - compara a coluna com as formas conhecidas do identificador (só dígitos,
+#                 com máscara, sem zeros à esquerda). Permite ao Impala usar estatísticas min/max.
+#   "regexp"    - modo antigo: regexp_replace em todas as linhas (full scan das tabelas)
+IDENT_LOOKUP_MODE = "variantes"
+
+# Repete com "regexp" (full scan) uma busca que não encontrou nada pelas variantes, para
+# identificadores gravados em formato não previsto. Desligado: um CNPJ sem infrações (o
+# caso comum de busca vazia) custaria uma varredura completa das tabelas a cada consulta.
+# Para formatos fora das variantes, prefira uma coluna normalizada (COLUNAS_IDENT_NORMALIZADAS).
+IDENT_REPETIR_COM_REGEXP = False
+
+# Sufixo da coluna só com dígitos criada na réplica local (ex.: cnpj_emitente_norm)
+SUFIXO_COLUNA_NORMALIZADA = "_norm"
+
+# Colunas já normalizadas (apenas dígitos) disponíveis nas tabelas, se existirem.
+# Ex.: {"cnpj_emitente": "cnpj_emitente_num"} - quando configurado, tem prioridade sobre o modo acima.
+COLUNAS_IDENT_NORMALIZADAS = {}
+
+
+def sanitize_identificador(raw: str) -> str:
+    """Remove qualquer coisa que não seja dígito (CNPJ/IE)."""
+    return re.sub(r"\D+", "", raw or "")
+
+def variantes_identificador(identificador_digits: str) -> list:
+    """
+    Retorna as formas conhecidas em que um CNPJ/IE pode estar gravado nas tabelas.
+    Ex.: '12345678000190' -> ['12345678000190', '12.345.678/0001-90']
+    """
+    digits = sanitize_identificador(identificador_digits)
+    if not digits:
+        return []
+
+    variantes = [digits]
+    if len(digits) == 14:
+        # CNPJ com máscara
+        variantes.append(f"{digits[:2]}.{digits[2:5]}.{digits[5:8]}/{digits[8:12]}-{digits[12:]}")
+    elif len(digits) == 9:
+        # IE de SC com máscara
+        variantes.append(f"{digits[:3]}.{digits[3:6]}.{digits[6:]}")
+
+    # Identificador gravado como número (perde zeros à esquerda)
+    sem_zeros = digits.lstrip('0')
+    if sem_zeros and sem_zeros != digits:
+        variantes.append(sem_zeros)
+
+    return variantes
+
+def filtro_identificador(coluna: str, identificador_digits: str, modo: str = None) -> str:
+    """
+    Monta a condição SQL de busca do CNPJ/IE na coluna informada.
+
+    No modo "variantes" a coluna é comparada diretamente (IN) com as formas conhecidas
+    do identificador, sem aplicar função sobre a coluna - o Impala pode usar estatísticas
+    e pruning. No modo "regexp" mantém o comportamento antigo (regexp_replace por linha).
+    No modo "replica" usa a coluna só com dígitos da réplica local (<coluna>_norm), pela
+    qual os arquivos são ordenados.
+    """
+    digits = sanitize_identificador(identificador_digits)
+    modo = modo or IDENT_LOOKUP_MODE
+
+    if modo == "replica":
+        return f"{coluna}{SUFIXO_COLUNA_NORMALIZADA} = '{digits}'"
+
+    coluna_normalizada = COLUNAS_IDENT_NORMALIZADAS.get(coluna)
+    if coluna_normalizada and modo != "regexp":
+        return f"{coluna_normalizada} = '{digits}'"
+
+    if modo == "regexp":
+        return f"regexp_replace({coluna}, '[^0-9]', '') = '{digits}'"
+
+    variantes = variantes_identificador(digits)
+    if not variantes:
+        return "1 = 0"
+    variantes_str = ", ".join(f"'{v}'" for v in variantes)
+    return f"{coluna} IN ({variantes_str})"
+
+def modos_busca_identificador(coluna: str = 'cnpj_emitente') -> list:
+    """
+    Modos de filtro_identificador em ordem de tentativa.
+
+    Por padrão, só IDENT_LOOKUP_MODE. Com IDENT_REPETIR_COM_REGEXP, uma busca pelas
+    variantes sem nenhuma linha é repetida com regexp_replace (full scan). Coluna
+    normalizada (COLUNAS_IDENT_NORMALIZADAS) e modo "regexp" já comparam só os dígitos e
+    nunca têm a segunda tentativa.
+    """
+    if not IDENT_REPETIR_COM_REGEXP or IDENT_LOOKUP_MODE == "regexp" or COLUNAS_IDENT_NORMALIZADAS.get(coluna):
+        return [IDENT_LOOKUP_MODE]
+    return [IDENT_LOOKUP_MODE, "regexp"]
+
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Processamento em lotes (streaming): fonte de dados em lotes, colunas numéricas, CSV e lotes em disco."""
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+
+# Tamanho dos lotes (linhas) no processamento em streaming: carga do Impala,
+# montagem da exportação, CSV, Excel e agregações da aba Análise.
+# A memória extra de cada etapa fica limitada a um lote, independente do total de linhas.
+STREAM_CHUNK_SIZE = 50000
+
+
+def coluna_numerica(serie: pd.Series) -> pd.Series:
+    """
+    Valores numéricos de uma coluna, com nulos/inválidos como 0.
+    Colunas já tipadas pelo SCHEMA_CONSULTA não são convertidas de novo.
+    """
+    if not pd.api.types.is_numeric_dtype(serie):
+        serie = pd.to_numeric(serie, errors='coerce')
+    return serie.fillna(0)
+
+
+def iter_df_chunks(dados, chunksize: int = None, ordenar_por: str = None):
+    """
+    Normaliza uma fonte de dados em uma sequência de lotes (DataFrames).
+
+    Aceita:
+        - DataFrame: fatiado em lotes de `chunksize` linhas (fatias, sem cópia completa).
+          Com `ordenar_por`, os lotes saem na ordem da coluna (nulos no final) usando
+          apenas um vetor de posições, sem ordenar/copiar o DataFrame inteiro.
+        - função sem argumentos que retorna um iterável de lotes (pode ser relida, ex.: em retry)
+        - iterável/gerador de lotes (consumido uma única vez; `ordenar_por` é ignorado)
+    """
+    chunksize = chunksize or STREAM_CHUNK_SIZE
+
+    if dados is None:
+        return
+    if isinstance(dados, pd.DataFrame):
+        if ordenar_por and ordenar_por in dados.columns:
+            ordem = dados[ordenar_por].reset_index(drop=True).sort_values(
+                kind='stable', na_position='last'
+            ).index.to_numpy()
+            for inicio in range(0, len(dados), chunksize):
+                yield dados.take(ordem[inicio:inicio + chunksize])
+            return
+        for inicio in range(0, len(dados), chunksize):
+            yield dados.iloc[inicio:inicio + chunksize]
+        return
+    if callable(dados):
+        dados = dados()
+    for chunk in dados:
+        if chunk is not None and not chunk.empty:
+            yield chunk
+
+
+def escrever_csv_lotes(dados, destino) -> int:
+    """
+    Escreve os dados em CSV no formato brasileiro, lote a lote, no arquivo binário `destino`.
+    O cabeçalho é escrito só no primeiro lote; cada lote é convertido e codificado isoladamente.
+
+    Args:
+        dados: DataFrame, função ou iterável de lotes (ver iter_df_chunks)
+        destino: objeto com write(bytes) - BytesIO, arquivo local ou arquivo SMB
+
+    Returns:
+        int: número de linhas escritas
+    """
+    total = 0
+    for chunk in iter_df_chunks(dados):
+        csv_str = chunk.to_csv(index=False, header=(total == 0), sep=";", decimal=",")
+        destino.write(csv_str.encode("latin-1", errors="replace"))
+        total += len(chunk)
+
+    # DataFrame vazio: mantém o comportamento anterior (arquivo só com cabeçalho)
+    if total == 0 and isinstance(dados, pd.DataFrame):
+        destino.write(dados.to_csv(index=False, sep=";", decimal=",").encode("latin-1", errors="replace"))
+
+    return total
+
+
+
+def gravar_lotes_parquet(dados, prefixo: str = "argos_lotes_", diretorio_base: str = None,
+                         ordenar_por: str = None) -> tuple:
+    """
+    Grava os lotes de `dados` (ver iter_df_chunks, inclusive `ordenar_por`) num diretório
+    temporário novo, um Parquet por lote, na ordem, para relê-los com ler_lotes_parquet sem
+    manter os dados em memória. Exige pyarrow.
+
+    O diretório (mkdtemp: acesso só do usuário) fica com quem chama, que o remove com
+    shutil.rmtree; se a gravação falhar, é removido aqui.
+
+    Returns:
+        tuple: (diretório, linhas gravadas)
+    """
+    diretorio = tempfile.mkdtemp(prefix=prefixo, dir=diretorio_base)
+    linhas = 0
+    try:
+        for i, chunk in enumerate(iter_df_chunks(dados, ordenar_por=ordenar_por)):
+            chunk.to_parquet(os.path.join(diretorio, f"{i:06d}.parquet"), index=False)
+            linhas += len(chunk)
+    except BaseException:
+        shutil.rmtree(diretorio, ignore_errors=True)
+        raise
+    return diretorio, linhas
+
+
+def ler_lotes_parquet(diretorio: str):
+    """Lotes gravados por gravar_lotes_parquet, na ordem em que foram gravados."""
+    for nome in sorted(os.listdir(diretorio)):
+        yield pd.read_parquet(os.path.join(diretorio, nome))
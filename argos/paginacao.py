@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""Paginação do ranking por cursor (valor da última empresa exibida, e não a posição)."""
+import numpy as np
+import pandas as pd
+
+
+def inicio_apos_cursor(ordem: pd.DataFrame, cursor: tuple) -> int:
+    """
+    Posição da primeira empresa depois do cursor (TOTAL, CNPJ, razão da última empresa
+    exibida). `ordem` vem ordenada por TOTAL decrescente e, nos empates, por _cnpj e
+    _razao crescentes. Busca binária no TOTAL e desempate só entre os empates.
+    Como o cursor é o valor e não a posição, continua válido quando a versão das tabelas muda.
+    """
+    if not cursor:
+        return 0
+    total, cnpj, razao = cursor
+    negativos = -ordem['TOTAL'].to_numpy()
+    inicio = int(np.searchsorted(negativos, -total, side='left'))
+    fim = int(np.searchsorted(negativos, -total, side='right'))
+    if inicio == fim:
+        return inicio
+    empates = ordem.iloc[inicio:fim]
+    antes = (empates['_cnpj'] < cnpj) | ((empates['_cnpj'] == cnpj) & (empates['_razao'] <= razao))
+    return inicio + int(antes.sum())
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+"""Gravação das exportações na pasta de rede (SMB/DFS) e diagnóstico da conexão."""
+import math
+import shutil
+
+import pandas as pd
+
+from argos.excel import (MAX_ROWS_PER_EXCEL, export_to_excel_template, gerar_partes_excel,
+                         get_export_filename, get_export_filename_parte)
+from argos.lotes import escrever_csv_lotes
+
+# Para salvar na rede
+try:
+    import smbclient
+    SMB_AVAILABLE = True
+except ImportError:
+    SMB_AVAILABLE = False
+
+# Caminho da rede para salvar arquivos (evita consumo de memória)
+REDE_PATH = r"\\sef.sc.gov.br\DFS\Fiscalizacao\NIAT\ARGOS\ARGOS_EXPORT"
+
+
+def get_folder_link(path: str) -> str:
+    """
+    Gera um link para copiar o caminho da pasta.
+    """
+    return path
+
+
+def smb_write_with_retry(filepath: str, data, max_retries: int = 2) -> None:
+    """
+    Salva arquivo via SMB com retry automático.
+    Se detectar erro de DFS/conexão, reseta o cache e tenta novamente.
+
+    Args:
+        filepath: Caminho completo do arquivo na rede
+        data: Dados binários para salvar, arquivo binário aberto (copiado em blocos desde o
+              início a cada tentativa), ou função escrever(f) que grava direto no arquivo
+              aberto (streaming). A função é chamada de novo a cada tentativa.
+        max_retries: Número máximo de tentativas (padrão: 2)
+
+    Raises:
+        Exception: Se todas as tentativas falharem
+    """
+    last_error = None
+
+    for attempt in range(max_retries):
+        try:
+            with smbclient.open_file(filepath, mode="wb") as f:
+                if callable(data):
+                    data(f)
+                elif hasattr(data, 'read'):
+                    data.seek(0)
+                    shutil.copyfileobj(data, f, 1024 * 1024)
+                else:
+                    f.write(data)
+            return  # Sucesso!
+        except Exception as e:
+            last_error = e
+            error_msg = str(e)
+
+            # Se for erro de DFS/conexão e ainda temos tentativas, reseta e tenta novamente
+            is_dfs_error = "0xc000035c" in error_msg or "STATUS_UNKNOWN" in error_msg
+            is_connection_error = "connection" in error_msg.lower() or "reset" in error_msg.lower()
+
+            if (is_dfs_error or is_connection_error) and attempt < max_retries - 1:
+                try:
+                    # Reseta cache de conexões SMB
+                    smbclient.reset_connection_cache()
+                    import time
+                    time.sleep(1)  # Pequena pausa antes de tentar novamente
+                except:
+                    pass
+                continue
+            else:
+                # Erro não recuperável ou última tentativa
+                raise
+
+    # Se chegou aqui, todas as tentativas falharam
+    if last_error:
+        raise last_error
+
+def mensagem_erro_rede(error_msg: str, filepath_info: str = "N/A") -> str:
+    """Mensagem para o usuário de um erro ao gravar o Excel na rede (Kerberos, DFS ou genérico)."""
+    # Detecta erro de autenticação Kerberos expirada
+    if "Ticket expired" in error_msg or "SpnegoError" in error_msg or "authenticate" in error_msg.lower():
+        return "🔐 **Sessão de rede expirada!** Faça logout/login no Windows ou acesse qualquer pasta de rede no Explorer para renovar."
+
+    # Detecta erros de DFS/rede específicos
+    if "0xc000035c" in error_msg or "STATUS_UNKNOWN" in error_msg:
+        return f"❌ **Erro de rede DFS!** Possíveis causas:\n\n1. 🔐 Sessão expirada - tente acessar `{REDE_PATH}` no Explorer primeiro\n2. 📁 Pasta de destino indisponível\n3. 🔄 Reinicie o Streamlit\n\n**Detalhes:** {error_msg[:200]}"
+
+    # Erro genérico com mais informações
+    return f"Erro ao salvar: {error_msg}\n\n**Caminho:** {filepath_info}"
+
+def save_csv_to_network(df, contrib_info: dict, nivel: str) -> tuple:
+    """
+    Salva CSV diretamente na rede usando smbclient.
+    Formato brasileiro: separador (;), decimal (,), encoding latin-1
+
+    O CSV é gravado lote a lote direto no arquivo de rede (sem gerar o arquivo inteiro em memória).
+    `df` pode ser DataFrame ou função que retorna lotes (ver iter_df_chunks) - ambos
+    podem ser relidos se a gravação precisar ser repetida.
+
+    Returns:
+        tuple: (success, message, filepath, folder_path)
+    """
+    if not SMB_AVAILABLE:
+        return False, "Biblioteca smbclient não disponível. Instale com: pip install smbprotocol", None, REDE_PATH
+    
+    try:
+        filename = get_export_filename(contrib_info, nivel, "csv")
+        filepath = f"{REDE_PATH}\\{filename}"
+        
+        # Grava o CSV em lotes direto na rede, com retry automático (reseta cache SMB se erro DFS)
+        smb_write_with_retry(filepath, lambda f: escrever_csv_lotes(df, f))
+
+        return True, "CSV salvo com sucesso!", filepath, REDE_PATH
+
+    except Exception as e:
+        error_msg = str(e)
+        # Detecta erro de autenticação Kerberos expirada
+        if "Ticket expired" in error_msg or "SpnegoError" in error_msg or "authenticate" in error_msg.lower():
+            return False, "🔐 **Sessão de rede expirada!** Faça logout/login no Windows ou acesse qualquer pasta de rede no Explorer para renovar.", None, REDE_PATH
+
+        # Detecta erros de DFS/rede específicos
+        if "0xc000035c" in error_msg or "STATUS_UNKNOWN" in error_msg:
+            return False, f"❌ **Erro de rede DFS!** Possíveis causas:\n\n1. 🔐 Sessão expirada - tente acessar `{REDE_PATH}` no Explorer primeiro\n2. 📁 Pasta de destino indisponível\n3. 🔄 Reinicie o Streamlit\n\n**Caminho:** {filepath}\n**Detalhes:** {error_msg[:200]}", None, REDE_PATH
+
+        return False, f"Erro ao salvar CSV: {error_msg}\n\n**Caminho:** {filepath}", None, REDE_PATH
+
+
+def diagnostico_rede() -> dict:
+    """
+    Executa diagnóstico completo de conexão com a rede.
+    Retorna dict com resultados de cada teste.
+    """
+    from datetime import datetime
+    import traceback
+
+    resultados = {
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'smb_disponivel': SMB_AVAILABLE,
+        'rede_path': REDE_PATH,
+        'testes': []
+    }
+
+    if not SMB_AVAILABLE:
+        resultados['testes'].append({
+            'nome': 'Biblioteca SMB',
+            'status': 'ERRO',
+            'mensagem': 'smbclient não instalado. Execute: pip install smbprotocol',
+            'detalhes': None
+        })
+        return resultados
+
+    resultados['testes'].append({
+        'nome': 'Biblioteca SMB',
+        'status': 'OK',
+        'mensagem': 'smbprotocol disponível',
+        'detalhes': None
+    })
+
+    # Teste 1: Listar diretório
+    try:
+        arquivos = smbclient.listdir(REDE_PATH)
+        resultados['testes'].append({
+            'nome': 'Listar diretório',
+            'status': 'OK',
+            'mensagem': f'Diretório acessível ({len(arquivos)} itens)',
+            'detalhes': arquivos[:10] if len(arquivos) > 10 else arquivos
+        })
+    except Exception as e:
+        resultados['testes'].append({
+            'nome': 'Listar diretório',
+            'status': 'ERRO',
+            'mensagem': str(e)[:300],
+            'detalhes': traceback.format_exc()
+        })
+        # Se não conseguiu listar, não adianta continuar
+        return resultados
+
+    # Teste 2: Criar arquivo de teste
+    test_filename = f"_TESTE_CONEXAO_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+    test_filepath = f"{REDE_PATH}\\{test_filename}"
+    test_content = f"Teste de conexão realizado em {datetime.now()}\nUsuário: ARGOS\nSistema: GESSUPER"
+
+    try:
+        with smbclient.open_file(test_filepath, mode="w") as f:
+            f.write(test_content)
+        resultados['testes'].append({
+            'nome': 'Criar arquivo',
+            'status': 'OK',
+            'mensagem': f'Arquivo criado: {test_filename}',
+            'detalhes': test_filepath
+        })
+    except Exception as e:
+        resultados['testes'].append({
+            'nome': 'Criar arquivo',
+            'status': 'ERRO',
+            'mensagem': str(e)[:300],
+            'detalhes': traceback.format_exc()
+        })
+        return resultados
+
+    # Teste 3: Ler arquivo de teste
+    try:
+        with smbclient.open_file(test_filepath, mode="r") as f:
+            conteudo_lido = f.read()
+        if conteudo_lido == test_content:
+            resultados['testes'].append({
+                'nome': 'Ler arquivo',
+                'status': 'OK',
+                'mensagem': 'Conteúdo verificado corretamente',
+                'detalhes': None
+            })
+        else:
+            resultados['testes'].append({
+                'nome': 'Ler arquivo',
+                'status': 'AVISO',
+                'mensagem': 'Arquivo lido mas conteúdo difere',
+                'detalhes': conteudo_lido[:100]
+            })
+    except Exception as e:
+        resultados['testes'].append({
+            'nome': 'Ler arquivo',
+            'status': 'ERRO',
+            'mensagem': str(e)[:300],
+            'detalhes': traceback.format_exc()
+        })
+
+    # Teste 4: Deletar arquivo de teste
+    try:
+        smbclient.remove(test_filepath)
+        resultados['testes'].append({
+            'nome': 'Deletar arquivo',
+            'status': 'OK',
+            'mensagem': 'Arquivo de teste removido',
+            'detalhes': None
+        })
+    except Exception as e:
+        resultados['testes'].append({
+            'nome': 'Deletar arquivo',
+            'status': 'AVISO',
+            'mensagem': f'Não foi possível remover: {str(e)[:200]}',
+            'detalhes': f'Remova manualmente: {test_filepath}'
+        })
+
+    # Teste 5: Criar arquivo binário (simula Excel)
+    test_bin_filename = f"_TESTE_BINARIO_{datetime.now().strftime('%Y%m%d_%H%M%S')}.bin"
+    test_bin_filepath = f"{REDE_PATH}\\{test_bin_filename}"
+    test_bin_content = b"TESTE" * 1000  # 5KB de dados binários
+
+    try:
+        with smbclient.open_file(test_bin_filepath, mode="wb") as f:
+            f.write(test_bin_content)
+        resultados['testes'].append({
+            'nome': 'Criar arquivo binário',
+            'status': 'OK',
+            'mensagem': f'Arquivo binário criado: {test_bin_filename} (5KB)',
+            'detalhes': test_bin_filepath
+        })
+
+        # Tenta deletar
+        try:
+            smbclient.remove(test_bin_filepath)
+        except:
+            pass
+
+    except Exception as e:
+        resultados['testes'].append({
+            'nome': 'Criar arquivo binário',
+            'status': 'ERRO',
+            'mensagem': str(e)[:300],
+            'detalhes': traceback.format_exc()
+        })
+
+    return resultados
+
+
+def save_to_network(df: pd.DataFrame, contrib_info: dict, nivel: str, progress_callback=None, grupo: str = None) -> tuple:
+    """
+    Salva os arquivos Excel diretamente na rede, evitando consumo de memória.
+
+    Args:
+        df: DataFrame com os dados
+        contrib_info: Informações do contribuinte
+        nivel: Nível de acurácia
+        progress_callback: Função callback para progresso
+        grupo: Grupo de operação para determinar estrutura de colunas
+
+    Returns:
+        tuple: (success, message, file_paths)
+    """
+    if not SMB_AVAILABLE:
+        return False, "Biblioteca smbclient não disponível", []
+
+    total_rows = len(df)
+    file_paths = []
+
+    try:
+        # Cria diretório se não existir
+        try:
+            smbclient.makedirs(REDE_PATH, exist_ok=True)
+        except:
+            pass  # Diretório pode já existir
+
+        # Se cabe em um único arquivo
+        if total_rows <= MAX_ROWS_PER_EXCEL:
+            if progress_callback:
+                progress_callback(0, 1, "Gerando arquivo Excel...")
+
+            excel_data = export_to_excel_template(df, contrib_info, nivel, grupo=grupo)
+            filename = get_export_filename(contrib_info, nivel, "xlsx")
+            filepath = f"{REDE_PATH}\\{filename}"
+            
+            with smbclient.open_file(filepath, mode="wb") as f:
+                f.write(excel_data)
+            
+            file_paths.append(filepath)
+            
+            if progress_callback:
+                progress_callback(1, 1, "Arquivo salvo na rede!")
+            
+            return True, f"Arquivo salvo com sucesso!", file_paths
+        
+        # Precisa dividir em múltiplas partes (geradas em paralelo - ver gerar_partes_excel)
+        total_partes = math.ceil(total_rows / MAX_ROWS_PER_EXCEL)
+
+        for parte, total_partes, caminho in gerar_partes_excel(df, contrib_info, nivel, total_rows, progress_callback, grupo):
+            # Nome e caminho do arquivo
+            filepath = f"{REDE_PATH}\\{get_export_filename_parte(contrib_info, nivel, parte, total_partes)}"
+
+            # Salva na rede
+            with smbclient.open_file(filepath, mode="wb") as f, open(caminho, 'rb') as origem:
+                shutil.copyfileobj(origem, f, 1024 * 1024)
+
+            file_paths.append(filepath)
+
+        return True, f"{total_partes} arquivos salvos com sucesso!", file_paths
+    
+    except Exception as e:
+        error_msg = str(e)
+        # Detecta erro de autenticação Kerberos expirada
+        if "Ticket expired" in error_msg or "SpnegoError" in error_msg or "authenticate" in error_msg.lower():
+            return False, "🔐 **Sessão de rede expirada!** Faça logout/login no Windows ou acesse qualquer pasta de rede no Explorer para renovar.", file_paths
+        return False, f"Erro ao salvar: {error_msg}", file_paths
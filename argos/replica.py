@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+Réplica local das tabelas de infrações em Parquet, consultada com DuckDB.
+
+A versão atual de cada tabela no Impala vem de quem chama (função `versao_tabela`,
+tabela -> versão ou None), para que o módulo não dependa do cache do Streamlit.
+"""
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from argos.identificador import SUFIXO_COLUNA_NORMALIZADA
+from argos.lotes import STREAM_CHUNK_SIZE
+from argos.tempos import registrar_tempo_tabela
+
+# Gravação do Parquet - opcional
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+# Motor SQL embarcado - opcional
+try:
+    import duckdb
+    DUCKDB_AVAILABLE = True
+except ImportError:
+    DUCKDB_AVAILABLE = False
+
+# Réplica local das tabelas de infrações em Parquet, consultada com DuckDB (ver argos.replica).
+# Desligada por padrão; pode ser ativada em secrets.toml, seção [replica_local].
+REPLICA_LOCAL_CONFIG = {
+    'ativo': False,
+    'diretorio': os.path.join(tempfile.gettempdir(), "argos_replica"),
+    'sincronizar_automaticamente': True,  # sincroniza tabelas desatualizadas a cada ciclo do aquecimento
+    'max_idade_horas': 36,                # validade da réplica quando a versão da tabela não pode ser consultada
+    'linhas_por_row_group': 100000,       # menor = índice min/max mais fino por CNPJ
+}
+
+# Colunas que ganham uma cópia só com dígitos na réplica (<coluna>_norm); a primeira ordena o arquivo
+REPLICA_COLUNAS_NORMALIZADAS = ['cnpj_emitente']
+
+# Tabelas em sincronização neste processo (evita duas cargas da mesma tabela)
+_REPLICA_SINCRONIZANDO = set()
+_REPLICA_LOCK = threading.Lock()
+
+
+def replica_local_ativa() -> bool:
+    """A réplica precisa de DuckDB (consultas) e pyarrow (gravação) e é ligada na configuração."""
+    return bool(REPLICA_LOCAL_CONFIG['ativo']) and DUCKDB_AVAILABLE and PYARROW_AVAILABLE
+
+
+def _caminhos_replica(tabela: str) -> tuple:
+    """(arquivo Parquet, manifesto JSON) da réplica de uma tabela."""
+    base = os.path.join(REPLICA_LOCAL_CONFIG['diretorio'], re.sub(r'[^0-9A-Za-z_]+', '_', tabela))
+    return f"{base}.parquet", f"{base}.json"
+
+
+def ler_manifesto_replica(tabela: str):
+    """Manifesto da última sincronização da tabela, ou None se não houver réplica."""
+    arquivo, manifesto = _caminhos_replica(tabela)
+    try:
+        with open(manifesto, encoding='utf-8') as f:
+            dados = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return dados if os.path.exists(arquivo) else None
+
+
+def replica_atualizada(tabela: str, versao_tabela) -> bool:
+    """
+    A réplica da tabela vale enquanto a versão gravada no manifesto for a versão atual da
+    tabela no Impala (`versao_tabela(tabela)`). Se a sonda falhar, vale até max_idade_horas.
+    """
+    if not replica_local_ativa():
+        return False
+    manifesto = ler_manifesto_replica(tabela)
+    if not manifesto:
+        return False
+    versao = versao_tabela(tabela)
+    if versao is not None:
+        return manifesto.get('versao') == versao
+    return time.time() - manifesto.get('sincronizado_em', 0) < float(REPLICA_LOCAL_CONFIG['max_idade_horas']) * 3600
+
+
+def _sql_para_duckdb(query: str) -> str:
+    """
+    Adapta o SQL do Impala ao DuckDB. O único ponto divergente nas queries do sistema é o
+    CAST: no Impala um valor inválido (ex.: 'EXCLUIR' para FLOAT) vira NULL; no DuckDB,
+    erro. TRY_CAST tem o comportamento do Impala.
+    """
+    return re.sub(r'(?<![A-Za-z_])CAST\s*\(', 'TRY_CAST(', query, flags=re.IGNORECASE)
+
+
+def consultar_replica(tabelas, query: str, origem: str) -> pd.DataFrame:
+    """
+    Executa uma query do sistema (SQL do Impala) sobre a réplica local com DuckDB.
+    Cada tabela vira uma view com o mesmo nome do Impala (ex.: niat.infracoes_..._3M).
+    O filtro por CNPJ normalizado usa o min/max de cada row group para ler só os trechos do arquivo daquele CNPJ.
+    """
+    inicio = time.perf_counter()
+    conn = duckdb.connect()
+    try:
+        esquemas = set()
+        for tabela in tabelas:
+            arquivo, _ = _caminhos_replica(tabela)
+            if '.' in tabela:
+                esquema = tabela.split('.', 1)[0]
+                if esquema not in esquemas:
+                    conn.execute(f"CREATE SCHEMA IF NOT EXISTS {esquema}")
+                    esquemas.add(esquema)
+            arquivo_sql = arquivo.replace("'", "''")
+            conn.execute(f"CREATE VIEW {tabela} AS SELECT * FROM read_parquet('{arquivo_sql}')")
+        df = conn.execute(_sql_para_duckdb(query)).df()
+    finally:
+        conn.close()
+    registrar_tempo_tabela(origem, "réplica: " + " + ".join(tabelas), time.perf_counter() - inicio, len(df))
+    return df
+
+
+def _tipo_arrow(tipo_impala: str):
+    """Tipo Arrow da coluna na réplica, a partir do tipo do DESCRIBE do Impala."""
+    tipo = (tipo_impala or "").lower()
+    if tipo in ('tinyint', 'smallint', 'int', 'bigint'):
+        return pyarrow.int64()
+    if tipo.startswith(('float', 'double', 'decimal', 'real')):
+        return pyarrow.float64()
+    if tipo == 'boolean':
+        return pyarrow.bool_()
+    if tipo == 'timestamp':
+        return pyarrow.timestamp('us')
+    if tipo == 'date':
+        return pyarrow.date32()
+    return pyarrow.string()
+
+
+def _lote_para_arrow(chunk: pd.DataFrame, schema):
+    """Converte um lote lido do Impala para o schema fixo da réplica (mesmo schema em todos os lotes)."""
+    for col in REPLICA_COLUNAS_NORMALIZADAS:
+        if col in chunk.columns:
+            texto = chunk[col].astype(object)
+            chunk[col + SUFIXO_COLUNA_NORMALIZADA] = texto.where(
+                texto.isna(), texto.astype(str).str.replace(r'\D+', '', regex=True)
+            )
+    colunas = {}
+    for campo in schema:
+        serie = chunk[campo.name] if campo.name in chunk.columns else pd.Series([None] * len(chunk))
+        if pyarrow.types.is_integer(campo.type) or pyarrow.types.is_floating(campo.type):
+            serie = pd.to_numeric(serie, errors='coerce')
+        elif pyarrow.types.is_timestamp(campo.type) or pyarrow.types.is_date(campo.type):
+            serie = pd.to_datetime(serie, errors='coerce')
+            if pyarrow.types.is_date(campo.type):
+                serie = serie.dt.date
+        elif pyarrow.types.is_string(campo.type):
+            serie = serie.astype(object)
+            serie = serie.where(serie.isna(), serie.astype(str))
+        colunas[campo.name] = pyarrow.array(serie.reset_index(drop=True), type=campo.type, from_pandas=True, safe=False)
+    return pyarrow.Table.from_pydict(colunas, schema=schema)
+
+
+def sincronizar_replica_tabela(engine, tabela: str, versao_tabela) -> dict:
+    """
+    Copia a tabela do Impala para a réplica local.
+
+    1. Lê a tabela em lotes (cursor de streaming) e grava um Parquet provisório com o
+       schema do DESCRIBE, mais as colunas normalizadas (<coluna>_norm).
+    2. Com DuckDB, reordena pelo CNPJ normalizado e grava o arquivo final com row groups
+       de `linhas_por_row_group` linhas: o min/max de cada row group no rodapé do Parquet
+       funciona como índice por CNPJ.
+    3. Troca o arquivo e o manifesto (versão da tabela, linhas, row groups) com os.replace.
+
+    Returns:
+        dict com o resultado (também é o manifesto gravado)
+    """
+    with _REPLICA_LOCK:
+        if tabela in _REPLICA_SINCRONIZANDO:
+            return {'tabela': tabela, 'status': 'já em sincronização'}
+        _REPLICA_SINCRONIZANDO.add(tabela)
+
+    inicio = time.perf_counter()
+    arquivo, manifesto = _caminhos_replica(tabela)
+    sufixo = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    provisorio = arquivo + ".carga" + sufixo
+    ordenado = arquivo + sufixo
+    try:
+        os.makedirs(REPLICA_LOCAL_CONFIG['diretorio'], exist_ok=True)
+        versao = versao_tabela(tabela)
+
+        colunas = pd.read_sql(f"DESCRIBE {tabela}", engine)
+        campos = [pyarrow.field(str(nome), _tipo_arrow(str(tipo))) for nome, tipo in zip(colunas.iloc[:, 0], colunas.iloc[:, 1])]
+        nomes = {campo.name for campo in campos}
+        campos += [pyarrow.field(col + SUFIXO_COLUNA_NORMALIZADA, pyarrow.string())
+                   for col in REPLICA_COLUNAS_NORMALIZADAS if col in nomes]
+        schema = pyarrow.schema(campos)
+
+        linhas = 0
+        with pq.ParquetWriter(provisorio, schema) as writer:
+            with engine.connect().execution_options(stream_results=True) as conn:
+                for chunk in pd.read_sql(f"SELECT * FROM {tabela}", conn, chunksize=STREAM_CHUNK_SIZE):
+                    if not chunk.empty:
+                        writer.write_table(_lote_para_arrow(chunk, schema))
+                        linhas += len(chunk)
+
+        ordem = [col + SUFIXO_COLUNA_NORMALIZADA for col in REPLICA_COLUNAS_NORMALIZADAS if col in nomes]
+        order_by = f"ORDER BY {ordem[0]}" if ordem else ""
+        conn_duck = duckdb.connect()
+        try:
+            conn_duck.execute(
+                f"COPY (SELECT * FROM read_parquet('{provisorio.replace(chr(39), chr(39) * 2)}') {order_by}) "
+                f"TO '{ordenado.replace(chr(39), chr(39) * 2)}' "
+                f"(FORMAT PARQUET, ROW_GROUP_SIZE {int(REPLICA_LOCAL_CONFIG['linhas_por_row_group'])})"
+            )
+        finally:
+            conn_duck.close()
+
+        os.replace(ordenado, arquivo)
+        resultado = {
+            'tabela': tabela,
+            'versao': versao,
+            'sincronizado_em': time.time(),
+            'linhas': linhas,
+            'row_groups': pq.ParquetFile(arquivo).num_row_groups,
+            'mb': round(os.path.getsize(arquivo) / (1024 * 1024), 1),
+            'segundos': round(time.perf_counter() - inicio, 1),
+            'status': 'ok',
+        }
+        with open(manifesto + sufixo, 'w', encoding='utf-8') as f:
+            json.dump(resultado, f)
+        os.replace(manifesto + sufixo, manifesto)
+        registrar_tempo_tabela('replica_sync', tabela, time.perf_counter() - inicio, linhas)
+        return resultado
+    except Exception as e:
+        registrar_tempo_tabela('replica_sync', tabela, time.perf_counter() - inicio, 0, f"erro: {str(e)[:80]}")
+        return {'tabela': tabela, 'status': f"erro: {str(e)[:150]}", 'segundos': round(time.perf_counter() - inicio, 1)}
+    finally:
+        for caminho in (provisorio, ordenado):
+            try:
+                os.remove(caminho)
+            except OSError:
+                pass
+        with _REPLICA_LOCK:
+            _REPLICA_SINCRONIZANDO.discard(tabela)
+
+
+def sincronizar_tabelas(engine, tabelas: list, versao_tabela, forcar: bool = False) -> list:
+    """Sincroniza, uma por vez, as tabelas cuja réplica está ausente ou desatualizada."""
+    if not replica_local_ativa():
+        return []
+    return [
+        sincronizar_replica_tabela(engine, tabela, versao_tabela)
+        for tabela in tabelas
+        if forcar or not replica_atualizada(tabela, versao_tabela)
+    ]
+
+
+def status_replica(tabelas: dict, versao_tabela) -> pd.DataFrame:
+    """Estado da réplica de cada tabela ({tipo: tabela}), para o diagnóstico."""
+    registros = []
+    for tipo, tabela in tabelas.items():
+        manifesto = ler_manifesto_replica(tabela) or {}
+        with _REPLICA_LOCK:
+            sincronizando = tabela in _REPLICA_SINCRONIZANDO
+        registros.append({
+            'tipo': tipo,
+            'tabela': tabela,
+            'atualizada': replica_atualizada(tabela, versao_tabela),
+            'sincronizando': sincronizando,
+            'sincronizada em': (datetime.fromtimestamp(manifesto['sincronizado_em']).strftime('%d/%m/%Y %H:%M')
+                                if manifesto.get('sincronizado_em') else "-"),
+            'linhas': manifesto.get('linhas'),
+            'row groups': manifesto.get('row_groups'),
+            'MB': manifesto.get('mb'),
+        })
+    return pd.DataFrame(registros)
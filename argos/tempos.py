@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""Tempos das consultas por tabela (Impala e réplica local), para o diagnóstico."""
+import threading
+from datetime import datetime
+
+import pandas as pd
+
+# Quantidade de tempos de consulta por tabela mantidos para diagnóstico
+MAX_REGISTROS_TEMPOS = 200
+
+# Registro em memória dos tempos por tabela (compartilhado entre sessões)
+_TEMPOS_TABELAS = []
+_TEMPOS_TABELAS_LOCK = threading.Lock()
+
+
+def registrar_tempo_tabela(origem: str, tabela: str, segundos: float, linhas: int, status: str = "ok") -> dict:
+    """Registra o tempo de uma consulta por tabela (mantém os últimos MAX_REGISTROS_TEMPOS)."""
+    registro = {
+        'quando': datetime.now().strftime('%d/%m/%Y %H:%M:%S'),
+        'origem': origem,
+        'tabela': tabela,
+        'segundos': round(segundos, 2),
+        'linhas': linhas,
+        'status': status,
+    }
+    with _TEMPOS_TABELAS_LOCK:
+        _TEMPOS_TABELAS.append(registro)
+        del _TEMPOS_TABELAS[:-MAX_REGISTROS_TEMPOS]
+    return registro
+
+
+def get_tempos_tabelas() -> pd.DataFrame:
+    """Retorna os tempos registrados por tabela, do mais recente para o mais antigo."""
+    with _TEMPOS_TABELAS_LOCK:
+        registros = list(_TEMPOS_TABELAS)
+    return pd.DataFrame(registros[::-1], columns=['quando', 'origem', 'tabela', 'segundos', 'linhas', 'status'])
+
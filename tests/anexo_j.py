@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Dados sintéticos do Anexo J e comparação de arquivos, usados pelos testes e pelo benchmark."""
+from io import BytesIO
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+from argos.excel import COLUNAS_J1_MOEDA, COLUNAS_J1_PERCENTUAL, XLSXWRITER_AVAILABLE, _layout_anexo_j1
+
+CONTRIB_INFO = {'cnpj': '00.000.000/0000-00', 'razao_social': 'TESTE'}
+
+# Modos de escrita do Anexo J utilizáveis neste ambiente
+MODOS_ESCRITA = ("padrao", "streaming", "xlsxwriter") if XLSXWRITER_AVAILABLE else ("padrao", "streaming")
+
+
+def df_sintetico_anexo_j(linhas: int, grupo: str = None) -> pd.DataFrame:
+    """DataFrame com as colunas da J1 do layout do grupo e valores plausíveis."""
+    colunas = _layout_anexo_j1(bool(grupo))['column_mapping'].keys()
+    rng = np.random.default_rng(0)
+    datas = pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, linhas), unit='D')
+
+    dados = {}
+    for col in colunas:
+        if col == 'data_emissao':
+            dados[col] = datas.strftime('%d/%m/%Y')
+        elif col == 'periodo':
+            dados[col] = datas.strftime('01/%m/%Y')
+        elif col in COLUNAS_J1_MOEDA:
+            dados[col] = rng.uniform(1, 5000, linhas).round(2)
+        elif col in COLUNAS_J1_PERCENTUAL:
+            dados[col] = rng.choice([7.0, 12.0, 17.0, 25.0], linhas)
+        else:
+            dados[col] = [f"{col}_{i % 997}" for i in range(linhas)]
+    return pd.DataFrame(dados)
+
+
+def comparar_workbooks_excel(conteudo_a: bytes, conteudo_b: bytes, max_diferencas: int = 20) -> list:
+    """
+    Compara dois arquivos do Anexo J: abas, valores e fórmulas de cada célula (com o
+    formato numérico das preenchidas), células mescladas, painel congelado, autofiltro,
+    larguras das colunas e alturas das linhas. Célula vazia e texto vazio são equivalentes.
+
+    Returns:
+        list de str com as diferenças encontradas (vazia = arquivos equivalentes)
+    """
+    wb_a = openpyxl.load_workbook(BytesIO(conteudo_a))
+    wb_b = openpyxl.load_workbook(BytesIO(conteudo_b))
+    if wb_a.sheetnames != wb_b.sheetnames:
+        return [f"Abas: {wb_a.sheetnames} x {wb_b.sheetnames}"]
+
+    def larguras(ws):
+        por_coluna = {}
+        for dim in ws.column_dimensions.values():
+            if dim.customWidth or dim.width:
+                for col_idx in range(dim.min or 1, (dim.max or dim.min or 1) + 1):
+                    por_coluna[col_idx] = round(dim.width or 0, 2)
+        return por_coluna
+
+    def alturas(ws):
+        return {row: round(dim.height, 2) for row, dim in ws.row_dimensions.items() if dim.height}
+
+    diferencas = []
+    for nome in wb_a.sheetnames:
+        ws_a, ws_b = wb_a[nome], wb_b[nome]
+        propriedades = (
+            ("painel congelado", ws_a.freeze_panes, ws_b.freeze_panes),
+            ("autofiltro", ws_a.auto_filter.ref or None, ws_b.auto_filter.ref or None),
+            ("mescladas", sorted(str(r) for r in ws_a.merged_cells.ranges),
+             sorted(str(r) for r in ws_b.merged_cells.ranges)),
+            ("larguras", larguras(ws_a), larguras(ws_b)),
+            ("alturas", alturas(ws_a), alturas(ws_b)),
+        )
+        for descricao, valor_a, valor_b in propriedades:
+            if valor_a != valor_b:
+                diferencas.append(f"{nome} - {descricao}: {valor_a} x {valor_b}")
+
+        max_row = max(ws_a.max_row, ws_b.max_row)
+        max_col = max(ws_a.max_column, ws_b.max_column)
+        linhas_a = ws_a.iter_rows(min_row=1, max_row=max_row, max_col=max_col)
+        linhas_b = ws_b.iter_rows(min_row=1, max_row=max_row, max_col=max_col)
+        for linha_a, linha_b in zip(linhas_a, linhas_b):
+            for cell_a, cell_b in zip(linha_a, linha_b):
+                valor_a = None if cell_a.value == '' else cell_a.value
+                valor_b = None if cell_b.value == '' else cell_b.value
+                if valor_a != valor_b:
+                    diferencas.append(f"{nome}!{cell_a.coordinate}: {valor_a!r} x {valor_b!r}")
+                elif valor_a is not None and cell_a.number_format != cell_b.number_format:
+                    diferencas.append(f"{nome}!{cell_a.coordinate} formato: {cell_a.number_format} x {cell_b.number_format}")
+                if len(diferencas) >= max_diferencas:
+                    return diferencas
+
+    return diferencas
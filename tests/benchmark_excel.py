@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark do export do Anexo J: linhas por segundo e tamanho do arquivo em cada modo de
+escrita, com fórmulas e com valores estáticos, sobre os mesmos dados sintéticos.
+
+    python tests/benchmark_excel.py [linhas] [grupo]
+"""
+import itertools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+from anexo_j import CONTRIB_INFO, MODOS_ESCRITA, df_sintetico_anexo_j
+from argos.excel import export_to_excel_template
+
+
+def benchmark_export_excel(linhas: int = 20000, grupo: str = None) -> list:
+    """
+    Returns:
+        list de dicts: {'modo', 'valores', 'linhas', 'segundos', 'linhas_por_segundo', 'tamanho_mb'}
+    """
+    df = df_sintetico_anexo_j(linhas, grupo)
+    resultados = []
+    for valores_estaticos, modo in itertools.product((False, True), MODOS_ESCRITA):
+        inicio = time.perf_counter()
+        conteudo = export_to_excel_template(df, CONTRIB_INFO, 'TODOS', grupo=grupo, modo_escrita=modo,
+                                            valores_estaticos=valores_estaticos)
+        segundos = time.perf_counter() - inicio
+        resultados.append({
+            'modo': modo,
+            'valores': "calculados" if valores_estaticos else "fórmulas",
+            'linhas': linhas,
+            'segundos': round(segundos, 2),
+            'linhas_por_segundo': int(linhas / segundos) if segundos > 0 else 0,
+            'tamanho_mb': round(len(conteudo) / 1024 / 1024, 2)
+        })
+    return resultados
+
+
+if __name__ == "__main__":
+    linhas = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    grupo = sys.argv[2] if len(sys.argv) > 2 else "GESSUPER_NFCE"
+    print(pd.DataFrame(benchmark_export_excel(linhas, grupo)).to_string(index=False))
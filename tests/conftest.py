@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+# O pacote argos fica na raiz do repositório, ao lado do script do Streamlit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import importlib.util
+import zipfile
+from datetime import datetime
+from io import BytesIO
+
+import openpyxl
+import pandas as pd
+import pytest
+
+from anexo_j import CONTRIB_INFO, MODOS_ESCRITA, comparar_workbooks_excel, df_sintetico_anexo_j
+from argos import excel
+from argos.excel import calcular_icms_fisco, export_to_excel_template, gerar_partes_excel
+from argos.lotes import coluna_numerica
+
+LINHAS = 300
+GRUPOS = (None, "GESSUPER_NFCE")  # layout padrão e estendido
+
+
+@pytest.mark.parametrize("grupo", GRUPOS)
+@pytest.mark.parametrize("valores_estaticos", (False, True))
+@pytest.mark.parametrize("modo", [m for m in MODOS_ESCRITA if m != "padrao"])
+def test_modos_de_escrita_geram_o_mesmo_arquivo(modo, valores_estaticos, grupo):
+    df = df_sintetico_anexo_j(LINHAS, grupo)
+    referencia = export_to_excel_template(df, CONTRIB_INFO, 'TODOS', grupo=grupo, modo_escrita="padrao",
+                                          valores_estaticos=valores_estaticos)
+    conteudo = export_to_excel_template(df, CONTRIB_INFO, 'TODOS', grupo=grupo, modo_escrita=modo,
+                                        valores_estaticos=valores_estaticos)
+    assert comparar_workbooks_excel(referencia, conteudo) == []
+
+
+@pytest.mark.parametrize("modo", MODOS_ESCRITA)
+def test_totais_estaticos_da_j2_iguais_a_soma_por_periodo(modo):
+    grupo = "GESSUPER_NFCE"
+    df = df_sintetico_anexo_j(LINHAS, grupo)
+    passo = LINHAS // 7
+    lotes = [df.iloc[inicio:inicio + passo] for inicio in range(0, LINHAS, passo)]
+    conteudo = export_to_excel_template(lotes, CONTRIB_INFO, 'TODOS', grupo=grupo, total_linhas=LINHAS,
+                                        modo_escrita=modo, valores_estaticos=True)
+
+    destacado = coluna_numerica(df['icms_emitente'])
+    devido, _ = calcular_icms_fisco(coluna_numerica(df['bc_fisco']), coluna_numerica(df['aliquota_ia_icms']), destacado)
+    esperado = pd.DataFrame({'destacado': destacado, 'devido': devido}).groupby(
+        pd.to_datetime(df['periodo'], dayfirst=True).dt.date
+    ).sum()
+
+    ws_j2 = openpyxl.load_workbook(BytesIO(conteudo))["ANEXO J2 - ICMS DEVIDO"]
+    gravado = {}
+    totais = None
+    for periodo, valor_b, valor_c, valor_d in ws_j2.iter_rows(min_row=12, max_col=4, values_only=True):
+        if periodo == "TOTAL":
+            totais = (valor_b, valor_c, valor_d)
+            break
+        periodo = periodo.date() if isinstance(periodo, datetime) else periodo
+        gravado[periodo] = (valor_b, valor_c, valor_d)
+    assert totais is not None, "linha TOTAL ausente na J2"
+
+    assert set(gravado) == set(esperado.index)
+    for periodo, (valor_b, valor_c) in esperado.iterrows():
+        obtido_b, obtido_c, obtido_d = gravado[periodo]
+        assert obtido_b == pytest.approx(valor_b, abs=0.01)
+        assert obtido_c == pytest.approx(valor_c, abs=0.01)
+        assert obtido_d == pytest.approx(obtido_c - obtido_b, abs=0.01)
+    assert totais[0] == pytest.approx(esperado['destacado'].sum(), abs=0.01)
+    assert totais[1] == pytest.approx(esperado['devido'].sum(), abs=0.01)
+
+
+def _valores(conteudo: bytes) -> list:
+    wb = openpyxl.load_workbook(BytesIO(conteudo))
+    return [linha for ws in wb for linha in ws.iter_rows(values_only=True)]
+
+
+def _gerar_partes(df, total_rows):
+    partes = []
+    for parte, total_partes, caminho in gerar_partes_excel(df, CONTRIB_INFO, 'TODOS', total_rows,
+                                                           grupo="GESSUPER_NFCE"):
+        with open(caminho, 'rb') as f:
+            partes.append((parte, total_partes, f.read()))
+    return partes
+
+
+@pytest.mark.skipif(importlib.util.find_spec("pyarrow") is None, reason="partes em paralelo exigem pyarrow")
+def test_partes_em_paralelo_iguais_as_sequenciais(monkeypatch):
+    df = df_sintetico_anexo_j(LINHAS, "GESSUPER_NFCE")
+    monkeypatch.setattr(excel, 'MAX_ROWS_PER_EXCEL', 120)
+    monkeypatch.setitem(excel.EXCEL_PARALELO_CONFIG, 'max_processos', 1)
+    sequenciais = _gerar_partes(df, LINHAS)
+    monkeypatch.setitem(excel.EXCEL_PARALELO_CONFIG, 'max_processos', 2)
+    paralelas = _gerar_partes(df, LINHAS)
+
+    assert [(p, t) for p, t, _ in paralelas] == [(1, 3), (2, 3), (3, 3)]
+    for (_, _, sequencial), (_, _, paralela) in zip(sequenciais, paralelas):
+        assert _valores(sequencial) == _valores(paralela)
+
+
+def test_parte_a_mais_que_o_total_contado_falha(monkeypatch):
+    df = df_sintetico_anexo_j(LINHAS, "GESSUPER_NFCE")
+    monkeypatch.setattr(excel, 'MAX_ROWS_PER_EXCEL', 120)
+    monkeypatch.setitem(excel.EXCEL_PARALELO_CONFIG, 'max_processos', 1)
+    lotes = [df.iloc[inicio:inicio + 50] for inicio in range(0, LINHAS, 50)]
+    with pytest.raises(RuntimeError, match="Prepare a exportação de novo"):
+        _gerar_partes(iter(lotes), 200)
+
+
+@pytest.mark.parametrize("modo", ("padrao", "streaming"))
+@pytest.mark.parametrize("valores_estaticos", (False, True))
+def test_recalculo_ao_abrir_so_com_formulas(modo, valores_estaticos):
+    df = df_sintetico_anexo_j(20, "GESSUPER_NFCE")
+    conteudo = export_to_excel_template(df, CONTRIB_INFO, 'TODOS', grupo="GESSUPER_NFCE", modo_escrita=modo,
+                                        valores_estaticos=valores_estaticos)
+    with zipfile.ZipFile(BytesIO(conteudo)) as arquivo:
+        workbook_xml = arquivo.read("xl/workbook.xml").decode("utf-8")
+    assert ('fullCalcOnLoad="1"' in workbook_xml) is not valores_estaticos
+
+
+def test_icms_arredonda_a_metade_para_longe_do_zero():
+    # 17 - 16,875 = 0,125: o ROUND do Impala (contagem) e do Excel dá 0,13; o round do pandas, 0,12
+    bc_fisco = pd.Series([12.5, 100.0, 100.0])
+    aliquota = pd.Series([1.0, 17.0, 17.0])
+    destacado = pd.Series([0.0, 16.875, 17.125])
+    devido, nao_recolhido = calcular_icms_fisco(bc_fisco, aliquota, destacado)
+    assert devido.tolist() == [0.13, 17.0, 17.0]
+    assert nao_recolhido.tolist() == [0.13, 0.13, 0.0]
+
+
+@pytest.mark.filterwarnings("error::FutureWarning")
+def test_totais_estaticos_com_periodo_category():
+    # Lotes da consulta chegam com periodo category (SCHEMA_CONSULTA) e todas as categorias da consulta
+    grupo = "GESSUPER_NFCE"
+    df = df_sintetico_anexo_j(40, grupo)
+    categorias = df.astype({'periodo': 'category'})
+    referencia = export_to_excel_template([df.iloc[:20], df.iloc[20:]], CONTRIB_INFO, 'TODOS', grupo=grupo,
+                                          total_linhas=40, valores_estaticos=True)
+    conteudo = export_to_excel_template([categorias.iloc[:20], categorias.iloc[20:]], CONTRIB_INFO, 'TODOS',
+                                        grupo=grupo, total_linhas=40, valores_estaticos=True)
+    assert comparar_workbooks_excel(referencia, conteudo) == []
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+import pytest
+
+from anexo_j import CONTRIB_INFO, df_sintetico_anexo_j
+from argos import exportacao
+from argos.exportacao import (_liberar_trava_artefato, _remover_travas_obsoletas, _travar_artefato,
+                              chave_artefato_exportacao)
+
+CHAVE = chave_artefato_exportacao("GESSUPER_NFCE", "anexo_j", "TODOS", "12345678000190", "v1")
+
+
+@pytest.fixture
+def diretorio_cache(tmp_path, monkeypatch):
+    monkeypatch.setitem(exportacao.EXPORT_CACHE_CONFIG, 'diretorio', str(tmp_path))
+    return tmp_path
+
+
+def test_trava_do_artefato_e_exclusiva(diretorio_cache):
+    trava = _travar_artefato(CHAVE)
+    assert trava is not None
+    assert _travar_artefato(CHAVE) is None
+    _liberar_trava_artefato(trava)
+
+    trava = _travar_artefato(CHAVE)
+    assert trava is not None
+    _liberar_trava_artefato(trava)
+    assert not list(diretorio_cache.glob("*.lock"))
+
+
+@pytest.mark.skipif(not exportacao.FCNTL_AVAILABLE, reason="limpeza das travas usa flock")
+def test_limpeza_so_remove_travas_antigas_e_livres(diretorio_cache):
+    trava = _travar_artefato(CHAVE)
+    antigo = time.time() - exportacao.TRAVA_ARTEFATO_OBSOLETA_SECONDS - 60
+    os.utime(trava[0], (antigo, antigo))
+    assert _remover_travas_obsoletas(str(diretorio_cache)) == 0
+    assert os.path.exists(trava[0])
+    _liberar_trava_artefato(trava)
+
+    # Trava deixada por um processo que morreu: o arquivo fica, sem flock
+    abandonada = diretorio_cache / "abandonada.lock"
+    abandonada.write_text("")
+    recente = diretorio_cache / "recente.lock"
+    recente.write_text("")
+    os.utime(abandonada, (antigo, antigo))
+    assert _remover_travas_obsoletas(str(diretorio_cache)) == 1
+    assert not abandonada.exists()
+    assert recente.exists()
+
+
+def _esperar_job(job_id, limite=120):
+    inicio = time.monotonic()
+    while time.monotonic() - inicio < limite:
+        job = next(j for j in exportacao.get_jobs_exportacao() if j['id'] == job_id)
+        if job['status'] not in exportacao.EXPORT_JOB_ATIVOS:
+            return job
+        time.sleep(0.1)
+    raise AssertionError(f"job {job_id} não terminou")
+
+
+@pytest.mark.skipif(not exportacao.PYARROW_AVAILABLE, reason="lotes da fonte em disco exigem pyarrow")
+def test_job_le_a_fonte_uma_vez_e_remove_os_lotes(diretorio_cache, tmp_path, monkeypatch):
+    diretorio_jobs = tmp_path / "jobs"
+    monkeypatch.setitem(exportacao.EXPORT_JOBS_CONFIG, 'diretorio', str(diretorio_jobs))
+    df = df_sintetico_anexo_j(60, "GESSUPER_NFCE")
+    leituras = []
+
+    def fonte():
+        leituras.append(1)
+        return iter([df.iloc[:30], df.iloc[30:]])
+
+    job_id = exportacao.enviar_job_exportacao(fonte, CONTRIB_INFO, 'TODOS', "GESSUPER_NFCE", None, "download",
+                                              "teste_fonte", CHAVE)
+    job = _esperar_job(job_id)
+    assert job['status'] == "concluido", job['erro']
+    assert os.path.exists(job['arquivo'])
+    assert job['lotes'] is None
+    assert leituras == [1]
+    assert job_id not in exportacao._FONTES_JOBS
+    assert not list(diretorio_jobs.glob("argos_fonte_*"))
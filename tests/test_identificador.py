@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from argos import identificador
+from argos.identificador import (filtro_identificador, modos_busca_identificador, sanitize_identificador,
+                                 variantes_identificador)
+
+
+def test_sanitize_mantem_so_digitos():
+    assert sanitize_identificador("12.345.678/0001-90") == "12345678000190"
+    assert sanitize_identificador(None) == ""
+
+
+def test_variantes_de_cnpj():
+    assert variantes_identificador("12.345.678/0001-90") == ["12345678000190", "12.345.678/0001-90"]
+    assert variantes_identificador("01234567000189") == [
+        "01234567000189", "01.234.567/0001-89", "1234567000189"
+    ]
+
+
+def test_variantes_de_ie_de_sc():
+    assert variantes_identificador("251234567") == ["251234567", "251.234.567"]
+
+
+def test_variantes_vazias():
+    assert variantes_identificador("") == []
+    assert filtro_identificador("cnpj_emitente", "") == "1 = 0"
+
+
+def test_filtro_por_variantes_compara_a_coluna_sem_funcao():
+    assert filtro_identificador("cnpj_emitente", "12345678000190", "variantes") == (
+        "cnpj_emitente IN ('12345678000190', '12.345.678/0001-90')"
+    )
+
+
+def test_filtro_regexp_e_replica():
+    assert filtro_identificador("cnpj_emitente", "12345678000190", "regexp") == (
+        "regexp_replace(cnpj_emitente, '[^0-9]', '') = '12345678000190'"
+    )
+    assert filtro_identificador("cnpj_emitente", "12345678000190", "replica") == (
+        "cnpj_emitente_norm = '12345678000190'"
+    )
+
+
+def test_filtro_usa_coluna_normalizada(monkeypatch):
+    monkeypatch.setitem(identificador.COLUNAS_IDENT_NORMALIZADAS, "cnpj_emitente", "cnpj_emitente_num")
+    assert filtro_identificador("cnpj_emitente", "12345678000190") == "cnpj_emitente_num = '12345678000190'"
+    assert modos_busca_identificador("cnpj_emitente") == ["variantes"]
+
+
+def test_regexp_so_como_segunda_tentativa_opcional(monkeypatch):
+    assert modos_busca_identificador() == ["variantes"]
+    monkeypatch.setattr(identificador, "IDENT_REPETIR_COM_REGEXP", True)
+    assert modos_busca_identificador() == ["variantes", "regexp"]
+    monkeypatch.setattr(identificador, "IDENT_LOOKUP_MODE", "regexp")
+    assert modos_busca_identificador() == ["regexp"]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+
+from argos.paginacao import inicio_apos_cursor
+
+
+def _ordem():
+    ordem = pd.DataFrame({
+        'TOTAL': [500.0, 300.0, 300.0, 300.0, 100.0],
+        '_cnpj': ['5', '1', '2', '2', '9'],
+        '_razao': ['E', 'A', 'B', 'C', 'Z'],
+    })
+    return ordem.sort_values(['TOTAL', '_cnpj', '_razao'], ascending=[False, True, True], ignore_index=True)
+
+
+def test_sem_cursor_comeca_do_inicio():
+    assert inicio_apos_cursor(_ordem(), None) == 0
+
+
+def test_cursor_sem_empate():
+    assert inicio_apos_cursor(_ordem(), (500.0, '5', 'E')) == 1
+    assert inicio_apos_cursor(_ordem(), (100.0, '9', 'Z')) == 5
+
+
+def test_cursor_no_meio_dos_empates():
+    ordem = _ordem()
+    assert inicio_apos_cursor(ordem, (300.0, '1', 'A')) == 2
+    assert inicio_apos_cursor(ordem, (300.0, '2', 'B')) == 3
+    assert inicio_apos_cursor(ordem, (300.0, '2', 'C')) == 4
+
+
+def test_cursor_de_empresa_que_saiu_do_ranking():
+    # Depois de uma recarga, a última empresa exibida pode não existir mais: a página
+    # continua na primeira empresa que viria depois dela
+    ordem = _ordem()
+    assert inicio_apos_cursor(ordem, (400.0, '7', 'X')) == 1
+    assert inicio_apos_cursor(ordem, (300.0, '15', 'Q')) == 2
+    assert inicio_apos_cursor(ordem, (50.0, '0', 'A')) == 5